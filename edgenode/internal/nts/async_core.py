@@ -0,0 +1,268 @@
+# coding: utf-8
+""" asyncio daemon core """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import signal
+import time
+import traceback
+import urllib.parse
+
+import deadlines
+import debug_hooks
+import event_dispatcher
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+DEFAULT_MAX_INFLIGHT = 1024
+DEFAULT_EXECUTOR_THREADS = 4
+DRAIN_TIMEOUT = 10.0
+
+_LOG = logging.getLogger(__name__)
+
+_EXECUTOR = None
+
+
+class DockerAPIError(Exception):
+    """ docker API request failure """
+
+
+class AsyncDockerClient():
+    """ minimal docker engine API client over the unix socket """
+    def __init__(self, socket_path=DOCKER_SOCKET):
+        self.socket_path = socket_path
+
+    async def _request(self, path, params=None):
+        """ send GET request, returns (reader, writer, headers) """
+        if params:
+            path = "{}?{}".format(path, urllib.parse.urlencode(params))
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        writer.write("GET {} HTTP/1.1\r\nHost: docker\r\nConnection: close\r\n\r\n"
+                     .format(path).encode("ascii"))
+        try:
+            status_line = await reader.readline()
+            status = status_line.split(None, 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            if len(status) < 2 or not status[1].startswith(b"2"):
+                body = b"".join([chunk async for chunk in self._body(reader, headers)])
+                raise DockerAPIError("{} {}: {}".format(
+                    path, status_line.decode("latin-1").strip(), body.decode("utf-8", "replace")))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer, headers
+
+    @staticmethod
+    async def _body(reader, headers):
+        """ yield response body chunks """
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await reader.readline()
+                if not size_line:
+                    return
+                size = int(size_line.split(b";")[0], 16)
+                if size == 0:
+                    return
+                chunk = await reader.readexactly(size + 2)
+                yield chunk[:-2]
+        elif "content-length" in headers:
+            yield await reader.readexactly(int(headers["content-length"]))
+        else:
+            yield await reader.read()
+
+    async def inspect(self, container_id):
+        """ inspect container """
+        reader, writer, headers = await self._request(
+            "/containers/{}/json".format(urllib.parse.quote(container_id)))
+        try:
+            body = b"".join([chunk async for chunk in self._body(reader, headers)])
+        finally:
+            writer.close()
+        return json.loads(body.decode("utf-8"))
+
+    async def events(self, filters=None, since=None):
+        """ yield decoded events from the docker event stream """
+        params = {}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        if since is not None:
+            params["since"] = since
+        reader, writer, headers = await self._request("/events", params)
+        decoder = json.JSONDecoder()
+        pending = ""
+        try:
+            async for chunk in self._body(reader, headers):
+                pending += chunk.decode("utf-8")
+                while True:
+                    pending = pending.lstrip()
+                    if not pending:
+                        break
+                    try:
+                        event, end = decoder.raw_decode(pending)
+                    except ValueError:
+                        break
+                    pending = pending[end:]
+                    yield event
+        finally:
+            writer.close()
+
+
+async def follow_events(client, cursor, filters=None, reconnect_delay=1.0):
+    """ yield docker events, resuming from the cursor when the stream breaks """
+    while True:
+        try:
+            async for event in client.events(filters, cursor.since()):
+                if cursor.seen(event):
+                    continue
+                yield event
+                cursor.update(event)
+            _LOG.warning("Docker events stream ended, resuming")
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.error("Docker events stream error %s, resuming", err)
+        cursor.flush()
+        await asyncio.sleep(reconnect_delay)
+
+
+def event_loop():
+    """ create and set the event loop of the asyncio mode """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+async def run_blocking(func, *args):
+    """ run blocking call (e.g. NES ctypes call) on the core executor """
+    return await asyncio.get_event_loop().run_in_executor(_EXECUTOR,
+                                                          debug_hooks.profiled(func), *args)
+
+
+class AsyncDispatcher():
+    """ run event handlers as tasks, in order per key
+
+    Offers the EventDispatcher interface to the asyncio mode. A task waits
+    for the previous task of the same key, tasks of different keys run
+    concurrently up to max_inflight at a time. Handlers may be coroutine
+    functions or blocking functions, the latter run on the core executor.
+    Coroutine handlers are cancelled at the event deadline.
+    """
+    def __init__(self, handler, max_inflight=DEFAULT_MAX_INFLIGHT):
+        self.handler = handler
+        self.max_inflight = max_inflight
+        self.stats = event_dispatcher.DispatcherStats()
+        self._running = asyncio.Semaphore(max_inflight)
+        self._tails = {}
+        self._tasks = set()
+
+    def queue_depth(self):
+        """ number of pending and running handlers """
+        return len(self._tasks)
+
+    def submit(self, key, *args):
+        """ schedule handler(*args) after previous work of key """
+        self.submit_call(key, self.handler, *args)
+
+    def submit_call(self, key, func, *args):
+        """ schedule func(*args) after previous work of key """
+        with self.stats.lock:
+            self.stats.submitted += 1
+        task = asyncio.ensure_future(self._run(self._tails.get(key), time.monotonic(),
+                                               func, args))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(functools.partial(self._done, key))
+
+    def _done(self, key, task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, previous, enqueued, func, args):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._running:
+            self.stats.record_wait(time.monotonic() - enqueued)
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    await deadlines.within("event", func, *args)
+                else:
+                    await run_blocking(func, *args)
+            except asyncio.CancelledError:
+                raise
+            except deadlines.DeadlineExceeded as err:
+                with self.stats.lock:
+                    self.stats.failed += 1
+                _LOG.error("Event handler cancelled: %s", err)
+            except Exception as err:  # pylint: disable=broad-except
+                with self.stats.lock:
+                    self.stats.failed += 1
+                _LOG.critical("Event handler error %s", err)
+                _LOG.critical("%s", traceback.format_exc())
+
+    async def wait_capacity(self, limit):
+        """ wait until fewer than limit handlers are pending """
+        while len(self._tasks) >= limit:
+            with self.stats.lock:
+                self.stats.backpressure_waits += 1
+            await asyncio.wait(list(self._tasks), return_when=asyncio.FIRST_COMPLETED)
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        """ wait for pending handlers, cancel the ones still running after timeout """
+        if not self._tasks:
+            return
+        _LOG.info("Draining %s pending events", len(self._tasks))
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            _LOG.warning("Cancelled %s events still pending after %ss", len(pending), timeout)
+            await asyncio.wait(pending)
+
+
+def run(poll, dispatchers, executor_threads=DEFAULT_EXECUTOR_THREADS,
+        drain_timeout=DRAIN_TIMEOUT, watchdog=None):
+    """ run poll coroutine until it ends or SIGINT/SIGTERM, then drain the dispatchers
+
+    The watchdog, if given, watches the event loop heartbeat.
+    """
+    global _EXECUTOR # pylint: disable=global-statement
+    _EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=executor_threads)
+    loop = asyncio.get_event_loop()
+    heartbeat = None
+    if watchdog is not None:
+        heartbeat = deadlines.LoopHeartbeat(loop)
+        watchdog.watch("event-loop", heartbeat.running)
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    poll_task = asyncio.ensure_future(poll)
+    stop_task = asyncio.ensure_future(stopping.wait())
+    try:
+        loop.run_until_complete(asyncio.wait([poll_task, stop_task],
+                                             return_when=asyncio.FIRST_COMPLETED))
+        if stopping.is_set():
+            _LOG.info("Quiting")
+        for task in (poll_task, stop_task):
+            task.cancel()
+        loop.run_until_complete(asyncio.wait([poll_task, stop_task]))
+        loop.run_until_complete(asyncio.gather(*(dispatcher.drain(drain_timeout)
+                                                 for dispatcher in dispatchers)))
+        if not poll_task.cancelled() and poll_task.exception() is not None:
+            raise poll_task.exception()
+    finally:
+        if heartbeat is not None:
+            heartbeat.cancel()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        _EXECUTOR.shutdown(wait=True)
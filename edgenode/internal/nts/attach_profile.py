@@ -0,0 +1,149 @@
+# coding: utf-8
+""" veth attach profiles selected per sandbox by label """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import json
+import logging
+import re
+
+PROFILE_LABEL = "nts.attach-profile"
+# built-in profile of the plain veth pairs: default MTU, one queue, default offloads
+PLAIN_PROFILE = "plain"
+# OVS tables whose columns a profile sets on the port
+OVS_TABLES = {"interface": "Interface", "port": "Port"}
+MIN_MTU = 68
+MAX_MTU = 65535
+MAX_QUEUES = 4096
+
+_FEATURE_PATTERN = re.compile(r"^[a-z][a-z0-9-]*$")
+_COLUMN_PATTERN = re.compile(r"^[a-z_]+(:[A-Za-z0-9_.-]+)?$")
+
+_LOG = logging.getLogger(__name__)
+
+
+def _int_field(spec, field, low, high):
+    value = spec.get(field)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+        raise ValueError("{} must be an integer from {} to {}".format(field, low, high))
+    return value
+
+
+class AttachProfile():
+    """ link and bridge port settings applied to a veth pair before it is up
+
+    mtu and queues (number of TX and RX queues) are set on both ends when
+    the pair is created, offloads maps ethtool feature names to on/off and
+    is applied to both ends as well. ovs maps OVS table names to the column
+    values set on the port when it is added to the bridge, "column:key"
+    names setting one key of a map column.
+    """
+    def __init__(self, name, mtu=None, queues=None, offloads=None, ovs=None):
+        self.name = name
+        self.mtu = mtu
+        self.queues = queues
+        self.offloads = offloads or {}
+        self.ovs = ovs or {}
+
+    @classmethod
+    def from_spec(cls, name, spec):
+        """ profile described by a dict, raises ValueError if it is invalid """
+        if not isinstance(spec, dict):
+            raise ValueError("profile {} is not an object".format(name))
+        unknown = set(spec) - {"mtu", "queues", "offloads"} - set(OVS_TABLES)
+        if unknown:
+            raise ValueError("profile {} has unknown fields {}".format(
+                name, ", ".join(sorted(unknown))))
+        offloads = spec.get("offloads") or {}
+        if not isinstance(offloads, dict) or \
+                not all(_FEATURE_PATTERN.match(feature) and isinstance(enabled, bool)
+                        for feature, enabled in offloads.items()):
+            raise ValueError("profile {} offloads must map feature names to true or false"
+                             .format(name))
+        ovs = {}
+        for field, table in OVS_TABLES.items():
+            columns = spec.get(field) or {}
+            if not isinstance(columns, dict) or \
+                    not all(_COLUMN_PATTERN.match(column) and
+                            isinstance(value, (int, str)) and not isinstance(value, bool)
+                            for column, value in columns.items()):
+                raise ValueError("profile {} {} must map column names to integers or strings"
+                                 .format(name, field))
+            if columns:
+                ovs[table] = dict(columns)
+        try:
+            return cls(name, _int_field(spec, "mtu", MIN_MTU, MAX_MTU),
+                       _int_field(spec, "queues", 1, MAX_QUEUES), dict(offloads), ovs)
+        except ValueError as err:
+            raise ValueError("profile {}: {}".format(name, err))
+
+    def vsctl_args(self, if_name):
+        """ ovs-vsctl arguments setting the OVS columns of port if_name """
+        args = []
+        for table, columns in sorted(self.ovs.items()):
+            args += ["--", "set", table, if_name]
+            args += ["{}={}".format(column, json.dumps(value))
+                     for column, value in sorted(columns.items())]
+        return args
+
+    def __str__(self):
+        settings = []
+        if self.mtu:
+            settings.append("mtu {}".format(self.mtu))
+        if self.queues:
+            settings.append("{} queues".format(self.queues))
+        settings.extend("{} {}".format(feature, "on" if enabled else "off")
+                        for feature, enabled in sorted(self.offloads.items()))
+        for columns in self.ovs.values():
+            settings.extend("{}={}".format(column, value)
+                            for column, value in sorted(columns.items()))
+        return "{} ({})".format(self.name, ", ".join(settings)) if settings else self.name
+
+
+PLAIN = AttachProfile(PLAIN_PROFILE)
+
+
+def load_profiles(path):
+    """ map profile names to the profiles of a JSON file
+
+    The file holds an object of profile names to their fields, see
+    AttachProfile.from_spec(). Raises OSError or ValueError.
+    """
+    with open(path) as profiles_file:
+        specs = json.load(profiles_file)
+    if not isinstance(specs, dict):
+        raise ValueError("{} does not hold an object of profiles".format(path))
+    return {name: AttachProfile.from_spec(name, spec) for name, spec in specs.items()}
+
+
+class AttachProfiles():
+    """ profiles chosen per sandbox by the value of its label_key label
+
+    Sandboxes without the label, or naming an unknown profile, get the
+    default one.
+    """
+    def __init__(self, profiles, default=PLAIN_PROFILE, label_key=PROFILE_LABEL):
+        self.profiles = dict(profiles)
+        self.profiles.setdefault(PLAIN_PROFILE, PLAIN)
+        if default not in self.profiles:
+            raise ValueError("unknown attach profile {}".format(default))
+        self.default = self.profiles[default]
+        self.label_key = label_key
+
+    @property
+    def selectable(self):
+        """ whether sandboxes may get another profile than the default one """
+        return len(self.profiles) > 1
+
+    def select(self, labels):
+        """ profile named by the labels """
+        name = labels.get(self.label_key)
+        if name is None:
+            return self.default
+        profile = self.profiles.get(name)
+        if profile is None:
+            _LOG.warning("Unknown attach profile %s, using %s", name, self.default.name)
+            return self.default
+        return profile
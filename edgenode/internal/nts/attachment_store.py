@@ -0,0 +1,206 @@
+# coding: utf-8
+""" persistent record of the interfaces attached to sandboxes """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import json
+import logging
+import os
+import threading
+import time
+
+# record fields holding interface names, indexed for by_interface()
+INTERFACE_FIELDS = ("host_if", "container_if", "kni_if")
+# the log is compacted once it has this many more lines than live records
+COMPACT_SLACK = 1024
+
+_LOG = logging.getLogger(__name__)
+
+
+def _sync_dir(path):
+    """ sync the directory, so a file renamed into it survives a node crash """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AttachmentStore():
+    """ sandbox attachments kept in memory and in an append-only log file
+
+    A record is a dict of the sandbox "id", its "netns" path, interface
+    names (INTERFACE_FIELDS), "bridge", "state" and "created"/"updated"
+    times. Every change appends the full record as one JSON line, removals
+    append {"id", "removed": true}. A change returns once its line is
+    synced to disk, so the log survives a node crash as well; concurrent
+    changes share one sync. A line cut short by a crash is ignored when
+    loading. Once the log grows COMPACT_SLACK lines past the live records,
+    it is rewritten to a temporary file, synced and renamed over.
+    """
+    def __init__(self, path, compact_slack=COMPACT_SLACK):
+        self.path = path
+        self.compact_slack = compact_slack
+        self._records = {}
+        self._interfaces = {}
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._file = None
+        # lines appended, and of those the ones synced, changing with _sync_lock held
+        self._written = 0
+        self._synced = 0
+        self._sync_lock = threading.Lock()
+        self.stats = {"writes": 0, "syncs": 0, "compactions": 0, "write_errors": 0}
+
+    def _index(self, record, add):
+        for field in INTERFACE_FIELDS:
+            if_name = record.get(field)
+            if not if_name:
+                continue
+            if add:
+                self._interfaces[if_name] = record["id"]
+            elif self._interfaces.get(if_name) == record["id"]:
+                del self._interfaces[if_name]
+
+    def _apply(self, entry):
+        old = self._records.pop(entry["id"], None)
+        if old is not None:
+            self._index(old, False)
+        if not entry.get("removed"):
+            self._records[entry["id"]] = entry
+            self._index(entry, True)
+
+    def load(self):
+        """ read the log and open it for appending, returns number of records """
+        with self._lock:
+            try:
+                with open(self.path) as log_file:
+                    for line in log_file:
+                        self._lines += 1
+                        try:
+                            self._apply(json.loads(line))
+                        except (ValueError, KeyError, TypeError):
+                            _LOG.warning("Skipping damaged line %s of %s", self._lines, self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                _LOG.error("Failed to read attachments from %s: %s", self.path, err)
+            # start from a clean file, dropping a damaged tail and old lines
+            self._compact()
+            return len(self._records)
+
+    def _write(self, entry):
+        """ append entry to the log, called with the lock held """
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps(entry, sort_keys=True) + "\n")
+            self._file.flush()
+        except OSError as err:
+            self.stats["write_errors"] += 1
+            _LOG.error("Failed to write attachment of %s: %s", entry["id"], err)
+            return
+        self.stats["writes"] += 1
+        self._lines += 1
+        self._written += 1
+        if self._lines > len(self._records) + self.compact_slack:
+            self._compact()
+
+    def _sync(self, written):
+        """ sync the log up to its line written, unless another change did already """
+        with self._sync_lock:
+            if self._synced >= written:
+                return
+            with self._lock:
+                target = self._written
+                # a duplicate, compaction may close the file meanwhile
+                fd = os.dup(self._file.fileno()) if self._file is not None else None
+            if fd is None:
+                return
+            try:
+                os.fsync(fd)
+            except OSError as err:
+                self.stats["write_errors"] += 1
+                _LOG.error("Failed to sync attachments log %s: %s", self.path, err)
+                return
+            finally:
+                os.close(fd)
+            self._synced = target
+            self.stats["syncs"] += 1
+
+    def _compact(self):
+        """ rewrite the log with the live records, called with the lock held """
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as tmp_file:
+                for record in self._records.values():
+                    tmp_file.write(json.dumps(record, sort_keys=True) + "\n")
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path)
+            _sync_dir(os.path.dirname(self.path) or ".")
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "a")
+        except OSError as err:
+            _LOG.error("Failed to compact attachments log %s: %s", self.path, err)
+            return
+        self._lines = len(self._records)
+        self.stats["compactions"] += 1
+
+    def get(self, sandbox_id):
+        """ record of the sandbox, None if it has none """
+        with self._lock:
+            record = self._records.get(sandbox_id)
+            return dict(record) if record is not None else None
+
+    def by_interface(self, if_name):
+        """ record of the sandbox the interface is attached to, None if none is """
+        with self._lock:
+            sandbox_id = self._interfaces.get(if_name)
+            return dict(self._records[sandbox_id]) if sandbox_id is not None else None
+
+    def records(self):
+        """ snapshot of all records """
+        with self._lock:
+            return [dict(record) for record in self._records.values()]
+
+    def update(self, sandbox_id, **fields):
+        """ set fields of the sandbox record, creating it if needed, returns the record """
+        now = time.time()
+        with self._lock:
+            record = dict(self._records.get(sandbox_id) or {"id": sandbox_id, "created": now})
+            record.update(fields)
+            record["updated"] = now
+            self._apply(record)
+            self._write(record)
+            written = self._written
+        self._sync(written)
+        return dict(record)
+
+    def remove(self, sandbox_id):
+        """ drop the sandbox record, returns it or None """
+        with self._lock:
+            record = self._records.get(sandbox_id)
+            if record is None:
+                return None
+            self._apply({"id": sandbox_id, "removed": True})
+            self._write({"id": sandbox_id, "removed": True})
+            written = self._written
+        self._sync(written)
+        return record
+
+    def snapshot(self):
+        """ stats with the number of records """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["records"] = len(self._records)
+            stats["log_lines"] = self._lines
+        return stats
+
+    def close(self):
+        """ close the log file """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" stand-in NES control server
+
+Serves the KNI, statistics and route requests of
+libs/libnes_api/libnes_api_protocol.h on a unix socket, so nes_api clients
+can be driven without a DPDK NES daemon. Device and ring counters grow by
+the number of requests served. Every other request is answered with an
+error. Like NES, requests are read into a 512 byte buffer per client and a
+client whose data fills it is disconnected.
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import nes_routes
+import nes_stats
+
+# nes_api_msg_t header: message_type, function_id, data_size
+MSG_HEADER = struct.Struct("=HHH")
+MSG_REQUEST, MSG_RESPONSE, MSG_ERROR = 0, 1, 2
+FUNC_STATS_DEV_ALL = 0
+FUNC_STATS_DEV = 1
+FUNC_ADD_ROUTE = 4
+FUNC_ADD_MIRROR = 5
+FUNC_DEL_ROUTE = 7
+FUNC_ROUTE_CLEAR_ALL = 8
+FUNC_STATS_CLEAR_ALL = 9
+FUNC_STATS_RING_ALL = 10
+FUNC_STATS_RING = 11
+FUNC_ADD_KNI = 12
+FUNC_DEL_KNI = 13
+FUNC_ROUTE_LIST = 14
+KNI_NAMESIZE = 32
+KNI_NAME_FORMAT = "vEth{}"
+DEVICES = ("ENB", "EPC", "KNI")
+RINGS = ("NTS_UPSTR_GTPU", "NTS_DWSTR_GTPU", "NTS_UPSTR_IP", "NTS_DWSTR_IP")
+NES_ROUTE_EXISTS = 4
+# MAX_BUFFER_SIZE of daemon/ctrl/nes_ctrl.c
+BUFFER_SIZE = 512
+_INT = struct.Struct("=i")
+_U16 = struct.Struct("=H")
+_ROUTE_LIST_REQ = struct.Struct("=HH")
+
+
+class KniTable():
+    """ KNI devices created per device ID, the way nes_dev_kni.c names them """
+    def __init__(self, max_kni=0):
+        self.max_kni = max_kni
+        self.devices = {}
+        self.free_ports = []
+        self.next_port = 0
+
+    def add(self, dev_id):
+        """ create KNI device, returns its name or None """
+        if dev_id in self.devices:
+            return None
+        if self.free_ports:
+            port = self.free_ports.pop()
+        elif self.max_kni and self.next_port >= self.max_kni:
+            return None
+        else:
+            port = self.next_port
+            self.next_port += 1
+        self.devices[dev_id] = port
+        return KNI_NAME_FORMAT.format(port)
+
+    def delete(self, dev_id):
+        """ delete KNI device, returns its name or None """
+        port = self.devices.pop(dev_id, None)
+        if port is None:
+            return None
+        self.free_ports.append(port)
+        return KNI_NAME_FORMAT.format(port)
+
+
+class StatsTable():
+    """ device and ring counters, growing with the requests served """
+    def __init__(self):
+        self.devices = (nes_stats.NesApiDevT * len(DEVICES))()
+        for index, name in enumerate(DEVICES):
+            self.devices[index].name = name.encode("utf-8")
+            self.devices[index].index = index
+        self.rings = (nes_stats.NesApiRingT * len(RINGS))()
+        for index, name in enumerate(RINGS):
+            self.rings[index].name = name.encode("utf-8")
+            self.rings[index].index = index
+
+    def tick(self):
+        """ count one more packet on every device and ring """
+        for item in list(self.devices) + list(self.rings):
+            item.stats.rcv_cnt += 1
+            item.stats.snd_cnt += 1
+
+    def clear(self):
+        """ zero all counters """
+        for item in list(self.devices) + list(self.rings):
+            for name, _ in item.stats._fields_:
+                setattr(item.stats, name, 0)
+
+
+class RouteTable():
+    """ routes added, by lookup fields """
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, data):
+        """ add route of nes_route_add request data, returns NES error code """
+        mac = bytes(data[:6])
+        lookup = data[6:].split(b"\0", 1)[0].decode("utf-8", "replace")
+        try:
+            fields = nes_routes.parse_lookup(lookup)
+        except ValueError:
+            return 1
+        if fields in self.routes:
+            return NES_ROUTE_EXISTS
+        self.routes[fields] = mac
+        return 0
+
+    def remove(self, data):
+        """ remove route of nes_route_remove request data, returns NES error code """
+        lookup = data.split(b"\0", 1)[0].decode("utf-8", "replace")
+        try:
+            fields = nes_routes.parse_lookup(lookup)
+        except ValueError:
+            return 1
+        return 0 if self.routes.pop(fields, None) is not None else 1
+
+    def page(self, data):
+        """ nes_route_data_t array of nes_route_list request data """
+        entry_offset, max_entry_cnt = _ROUTE_LIST_REQ.unpack(data)
+        routes = list(self.routes.items())[entry_offset:entry_offset + max_entry_cnt]
+        page = (nes_routes.NesRouteDataT * len(routes))()
+        for item, (fields, mac) in zip(page, routes):
+            for name, value in zip(nes_routes.FIELDS, fields):
+                setattr(item, name, value)
+            item.dst_mac_addr.ether_addr_octet[:] = mac
+        return bytes(page)
+
+class _NesHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.stats["connections"] += 1
+            server.clients.add(self.request)
+        try:
+            self._serve()
+        finally:
+            with server.lock:
+                server.clients.discard(self.request)
+
+    def _serve(self):
+        buf = bytearray()
+        while True:
+            room = BUFFER_SIZE - len(buf)
+            try:
+                data = self.request.recv(room)
+            except OSError:
+                return
+            if not data:
+                return
+            if len(data) == room:
+                # nes_ctrl.c drops the client, the requests can not be told apart any more
+                with self.server.lock:
+                    self.server.stats["overflows"] += 1
+                return
+            buf += data
+            while len(buf) >= MSG_HEADER.size:
+                message_type, function_id, data_size = MSG_HEADER.unpack_from(buf)
+                end = MSG_HEADER.size + data_size
+                if len(buf) < end:
+                    break
+                response = self.server.process(message_type, function_id,
+                                               bytes(buf[MSG_HEADER.size:end]))
+                del buf[:end]
+                try:
+                    self.request.sendall(response)
+                except OSError:
+                    return
+
+
+class FakeNesServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ NES control socket server with injected latency
+
+    Each request takes latency seconds plus up to jitter more, and fails
+    with fail_ratio probability. NES handles control requests one at a
+    time, so unless concurrent is set requests wait for each other.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, latency=0.0, jitter=0.0, fail_ratio=0.0, max_kni=0,
+                 concurrent=False, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_ratio = fail_ratio
+        self.concurrent = concurrent
+        self.kni = KniTable(max_kni)
+        self.counters = StatsTable()
+        self.routes = RouteTable()
+        self.stats = {"connections": 0, "requests": 0, "kni_add": 0, "kni_del": 0,
+                      "stats": 0, "routes": 0, "errors": 0, "overflows": 0}
+        self.lock = threading.Lock()
+        self.clients = set()
+        self._random = random.Random(seed)
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _NesHandler)
+
+    def _delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _apply(self, function_id, data):
+        """ run request, returns response data or None on error """
+        if self.fail_ratio and self._random.random() < self.fail_ratio:
+            return None
+        self.counters.tick()
+        if function_id in (FUNC_ADD_KNI, FUNC_DEL_KNI):
+            return self._apply_kni(function_id, data)
+        if function_id in (FUNC_STATS_DEV_ALL, FUNC_STATS_RING_ALL, FUNC_STATS_DEV,
+                           FUNC_STATS_RING, FUNC_STATS_CLEAR_ALL):
+            self.stats["stats"] += 1
+            return self._apply_stats(function_id, data)
+        if function_id in (FUNC_ADD_ROUTE, FUNC_ADD_MIRROR, FUNC_DEL_ROUTE,
+                           FUNC_ROUTE_CLEAR_ALL, FUNC_ROUTE_LIST):
+            self.stats["routes"] += 1
+            return self._apply_routes(function_id, data)
+        return None
+
+    def _apply_kni(self, function_id, data):
+        dev_id = data.split(b"\0", 1)[0].decode("utf-8", "replace")
+        if function_id == FUNC_ADD_KNI:
+            self.stats["kni_add"] += 1
+            if_name = self.kni.add(dev_id)
+        else:
+            self.stats["kni_del"] += 1
+            if_name = self.kni.delete(dev_id)
+        if if_name is None:
+            return None
+        return if_name.encode("utf-8").ljust(KNI_NAMESIZE, b"\0")
+
+    def _apply_stats(self, function_id, data):
+        if function_id == FUNC_STATS_DEV_ALL:
+            return bytes(self.counters.devices)
+        if function_id == FUNC_STATS_RING_ALL:
+            return bytes(self.counters.rings)
+        if function_id == FUNC_STATS_CLEAR_ALL:
+            self.counters.clear()
+            return _INT.pack(0)
+        items = self.counters.devices if function_id == FUNC_STATS_DEV else \
+            self.counters.rings
+        index = _U16.unpack(data)[0] if len(data) == _U16.size else len(items)
+        if index >= len(items):
+            return None
+        return bytes(items[index].stats)
+
+    def _apply_routes(self, function_id, data):
+        if function_id in (FUNC_ADD_ROUTE, FUNC_ADD_MIRROR):
+            return _INT.pack(self.routes.add(data))
+        if function_id == FUNC_DEL_ROUTE:
+            return _INT.pack(self.routes.remove(data))
+        if function_id == FUNC_ROUTE_CLEAR_ALL:
+            self.routes.routes.clear()
+            return _INT.pack(0)
+        if len(data) != _ROUTE_LIST_REQ.size:
+            return None
+        return self.routes.page(data)
+
+    def process(self, message_type, function_id, data):
+        """ response message to the request """
+        if self.concurrent:
+            self._delay()
+        with self.lock:
+            if not self.concurrent:
+                self._delay()
+            self.stats["requests"] += 1
+            payload = self._apply(function_id, data) if message_type == MSG_REQUEST else None
+            if payload is None:
+                self.stats["errors"] += 1
+                return MSG_HEADER.pack(MSG_ERROR, function_id, 0)
+        return MSG_HEADER.pack(MSG_RESPONSE, function_id, len(payload)) + payload
+
+    def drop_clients(self):
+        """ close the connections of all clients, as NES does when it restarts """
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def snapshot(self):
+        """ counters and KNI devices left """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["kni_devices"] = len(self.kni.devices)
+            stats["routes_left"] = len(self.routes.routes)
+        return stats
+
+
+def _serve(path, options, ready, stop, results):
+    server = FakeNesServer(path, **options)
+    thread = threading.Thread(target=server.serve_forever, name="fake-nes")
+    thread.daemon = True
+    thread.start()
+    ready.set()
+    stop.wait()
+    server.shutdown()
+    server.server_close()
+    results.put(server.snapshot())
+
+
+class FakeNesProcess():
+    """ FakeNesServer run in a child process, so it does not share the GIL
+    and CPU accounting with the process under test
+    """
+    def __init__(self, path, **options):
+        self.path = path
+        self._ready = multiprocessing.Event()
+        self._stop = multiprocessing.Event()
+        self._results = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(path, options, self._ready, self._stop, self._results),
+            name="fake-nes")
+        self._process.daemon = True
+
+    def start(self, timeout=10.0):
+        """ start server, returns False if it is not listening within timeout """
+        self._process.start()
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        """ stop server, returns its stats """
+        self._stop.set()
+        try:
+            stats = self._results.get(timeout=10.0)
+        except queue.Empty:
+            stats = {}
+        self._process.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        return stats
+
+
+def make_parser():
+    """ make parser function """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s", "--socket", action="store", metavar="PATH", dest="socket_path",
+        default="/tmp/fake_nes.sock",
+        help="Control socket path")
+    parser.add_argument(
+        "-l", "--latency", action="store", metavar="SECONDS", dest="latency",
+        type=float, default=0.0,
+        help="Time each request takes")
+    parser.add_argument(
+        "-j", "--jitter", action="store", metavar="SECONDS", dest="jitter",
+        type=float, default=0.0,
+        help="Maximum random time added to the latency")
+    parser.add_argument(
+        "-e", "--fail-ratio", action="store", metavar="RATIO", dest="fail_ratio",
+        type=float, default=0.0,
+        help="Share of requests answered with an error")
+    parser.add_argument(
+        "-k", "--kni-max", action="store", metavar="COUNT", dest="max_kni",
+        type=int, default=0,
+        help="Maximum number of KNI devices, unlimited when 0")
+    parser.add_argument(
+        "-c", "--concurrent", action="store_true", dest="concurrent",
+        help="Process requests of different sessions concurrently")
+    return parser
+
+def main(options):
+    """ main """
+    server = FakeNesServer(options.socket_path, options.latency, options.jitter,
+                           options.fail_ratio, options.max_kni, options.concurrent)
+    print("Serving NES control requests on {}".format(options.socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket_path)
+    print(json.dumps(server.snapshot(), sort_keys=True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(make_parser().parse_args()))
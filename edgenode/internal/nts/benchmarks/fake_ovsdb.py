@@ -0,0 +1,472 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" stand-in ovsdb-server
+
+Serves the subset of the OVSDB JSON-RPC protocol (RFC 7047) used by
+ovsdb_client.py on a unix socket: monitor, monitor_cancel, echo and
+transact with insert, update, mutate and delete of the Bridge, Port and
+Interface tables. Columns other than the names and references are kept as
+sent, the string maps of ports and interfaces can be mutated as well. Like
+ovs-vswitchd, it assigns an ofport to new interfaces a while after they are
+committed.
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import codecs
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import socketserver
+import sys
+import threading
+import time
+import uuid
+
+DB_NAME = "Open_vSwitch"
+REFERENCES = {"Bridge": ("ports", "Port"), "Port": ("interfaces", "Interface")}
+INDEXED = ("Port", "Interface")
+# string to string maps of the Port and Interface tables
+MAP_COLUMNS = ("external_ids", "options", "other_config")
+
+
+def _encode(value):
+    """ OVSDB JSON of a column value, one element sets are bare atoms """
+    if isinstance(value, set):
+        atoms = [["uuid", atom] for atom in sorted(value)]
+        return atoms[0] if len(atoms) == 1 else ["set", atoms]
+    if value is None:
+        return ["set", []]
+    return value
+
+def _encode_row(row):
+    return {column: _encode(value) for column, value in row.items()}
+
+def _new_row(table, name):
+    if table == "Interface":
+        return {"name": name, "ofport": None}
+    return {"name": name, REFERENCES[table][0]: set()}
+
+
+class TransactionError(Exception):
+    """ operation failure, aborts the transaction """
+    def __init__(self, error, details=""):
+        Exception.__init__(self, error)
+        self.error = error
+        self.details = details
+
+
+class Database():
+    """ Bridge, Port and Interface tables """
+    def __init__(self, bridges):
+        self.tables = {"Bridge": {}, "Port": {}, "Interface": {}}
+        for name in bridges:
+            self.tables["Bridge"][str(uuid.uuid4())] = _new_row("Bridge", name)
+
+    def _uuid(self, atom, named):
+        if atom[0] == "named-uuid":
+            if atom[1] not in named:
+                raise TransactionError("referential integrity violation",
+                                       "unknown named-uuid {}".format(atom[1]))
+            return named[atom[1]]
+        return atom[1]
+
+    def _set(self, value, named):
+        atoms = value[1] if value[0] == "set" else [value]
+        return {self._uuid(atom, named) for atom in atoms}
+
+    def _where(self, table, conditions):
+        rows = []
+        for row_uuid, row in self.tables[table].items():
+            if all(row.get(column) == value for column, function, value in conditions
+                   if function == "=="):
+                rows.append(row_uuid)
+        return rows
+
+    def _insert(self, op, named):
+        table = op["table"]
+        row_uuid = str(uuid.uuid4())
+        row = _new_row(table, op["row"]["name"])
+        self._set_columns(table, row, op["row"], named)
+        self.tables[table][row_uuid] = row
+        if "uuid-name" in op:
+            named[op["uuid-name"]] = row_uuid
+        return {"uuid": ["uuid", row_uuid]}
+
+    def _set_columns(self, table, row, values, named):
+        """ set row columns, references are decoded and the others kept as sent """
+        for column, value in values.items():
+            if table in REFERENCES and column == REFERENCES[table][0]:
+                row[column] = self._set(value, named)
+            elif column != "name":
+                row[column] = value
+
+    def _update(self, op, named):
+        rows = self._where(op["table"], op["where"])
+        for row_uuid in rows:
+            self._set_columns(op["table"], self.tables[op["table"]][row_uuid], op["row"], named)
+        return {"count": len(rows)}
+
+    def _mutate_map(self, rows, table, column, mutator, value):
+        """ insert [key, value] pairs into or delete keys from a map column """
+        for row_uuid in rows:
+            row = self.tables[table][row_uuid]
+            pairs = dict(row.get(column, ["map", []])[1])
+            if mutator == "insert" and value[0] == "map":
+                for key, atom in value[1]:
+                    pairs.setdefault(key, atom)
+            elif mutator == "delete":
+                for key in (value[1] if value[0] == "set" else [value]):
+                    pairs.pop(key, None)
+            else:
+                raise TransactionError("domain error",
+                                       "unsupported mutator {}".format(mutator))
+            row[column] = ["map", [[key, atom] for key, atom in sorted(pairs.items())]]
+
+    def _mutate(self, op, named):
+        table = op["table"]
+        rows = self._where(table, op["where"])
+        for column, mutator, value in op["mutations"]:
+            if column in MAP_COLUMNS and table in INDEXED:
+                self._mutate_map(rows, table, column, mutator, value)
+                continue
+            if table not in REFERENCES or column != REFERENCES[table][0]:
+                raise TransactionError("constraint violation",
+                                       "cannot mutate {}.{}".format(table, column))
+            atoms = self._set(value, named)
+            for row_uuid in rows:
+                if mutator == "insert":
+                    self.tables[table][row_uuid][column] |= atoms
+                elif mutator == "delete":
+                    self.tables[table][row_uuid][column] -= atoms
+                else:
+                    raise TransactionError("domain error",
+                                           "unsupported mutator {}".format(mutator))
+        return {"count": len(rows)}
+
+    def _delete(self, op):
+        rows = self._where(op["table"], op["where"])
+        for row_uuid in rows:
+            del self.tables[op["table"]][row_uuid]
+        return {"count": len(rows)}
+
+    def _collect(self):
+        """ drop Port and Interface rows nothing refers to, as they are not root """
+        for table, (column, child) in (("Bridge", REFERENCES["Bridge"]),
+                                       ("Port", REFERENCES["Port"])):
+            referenced = set()
+            for row in self.tables[table].values():
+                referenced |= row[column]
+            for row_uuid in list(self.tables[child]):
+                if row_uuid not in referenced:
+                    del self.tables[child][row_uuid]
+
+    def _check(self):
+        for table in INDEXED:
+            names = [row["name"] for row in self.tables[table].values()]
+            if len(names) != len(set(names)):
+                raise TransactionError("constraint violation",
+                                       "duplicate {} name".format(table))
+        for table, (column, child) in REFERENCES.items():
+            for row in self.tables[table].values():
+                if not row[column] <= set(self.tables[child]):
+                    raise TransactionError("referential integrity violation",
+                                           "{}.{} refers to a missing row".format(table, column))
+
+    def transact(self, ops):
+        """ apply ops atomically, returns (results, changed rows {table: {uuid: (old, new)}}) """
+        before = copy.deepcopy(self.tables)
+        named = {}
+        results = []
+        try:
+            for op in ops:
+                if op.get("table") not in self.tables:
+                    raise TransactionError("unknown table", str(op.get("table")))
+                if op["op"] == "insert":
+                    results.append(self._insert(op, named))
+                elif op["op"] == "update":
+                    results.append(self._update(op, named))
+                elif op["op"] == "mutate":
+                    results.append(self._mutate(op, named))
+                elif op["op"] == "delete":
+                    results.append(self._delete(op))
+                else:
+                    raise TransactionError("not supported", op["op"])
+            self._collect()
+            self._check()
+        except TransactionError as err:
+            self.tables = before
+            results.append({"error": err.error, "details": err.details})
+            results.extend([None] * (len(ops) - len(results)))
+            return results, {}
+        return results, self.changes(before)
+
+    def changes(self, before):
+        """ rows differing from the before tables """
+        changes = {}
+        for table, rows in self.tables.items():
+            old_rows = before[table]
+            for row_uuid in set(rows) | set(old_rows):
+                old, new = old_rows.get(row_uuid), rows.get(row_uuid)
+                if old != new:
+                    changes.setdefault(table, {})[row_uuid] = (old, new)
+        return changes
+
+
+def _updates(changes):
+    """ monitor table-updates of the changes """
+    updates = {}
+    for table, rows in changes.items():
+        for row_uuid, (old, new) in rows.items():
+            update = {}
+            if old is not None:
+                update["old"] = _encode_row(old)
+            if new is not None:
+                update["new"] = _encode_row(new)
+            updates.setdefault(table, {})[row_uuid] = update
+    return updates
+
+
+class _OvsdbHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.send_lock = threading.Lock()
+        self.monitors = set()
+
+    def send(self, message):
+        """ send JSON-RPC message, returns False if the client is gone """
+        data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+        try:
+            with self.send_lock:
+                self.request.sendall(data)
+        except OSError:
+            return False
+        return True
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.stats["connections"] += 1
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buf = ""
+        try:
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    return
+                buf += utf8.decode(data)
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        message, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    if "method" in message and message.get("id") is not None:
+                        self.send(server.process(self, message))
+        except OSError:
+            pass
+        finally:
+            server.unmonitor(self)
+
+
+class FakeOvsdbServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ OVSDB server with injected latency
+
+    Each transaction takes latency seconds and transactions run one at a
+    time, as in ovsdb-server. New interfaces get their ofport ofport_latency
+    seconds after the commit, or -1 with fail_ratio probability.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, bridges=("br-int",), latency=0.0, ofport_latency=0.0,
+                 fail_ratio=0.0, seed=1):
+        self.latency = latency
+        self.ofport_latency = ofport_latency
+        self.fail_ratio = fail_ratio
+        self.db = Database(bridges)
+        self.stats = {"connections": 0, "transactions": 0, "operations": 0, "errors": 0,
+                      "ports_added": 0, "ports_deleted": 0}
+        self.lock = threading.Lock()
+        self._monitors = {}
+        self._ofports = itertools.count(1)
+        self._random = random.Random(seed)
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _OvsdbHandler)
+
+    def process(self, handler, message):
+        """ response to the request """
+        method, params = message["method"], message.get("params", [])
+        result, error = None, None
+        if method == "echo":
+            result = params
+        elif method == "list_dbs":
+            result = [DB_NAME]
+        elif method == "monitor":
+            result = self.monitor(handler, params[1])
+        elif method == "monitor_cancel":
+            with self.lock:
+                self._monitors.pop((handler, json.dumps(params[0])), None)
+            result = {}
+        elif method == "transact":
+            result = self.transact(params[1:])
+        else:
+            error = "unknown method"
+        return {"result": result, "error": error, "id": message["id"]}
+
+    def monitor(self, handler, monitor_id):
+        """ register monitor, returns the initial table updates """
+        with self.lock:
+            self._monitors[(handler, json.dumps(monitor_id))] = monitor_id
+            return _updates({table: {row_uuid: (None, row) for row_uuid, row in rows.items()}
+                             for table, rows in self.db.tables.items()})
+
+    def unmonitor(self, handler):
+        """ drop monitors of the closed connection """
+        with self.lock:
+            for key in [key for key in self._monitors if key[0] is handler]:
+                del self._monitors[key]
+
+    def _notify(self, changes):
+        """ send monitor updates, called with the lock held """
+        if not changes:
+            return
+        updates = _updates(changes)
+        for (handler, _), monitor_id in list(self._monitors.items()):
+            handler.send({"method": "update", "params": [monitor_id, updates], "id": None})
+
+    def transact(self, ops):
+        """ run transaction and notify monitors before answering, as ovsdb-server does """
+        with self.lock:
+            if self.latency > 0:
+                time.sleep(self.latency)
+            self.stats["transactions"] += 1
+            self.stats["operations"] += len(ops)
+            results, changes = self.db.transact(ops)
+            if not changes and any(result and "error" in result for result in results):
+                self.stats["errors"] += 1
+            ports = changes.get("Port", {}).values()
+            self.stats["ports_added"] += sum(1 for old, _ in ports if old is None)
+            self.stats["ports_deleted"] += sum(1 for _, new in ports if new is None)
+            self._notify(changes)
+        new_interfaces = [row_uuid for row_uuid, (old, _)
+                          in changes.get("Interface", {}).items() if old is None]
+        if new_interfaces:
+            timer = threading.Timer(self.ofport_latency, self._assign_ofports,
+                                    args=(new_interfaces,))
+            timer.daemon = True
+            timer.start()
+        return results
+
+    def _assign_ofports(self, interfaces):
+        with self.lock:
+            before = copy.deepcopy(self.db.tables)
+            for row_uuid in interfaces:
+                row = self.db.tables["Interface"].get(row_uuid)
+                if row is None:
+                    continue
+                if self.fail_ratio and self._random.random() < self.fail_ratio:
+                    row["ofport"] = -1
+                else:
+                    row["ofport"] = next(self._ofports)
+            self._notify(self.db.changes(before))
+
+    def snapshot(self):
+        """ counters and ports left """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["ports"] = len(self.db.tables["Port"])
+        return stats
+
+
+def _serve(path, options, ready, stop, results):
+    server = FakeOvsdbServer(path, **options)
+    thread = threading.Thread(target=server.serve_forever, name="fake-ovsdb")
+    thread.daemon = True
+    thread.start()
+    ready.set()
+    stop.wait()
+    server.shutdown()
+    server.server_close()
+    results.put(server.snapshot())
+
+
+class FakeOvsdbProcess():
+    """ FakeOvsdbServer run in a child process, see FakeNesProcess """
+    def __init__(self, path, **options):
+        self.path = path
+        self._ready = multiprocessing.Event()
+        self._stop = multiprocessing.Event()
+        self._results = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(path, options, self._ready, self._stop, self._results),
+            name="fake-ovsdb")
+        self._process.daemon = True
+
+    def start(self, timeout=10.0):
+        """ start server, returns False if it is not listening within timeout """
+        self._process.start()
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        """ stop server, returns its stats """
+        self._stop.set()
+        try:
+            stats = self._results.get(timeout=10.0)
+        except queue.Empty:
+            stats = {}
+        self._process.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        return stats
+
+
+def make_parser():
+    """ make parser function """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s", "--socket", action="store", metavar="PATH", dest="socket_path",
+        default="/tmp/fake_ovsdb.sock",
+        help="Database socket path")
+    parser.add_argument(
+        "-b", "--bridge", action="append", metavar="NAME", dest="bridges",
+        help="Bridge to create, br-int if none is given")
+    parser.add_argument(
+        "-l", "--latency", action="store", metavar="SECONDS", dest="latency",
+        type=float, default=0.0,
+        help="Time each transaction takes")
+    parser.add_argument(
+        "-p", "--ofport-latency", action="store", metavar="SECONDS", dest="ofport_latency",
+        type=float, default=0.0,
+        help="Time until a new interface gets its ofport")
+    parser.add_argument(
+        "-e", "--fail-ratio", action="store", metavar="RATIO", dest="fail_ratio",
+        type=float, default=0.0,
+        help="Share of new interfaces getting ofport -1")
+    return parser
+
+def main(options):
+    """ main """
+    server = FakeOvsdbServer(options.socket_path, options.bridges or ["br-int"],
+                             options.latency, options.ofport_latency, options.fail_ratio)
+    print("Serving OVSDB on {}".format(options.socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket_path)
+    print(json.dumps(server.snapshot(), sort_keys=True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(make_parser().parse_args()))
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" NES KNI request batching benchmark
+
+Replays a node drain and refill, a nes_kni_del and nes_kni_add per
+container followed by a nes_kni_del per container, from concurrent workers
+against the stand-in NES control server, once on pooled sessions and once
+per batch window, and reports requests per second and request latency.
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import fake_nes
+import kni_docker_daemon
+import nes_kni_batch
+
+DEFAULT_WINDOWS = "0,0.001,0.005,0.01,0.02"
+
+
+def make_parser():
+    """ make parser function """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--containers", action="store", metavar="COUNT", dest="containers",
+        type=int, default=200,
+        help="Number of containers refilled and drained per run")
+    parser.add_argument(
+        "-w", "--workers", action="store", metavar="WORKERS", dest="workers",
+        type=int, default=8,
+        help="Number of concurrent callers")
+    parser.add_argument(
+        "-W", "--windows", action="store", metavar="SECONDS[,SECONDS...]", dest="windows",
+        default=DEFAULT_WINDOWS,
+        help="Batch windows to run")
+    parser.add_argument(
+        "-b", "--batch", action="store", metavar="COUNT", dest="batch",
+        type=int, default=nes_kni_batch.DEFAULT_MAX_BATCH,
+        help="Maximum number of requests per batch")
+    parser.add_argument(
+        "-s", "--nes-sessions", action="store", metavar="SESSIONS", dest="nes_sessions",
+        type=int, default=kni_docker_daemon.NES_POOL_SIZE,
+        help="Maximum number of pooled NES control sessions")
+    parser.add_argument(
+        "--nes-latency", action="store", metavar="SECONDS", dest="nes_latency",
+        type=float, default=0.0002,
+        help="Time the fake NES takes per request")
+    parser.add_argument(
+        "-l", "--library", action="store", metavar="LIB_PATH", dest="library",
+        default=os.path.normpath(os.path.join(NTS_DIR, "build", "libnes_api_shared.so")),
+        help="nes_api shared library file path")
+    parser.add_argument(
+        "-o", "--output", action="store", metavar="PATH", dest="output",
+        default=None,
+        help="Write results as JSON to PATH")
+    return parser
+
+def percentile(values, share):
+    """ nearest rank percentile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+def run(options, workdir, window):
+    """ drain and refill once, window None runs without batching, returns results """
+    socket_path = os.path.join(workdir, "nes.sock")
+    cfg_path = os.path.join(workdir, "nes.cfg")
+    with open(cfg_path, "w") as cfg_file:
+        cfg_file.write("[NES_SERVER]\nctrl_socket = {}\n".format(socket_path))
+    server = fake_nes.FakeNesProcess(socket_path, latency=options.nes_latency)
+    if not server.start():
+        raise RuntimeError("Fake NES server did not start")
+    nes_context = kni_docker_daemon.nes_lib_load(options.library, cfg_path,
+                                                 options.nes_sessions)
+    if nes_context is None:
+        server.stop()
+        raise RuntimeError("Failed to load nes_api library {}".format(options.library))
+    if window is not None:
+        nes_context.batcher = nes_kni_batch.KniBatcher(nes_context.lib, nes_context.pool,
+                                                       window, options.batch)
+
+    dev_ids = ["{:012x}{:052x}".format(index + 1, index) for index in range(options.containers)]
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def worker(first):
+        own = []
+        failed = 0
+        for phase in ((True, False), (True,)):
+            for dev_id in dev_ids[first::options.workers]:
+                for delete_if in phase:
+                    start = time.monotonic()
+                    ret, _ = kni_docker_daemon.modify_kni_interface(nes_context, dev_id,
+                                                                     delete_if)
+                    own.append(time.monotonic() - start)
+                    # the defensive delete of a new container is expected to fail
+                    if ret != kni_docker_daemon.NES_SUCCESS and \
+                            not (delete_if and len(phase) == 2):
+                        failed += 1
+        with lock:
+            latencies.extend(own)
+            failures.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(first,))
+               for first in range(options.workers)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    kni_docker_daemon.nes_disconnect(nes_context)
+    server_stats = server.stop()
+
+    latencies.sort()
+    batches = nes_context.batcher.stats if nes_context.batcher is not None else {}
+    return {"window": window, "requests": len(latencies), "failed": sum(failures),
+            "requests_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "latency_ms": {"p50": percentile(latencies, 0.5) * 1e3,
+                           "p99": percentile(latencies, 0.99) * 1e3},
+            "batches": batches.get("batches", 0),
+            "mean_batch": batches["requests"] / batches["batches"] if batches.get("batches")
+                          else 1.0,
+            "sessions": dict(nes_context.pool.stats),
+            "kni_devices_left": server_stats.get("kni_devices")}
+
+def main(options):
+    """ main """
+    logging.basicConfig(level=logging.WARNING)
+    kni_docker_daemon._LOG = logging.getLogger("kni_docker_daemon")
+    windows = [None] + [float(window) for window in options.windows.split(",")]
+    workdir = tempfile.mkdtemp(prefix="kni-batch-bench-")
+    results = []
+    try:
+        print("{:>10s} {:>10s} {:>9s} {:>9s} {:>8s} {:>7s}".format(
+            "window ms", "req/s", "p50 ms", "p99 ms", "batches", "mean"))
+        for window in windows:
+            result = run(options, workdir, window)
+            results.append(result)
+            print("{:>10s} {:10.0f} {:9.2f} {:9.2f} {:8d} {:7.1f}".format(
+                "pooled" if window is None else "{:g}".format(window * 1e3),
+                result["requests_per_sec"], result["latency_ms"]["p50"],
+                result["latency_ms"]["p99"], result["batches"], result["mean_batch"]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump({"options": vars(options), "results": results}, output, indent=2,
+                      sort_keys=True)
+    return 1 if any(result["failed"] or result["kni_devices_left"] for result in results) \
+        else 0
+
+if __name__ == '__main__':
+    sys.exit(main(make_parser().parse_args()))
@@ -0,0 +1,669 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" kni/ovs daemon load benchmark
+
+Drives the docker event fan-out of the daemons with a synthetic event stream,
+a stand-in NES control server and stubbed link/OVS operations, and reports
+attach throughput, event to interface ready latency and CPU/RSS use.
+Results are written as JSON and can be compared against a stored baseline.
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import attach_profile
+import attachment_store
+import docker_events
+import event_dispatcher
+import event_fanout
+import fake_nes
+import fake_ovsdb
+import kni_docker_daemon
+import kni_pool
+import link_backend
+import metrics
+import ovs_docker_daemon
+import ovsdb_client
+import pod_selector
+import sandbox_lifecycle
+import synthetic_docker
+import veth_pool
+
+DAEMONS = ("kni", "ovs")
+NAME_FILTER = "mec-app"
+# events ending in an interface attached / detached per daemon
+ATTACH_ACTIONS = {"kni": "start", "ovs": "start"}
+DETACH_ACTIONS = {"kni": "kill", "ovs": "die"}
+# metrics compared against the baseline: (path, True if higher is better)
+COMPARED = ((("attaches_per_sec",), True),
+            (("latency", "attach", "p50"), False),
+            (("latency", "attach", "p99"), False),
+            (("cpu", "per_event"), False),
+            (("rss", "max_kb"), False))
+
+NSENTER_STUB = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in --*) shift ;; *) break ;; esac
+done
+exec "$@"
+"""
+OVS_VSCTL_STUB = """#!/bin/sh
+{sleep}exit 0
+"""
+
+_LOG = logging.getLogger(__name__)
+
+
+class StubLinkBackend():
+    """ link backend keeping links in memory, each operation takes latency seconds """
+    name = "stub"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.links = {}
+        self._lock = threading.Lock()
+
+    def _op(self, stage, if_name=None, ns_path=None, remove=False):
+        """ record link operation, moves if_name to ns_path unless only renamed up """
+        start = time.monotonic()
+        if self.latency:
+            time.sleep(self.latency)
+        if if_name is not None:
+            with self._lock:
+                for links in self.links.values():
+                    links.discard(if_name)
+                if not remove:
+                    self.links.setdefault(ns_path, set()).add(if_name)
+        metrics.observe_stage(stage, start)
+        return True
+
+    def add_veth(self, if_name, peer_name, mtu=None, queues=None): # pylint: disable=unused-argument
+        """ create veth pair in the daemon namespace """
+        with self._lock:
+            self.links.setdefault(None, set()).add(peer_name)
+        return self._op("link_add_veth", if_name, None)
+
+    def delete_link(self, if_name):
+        """ delete link """
+        return self._op("link_delete", if_name, remove=True)
+
+    def rename_link(self, if_name, new_name):
+        """ rename link """
+        with self._lock:
+            for links in self.links.values():
+                if if_name in links:
+                    links.discard(if_name)
+                    links.add(new_name)
+        return self._op("link_rename")
+
+    def move_link_to_host(self, if_name):
+        """ move link to the host namespace """
+        return self._op("link_move_to_host", if_name, link_backend.HOST_NS)
+
+    def move_link_from_host(self, if_name, dst_ns_path):
+        """ move link from the host namespace """
+        return self._op("link_move_from_host", if_name, dst_ns_path)
+
+    def move_link(self, if_name, dst_ns_path):
+        """ move link to the namespace """
+        return self._op("link_move", if_name, dst_ns_path)
+
+    def set_link_up(self, if_name): # pylint: disable=unused-argument
+        """ bring link up """
+        return self._op("link_up")
+
+    def set_offloads(self, if_name, features): # pylint: disable=unused-argument
+        """ set offload features """
+        return self._op("link_offloads")
+
+    def list_links(self, ns_path):
+        """ {name: MAC address} of the links in the namespace """
+        with self._lock:
+            return {name: "" for name in self.links.get(ns_path, ())}
+
+
+class LatencyRecorder():
+    """ wrap an event handler and record event to handled latency per action """
+    def __init__(self, event_arg):
+        self.event_arg = event_arg
+        self.samples = {}
+
+    def wrap(self, handler):
+        """ handler recording its events """
+        def handle(*args, **kwargs):
+            success = handler(*args, **kwargs)
+            event = args[self.event_arg]
+            now = time.time()
+            # list.append is atomic, workers need no lock
+            self.samples.setdefault(event['Action'], []).append(
+                (now - event['timeNano'] / 1e9, time.monotonic()))
+            return success
+        return handle
+
+
+def percentiles(values):
+    """ p50/p90/p99/max of values, nearest rank """
+    if not values:
+        return {}
+    values = sorted(values)
+    rank = lambda q: values[max(0, int(math.ceil(q * len(values))) - 1)]
+    return {"count": len(values), "p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99),
+            "max": values[-1], "mean": sum(values) / len(values)}
+
+def stage_summary():
+    """ {stage: {count, mean}} from the stage latency metrics """
+    summary = {}
+    for (stage,), child in metrics.STAGE_LATENCY.children():
+        _, count, total = child.snapshot()
+        if count:
+            summary[stage] = {"count": count, "mean": total / count}
+    return summary
+
+def counter_values(counter):
+    """ {label: value} of a counter, several labels are joined with "/" """
+    return {"/".join(labels): child.value() for labels, child in counter.children()}
+
+def counter_deltas(counter, before):
+    """ {label: increase} of a counter since before """
+    return {label: value - before.get(label, 0)
+            for label, value in counter_values(counter).items()
+            if value - before.get(label, 0)}
+
+def current_rss_kb():
+    """ resident set size of the process """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return 0
+
+
+class Bench():
+    """ one daemon run over the schedule """
+    def __init__(self, daemon, options, schedule, workdir):
+        self.daemon = daemon
+        self.options = options
+        self.schedule = schedule
+        self.workdir = workdir
+        self.selector = pod_selector.PodSelector.legacy(NAME_FILTER)
+        self.cursor = docker_events.EventCursor(os.path.join(workdir, daemon + ".cursor"))
+        self.server = None
+        self.handler = None
+        self.nes_context = None
+        self.ovsdb = None
+        self.pool = None
+        self.store = None
+
+    def _setup_kni(self):
+        """ start fake NES and load nes_api, returns (handler, event argument index) """
+        socket_path = os.path.join(self.workdir, "nes.sock")
+        cfg_path = os.path.join(self.workdir, "nes.cfg")
+        with open(cfg_path, "w") as cfg_file:
+            cfg_file.write("[NES_SERVER]\nctrl_socket = {}\n".format(socket_path))
+        self.server = fake_nes.FakeNesProcess(
+            socket_path, latency=self.options.nes_latency, jitter=self.options.nes_jitter,
+            fail_ratio=self.options.nes_fail_ratio, max_kni=self.options.kni_max,
+            seed=self.options.seed)
+        if not self.server.start():
+            raise RuntimeError("Fake NES server did not start")
+        kni_docker_daemon._LINK = StubLinkBackend(self.options.link_latency)
+        if self.options.nes_client == "python":
+            self.nes_context = kni_docker_daemon.nes_client_load(cfg_path)
+        else:
+            self.nes_context = kni_docker_daemon.nes_lib_load(self.options.library, cfg_path,
+                                                              self.options.nes_sessions)
+        if self.nes_context is None:
+            raise RuntimeError("Failed to set up the {} NES client".format(self.options.nes_client))
+        if self.options.kni_pool:
+            nes_context = self.nes_context
+            self.pool = kni_pool.KniPool(
+                self.options.kni_pool, max(1, self.options.kni_pool // 2), self.options.kni_max,
+                lambda dev_id: kni_docker_daemon.add_kni_interface(nes_context, dev_id),
+                lambda dev_id: bool(kni_docker_daemon.del_kni_interface(nes_context, dev_id)))
+            kni_docker_daemon._POOL = self.pool
+        self.handler = kni_docker_daemon.KniHandler(self.handler_options())
+        self.handler.nes_context = self.nes_context
+        return kni_docker_daemon.handle_event, 2
+
+    def _setup_ovs(self):
+        """ install OVS tool stubs or start fake OVSDB, returns (handler, event argument index) """
+        bin_dir = os.path.join(self.workdir, "bin")
+        os.mkdir(bin_dir)
+        sleep = "sleep {}\n".format(self.options.ovs_latency) if self.options.ovs_latency else ""
+        for name, script in (("nsenter", NSENTER_STUB),
+                             ("ovs-vsctl", OVS_VSCTL_STUB.format(sleep=sleep))):
+            path = os.path.join(bin_dir, name)
+            with open(path, "w") as stub:
+                stub.write(script)
+            os.chmod(path, 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        ovs_docker_daemon._LINK = StubLinkBackend(self.options.link_latency)
+        ovs_docker_daemon.OVS_VSCTL = os.path.join(bin_dir, "ovs-vsctl")
+        if self.options.attach_profiles:
+            ovs_docker_daemon._PROFILES = attach_profile.AttachProfiles(
+                attach_profile.load_profiles(self.options.attach_profiles),
+                self.options.attach_profile)
+        if self.options.ovsdb:
+            socket_path = os.path.join(self.workdir, "db.sock")
+            self.server = fake_ovsdb.FakeOvsdbProcess(
+                socket_path, bridges=[self.options.bridge], latency=self.options.ovs_latency,
+                ofport_latency=self.options.ofport_latency, seed=self.options.seed)
+            if not self.server.start():
+                raise RuntimeError("Fake OVSDB server did not start")
+            self.ovsdb = ovsdb_client.OvsdbClient(socket_path)
+            if not self.ovsdb.connect():
+                raise RuntimeError("Failed to connect to fake OVSDB")
+            ovs_docker_daemon._OVSDB = self.ovsdb
+        if self.options.veth_pool:
+            bridge = self.options.bridge
+            self.pool = veth_pool.VethPool(
+                self.options.veth_pool, max(1, self.options.veth_pool // 2),
+                lambda host_if, peer_if: ovs_docker_daemon.create_pool_pair(host_if, peer_if,
+                                                                            bridge),
+                lambda host_if, peer_if: ovs_docker_daemon.destroy_pool_pair(host_if, peer_if,
+                                                                             bridge),
+                os.path.join(self.workdir, "ovs_veth_pool.json"))
+            ovs_docker_daemon._POOL = self.pool
+        self.handler = ovs_docker_daemon.OvsHandler(self.handler_options())
+        return ovs_docker_daemon.handle_event, 1
+
+    def handler_options(self):
+        """ daemon options the handlers read while handling events """
+        return argparse.Namespace(name_filter=NAME_FILTER, bridge_name=self.options.bridge)
+
+    def _warm_up(self, timeout=60.0):
+        """ fill the veth or KNI pool before the replay starts """
+        self.pool.fill()
+        deadline = time.monotonic() + timeout
+        size = min(self.pool.size, self.options.kni_max or self.pool.size) \
+            if self.daemon == "kni" else self.pool.size
+        while self.pool.snapshot()["idle"] < size and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def run(self):
+        """ replay the schedule, returns results dict """
+        handler, event_arg = self._setup_kni() if self.daemon == "kni" else self._setup_ovs()
+        self.store = attachment_store.AttachmentStore(
+            os.path.join(self.workdir, self.daemon + "_attachments.log"))
+        self.store.load()
+        daemon_module = kni_docker_daemon if self.daemon == "kni" else ovs_docker_daemon
+        daemon_module._STORE = self.store
+        recorder = LatencyRecorder(event_arg)
+        dispatcher = event_dispatcher.EventDispatcher(recorder.wrap(handler),
+                                                      self.options.workers,
+                                                      self.options.queue_depth)
+        lifecycle = sandbox_lifecycle.SandboxLifecycle(dispatcher, self.options.debounce)
+
+        def drain():
+            lifecycle.flush()
+            dispatcher.join()
+
+        client = synthetic_docker.FakeDockerClient(self.schedule, drain,
+                                                   self.options.inspect_latency)
+        sandboxes = docker_events.SandboxCache(client)
+        counters = (counter_values(metrics.EVENT_FAILURES),
+                    counter_values(metrics.OPERATIONS_SAVED))
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            # as the daemons do at startup, so new sandboxes are known to be detached
+            self.handler.reconcile(sandboxes, self.selector, lifecycle)
+            if self.pool is not None:
+                self._warm_up()
+            event_fanout.EventFanout(sandboxes, self.selector,
+                                     [(self.handler, lifecycle)]).poll(self.cursor)
+        except synthetic_docker.ReplayFinished:
+            pass
+        finally:
+            lifecycle.stop()
+            dispatcher.stop()
+            self.store.close()
+            if self.pool is not None:
+                self.pool.stop()
+            if self.ovsdb is not None:
+                self.ovsdb.close()
+            server_stats = self.server.stop() if self.server is not None else None
+            if self.nes_context is not None:
+                kni_docker_daemon.nes_disconnect(self.nes_context)
+        return self._results(recorder, client, dispatcher, lifecycle, counters, usage, children,
+                             server_stats)
+
+    def _results(self, recorder, client, dispatcher, lifecycle, counters, usage, children,
+                 server_stats):
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        attach = recorder.samples.get(ATTACH_ACTIONS[self.daemon], [])
+        detach = recorder.samples.get(DETACH_ACTIONS[self.daemon], [])
+        # throughput over the time from the first event to the last attach done
+        attach_window = max(done for _, done in attach) - client.started if attach else 0.0
+        duration = client.finished - client.started
+        cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+        cpu_children = (end_children.ru_utime - children.ru_utime) + \
+            (end_children.ru_stime - children.ru_stime)
+        events = client.stats["events"]
+        failures, saved = counters
+        return {"daemon": self.daemon,
+                "events": events,
+                "attaches": len(attach),
+                "detaches": len(detach),
+                "failed": counter_deltas(metrics.EVENT_FAILURES, failures),
+                "saved": counter_deltas(metrics.OPERATIONS_SAVED, saved),
+                "duration": duration,
+                "attaches_per_sec": len(attach) / attach_window if attach_window else 0.0,
+                "latency": {"attach": percentiles([latency for latency, _ in attach]),
+                            "detach": percentiles([latency for latency, _ in detach])},
+                "cpu": {"seconds": cpu, "children_seconds": cpu_children,
+                        "percent": 100.0 * cpu / duration if duration else 0.0,
+                        "per_event": (cpu + cpu_children) / events if events else 0.0},
+                "rss": {"max_kb": end_usage.ru_maxrss, "current_kb": current_rss_kb()},
+                "stages": stage_summary(),
+                "dispatcher": dispatcher.stats.as_dict(),
+                "lifecycle": dict(lifecycle.stats),
+                "docker": dict(client.stats),
+                "nes": server_stats if self.daemon == "kni" else None,
+                "ovsdb": {"server": server_stats, "client": dict(self.ovsdb.stats)}
+                         if self.ovsdb is not None else None,
+                "veth_pool": self.pool.snapshot()
+                             if self.pool is not None and self.daemon == "ovs" else None,
+                "kni_pool": self.pool.snapshot()
+                            if self.pool is not None and self.daemon == "kni" else None,
+                "attachments": self.store.snapshot()}
+
+
+def make_schedule(options):
+    """ event schedule of the options """
+    if options.replay:
+        return synthetic_docker.EventSchedule.load(options.replay)
+    if options.pattern == "burst":
+        return synthetic_docker.EventSchedule.burst(options.count, options.hold,
+                                                    options.noise, options.seed)
+    if options.pattern == "churn":
+        return synthetic_docker.EventSchedule.churn(options.rate, options.duration,
+                                                    options.lifetime, options.noise,
+                                                    options.seed)
+    return synthetic_docker.EventSchedule.flap(options.count, options.cycles, options.lifetime,
+                                               options.lifetime, options.noise, options.seed)
+
+def _bench_process(daemon, options, schedule, results):
+    logging.basicConfig(level=options.verbosity,
+                        format="%(processName)s [%(levelname)s] %(module)s: %(message)s")
+    workdir = tempfile.mkdtemp(prefix="nts-bench-")
+    try:
+        results.put(Bench(daemon, options, schedule, workdir).run())
+    except Exception as err:  # pylint: disable=broad-except
+        _LOG.critical("{} benchmark failed: {}".format(daemon, err))
+        results.put({"daemon": daemon, "error": str(err)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_daemon(daemon, options, schedule):
+    """ run benchmark of one daemon in a fresh process, returns its results """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_bench_process,
+                                      args=(daemon, options, schedule, results),
+                                      name="bench-" + daemon)
+    process.start()
+    try:
+        result = results.get(timeout=options.timeout)
+    except queue.Empty:
+        process.terminate()
+        result = {"daemon": daemon, "error": "timed out"}
+    process.join()
+    return result
+
+
+def _lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+def compare(report, baseline, tolerance):
+    """ list of regressions of the report against the baseline report """
+    regressions = []
+    if baseline.get("schedule") != report["schedule"]:
+        _LOG.warning("Baseline was measured with a different event schedule, not compared")
+        return regressions
+    for daemon, result in report["results"].items():
+        base = baseline.get("results", {}).get(daemon)
+        if base is None or "error" in result:
+            continue
+        for path, higher_better in COMPARED:
+            value, reference = _lookup(result, path), _lookup(base, path)
+            if not value or not reference:
+                continue
+            change = (value - reference) / reference
+            if (-change if higher_better else change) > tolerance:
+                regressions.append("{} {}: {:.6g} vs baseline {:.6g} ({:+.1%})".format(
+                    daemon, ".".join(path), value, reference, change))
+    return regressions
+
+def print_result(result):
+    """ print human readable summary of a daemon run """
+    if "error" in result:
+        print("{}: failed: {}".format(result["daemon"], result["error"]))
+        return
+    print("{}: {} events in {:.3f}s, {} attaches, {} detaches, failed {}, saved {}".format(
+        result["daemon"], result["events"], result["duration"], result["attaches"],
+        result["detaches"], result["failed"] or "none", result["saved"] or "none"))
+    print("  attaches/sec {:.1f}".format(result["attaches_per_sec"]))
+    for kind in ("attach", "detach"):
+        latency = result["latency"][kind]
+        if latency:
+            print("  {} latency p50 {:.2f}ms p99 {:.2f}ms max {:.2f}ms".format(
+                kind, latency["p50"] * 1e3, latency["p99"] * 1e3, latency["max"] * 1e3))
+    print("  cpu {:.3f}s ({:.0f}%), children {:.3f}s, {:.0f}us/event, max rss {}kB".format(
+        result["cpu"]["seconds"], result["cpu"]["percent"], result["cpu"]["children_seconds"],
+        result["cpu"]["per_event"] * 1e6, result["rss"]["max_kb"]))
+
+
+def make_parser():
+    """ make parser function """
+    log_levels = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d", "--daemon", action="append", metavar="DAEMON", dest="daemons",
+        choices=DAEMONS,
+        help="Daemon to benchmark ({}), may be given multiple times, all by default"
+        .format(", ".join(DAEMONS)))
+    parser.add_argument(
+        "-P", "--pattern", action="store", metavar="PATTERN", dest="pattern",
+        default="burst", choices=synthetic_docker.PATTERNS,
+        help="Event pattern ({})".format(", ".join(synthetic_docker.PATTERNS)))
+    parser.add_argument(
+        "-n", "--count", action="store", metavar="COUNT", dest="count",
+        type=int, default=200,
+        help="Number of containers of the burst and flap patterns")
+    parser.add_argument(
+        "-r", "--rate", action="store", metavar="RATE", dest="rate",
+        type=float, default=50.0,
+        help="Containers started per second in the churn pattern")
+    parser.add_argument(
+        "-D", "--duration", action="store", metavar="SECONDS", dest="duration",
+        type=float, default=5.0,
+        help="Duration of the churn pattern")
+    parser.add_argument(
+        "--lifetime", action="store", metavar="SECONDS", dest="lifetime",
+        type=float, default=1.0,
+        help="Container lifetime in the churn pattern, up and down time in the flap pattern")
+    parser.add_argument(
+        "--hold", action="store", metavar="SECONDS", dest="hold",
+        type=float, default=1.0,
+        help="Time between the start and the stop burst")
+    parser.add_argument(
+        "--cycles", action="store", metavar="CYCLES", dest="cycles",
+        type=int, default=5,
+        help="Restarts of each container in the flap pattern")
+    parser.add_argument(
+        "--noise", action="store", metavar="RATIO", dest="noise",
+        type=float, default=0.0,
+        help="Share of containers not selected by the daemons")
+    parser.add_argument(
+        "--seed", action="store", metavar="SEED", dest="seed",
+        type=int, default=1,
+        help="Random seed of the event pattern and the injected failures")
+    parser.add_argument(
+        "--record", action="store", metavar="PATH", dest="record",
+        default=None,
+        help="Save the event schedule to PATH")
+    parser.add_argument(
+        "--replay", action="store", metavar="PATH", dest="replay",
+        default=None,
+        help="Replay the event schedule saved in PATH instead of generating one")
+    parser.add_argument(
+        "-w", "--workers", action="store", metavar="WORKERS", dest="workers",
+        type=int, default=event_dispatcher.DEFAULT_WORKERS,
+        help="Number of containers events processed concurrently")
+    parser.add_argument(
+        "-q", "--queue-depth", action="store", metavar="DEPTH", dest="queue_depth",
+        type=int, default=event_dispatcher.DEFAULT_QUEUE_DEPTH,
+        help="Maximum number of queued events per worker")
+    parser.add_argument(
+        "--debounce", action="store", metavar="SECONDS", dest="debounce",
+        type=float, default=sandbox_lifecycle.DEFAULT_DEBOUNCE,
+        help="Coalesce events of a sandbox arriving within SECONDS into their net change")
+    parser.add_argument(
+        "-s", "--nes-sessions", action="store", metavar="SESSIONS", dest="nes_sessions",
+        type=int, default=kni_docker_daemon.NES_POOL_SIZE,
+        help="Maximum number of pooled NES control sessions")
+    parser.add_argument(
+        "-l", "--library", action="store", metavar="LIB_PATH", dest="library",
+        default=os.path.normpath(os.path.join(NTS_DIR, "build", "libnes_api_shared.so")),
+        help="nes_api shared library file path")
+    parser.add_argument(
+        "--nes-client", action="store", metavar="CLIENT", dest="nes_client",
+        default="library", choices=kni_docker_daemon.NES_CLIENTS,
+        help="NES client of the kni daemon ({})".format(", ".join(kni_docker_daemon.NES_CLIENTS)))
+    parser.add_argument(
+        "--nes-latency", action="store", metavar="SECONDS", dest="nes_latency",
+        type=float, default=0.0005,
+        help="Time the fake NES takes per request")
+    parser.add_argument(
+        "--nes-jitter", action="store", metavar="SECONDS", dest="nes_jitter",
+        type=float, default=0.0,
+        help="Maximum random time added to the fake NES latency")
+    parser.add_argument(
+        "--nes-fail-ratio", action="store", metavar="RATIO", dest="nes_fail_ratio",
+        type=float, default=0.0,
+        help="Share of NES requests failing")
+    parser.add_argument(
+        "--kni-max", action="store", metavar="COUNT", dest="kni_max",
+        type=int, default=0,
+        help="Maximum number of KNI devices of the fake NES, unlimited when 0")
+    parser.add_argument(
+        "--kni-pool", action="store", metavar="SIZE", dest="kni_pool",
+        type=int, default=0,
+        help="Attach kni daemon containers from a warm pool of SIZE KNI interfaces")
+    parser.add_argument(
+        "--link-latency", action="store", metavar="SECONDS", dest="link_latency",
+        type=float, default=0.0,
+        help="Time each stubbed link operation takes")
+    parser.add_argument(
+        "--ovs-latency", action="store", metavar="SECONDS", dest="ovs_latency",
+        type=float, default=0.0,
+        help="Time each stubbed ovs-vsctl run (or fake OVSDB transaction) takes")
+    parser.add_argument(
+        "--ovsdb", action="store_true", dest="ovsdb",
+        help="Manage ports of the ovs daemon over a fake OVSDB instead of ovs-vsctl")
+    parser.add_argument(
+        "--veth-pool", action="store", metavar="SIZE", dest="veth_pool",
+        type=int, default=0,
+        help="Attach ovs daemon containers from a warm pool of SIZE veth pairs")
+    parser.add_argument(
+        "--attach-profiles", action="store", metavar="PATH", dest="attach_profiles",
+        default=None,
+        help="Attach ovs daemon containers with the attach profiles of the JSON file in PATH")
+    parser.add_argument(
+        "--attach-profile", action="store", metavar="NAME", dest="attach_profile",
+        default=attach_profile.PLAIN_PROFILE,
+        help="Attach profile of the ovs daemon containers (default: %(default)s)")
+    parser.add_argument(
+        "--ofport-latency", action="store", metavar="SECONDS", dest="ofport_latency",
+        type=float, default=0.0,
+        help="Time until the fake OVSDB assigns an ofport to a new interface")
+    parser.add_argument(
+        "--inspect-latency", action="store", metavar="SECONDS", dest="inspect_latency",
+        type=float, default=0.0,
+        help="Time each docker inspect takes")
+    parser.add_argument(
+        "-b", "--bridge", action="store", metavar="BRIDGE_NAME", dest="bridge",
+        default="br0",
+        help="OVS bridge name")
+    parser.add_argument(
+        "-o", "--output", action="store", metavar="PATH", dest="output",
+        default=None,
+        help="Write results as JSON to PATH, to be used as a baseline")
+    parser.add_argument(
+        "-B", "--baseline", action="store", metavar="PATH", dest="baseline",
+        default=None,
+        help="Compare results against the baseline in PATH, exit with 2 on regressions")
+    parser.add_argument(
+        "-t", "--tolerance", action="store", metavar="RATIO", dest="tolerance",
+        type=float, default=0.25,
+        help="Relative change against the baseline reported as a regression")
+    parser.add_argument(
+        "--timeout", action="store", metavar="SECONDS", dest="timeout",
+        type=float, default=600.0,
+        help="Maximum time of a daemon run")
+    parser.add_argument(
+        "-v", "--verbosity", action="store", metavar="LEVEL", dest="verbosity",
+        default="WARNING", choices=log_levels,
+        help="Daemons diagnostic output verbosity")
+    return parser
+
+def main(options):
+    """ main """
+    schedule = make_schedule(options)
+    if options.record:
+        schedule.save(options.record)
+    daemons = options.daemons or DAEMONS
+    print("{} events ({} starts), daemons {}".format(len(schedule.entries),
+                                                    schedule.count("start"),
+                                                    ", ".join(daemons)))
+    results = {}
+    for daemon in daemons:
+        results[daemon] = run_daemon(daemon, options, schedule)
+        print_result(results[daemon])
+
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "schedule": schedule.digest(),
+              "host": {"python": platform.python_version(), "machine": platform.machine(),
+                       "cpus": os.cpu_count()},
+              "options": {key: value for key, value in sorted(vars(options).items())
+                          if key not in ("output", "baseline", "record", "daemons")},
+              "results": results}
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write("\n")
+    status = 1 if any("error" in result for result in results.values()) else 0
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), options.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            status = 2
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(make_parser().parse_args()))
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" NES control client benchmark
+
+Sends a nes_kni_add, a nes_kni_del and a nes_stats_dev per container
+from concurrent workers against the stand-in NES control server, through
+the nes_api library on pooled sessions, through the protocol client shared
+by threads, pipelined in batches and from asyncio tasks, and reports round
+trips per second and request latency.
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import fake_nes
+import kni_docker_daemon
+import nes_client
+import nes_stats
+
+MODES = ("library", "python", "pipelined", "asyncio")
+
+
+def make_parser():
+    """ make parser function """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--containers", action="store", metavar="COUNT", dest="containers",
+        type=int, default=2000,
+        help="Number of containers whose requests are sent per run")
+    parser.add_argument(
+        "-w", "--workers", action="store", metavar="WORKERS", dest="workers",
+        type=int, default=8,
+        help="Number of concurrent callers")
+    parser.add_argument(
+        "-m", "--modes", action="store", metavar="MODE[,MODE...]", dest="modes",
+        default=",".join(MODES),
+        help="Clients to run ({})".format(", ".join(MODES)))
+    parser.add_argument(
+        "-s", "--nes-sessions", action="store", metavar="SESSIONS", dest="nes_sessions",
+        type=int, default=kni_docker_daemon.NES_POOL_SIZE,
+        help="Maximum number of pooled NES control sessions of the library")
+    parser.add_argument(
+        "--nes-latency", action="store", metavar="SECONDS", dest="nes_latency",
+        type=float, default=0.0,
+        help="Time the fake NES takes per request")
+    parser.add_argument(
+        "-l", "--library", action="store", metavar="LIB_PATH", dest="library",
+        default=os.path.normpath(os.path.join(NTS_DIR, "build", "libnes_api_shared.so")),
+        help="nes_api shared library file path")
+    parser.add_argument(
+        "-o", "--output", action="store", metavar="PATH", dest="output",
+        default=None,
+        help="Write results as JSON to PATH")
+    return parser
+
+def percentile(values, share):
+    """ nearest rank percentile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+def _check(results):
+    """ number of failed results of a container's requests """
+    (add_ret, _), (del_ret, _), stats = results
+    return (add_ret != nes_client.NES_SUCCESS) + (del_ret != nes_client.NES_SUCCESS) + \
+        (stats is None)
+
+def _requests(dev_id):
+    return [(nes_client.FUNC_ADD_KNI, (dev_id,)), (nes_client.FUNC_DEL_KNI, (dev_id,)),
+            (nes_client.FUNC_STATS_DEV, (0,))]
+
+def _run_threads(options, dev_ids, call):
+    """ call(dev_id) from the workers, returns (elapsed, latencies, failures) """
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def worker(first):
+        own = []
+        failed = 0
+        for dev_id in dev_ids[first::options.workers]:
+            start = time.monotonic()
+            failed += _check(call(dev_id))
+            own.append(time.monotonic() - start)
+        with lock:
+            latencies.extend(own)
+            failures.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(first,))
+               for first in range(options.workers)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - start, latencies, sum(failures)
+
+def run_library(options, cfg_path, dev_ids):
+    """ nes_api calls on pooled sessions """
+    nes_context = kni_docker_daemon.nes_lib_load(options.library, cfg_path,
+                                                 options.nes_sessions)
+    if nes_context is None:
+        raise RuntimeError("Failed to load nes_api library {}".format(options.library))
+    sampler = nes_stats.NesStatsSampler(nes_context.lib, nes_context.pool)
+
+    def call(dev_id):
+        added = kni_docker_daemon.modify_kni_interface(nes_context, dev_id, False)
+        deleted = kni_docker_daemon.modify_kni_interface(nes_context, dev_id, True)
+        return added, deleted, sampler.dev_stats(0)
+
+    try:
+        return _run_threads(options, dev_ids, call)
+    finally:
+        kni_docker_daemon.nes_disconnect(nes_context)
+
+def run_python(options, socket_path, dev_ids, pipelined):
+    """ protocol client calls, one at a time or the requests of a container at once """
+    client = nes_client.NesClient(socket_path)
+
+    def call(dev_id):
+        if pipelined:
+            return client.call_many(_requests(dev_id))
+        return client.kni_add(dev_id), client.kni_del(dev_id), client.stats_dev(0)
+
+    try:
+        return _run_threads(options, dev_ids, call)
+    finally:
+        client.close()
+
+def run_asyncio(options, socket_path, dev_ids):
+    """ asyncio protocol client calls, workers tasks at a time """
+    client = nes_client.AsyncNesClient(socket_path)
+    latencies = []
+    failures = []
+
+    async def worker(first):
+        failed = 0
+        for dev_id in dev_ids[first::options.workers]:
+            start = time.monotonic()
+            failed += _check((await client.kni_add(dev_id), await client.kni_del(dev_id),
+                              await client.stats_dev(0)))
+            latencies.append(time.monotonic() - start)
+        failures.append(failed)
+
+    async def run():
+        await client.connect()
+        start = time.monotonic()
+        await asyncio.gather(*(worker(first) for first in range(options.workers)))
+        elapsed = time.monotonic() - start
+        await client.close()
+        return elapsed
+
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    return elapsed, latencies, sum(failures)
+
+def run(options, workdir, mode):
+    """ send the requests of all containers once, returns results """
+    socket_path = os.path.join(workdir, "nes.sock")
+    cfg_path = os.path.join(workdir, "nes.cfg")
+    with open(cfg_path, "w") as cfg_file:
+        cfg_file.write("[NES_SERVER]\nctrl_socket = {}\n".format(socket_path))
+    server = fake_nes.FakeNesProcess(socket_path, latency=options.nes_latency)
+    if not server.start():
+        raise RuntimeError("Fake NES server did not start")
+    dev_ids = ["{:012x}{:052x}".format(index + 1, index) for index in range(options.containers)]
+    try:
+        if mode == "library":
+            elapsed, latencies, failed = run_library(options, cfg_path, dev_ids)
+        elif mode == "asyncio":
+            elapsed, latencies, failed = run_asyncio(options, socket_path, dev_ids)
+        else:
+            elapsed, latencies, failed = run_python(options, socket_path, dev_ids,
+                                                    mode == "pipelined")
+    finally:
+        server_stats = server.stop()
+
+    latencies.sort()
+    round_trips = 3 * len(latencies)
+    return {"mode": mode, "round_trips": round_trips, "failed": failed,
+            "round_trips_per_sec": round_trips / elapsed if elapsed else 0.0,
+            "latency_ms": {"p50": percentile(latencies, 0.5) * 1e3,
+                           "p99": percentile(latencies, 0.99) * 1e3},
+            "connections": server_stats.get("connections"),
+            "kni_devices_left": server_stats.get("kni_devices")}
+
+def main(options):
+    """ main """
+    logging.basicConfig(level=logging.WARNING)
+    kni_docker_daemon._LOG = logging.getLogger("kni_docker_daemon")
+    modes = [mode for mode in options.modes.split(",") if mode]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        print("Unknown mode {}".format(", ".join(sorted(unknown))))
+        return 1
+    workdir = tempfile.mkdtemp(prefix="nes-client-bench-")
+    results = []
+    try:
+        print("{:>10s} {:>12s} {:>9s} {:>9s} {:>6s}".format(
+            "client", "round trip/s", "p50 ms", "p99 ms", "conns"))
+        for mode in modes:
+            result = run(options, workdir, mode)
+            results.append(result)
+            print("{:>10s} {:12.0f} {:9.3f} {:9.3f} {:6d}".format(
+                mode, result["round_trips_per_sec"], result["latency_ms"]["p50"],
+                result["latency_ms"]["p99"], result["connections"] or 0))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump({"options": vars(options), "results": results}, output, indent=2,
+                      sort_keys=True)
+    return 1 if any(result["failed"] or result["kni_devices_left"] for result in results) \
+        else 0
+
+if __name__ == '__main__':
+    sys.exit(main(make_parser().parse_args()))
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" pod selector match cost benchmark
+
+Measures per-event PodSelector.match() cost on a large multi-tenant rule
+set against evaluating the same rules one after another.
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import fnmatch
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pod_selector # pylint: disable=wrong-import-position
+
+
+def make_parser():
+    """ make parser function """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t", "--tenants", action="store", metavar="TENANTS", dest="tenants",
+        type=int, default=500,
+        help="Number of tenants, each one adds a prefix, a glob and a regex rule")
+    parser.add_argument(
+        "-n", "--events", action="store", metavar="EVENTS", dest="events",
+        type=int, default=20000,
+        help="Number of events matched per run")
+    parser.add_argument(
+        "-m", "--match-ratio", action="store", metavar="RATIO", dest="match_ratio",
+        type=float, default=0.1,
+        help="Share of events selected by a rule")
+    return parser
+
+def make_rules(tenants):
+    """ per-tenant rules """
+    rules = ["uuid"]
+    for tenant in range(tenants):
+        rules.append("prefix:t{}-app".format(tenant))
+        rules.append("glob:t{}-*-edge".format(tenant))
+        rules.append("regex:t{}-job-[0-9]+$".format(tenant))
+        rules.append("pod-prefix:t{}-pod".format(tenant))
+    return rules
+
+def make_events(count, tenants, match_ratio):
+    """ container attributes of synthetic events """
+    rand = random.Random(1)
+    events = []
+    for _ in range(count):
+        tenant = rand.randrange(tenants)
+        if rand.random() < match_ratio:
+            name = rand.choice(["t{}-app-{}", "t{}-x-edge", "t{}-job-{}"]).format(
+                tenant, rand.randrange(1000))
+        else:
+            name = rand.choice(["kube-proxy-{}", "t{}-db-{}", "monitoring-{}"]).format(
+                tenant, rand.randrange(1000))
+        events.append({'name': name})
+    return events
+
+def naive_matcher(rules):
+    """ rules evaluated one by one, the cost grows with the rule count """
+    checks = []
+    for rule in rules:
+        kind, _, value = rule.partition(":")
+        if kind == "prefix":
+            checks.append(lambda name, value=value: name.startswith(value))
+        elif kind == "glob":
+            checks.append(re.compile(fnmatch.translate(value)).match)
+        elif kind == "regex":
+            checks.append(re.compile(value).match)
+        elif kind == "uuid":
+            checks.append(re.compile(pod_selector.UUID_PATTERN).match)
+    return lambda attributes: any(check(attributes['name']) for check in checks)
+
+def run(label, match, events):
+    """ time matching all events, best of 3 """
+    selected = sum(1 for attributes in events if match(attributes))
+    best = min(timeit.repeat(lambda: [match(attributes) for attributes in events],
+                             number=1, repeat=3))
+    print("{:10s} {:8.3f} us/event  {} selected".format(label, best / len(events) * 1e6,
+                                                        selected))
+    return selected
+
+def main(options):
+    """ main """
+    rules = make_rules(options.tenants)
+    events = make_events(options.events, options.tenants, options.match_ratio)
+    selector = pod_selector.PodSelector(rules)
+    print("{} rules, {} events".format(len(rules), len(events)))
+    compiled = run("compiled", selector.match, events)
+    naive = run("linear", naive_matcher(rules), events)
+    if compiled != naive:
+        print("Selected counts differ")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(make_parser().parse_args()))
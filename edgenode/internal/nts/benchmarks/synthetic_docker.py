@@ -0,0 +1,225 @@
+# coding: utf-8
+""" replayable synthetic docker events and an in-memory docker client serving them """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import hashlib
+import json
+import random
+import signal
+import threading
+import time
+
+PATTERNS = ("burst", "churn", "flap")
+NS_PATH_FORMAT = "/var/run/docker/netns/{}"
+
+
+class ReplayFinished(BaseException):
+    """ raised by the event stream once the schedule is replayed and drained
+
+    Not an Exception, so docker_events.follow_events() does not resume.
+    """
+
+
+def _container_id(rand):
+    return "{:064x}".format(rand.getrandbits(256))
+
+def _lifecycle_stop(at, container_id, name):
+    """ events of docker stop followed by docker rm """
+    return [{"at": at, "action": "kill", "id": container_id, "name": name,
+             "signal": str(int(signal.SIGTERM))},
+            {"at": at, "action": "die", "id": container_id, "name": name},
+            {"at": at, "action": "destroy", "id": container_id, "name": name}]
+
+
+class EventSchedule():
+    """ docker container events with their offsets from the replay start
+
+    Entries are {"at", "action", "id", "name"[, "signal"]} dicts sorted by
+    offset. A share of the containers (noise) has names not selected by the
+    daemons, their events only cost filtering.
+    """
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda entry: entry["at"])
+
+    @staticmethod
+    def _name(rand, index, noise):
+        if noise and rand.random() < noise:
+            return "sidecar-{}".format(index)
+        return "mec-app-{}".format(index)
+
+    @classmethod
+    def burst(cls, count, hold=1.0, noise=0.0, seed=1):
+        """ count containers started at once and stopped at once hold seconds later """
+        rand = random.Random(seed)
+        entries = []
+        for index in range(count):
+            container_id = _container_id(rand)
+            name = cls._name(rand, index, noise)
+            entries.append({"at": 0.0, "action": "start", "id": container_id, "name": name})
+            entries.extend(_lifecycle_stop(hold, container_id, name))
+        return cls(entries)
+
+    @classmethod
+    def churn(cls, rate, duration, lifetime=1.0, noise=0.0, seed=1):
+        """ containers started at rate per second for duration, each living lifetime """
+        rand = random.Random(seed)
+        entries = []
+        for index in range(int(rate * duration)):
+            at = index / rate
+            container_id = _container_id(rand)
+            name = cls._name(rand, index, noise)
+            entries.append({"at": at, "action": "start", "id": container_id, "name": name})
+            entries.extend(_lifecycle_stop(at + rand.uniform(0.5, 1.5) * lifetime,
+                                           container_id, name))
+        return cls(entries)
+
+    @classmethod
+    def flap(cls, count, cycles=5, uptime=0.05, downtime=0.05, noise=0.0, seed=1):
+        """ count crash looping containers, dying uptime after each of cycles starts """
+        rand = random.Random(seed)
+        entries = []
+        period = uptime + downtime
+        for index in range(count):
+            container_id = _container_id(rand)
+            name = cls._name(rand, index, noise)
+            phase = rand.uniform(0, period)
+            for cycle in range(cycles):
+                at = phase + cycle * period
+                entries.append({"at": at, "action": "start", "id": container_id, "name": name})
+                if cycle < cycles - 1:
+                    entries.append({"at": at + uptime, "action": "die", "id": container_id,
+                                    "name": name})
+            entries.extend(_lifecycle_stop(phase + cycles * period - downtime, container_id,
+                                           name))
+        return cls(entries)
+
+    def digest(self):
+        """ fingerprint of the schedule, equal for replays of the same schedule """
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(json.dumps(entry, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def save(self, path):
+        """ write schedule as JSON lines """
+        with open(path, "w") as schedule_file:
+            for entry in self.entries:
+                schedule_file.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    @classmethod
+    def load(cls, path):
+        """ read schedule written by save() """
+        with open(path) as schedule_file:
+            return cls([json.loads(line) for line in schedule_file if line.strip()])
+
+    def count(self, action):
+        """ number of events of the action """
+        return sum(1 for entry in self.entries if entry["action"] == action)
+
+
+class _FakeContainer():
+    def __init__(self, container_id, name, status):
+        self.id = container_id
+        self.name = name
+        self.status = status
+        self.labels = {}
+        self.attrs = {"Id": container_id, "Name": "/" + name,
+                      "Config": {"Labels": self.labels},
+                      "NetworkSettings": {"SandboxKey": NS_PATH_FORMAT.format(container_id[:12])}}
+
+
+class _FakeContainers():
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, container_id):
+        """ container by ID, as docker.DockerClient.containers.get() """
+        if self._client.inspect_latency:
+            time.sleep(self._client.inspect_latency)
+        with self._client.lock:
+            self._client.stats["inspects"] += 1
+            return self._client.containers_by_id[container_id]
+
+    def list(self, all=False, filters=None): # pylint: disable=redefined-builtin
+        """ containers, as docker.DockerClient.containers.list() """
+        with self._client.lock:
+            containers = list(self._client.containers_by_id.values())
+        return [container for container in containers if container.status != "removed"
+                if all or container.status == "running"
+                if not filters or filters.get("status") in (None, container.status)]
+
+
+class FakeDockerClient():
+    """ docker client replaying an EventSchedule
+
+    The events stream paces the schedule in real time and stamps every event
+    with the time it is emitted. Once the schedule is replayed it calls drain,
+    which is expected to block until all events are processed, and raises
+    ReplayFinished.
+    """
+    def __init__(self, schedule, drain=None, inspect_latency=0.0):
+        self.schedule = schedule
+        self.drain = drain
+        self.inspect_latency = inspect_latency
+        self.containers = _FakeContainers(self)
+        self.containers_by_id = {}
+        self.lock = threading.Lock()
+        self.stats = {"events": 0, "inspects": 0}
+        self.started = None
+        self.finished = None
+
+    def ping(self):
+        """ as docker.DockerClient.ping() """
+        return True
+
+    @staticmethod
+    def _filtered(entry, filters):
+        if not filters:
+            return False
+        actions = filters.get("event")
+        if actions and entry["action"] not in actions:
+            return True
+        types = filters.get("type")
+        return bool(types) and "container" not in types
+
+    def _update(self, entry):
+        with self.lock:
+            container = self.containers_by_id.get(entry["id"])
+            if container is None:
+                container = _FakeContainer(entry["id"], entry["name"], "created")
+                self.containers_by_id[entry["id"]] = container
+            if entry["action"] == "start":
+                container.status = "running"
+            elif entry["action"] == "die":
+                container.status = "exited"
+            elif entry["action"] == "destroy":
+                # still inspectable, handlers of its earlier events may be queued
+                container.status = "removed"
+
+    def events(self, decode=True, since=None, filters=None,
+               **kwargs): # pylint: disable=unused-argument
+        """ replay the schedule as docker.DockerClient.events(decode=True) """
+        self.started = time.monotonic()
+        last_nano = 0
+        for entry in self.schedule.entries:
+            delay = self.started + entry["at"] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._update(entry)
+            if self._filtered(entry, filters):
+                continue
+            # docker orders events by timeNano, keep them strictly increasing
+            last_nano = max(int(time.time() * 10**9), last_nano + 1)
+            attributes = {"name": entry["name"], "image": "busybox"}
+            if "signal" in entry:
+                attributes["signal"] = entry["signal"]
+            self.stats["events"] += 1
+            yield {"Type": "container", "Action": entry["action"], "status": entry["action"],
+                   "id": entry["id"], "from": "busybox", "scope": "local",
+                   "Actor": {"ID": entry["id"], "Attributes": attributes},
+                   "time": last_nano // 10**9, "timeNano": last_nano}
+        if self.drain is not None:
+            self.drain()
+        self.finished = time.monotonic()
+        raise ReplayFinished()
@@ -0,0 +1,238 @@
+# coding: utf-8
+""" non-blocking logging of the daemons """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LOG_FORMATS = ("text", "json")
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# records waiting for the writer thread, newer ones are dropped past it
+QUEUE_SIZE = 10000
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+# WARNING and above records let through per call site every interval
+DEFAULT_RATE_BURST = 5
+DEFAULT_RATE_INTERVAL = 10.0
+
+_PIPELINE = None
+
+
+class RateLimitFilter(logging.Filter):
+    """ at most burst WARNING and above records of a call site per interval
+
+    Records of the same call site beyond burst within interval seconds of
+    the first one are dropped. The first record let through afterwards
+    carries the number dropped in its suppressed attribute.
+    """
+    def __init__(self, burst=DEFAULT_RATE_BURST, interval=DEFAULT_RATE_INTERVAL):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self._sites = {}
+        self._lock = threading.Lock()
+        self.stats = {"suppressed": 0}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or record.created - site[0] >= self.interval:
+                # [window start, records let through, records dropped]
+                self._sites[key] = [record.created, 1, 0]
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                return True
+            if site[1] < self.burst:
+                site[1] += 1
+                return True
+            site[2] += 1
+            self.stats["suppressed"] += 1
+            return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """ hand records over to the writer thread without waiting """
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.stats = {"queued": 0, "dropped": 0}
+
+    def prepare(self, record):
+        # the arguments may change before the writer thread formats the record, the
+        # message is rendered now and the rest of the line only for records written
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return
+        self.stats["queued"] += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # the writer empties a full queue, stopping must not fail on it
+        self.queue.put(self._sentinel)
+
+
+class TextFormatter(logging.Formatter):
+    """ the daemons' text lines """
+    def __init__(self, title):
+        logging.Formatter.__init__(
+            self, title + ": [%(levelname)s] %(module)s(%(lineno)d): %(message)s", TIME_FORMAT)
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += " ({} similar messages suppressed)".format(suppressed)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """ one JSON object per line, with the sandbox and pod of the record if any """
+    def __init__(self, title):
+        logging.Formatter.__init__(self, datefmt=TIME_FORMAT)
+        self.title = title
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, self.datefmt),
+                 "daemon": self.title,
+                 "level": record.levelname,
+                 "module": record.module,
+                 "line": record.lineno,
+                 "message": record.getMessage()}
+        for field in ("sandbox", "pod", "suppressed"):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True, default=str)
+
+
+class _Pipeline():
+    """ queue handler and the writer thread feeding the output handlers """
+    def __init__(self, handlers, rate_burst, rate_interval):
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.handler = _QueueHandler(self.queue)
+        self.rate_limit = RateLimitFilter(rate_burst, rate_interval)
+        self.handler.addFilter(self.rate_limit)
+        self.listener = _QueueListener(self.queue, *handlers)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ start the writer thread """
+        self.listener.start()
+
+    def stop(self):
+        """ write queued records and stop the writer thread """
+        with self._lock:
+            if self.listener._thread is not None: # pylint: disable=protected-access
+                self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+
+    def stats(self):
+        """ queued, dropped, suppressed and pending records """
+        stats = dict(self.handler.stats)
+        stats.update(self.rate_limit.stats)
+        stats["pending"] = self.queue.qsize()
+        return stats
+
+
+def add_options(parser, log_path):
+    """ add logging options to the parser """
+    levels_str = "{0:s} or {1:s}".format(", ".join(LOG_LEVELS[:-1]), LOG_LEVELS[-1])
+    parser.add_argument(
+        "-v", "--verbosity", action="store", metavar="LEVEL", dest="verbosity", default="INFO",
+        choices=LOG_LEVELS,
+        help="Application diagnostic output verbosity ({0:s})".format(levels_str))
+    parser.add_argument(
+        "-p", "--log-path", action="store", metavar="LOG_PATH", dest="log_path",
+        default=log_path,
+        help="Log file path, logs only go to stderr when empty")
+    parser.add_argument(
+        "--log-format", action="store", metavar="FORMAT", dest="log_format",
+        default="text", choices=LOG_FORMATS,
+        help="Log line format ({})".format(", ".join(LOG_FORMATS)))
+    parser.add_argument(
+        "--log-max-bytes", action="store", metavar="BYTES", dest="log_max_bytes",
+        type=int, default=DEFAULT_MAX_BYTES,
+        help="Rotate the log file once it reaches BYTES")
+    parser.add_argument(
+        "--log-rotate-when", action="store", metavar="WHEN", dest="log_rotate_when",
+        default=None,
+        help="Rotate the log file by time instead of size, e.g. midnight, H or W0")
+    parser.add_argument(
+        "--log-backups", action="store", metavar="COUNT", dest="log_backups",
+        type=int, default=DEFAULT_BACKUPS,
+        help="Number of rotated log files kept")
+    parser.add_argument(
+        "--log-rate-burst", action="store", metavar="COUNT", dest="log_rate_burst",
+        type=int, default=DEFAULT_RATE_BURST,
+        help="Warnings and errors logged per source line within the rate interval, "
+        "unlimited when 0")
+    parser.add_argument(
+        "--log-rate-interval", action="store", metavar="SECONDS", dest="log_rate_interval",
+        type=float, default=DEFAULT_RATE_INTERVAL,
+        help="Rate interval of repeated warnings and errors")
+
+def _file_handler(options):
+    """ rotating handler of the log file """
+    if options.log_rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            options.log_path, when=options.log_rotate_when, backupCount=options.log_backups)
+    return logging.handlers.RotatingFileHandler(
+        options.log_path, maxBytes=options.log_max_bytes, backupCount=options.log_backups)
+
+def setup(options, title):
+    """ route the root logger through the writer thread, returns the root logger """
+    global _PIPELINE # pylint: disable=global-statement
+    formatter = JsonFormatter(title) if options.log_format == "json" else TextFormatter(title)
+    handlers = [logging.StreamHandler()]
+    file_error = None
+    if options.log_path:
+        try:
+            handlers.append(_file_handler(options))
+        except (OSError, ValueError) as err:
+            file_error = err
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _PIPELINE = _Pipeline(handlers, options.log_rate_burst, options.log_rate_interval)
+    _PIPELINE.start()
+    atexit.register(_PIPELINE.stop)
+    root_logger = logging.getLogger('')
+    root_logger.addHandler(_PIPELINE.handler)
+    root_logger.setLevel(options.verbosity)
+    if file_error is not None:
+        root_logger.error("Failed to open log file %s: %s", options.log_path, file_error)
+    return root_logger
+
+def shutdown():
+    """ write queued records and stop the writer thread, before exiting without atexit """
+    if _PIPELINE is not None:
+        _PIPELINE.stop()
+
+def stats():
+    """ stats of the logging pipeline, empty until it is set up """
+    return _PIPELINE.stats() if _PIPELINE is not None else {}
+
+def sandbox_log(logger, sandbox_id, pod_name):
+    """ logger adding the sandbox and pod to its records """
+    return logging.LoggerAdapter(logger, {"sandbox": sandbox_id, "pod": pod_name})
@@ -0,0 +1,221 @@
+# coding: utf-8
+""" deadlines, retries and watchdog of the blocking daemon operations """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+
+import daemon_logging
+import metrics
+
+# seconds an operation of the class may take, no deadline when 0
+DEFAULT_TIMEOUTS = {"command": 10.0, "docker": 10.0, "nes": 5.0, "ovsdb": 5.0, "event": 60.0}
+OPERATIONS = tuple(sorted(DEFAULT_TIMEOUTS))
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.1
+MAX_BACKOFF = 2.0
+DEFAULT_WATCHDOG = 30.0
+# exit status of a daemon restarted by the watchdog (EX_TEMPFAIL)
+EXIT_STALLED = 75
+
+_LOG = logging.getLogger(__name__)
+
+_TIMEOUTS = dict(DEFAULT_TIMEOUTS)
+_RETRY = {"retries": DEFAULT_RETRIES, "backoff": DEFAULT_BACKOFF}
+
+
+class DeadlineExceeded(Exception):
+    """ operation abandoned at its deadline """
+
+
+def add_options(parser):
+    """ add deadline and watchdog options to the parser """
+    parser.add_argument(
+        "--timeout", action="append", metavar="OPERATION=SECONDS", dest="timeouts",
+        help="Deadline of an operation class, may be given multiple times, no deadline when "
+        "0; classes: {}".format(", ".join("{} ({}s)".format(operation,
+                                                             DEFAULT_TIMEOUTS[operation])
+                                          for operation in OPERATIONS)))
+    parser.add_argument(
+        "--retries", action="store", metavar="COUNT", dest="retries",
+        type=int, default=DEFAULT_RETRIES,
+        help="Number of times an idempotent operation which failed or timed out is retried")
+    parser.add_argument(
+        "--retry-backoff", action="store", metavar="SECONDS", dest="retry_backoff",
+        type=float, default=DEFAULT_BACKOFF,
+        help="Delay before the first retry, doubled by each next one up to {}s"
+        .format(MAX_BACKOFF))
+    parser.add_argument(
+        "--watchdog", action="store", metavar="SECONDS", dest="watchdog",
+        type=float, default=DEFAULT_WATCHDOG,
+        help="Report event handlers and the event loop stalled for SECONDS, disabled when 0")
+    parser.add_argument(
+        "--watchdog-restart", action="store_true", dest="watchdog_restart",
+        help="Exit with status {} when a stall lasts twice the watchdog time, so the "
+        "daemon is restarted; threaded handlers are not cancelled at the event deadline, "
+        "so the watchdog time must cover their retried docker and command calls"
+        .format(EXIT_STALLED))
+
+def configure(options):
+    """ apply the deadline options, raises ValueError on invalid ones """
+    for value in options.timeouts or ():
+        operation, _, seconds = value.partition("=")
+        if operation not in DEFAULT_TIMEOUTS:
+            raise ValueError("unknown operation {}".format(operation))
+        _TIMEOUTS[operation] = float(seconds)
+    _RETRY["retries"] = max(0, options.retries)
+    _RETRY["backoff"] = options.retry_backoff
+
+def timeout(operation):
+    """ seconds an operation of the class may take, None without deadline """
+    return _TIMEOUTS[operation] or None
+
+def expired(operation, what):
+    """ count the timeout of what, returns the DeadlineExceeded error to raise """
+    metrics.OPERATION_TIMEOUTS.labels(operation).inc()
+    return DeadlineExceeded("{} timed out after {}s".format(what, _TIMEOUTS[operation]))
+
+def backoff(attempt):
+    """ delay before retry attempt (from 0), jittered so retries do not line up """
+    delay = min(MAX_BACKOFF, _RETRY["backoff"] * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+def call(operation, func, *args, retryable=(DeadlineExceeded,)):
+    """ func(*args), retried with backoff while it raises a retryable error """
+    for attempt in range(_RETRY["retries"] + 1):
+        try:
+            return func(*args)
+        except retryable as err:
+            if attempt == _RETRY["retries"]:
+                raise
+            delay = backoff(attempt)
+            metrics.OPERATION_RETRIES.labels(operation).inc()
+            _LOG.warning("%s operation failed: %s, retrying in %.2fs", operation, err, delay)
+            time.sleep(delay)
+    return None
+
+async def within(operation, func, *args, what=None):
+    """ await func(*args), cancelled with DeadlineExceeded at the operation deadline """
+    try:
+        return await asyncio.wait_for(func(*args), timeout(operation))
+    except asyncio.TimeoutError:
+        raise expired(operation, what or func.__name__) from None
+
+async def call_async(operation, func, *args, retryable=(DeadlineExceeded,), what=None):
+    """ await func(*args) within the operation deadline, retried like call() """
+    for attempt in range(_RETRY["retries"] + 1):
+        try:
+            return await within(operation, func, *args, what=what)
+        except retryable as err:
+            if attempt == _RETRY["retries"]:
+                raise
+            delay = backoff(attempt)
+            metrics.OPERATION_RETRIES.labels(operation).inc()
+            _LOG.warning("%s operation failed: %s, retrying in %.2fs", operation, err, delay)
+            await asyncio.sleep(delay)
+    return None
+
+
+class LoopHeartbeat():
+    """ time of the last event loop iteration, the loop stalls while it does not move """
+    def __init__(self, loop, interval=1.0):
+        self.loop = loop
+        self.interval = interval
+        self.last = time.monotonic()
+        self.thread_id = threading.get_ident()
+        self._handle = loop.call_soon(self._beat)
+
+    def _beat(self):
+        self.last = time.monotonic()
+        self._handle = self.loop.call_later(self.interval, self._beat)
+
+    def running(self):
+        """ (since, thread ID) of the loop, as the watchdog probes expect """
+        # a beat is only due interval after the previous one
+        return [(self.last + self.interval, self.thread_id)]
+
+    def cancel(self):
+        """ stop beating """
+        self._handle.cancel()
+
+
+class Watchdog():
+    """ thread reporting work stalled for longer than stall_after
+
+    Probes return (since, thread ID) of the work running now, e.g. the
+    events being handled by dispatcher workers or the event loop heartbeat.
+    Stalled work is logged once with the stack of its thread and counted.
+    With restart, work still stalled after twice stall_after makes the
+    daemon exit with EXIT_STALLED, for its supervisor to restart it;
+    threads blocked in a system call can not be interrupted otherwise.
+    """
+    def __init__(self, stall_after, restart=False, exit_func=None):
+        self.stall_after = stall_after
+        self.restart = restart
+        self.stats = {"checks": 0, "stalls": 0}
+        self._exit = exit_func or _exit_stalled
+        self._probes = []
+        self._reported = set()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def watch(self, source, probe):
+        """ check the work returned by probe(), reported as source """
+        self._probes.append((source, probe))
+
+    def start(self):
+        """ start checking every quarter of stall_after """
+        self._thread = threading.Thread(target=self._run, name="watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ stop checking """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.stall_after / 4):
+            self.check()
+
+    def check(self):
+        """ report stalled work, returns the longest stall in seconds """
+        now = time.monotonic()
+        frames = None
+        reported = set()
+        longest = 0.0
+        self.stats["checks"] += 1
+        for source, probe in self._probes:
+            for since, thread_id in probe():
+                stalled = now - since
+                if stalled < self.stall_after:
+                    continue
+                longest = max(longest, stalled)
+                reported.add((source, since, thread_id))
+                if (source, since, thread_id) in self._reported:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames() # pylint: disable=protected-access
+                self.stats["stalls"] += 1
+                metrics.WATCHDOG_STALLS.labels(source).inc()
+                frame = frames.get(thread_id)
+                _LOG.critical("%s stalled for %.1fs in:\n%s", source, stalled,
+                              "".join(traceback.format_stack(frame)) if frame else "?")
+        self._reported = reported
+        if self.restart and longest >= 2 * self.stall_after:
+            _LOG.critical("Stalled for %.1fs, exiting to be restarted", longest)
+            self._exit()
+        return longest
+
+def _exit_stalled():
+    """ exit at once, stalled threads would keep a regular exit waiting """
+    daemon_logging.shutdown()
+    os._exit(EXIT_STALLED) # pylint: disable=protected-access
@@ -0,0 +1,301 @@
+# coding: utf-8
+""" on-demand profiling, event step tracing and memory snapshots of the daemons """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+
+CAPTURES = ("profile", "trace")
+DEFAULT_SECONDS = 30.0
+# events kept by a trace capture, later ones are not traced
+TRACE_EVENTS = 10000
+DEFAULT_MEMORY_DIFFS = 5
+MEMORY_TOP = 25
+MEMORY_FRAMES = 10
+# time the profile is given for running handlers to return
+DUMP_WAIT = 5.0
+
+# active captures, None when disabled
+PROFILE = None
+TRACE = None
+
+_LOG = logging.getLogger(__name__)
+
+
+def _output_path(directory, kind, suffix):
+    return os.path.join(directory, "nts_{}_{}_{}.{}".format(
+        kind, os.getpid(), time.strftime("%Y%m%dT%H%M%S"), suffix))
+
+
+class ProfileCapture():
+    """ cProfile of the thread which started it and of the calls run through it """
+    def __init__(self):
+        self._main = cProfile.Profile()
+        self._profiles = {}
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        """ profile the calling thread """
+        self._main.enable()
+
+    def runcall(self, func, *args):
+        """ run func(*args) profiled on the calling thread """
+        thread_id = threading.get_ident()
+        with self._cond:
+            profile = self._profiles.get(thread_id)
+            if profile is None:
+                profile = self._profiles[thread_id] = cProfile.Profile()
+            self._running += 1
+        try:
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler holds the interpreter hooks, run unprofiled
+                return func(*args)
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def stop(self):
+        """ stop profiling the thread which started it """
+        self._main.disable()
+
+    def dump(self, path, timeout=DUMP_WAIT):
+        """ wait for running calls and write the merged profile to path """
+        with self._cond:
+            self._cond.wait_for(lambda: not self._running, timeout)
+            profiles = list(self._profiles.values())
+        stats = pstats.Stats(self._main)
+        for profile in profiles:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+class EventTrace():
+    """ times of the steps taken by the events handled """
+    def __init__(self, max_events=TRACE_EVENTS):
+        self.max_events = max_events
+        self._events = []
+        self._current = {}
+        self._lock = threading.Lock()
+
+    def begin(self, handler, sandbox_id, pod_name, event):
+        """ start the trace of the event about to be handled """
+        time_nano = event.get('timeNano')
+        record = {"handler": handler, "sandbox": sandbox_id, "pod": pod_name,
+                  "action": event['Action'],
+                  "event_time": time_nano / 1e9 if time_nano else None,
+                  "steps": []}
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                return
+            self._events.append(record)
+            self._current[(handler, sandbox_id)] = record
+        self.step(handler, sandbox_id, "queued")
+
+    def step(self, handler, sandbox_id, step):
+        """ record the step of the event being handled for the sandbox """
+        now = time.time()
+        with self._lock:
+            record = self._current.get((handler, sandbox_id))
+            if record is not None:
+                record["steps"].append((step, now))
+
+    def dump(self, path):
+        """ write the traced events as JSON lines, step times in ms after the event """
+        with self._lock:
+            events = list(self._events)
+        with open(path, "w") as trace_file:
+            for record in events:
+                start = record["event_time"] or (record["steps"][0][1] if record["steps"]
+                                                 else 0)
+                entry = dict(record)
+                entry["steps"] = [[step, round((at - start) * 1e3, 3)]
+                                  for step, at in record["steps"]]
+                trace_file.write(json.dumps(entry, sort_keys=True) + "\n")
+        return len(events)
+
+
+def trace_step(handler, sandbox_id, step):
+    """ record the step of the event handled for the sandbox when tracing """
+    trace = TRACE
+    if trace is not None:
+        trace.step(handler, sandbox_id, step)
+
+def profiled(func):
+    """ func, run through the active profile capture if any """
+    profile = PROFILE
+    if profile is None:
+        return func
+    return lambda *args: profile.runcall(func, *args)
+
+
+class DebugHooks():
+    """ captures toggled by SIGUSR1 and memory snapshots taken on SIGUSR2
+
+    SIGUSR1 starts a capture of seconds, a second SIGUSR1 ends it early.
+    Captures profile the event reader and the handlers with cProfile and
+    record the time of each step of the events handled. SIGUSR2 starts
+    tracemalloc, the following ones write the allocations grown since the
+    previous snapshot and the first one, until memory_diffs were written.
+    Results go to directory. When nothing is captured, a hook costs a
+    global lookup.
+    """
+    def __init__(self, directory, seconds=DEFAULT_SECONDS, captures=CAPTURES,
+                 memory_diffs=DEFAULT_MEMORY_DIFFS):
+        self.directory = directory
+        self.seconds = seconds
+        self.captures = captures
+        self.memory_diffs = memory_diffs
+        self._first = None
+        self._previous = None
+        self._diffs = 0
+        self._memory_lock = threading.Lock()
+        self.stats = {"profiles": 0, "traces": 0, "memory_snapshots": 0}
+
+    def install(self):
+        """ handle SIGUSR1, SIGUSR2 and SIGALRM, called from the main thread """
+        signal.signal(signal.SIGUSR1, self._toggle_capture)
+        signal.signal(signal.SIGALRM, self._end_capture)
+        signal.signal(signal.SIGUSR2, self._memory_snapshot)
+
+    def _toggle_capture(self, signum, frame): # pylint: disable=unused-argument
+        if PROFILE is not None or TRACE is not None:
+            self.stop_capture()
+        else:
+            self.start_capture()
+
+    def _end_capture(self, signum, frame): # pylint: disable=unused-argument
+        self.stop_capture()
+
+    def start_capture(self):
+        """ start the captures for the configured time, on the main thread """
+        global PROFILE, TRACE # pylint: disable=global-statement
+        if "profile" in self.captures:
+            profile = ProfileCapture()
+            profile.start()
+            PROFILE = profile
+        if "trace" in self.captures:
+            TRACE = EventTrace()
+        signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        _LOG.info("Capturing %s for %ss", ", ".join(self.captures), self.seconds)
+
+    def stop_capture(self):
+        """ stop the captures and write them in the background, on the main thread """
+        global PROFILE, TRACE # pylint: disable=global-statement
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        profile, trace = PROFILE, TRACE
+        PROFILE = TRACE = None
+        if profile is None and trace is None:
+            return
+        if profile is not None:
+            profile.stop()
+        thread = threading.Thread(target=self._write_capture, args=(profile, trace),
+                                  name="debug-capture")
+        thread.daemon = True
+        thread.start()
+
+    def _write_capture(self, profile, trace):
+        try:
+            if profile is not None:
+                path = _output_path(self.directory, "profile", "pstats")
+                profile.dump(path)
+                self.stats["profiles"] += 1
+                _LOG.info("Profile written to %s", path)
+            if trace is not None:
+                path = _output_path(self.directory, "trace", "jsonl")
+                events = trace.dump(path)
+                self.stats["traces"] += 1
+                _LOG.info("Trace of %s events written to %s", events, path)
+        except OSError as err:
+            _LOG.error("Failed to write the capture: %s", err)
+
+    def _memory_snapshot(self, signum, frame): # pylint: disable=unused-argument
+        thread = threading.Thread(target=self.memory_snapshot, name="debug-memory")
+        thread.daemon = True
+        thread.start()
+
+    def memory_snapshot(self):
+        """ start tracemalloc, or write the allocations grown since the previous snapshot """
+        with self._memory_lock:
+            self._memory_snapshot_locked()
+
+    def _memory_snapshot_locked(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_FRAMES)
+            self._first = self._previous = tracemalloc.take_snapshot()
+            self._diffs = 0
+            _LOG.info("Tracing memory allocations")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        self._diffs += 1
+        path = _output_path(self.directory, "memory", "txt")
+        try:
+            with open(path, "w") as memory_file:
+                current, peak = tracemalloc.get_traced_memory()
+                memory_file.write("traced {} bytes, peak {} bytes\n".format(current, peak))
+                for title, base in (("since the previous snapshot", self._previous),
+                                    ("since tracing started", self._first)):
+                    memory_file.write("\nTop {} allocations grown {}\n".format(MEMORY_TOP,
+                                                                               title))
+                    for stat in snapshot.compare_to(base, "traceback")[:MEMORY_TOP]:
+                        memory_file.write("{}\n".format(stat))
+                        for line in stat.traceback.format()[-2 * MEMORY_FRAMES:]:
+                            memory_file.write("    {}\n".format(line))
+        except OSError as err:
+            _LOG.error("Failed to write the memory snapshot: %s", err)
+        else:
+            self.stats["memory_snapshots"] += 1
+            _LOG.info("Memory snapshot %s of %s written to %s", self._diffs,
+                      self.memory_diffs, path)
+        self._previous = snapshot
+        if self.memory_diffs and self._diffs >= self.memory_diffs:
+            tracemalloc.stop()
+            self._first = self._previous = None
+            _LOG.info("Stopped tracing memory allocations")
+
+
+def add_options(parser):
+    """ add debug capture options to the parser """
+    parser.add_argument(
+        "--debug-dir", action="store", metavar="DIR", dest="debug_dir",
+        default=None,
+        help="Directory for profiles, traces and memory snapshots taken on SIGUSR1 and "
+        "SIGUSR2, the state directory by default")
+    parser.add_argument(
+        "--debug-seconds", action="store", metavar="SECONDS", dest="debug_seconds",
+        type=float, default=DEFAULT_SECONDS,
+        help="Length of the capture started by SIGUSR1")
+    parser.add_argument(
+        "--debug-capture", action="store", metavar="KIND[,KIND]", dest="debug_capture",
+        default=",".join(CAPTURES),
+        help="What SIGUSR1 captures ({})".format(", ".join(CAPTURES)))
+    parser.add_argument(
+        "--debug-memory-diffs", action="store", metavar="COUNT", dest="debug_memory_diffs",
+        type=int, default=DEFAULT_MEMORY_DIFFS,
+        help="Stop tracing memory after COUNT SIGUSR2 snapshots, never when 0")
+
+def install(options):
+    """ install the signal handlers of the options, returns the hooks """
+    captures = tuple(kind for kind in options.debug_capture.split(",") if kind)
+    unknown = set(captures) - set(CAPTURES)
+    if unknown:
+        raise ValueError("unknown capture {}".format(", ".join(sorted(unknown))))
+    hooks = DebugHooks(options.debug_dir or options.state_dir, options.debug_seconds,
+                       captures, options.debug_memory_diffs)
+    hooks.install()
+    return hooks
@@ -0,0 +1,326 @@
+# coding: utf-8
+""" docker events helpers """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import collections
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import deadlines
+import metrics
+import pod_selector
+
+DEFAULT_STATE_DIR = "/var/lib/appliance/nts"
+CURSOR_FLUSH_INTERVAL = 1.0
+RECONNECT_DELAY = 1.0
+SANDBOX_CACHE_SIZE = 256
+
+_LOG = logging.getLogger(__name__)
+
+# failures reaching docker; its API errors (404, 500) are requests.HTTPError,
+# an OSError as well, and are not retried
+_CONNECTION_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def sandbox_target(attributes, container_id, selector, pod_labels=None):
+    """ get (sandbox_id, pod_name) the container belongs to, None if it is not selected
+
+    attributes are the container labels plus its name, as reported in
+    docker event Actor attributes.
+    """
+    k8s_type = attributes.get(pod_selector.K8S_TYPE_LABEL)
+    if k8s_type is not None and k8s_type != 'container':
+        return None
+    if not selector.match(attributes, pod_labels):
+        _LOG.debug("%s is not selected, not processing.", attributes['name'])
+        return None
+    if k8s_type is None:
+        return container_id, attributes['name']
+    return attributes[pod_selector.K8S_SANDBOX_ID_LABEL], \
+        attributes[pod_selector.K8S_POD_NAME_LABEL]
+
+def event_target(event, sandboxes, selector):
+    """ get (sandbox_id, pod_name) the event is handled for, None if it is not
+
+    Destroy events only evict the container from the sandbox cache, pod
+    sandbox start events only record the pod labels. A plain docker
+    container which died is evicted as well, it gets a new network
+    namespace when it starts again.
+    """
+    if event['Type'] != 'container':
+        return None
+    if event['Action'] == 'destroy':
+        sandboxes.evict(event['Actor']['ID'])
+        return None
+    if sandbox_died(event):
+        sandboxes.evict(event['Actor']['ID'])
+    attributes = event['Actor']['Attributes']
+    if selector.uses_pod_labels and event['Action'] == 'start' and \
+            attributes.get(pod_selector.K8S_TYPE_LABEL) == 'podsandbox':
+        sandboxes.store_labels(event['Actor']['ID'], attributes)
+        return None
+    return sandbox_target(attributes, event['Actor']['ID'], selector, sandboxes.pod_labels)
+
+def sandbox_died(event):
+    """ check if the event is the death of a plain docker container
+
+    Such a container is its own sandbox and gets a new network namespace
+    when it starts again under the same ID, kubernetes ones are replaced by
+    a new sandbox instead.
+    """
+    return event['Type'] == 'container' and event['Action'] == 'die' and \
+        pod_selector.K8S_TYPE_LABEL not in event['Actor']['Attributes']
+
+def running_targets(docker_cli, selector):
+    """ map sandbox IDs of running containers passing the selector to pod names """
+    containers = docker_cli.containers.list(filters={"status": "running"})
+    pod_labels = {container.id: container.labels for container in containers
+                  if container.labels.get(pod_selector.K8S_TYPE_LABEL) == 'podsandbox'}
+    targets = {}
+    for container in containers:
+        attributes = dict(container.labels)
+        attributes['name'] = container.name
+        target = sandbox_target(attributes, container.id, selector,
+                                lambda sandbox_id: pod_labels.get(sandbox_id, {}))
+        if target is not None:
+            targets[target[0]] = target[1]
+    return targets
+
+def _get_container(docker_cli, container_id):
+    """ get container, a request failing at the docker deadline raises DeadlineExceeded
+
+    The deadline is the timeout of the docker client, see event_fanout.docker_connect().
+    """
+    start = time.monotonic()
+    try:
+        return docker_cli.containers.get(container_id)
+    except _CONNECTION_ERRORS as err:
+        limit = deadlines.timeout("docker")
+        if limit is not None and time.monotonic() - start >= limit:
+            raise deadlines.expired("docker", "inspect of {}".format(container_id)) from err
+        raise
+
+def inspect_sandbox(docker_cli, sandbox_id):
+    """ inspect sandbox container, returns its attrs
+
+    Connection failures and timeouts are retried, docker API errors are not,
+    like in SandboxCache.ns_path_async().
+    """
+    start = time.monotonic()
+    try:
+        sandbox = deadlines.call("docker", _get_container, docker_cli, sandbox_id,
+                                 retryable=_CONNECTION_ERRORS + (deadlines.DeadlineExceeded,))
+    except Exception:
+        metrics.observe_stage("docker_inspect", start, False)
+        raise
+    metrics.observe_stage("docker_inspect", start)
+    return sandbox.attrs
+
+def sandbox_ns_path(docker_cli, sandbox_id):
+    """ network namespace path of the sandbox """
+    return inspect_sandbox(docker_cli, sandbox_id)['NetworkSettings']['SandboxKey']
+
+def event_filters(actions, labels=None):
+    """ docker side events filters for container actions and label selectors """
+    filters = {"type": ["container"], "event": list(actions)}
+    if labels:
+        filters["label"] = list(labels)
+    return filters
+
+
+class SandboxCache():
+    """ bounded LRU cache of sandbox ID to network namespace path
+
+    All containers of a pod share the sandbox, so its inspection is done
+    once. Entries are evicted when the sandbox container is destroyed, or
+    dies for plain docker containers, and on_evict, if given, is called
+    with its namespace path. Kubernetes pod labels, only carried by the
+    sandbox, are kept the same way.
+    """
+    def __init__(self, docker_cli, size=SANDBOX_CACHE_SIZE, async_client=None, on_evict=None):
+        self.docker_cli = docker_cli
+        self.async_client = async_client
+        self.on_evict = on_evict
+        self.size = size
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._entries = collections.OrderedDict()
+        self._labels = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, sandbox_id):
+        with self._lock:
+            ip_ns_path = self._entries.get(sandbox_id)
+            if ip_ns_path is not None:
+                self._entries.move_to_end(sandbox_id)
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+            return ip_ns_path
+
+    def _store(self, sandbox_id, ip_ns_path):
+        if not ip_ns_path:
+            return
+        with self._lock:
+            self._entries[sandbox_id] = ip_ns_path
+            self._entries.move_to_end(sandbox_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def store_labels(self, sandbox_id, labels):
+        """ remember pod labels of the sandbox """
+        with self._lock:
+            self._labels[sandbox_id] = labels
+            self._labels.move_to_end(sandbox_id)
+            while len(self._labels) > self.size:
+                self._labels.popitem(last=False)
+
+    def pod_labels(self, sandbox_id):
+        """ pod labels of the sandbox, inspected when they were not seen
+
+        Blocks on docker when the sandbox started before the daemon.
+        """
+        with self._lock:
+            labels = self._labels.get(sandbox_id)
+            if labels is not None:
+                self._labels.move_to_end(sandbox_id)
+                return labels
+        try:
+            attrs = inspect_sandbox(self.docker_cli, sandbox_id)
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.error("Failed to inspect sandbox %s: %s", sandbox_id, err)
+            return {}
+        labels = attrs['Config']['Labels'] or {}
+        self.store_labels(sandbox_id, labels)
+        self._store(sandbox_id, attrs['NetworkSettings']['SandboxKey'])
+        return labels
+
+    def cached_ns_path(self, sandbox_id):
+        """ network namespace path of the sandbox if it is cached, None otherwise """
+        with self._lock:
+            return self._entries.get(sandbox_id)
+
+    def ns_path(self, sandbox_id):
+        """ network namespace path of the sandbox """
+        ip_ns_path = self._lookup(sandbox_id)
+        if ip_ns_path is None:
+            ip_ns_path = sandbox_ns_path(self.docker_cli, sandbox_id)
+            self._store(sandbox_id, ip_ns_path)
+        return ip_ns_path
+
+    async def ns_path_async(self, sandbox_id):
+        """ network namespace path of the sandbox, inspected with the asyncio client """
+        ip_ns_path = self._lookup(sandbox_id)
+        if ip_ns_path is None:
+            start = time.monotonic()
+            try:
+                sandbox = await deadlines.call_async(
+                    "docker", self.async_client.inspect, sandbox_id,
+                    # socket errors, async_core.DockerAPIError is not an OSError
+                    retryable=(OSError, deadlines.DeadlineExceeded),
+                    what="inspect of {}".format(sandbox_id))
+            except Exception:
+                metrics.observe_stage("docker_inspect", start, False)
+                raise
+            metrics.observe_stage("docker_inspect", start)
+            ip_ns_path = sandbox['NetworkSettings']['SandboxKey']
+            self._store(sandbox_id, ip_ns_path)
+        return ip_ns_path
+
+    def evict(self, sandbox_id):
+        """ drop the sandbox entry """
+        with self._lock:
+            self._labels.pop(sandbox_id, None)
+            ip_ns_path = self._entries.pop(sandbox_id, None)
+            if ip_ns_path is not None:
+                self.stats["evictions"] += 1
+        if ip_ns_path is not None and self.on_evict is not None:
+            self.on_evict(ip_ns_path)
+
+
+class EventCursor():
+    """ persisted position in the docker event stream
+
+    Keeps timeNano of the last event read and writes it to a file at most
+    every flush_interval seconds, so a resumed stream starts where the
+    previous one stopped.
+    """
+    def __init__(self, path, flush_interval=CURSOR_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.position = None
+        self._flushed = None
+        self._flush_time = 0.0
+
+    def load(self):
+        """ load position from the file, returns it or None """
+        try:
+            with open(self.path) as cursor_file:
+                self.position = int(cursor_file.read().strip())
+        except (OSError, ValueError) as err:
+            _LOG.debug("No events cursor loaded from %s: %s", self.path, err)
+            return None
+        self._flushed = self.position
+        return self.position
+
+    def since(self):
+        """ position in docker API 'since' format """
+        if self.position is None:
+            return None
+        return "{}.{:09d}".format(self.position // 10**9, self.position % 10**9)
+
+    def seen(self, event):
+        """ check if event was already read """
+        time_nano = event.get('timeNano')
+        return time_nano is not None and self.position is not None and \
+            time_nano <= self.position
+
+    def update(self, event):
+        """ move position to the event """
+        time_nano = event.get('timeNano')
+        if time_nano is None:
+            return
+        self.position = time_nano
+        now = time.monotonic()
+        if now - self._flush_time >= self.flush_interval:
+            self.flush()
+            self._flush_time = now
+
+    def reset_now(self):
+        """ move position to the current time, without flushing """
+        self.position = int(time.time() * 10**9)
+
+    def flush(self):
+        """ write position to the file """
+        if self.position is None or self.position == self._flushed:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as cursor_file:
+                cursor_file.write(str(self.position))
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            _LOG.error("Failed to save events cursor to %s: %s", self.path, err)
+            return
+        self._flushed = self.position
+
+
+def follow_events(docker_cli, cursor, reconnect_delay=RECONNECT_DELAY, **kwargs):
+    """ yield docker events, resuming from the cursor when the stream breaks """
+    while True:
+        try:
+            for event in docker_cli.events(decode=True, since=cursor.since(), **kwargs):
+                if cursor.seen(event):
+                    continue
+                yield event
+                cursor.update(event)
+            _LOG.warning("Docker events stream ended, resuming")
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.error("Docker events stream error %s, resuming", err)
+        cursor.flush()
+        time.sleep(reconnect_delay)
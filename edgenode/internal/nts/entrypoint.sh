@@ -7,9 +7,9 @@
 NTS_SOCKET0_MEM="${NTS_SOCKET0_MEM:-2048}"
 NTS_SOCKET1_MEM="${NTS_SOCKET1_MEM:-2048}"
 sigterm_handler() {
-    if [ "${kni_pid}" -ne 0 ]; then
-        kill -SIGTERM "${kni_pid}"
-        wait "${kni_pid}"
+    if [ "${daemon_pid}" -ne 0 ]; then
+        kill -SIGTERM "${daemon_pid}"
+        wait "${daemon_pid}"
     fi
 
     if [ "${nts_pid}" -ne 0 ]; then
@@ -34,13 +34,39 @@ exec ./nes-daemon \
     /var/lib/appliance/nts/nts.cfg &
 nts_pid="$!"
 
-exec ./kni_docker_daemon.py \
-    --library ./libnes_api_shared.so \
-    --config /var/lib/appliance/nts/nts.cfg &
-kni_pid="$!"
+# restart the daemon when its watchdog found it stalled (exit status 75)
+run_daemon() {
+    local pid=0
+    trap '[ "${pid}" -ne 0 ] && kill -SIGTERM "${pid}" && wait "${pid}"; exit 143' SIGTERM
+    while true; do
+        ./nts_docker_daemon.py "$@" &
+        pid="$!"
+        wait "${pid}"
+        status="$?"
+        if [ "${status}" -ne 75 ]; then
+            exit "${status}"
+        fi
+        echo "nts_docker_daemon stalled, restarting it"
+    done
+}
 
-exec ./ovs_docker_daemon.py \
-    --bridge "${OVS_BRIDGE_NAME}" \
-    --enable "${OVS_ENABLED}" &
+# one docker event stream for the KNI and the OvS interfaces
+daemon_args=(--kni --library ./libnes_api_shared.so --config /var/lib/appliance/nts/nts.cfg)
+# threaded handlers can not be cancelled at the event deadline, a slow docker daemon
+# keeps them busy long enough to look stalled, so restarting stalled ones is opt-in
+if [ "${NTS_WATCHDOG_RESTART,,}" = "true" ]; then
+    daemon_args+=(--watchdog-restart)
+fi
+if [ "${OVS_ENABLED,,}" = "true" ]; then
+    daemon_args+=(--ovs --bridge "${OVS_BRIDGE_NAME}")
+    # veth attach profiles, selected by the nts.attach-profile container or pod label
+    OVS_ATTACH_PROFILES="${OVS_ATTACH_PROFILES:-/var/lib/appliance/nts/attach_profiles.json}"
+    if [ -f "${OVS_ATTACH_PROFILES}" ]; then
+        daemon_args+=(--attach-profiles "${OVS_ATTACH_PROFILES}"
+                      --attach-profile "${OVS_ATTACH_PROFILE:-plain}")
+    fi
+fi
+run_daemon "${daemon_args[@]}" &
+daemon_pid="$!"
 
 wait $nts_pid
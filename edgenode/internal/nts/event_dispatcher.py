@@ -0,0 +1,138 @@
+# coding: utf-8
+""" docker event dispatcher """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import logging
+import queue
+import threading
+import time
+import traceback
+import debug_hooks
+
+DEFAULT_WORKERS = 8
+DEFAULT_QUEUE_DEPTH = 64
+
+_LOG = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DispatcherStats():
+    """ dispatcher counters """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.backpressure_waits = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def record_wait(self, wait):
+        """ record time an event spent in the queue """
+        with self.lock:
+            self.processed += 1
+            self.queue_wait_total += wait
+            if wait > self.queue_wait_max:
+                self.queue_wait_max = wait
+
+    def as_dict(self):
+        """ snapshot of the counters """
+        with self.lock:
+            avg = self.queue_wait_total / self.processed if self.processed else 0.0
+            return {"submitted": self.submitted,
+                    "processed": self.processed,
+                    "failed": self.failed,
+                    "backpressure_waits": self.backpressure_waits,
+                    "queue_wait_avg": avg,
+                    "queue_wait_max": self.queue_wait_max}
+
+
+class EventDispatcher():
+    """ shard events by key onto a bounded pool of worker threads
+
+    Every key (sandbox ID) is always handled by the same worker, so events of
+    one sandbox are processed in the order they were submitted, while events
+    of different sandboxes are processed concurrently. Each worker has its own
+    bounded queue; submit() blocks when it is full, which stops reading the
+    docker event stream until workers catch up. running() tells for how long
+    the workers are busy, for the watchdog.
+    """
+    def __init__(self, handler, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH):
+        if workers < 1:
+            raise ValueError("number of workers must be positive")
+        self.handler = handler
+        self.stats = DispatcherStats()
+        self._queues = [queue.Queue(maxsize=queue_depth) for _ in range(workers)]
+        self._busy = [None] * workers
+        self._threads = []
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(index, work_queue),
+                                      name="event-worker-{}".format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self, index, work_queue):
+        """ worker loop """
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                work_queue.task_done()
+                return
+            enqueued, func, args = item
+            self.stats.record_wait(time.monotonic() - enqueued)
+            profile = debug_hooks.PROFILE
+            self._busy[index] = (time.monotonic(), threading.get_ident())
+            try:
+                if profile is None:
+                    func(*args)
+                else:
+                    profile.runcall(func, *args)
+            except Exception as err:  # pylint: disable=broad-except
+                with self.stats.lock:
+                    self.stats.failed += 1
+                _LOG.critical("Event handler error %s", err)
+                _LOG.critical("%s", traceback.format_exc())
+            finally:
+                self._busy[index] = None
+                work_queue.task_done()
+
+    def running(self):
+        """ (start time, thread ID) of the events being handled """
+        return [busy for busy in list(self._busy) if busy is not None]
+
+    def queue_depth(self):
+        """ number of events waiting in all queues """
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def submit(self, key, *args):
+        """ queue handler(*args) on the worker owning key """
+        self.submit_call(key, self.handler, *args)
+
+    def submit_call(self, key, func, *args):
+        """ queue func(*args) on the worker owning key """
+        work_queue = self._queues[hash(key) % len(self._queues)]
+        item = (time.monotonic(), func, args)
+        with self.stats.lock:
+            self.stats.submitted += 1
+        try:
+            work_queue.put_nowait(item)
+        except queue.Full:
+            with self.stats.lock:
+                self.stats.backpressure_waits += 1
+            _LOG.debug("Event queue for %s full, waiting", key)
+            work_queue.put(item)
+
+    def join(self):
+        """ wait until all queued events are processed """
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def stop(self):
+        """ process queued events and stop workers """
+        for work_queue in self._queues:
+            work_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
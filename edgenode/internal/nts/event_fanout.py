@@ -0,0 +1,361 @@
+# coding: utf-8
+""" docker events of the node fanned out to interface handlers """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import logging
+import os
+import signal
+import sys
+import traceback
+import docker
+import async_core
+import daemon_logging
+import deadlines
+import debug_hooks
+import docker_events
+import event_dispatcher
+import link_backend
+import metrics
+import pod_selector
+import sandbox_lifecycle
+
+_LOG = logging.getLogger(__name__)
+
+
+def signal_handler(signum, frame): # pylint: disable=unused-argument
+    """ signal handling function """
+    _LOG.info("Quiting")
+    sys.exit(0)
+
+def add_common_options(parser, log_path):
+    """ add options shared by all handlers to the parser """
+    daemon_logging.add_options(parser, log_path)
+    debug_hooks.add_options(parser)
+    deadlines.add_options(parser)
+    parser.add_argument(
+        "-f", "--filter", action="store", metavar="NAME_FILTER", dest="name_filter",
+        default="mec-app",
+        help="Only add interfaces to a POD which name starts with name_filter")
+    parser.add_argument(
+        "--select", action="append", metavar="KIND:VALUE", dest="selectors",
+        help="Add interfaces to containers matching the rule, may be given multiple "
+        "times; kinds: {} (default: prefix:NAME_FILTER, uuid, pod-prefix:{})"
+        .format(", ".join(pod_selector.KINDS), pod_selector.K8S_POD_PREFIX))
+    parser.add_argument(
+        "-w", "--workers", action="store", metavar="WORKERS", dest="workers",
+        type=int, default=event_dispatcher.DEFAULT_WORKERS,
+        help="Number of containers events processed concurrently by each handler")
+    parser.add_argument(
+        "-k", "--link-backend", action="store", metavar="BACKEND", dest="link_backend",
+        default="subprocess", choices=link_backend.BACKENDS,
+        help="Interface management backend ({})".format(", ".join(link_backend.BACKENDS)))
+    parser.add_argument(
+        "-d", "--state-dir", action="store", metavar="STATE_DIR", dest="state_dir",
+        default=docker_events.DEFAULT_STATE_DIR,
+        help="Directory for the daemon persistent state")
+    parser.add_argument(
+        "--no-reconcile", action="store_false", dest="reconcile",
+        help="Resume from the saved events cursor instead of reconciling running containers")
+    parser.add_argument(
+        "--label", action="append", metavar="LABEL", dest="labels",
+        help="Only receive events of containers with the label (key or key=value), "
+        "may be given multiple times")
+    parser.add_argument(
+        "--sandbox-cache", action="store", metavar="SIZE", dest="sandbox_cache",
+        type=int, default=docker_events.SANDBOX_CACHE_SIZE,
+        help="Number of cached sandbox network namespace paths")
+    parser.add_argument(
+        "--async", action="store_true", dest="async_mode",
+        help="Process events on an asyncio event loop instead of worker threads")
+    parser.add_argument(
+        "--max-inflight", action="store", metavar="COUNT", dest="max_inflight",
+        type=int, default=async_core.DEFAULT_MAX_INFLIGHT,
+        help="Maximum number of events processed at once by each handler in the asyncio mode")
+    parser.add_argument(
+        "--debounce", action="store", metavar="SECONDS", dest="debounce",
+        type=float, default=sandbox_lifecycle.DEFAULT_DEBOUNCE,
+        help="Coalesce events of a sandbox arriving within SECONDS into their net change")
+    parser.add_argument(
+        "-q", "--queue-depth", action="store", metavar="DEPTH", dest="queue_depth",
+        type=int, default=event_dispatcher.DEFAULT_QUEUE_DEPTH,
+        help="Maximum number of queued events per worker before reading events is paused")
+    parser.add_argument(
+        "-m", "--metrics", action="store", metavar="ADDRESS", dest="metrics_address",
+        default="",
+        help="Serve Prometheus metrics on HOST:PORT or on a unix socket path, "
+        "disabled by default")
+
+def setup_logger(options, title):
+    """ setup logger function """
+    return daemon_logging.setup(options, title)
+
+def docker_connect():
+    """ docker connect function, requests other than the event stream have the docker deadline """
+    docker_cli = docker.from_env(timeout=deadlines.timeout("docker"))
+    try:
+        docker_cli.ping()
+    except docker.errors.APIError as err:
+        _LOG.critical("Failed to connect to docker server\n %s", err)
+        return None
+    return docker_cli
+
+
+class Handler():
+    """ interface handler fed by the shared docker event stream
+
+    name prefixes the handler metrics and state files, actions are the
+    docker event actions it handles. Changes of a sandbox interface state
+    run handle_event(*event_args(...), previous=state), or the
+    handle_event_async coroutine in the asyncio mode, on the handler's own
+    dispatcher.
+    """
+    name = None
+    description = None
+    actions = ()
+    handle_event = None
+    handle_event_async = None
+
+    def __init__(self, options):
+        self.options = options
+
+    @staticmethod
+    def add_options(parser):
+        """ add options of the handler to the parser """
+
+    def start(self, link):
+        """ set up the handler using the link backend, returns False if it cannot run """
+        return True
+
+    def event_state(self, event):
+        """ interface state the event asks for, None if it is not handled """
+        raise NotImplementedError
+
+    def event_args(self, sandboxes, event, sandbox_id, pod_name):
+        """ handle_event arguments of the event """
+        raise NotImplementedError
+
+    def reconcile(self, sandboxes, selector, lifecycle):
+        """ sync interfaces with the running sandboxes, returns their number """
+        return 0
+
+    def started(self):
+        """ called once reconciled, before the events are followed """
+
+    def stop(self):
+        """ release handler resources """
+
+
+class EventFanout():
+    """ one docker event stream fanned out to handlers
+
+    Events are filtered and their sandboxes inspected once, through the
+    shared SandboxCache. Each handler has its own sandbox lifecycle and
+    dispatcher, given in routes as (handler, lifecycle), so the failures
+    and the slowness of one handler do not reach the others, except for
+    backpressure pausing the shared stream.
+    """
+    def __init__(self, sandboxes, selector, routes):
+        self.sandboxes = sandboxes
+        self.selector = selector
+        self.routes = routes
+        self.actions = tuple(sorted(set(action for handler, _ in routes
+                                        for action in handler.actions)))
+
+    def targets(self, event):
+        """ (handler, lifecycle, state, sandbox_id, pod_name) of the handlers the event is for """
+        if event['Action'] == 'destroy':
+            for _, lifecycle in self.routes:
+                lifecycle.forget(event['Actor']['ID'])
+        elif docker_events.sandbox_died(event):
+            for _, lifecycle in self.routes:
+                lifecycle.died(event['Actor']['ID'])
+        target = docker_events.event_target(event, self.sandboxes, self.selector)
+        if target is None:
+            return []
+        targets = []
+        for handler, lifecycle in self.routes:
+            state = handler.event_state(event)
+            if state is not None:
+                targets.append((handler, lifecycle, state) + target)
+        return targets
+
+    def submit(self, event, handler, lifecycle, state, sandbox_id, pod_name):
+        """ pass the event on to the handler """
+        trace = debug_hooks.TRACE
+        if trace is not None:
+            trace.begin(handler.name, sandbox_id, pod_name, event)
+        try:
+            lifecycle.submit(sandbox_id, state,
+                             *handler.event_args(self.sandboxes, event, sandbox_id, pod_name))
+        except Exception as err:  # pylint: disable=broad-except
+            _LOG.error("%s handler failed to take %s event of %s: %s",
+                       handler.name, event['Action'], pod_name, err)
+
+    def flush(self):
+        """ dispatch changes waiting for their debounce window """
+        for _, lifecycle in self.routes:
+            lifecycle.flush()
+
+    def poll(self, cursor, labels=None):
+        """ docker poll function """
+        events = docker_events.follow_events(
+            self.sandboxes.docker_cli, cursor,
+            filters=docker_events.event_filters(self.actions, labels))
+
+        try:
+            for event in events:
+                try:
+                    for target in self.targets(event):
+                        self.submit(event, *target)
+                except (RuntimeError, KeyError) as err:
+                    _LOG.critical("Docker events error %s", err)
+                    _LOG.critical(traceback.format_exc())
+        finally:
+            self.flush()
+
+    async def poll_async(self, cursor, labels=None,
+                         max_pending=async_core.DEFAULT_MAX_INFLIGHT):
+        """ docker poll function for the asyncio mode """
+        events = async_core.follow_events(self.sandboxes.async_client, cursor,
+                                          docker_events.event_filters(self.actions, labels))
+
+        try:
+            async for event in events:
+                try:
+                    for target in self.targets(event):
+                        await target[1].dispatcher.wait_capacity(max_pending)
+                        self.submit(event, *target)
+                except (RuntimeError, KeyError) as err:
+                    _LOG.critical("Docker events error %s", err)
+                    _LOG.critical(traceback.format_exc())
+        finally:
+            self.flush()
+
+
+def main(options, handlers):
+    """ run handlers on the docker events of the node """
+    try:
+        selector = pod_selector.PodSelector(options.selectors) if options.selectors else \
+            pod_selector.PodSelector.legacy(options.name_filter)
+    except ValueError as err:
+        _LOG.critical("Invalid selector: %s", err)
+        return 1
+    try:
+        hooks = debug_hooks.install(options)
+    except ValueError as err:
+        _LOG.critical("Invalid debug capture: %s", err)
+        return 1
+    metrics.register_stats("nts_debug", "Debug captures", hooks.stats)
+    try:
+        deadlines.configure(options)
+    except ValueError as err:
+        _LOG.critical("Invalid timeout: %s", err)
+        return 1
+
+    link = link_backend.make_backend(options.link_backend, options.sandbox_cache)
+    started = []
+    try:
+        for handler in handlers:
+            if not handler.start(link):
+                _LOG.critical("Failed to start %s handler", handler.name)
+                return 1
+            started.append(handler)
+        return run(options, handlers, selector, link)
+    finally:
+        for handler in reversed(started):
+            handler.stop()
+        link.close()
+
+def run(options, handlers, selector, link):
+    """ follow the docker events with started handlers """
+    docker_cli = docker_connect()
+    if not docker_cli:
+        _LOG.info("Failed to connect do docker server")
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    routes = []
+    if options.async_mode:
+        loop = async_core.event_loop()
+        for handler in handlers:
+            dispatcher = async_core.AsyncDispatcher(handler.handle_event_async,
+                                                    options.max_inflight)
+            routes.append((handler, sandbox_lifecycle.SandboxLifecycle(
+                dispatcher, options.debounce, loop)))
+        sandboxes = docker_events.SandboxCache(docker_cli, options.sandbox_cache,
+                                               async_core.AsyncDockerClient(),
+                                               link.forget_netns)
+    else:
+        for handler in handlers:
+            dispatcher = event_dispatcher.EventDispatcher(handler.handle_event, options.workers,
+                                                          options.queue_depth)
+            routes.append((handler, sandbox_lifecycle.SandboxLifecycle(dispatcher,
+                                                                       options.debounce)))
+        sandboxes = docker_events.SandboxCache(docker_cli, options.sandbox_cache,
+                                               on_evict=link.forget_netns)
+    fanout = EventFanout(sandboxes, selector, routes)
+
+    metrics.QUEUE_DEPTH.set_function(
+        lambda: sum(lifecycle.dispatcher.queue_depth() for _, lifecycle in routes))
+    for handler, lifecycle in routes:
+        metrics.register_stats("nts_{}_events".format(handler.name),
+                               "Docker events dispatcher of the {} handler".format(handler.name),
+                               lifecycle.dispatcher.stats.as_dict)
+        metrics.register_stats("nts_{}_lifecycle".format(handler.name),
+                               "Sandbox interface lifecycle of the {} handler".format(
+                                   handler.name),
+                               lifecycle.stats)
+    metrics.register_stats("nts_sandbox_cache", "Sandbox cache", sandboxes.stats)
+    metrics.register_stats("nts_log", "Log records", daemon_logging.stats)
+    if options.link_backend == link_backend.NetlinkLinkBackend.name:
+        metrics.register_stats("nts_netns", "Open network namespace files", link.netns.snapshot)
+    if options.metrics_address:
+        metrics.start_server(options.metrics_address)
+    watchdog = None
+    if options.watchdog > 0:
+        watchdog = deadlines.Watchdog(options.watchdog, options.watchdog_restart)
+        if not options.async_mode:
+            for handler, lifecycle in routes:
+                watchdog.watch(handler.name, lifecycle.dispatcher.running)
+        metrics.register_stats("nts_watchdog", "Stall watchdog", watchdog.stats)
+
+    cursor = docker_events.EventCursor(os.path.join(
+        options.state_dir, "_".join(handler.name for handler in handlers) + "_events.cursor"))
+    if options.reconcile:
+        cursor.reset_now()
+        for handler, lifecycle in routes:
+            synced = handler.reconcile(sandboxes, selector, lifecycle)
+            _LOG.info("Reconciling %s running sandboxes for the %s handler", synced, handler.name)
+    else:
+        cursor.load()
+    for handler in handlers:
+        handler.started()
+
+    _LOG.info("[Started]")
+    _LOG.info("Waiting for containers events")
+    if watchdog is not None:
+        watchdog.start()
+    try:
+        if options.async_mode:
+            async_core.run(fanout.poll_async(cursor, options.labels,
+                                             options.max_inflight + options.queue_depth),
+                           [lifecycle.dispatcher for _, lifecycle in routes],
+                           watchdog=watchdog)
+        else:
+            try:
+                fanout.poll(cursor, options.labels)
+            finally:
+                for _, lifecycle in routes:
+                    lifecycle.stop()
+                    lifecycle.dispatcher.stop()
+    finally:
+        if watchdog is not None:
+            watchdog.stop()
+        cursor.flush()
+        _LOG.info("Sandbox cache stats: %s", sandboxes.stats)
+        for handler, lifecycle in routes:
+            _LOG.info("%s events stats: %s", handler.name, lifecycle.dispatcher.stats.as_dict())
+            _LOG.info("%s lifecycle stats: %s", handler.name, lifecycle.stats)
+    return 0
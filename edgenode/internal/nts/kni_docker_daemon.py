@@ -6,36 +6,63 @@
 
 import argparse
 import logging
-import subprocess
 import os
 import configparser
 import ctypes
 import signal
 import sys
-import traceback
-import re
-import docker
+import select
+import socket
+import struct
+import threading
+import time
+import collections
+import contextlib
+import async_core
+import attachment_store
+import daemon_logging
+import deadlines
+import debug_hooks
+import docker_events
+import event_fanout
+import kni_pool
+import link_backend
+import metrics
+import nes_client
+import nes_kni_batch
+import nes_routes
+import nes_stats
+import sandbox_lifecycle
 
 NES_SUCCESS = 0
 NES_FAIL = 1
 KNI_NAMESIZE = 32
-_HOST_NS = "/var/run/docker/netns/default"
-_HOST_NS_MNT = "/var/host_ns/mnt"
-
-_LOG = None
-
-def signal_handler():
-    """ signal handling function"""
-    _LOG.info("Quiting")
-    sys.exit(0)
+KNI_IF_PREFIX = "vEth"
+# die only tells that a restarted container needs its interface again
+EVENT_ACTIONS = ("start", "kill", "die", "destroy")
+NES_REMOTE_INVALID = nes_kni_batch.NES_REMOTE_INVALID
+NES_REMOTE_CONNECTED = nes_kni_batch.NES_REMOTE_CONNECTED
+NES_REMOTE_DISCONNECTED = nes_kni_batch.NES_REMOTE_DISCONNECTED
+NES_POOL_SIZE = 4
+NES_CLIENTS = ("library", "python")
+
+_LOG = logging.getLogger(__name__)
+_LINK = None
+_ALINK = None
+_STORE = None
+_POOL = None
+_KNI_CAPACITY = {"max": 0, "exhausted": 0}
 
 class NesContext():
-    """ context """
-    def __init__(self, lib, cfg_path):
+    """ context, without lib NES is reached through the protocol clients """
+    def __init__(self, lib, cfg_path, unix_sock_path, pool_size=NES_POOL_SIZE):
         self.lib = lib
         self.cfg_path = cfg_path
-        self.conn = None
-        self.conn_ptr = None
+        self.pool = NesConnectionPool(lib, unix_sock_path, pool_size,
+                                      deadlines.timeout("nes")) if lib else None
+        self.client = None
+        self.aclient = None
+        self.batcher = None
 
 class NesRemoteT(ctypes.Structure):
     """ remote """
@@ -47,285 +74,815 @@ class NesRemoteT(ctypes.Structure):
                 ("on_connection_closed", ctypes.c_void_p),
                 ("on_error", ctypes.c_void_p)]
 
+class NesConnectionPool():
+    """ pool of long-lived NES control sessions
+
+    Sessions are opened lazily, handed out one per caller and returned to the
+    pool after use, so consecutive KNI operations reuse an already connected
+    socket instead of paying for nes_conn_start/nes_conn_close every time.
+    A session found dead (e.g. after NES daemon restart) is dropped and
+    replaced by a fresh one. With a timeout, session socket calls fail once
+    NES does not answer for timeout seconds.
+    """
+    def __init__(self, lib, unix_sock_path, size, timeout=None):
+        self.lib = lib
+        self.unix_sock_path = ctypes.c_char_p(unix_sock_path.encode('utf-8'))
+        self.size = size
+        self.timeout = timeout
+        self.stats = {"connects": 0, "reuses": 0, "reconnects": 0, "failures": 0,
+                      "timeouts": 0}
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        """ open new session, returns None on failure """
+        conn = NesRemoteT()
+        try:
+            ret = self.lib.nes_conn_start(ctypes.byref(conn), self.unix_sock_path)
+        except RuntimeError as err:
+            _LOG.critical("nes_api library error\n %s", err)
+            ret = NES_FAIL
+        with self._lock:
+            if NES_SUCCESS != ret:
+                self.stats["failures"] += 1
+                return None
+            self.stats["connects"] += 1
+        if self.timeout is not None:
+            self._set_timeout(conn)
+        return conn
+
+    def _set_timeout(self, conn):
+        """ make the socket calls of the library on the session time out """
+        seconds = int(self.timeout)
+        value = struct.pack("ll", seconds, int((self.timeout - seconds) * 1e6))
+        try:
+            with socket.fromfd(conn.socket_fd, socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+        except OSError as err:
+            _LOG.warning("Failed to set timeout of NES session fd %s: %s", conn.socket_fd, err)
+
+    def expired(self, conn, start):
+        """ check if the failed call started at start ran into the timeout
+
+        The answer may still come, so the session is marked as broken.
+        """
+        if self.timeout is None or time.monotonic() - start < self.timeout:
+            return False
+        conn.state = NES_REMOTE_INVALID
+        with self._lock:
+            self.stats["timeouts"] += 1
+        _LOG.error("%s", deadlines.expired("nes", "NES call on session fd {}".format(
+            conn.socket_fd)))
+        return True
+
+    def _close(self, conn):
+        """ close session, errors are only logged
+
+        nes_conn_close() only closes the socket of a connected session, the
+        socket of a session the library or the pool found broken is closed
+        here. The session is left without socket, closing it again is a noop.
+        """
+        if conn.socket_fd < 0:
+            return
+        if conn.state == NES_REMOTE_CONNECTED:
+            try:
+                if NES_SUCCESS != self.lib.nes_conn_close(ctypes.byref(conn)):
+                    _LOG.debug("Failed to close nes session fd %s", conn.socket_fd)
+            except RuntimeError as err:
+                _LOG.critical("nes_api library error\n %s", err)
+        else:
+            try:
+                os.close(conn.socket_fd)
+            except OSError as err:
+                _LOG.debug("Failed to close nes session fd %s: %s", conn.socket_fd, err)
+        conn.socket_fd = -1
+        conn.state = NES_REMOTE_DISCONNECTED
+
+    @staticmethod
+    def is_alive(conn):
+        """ check if session is still usable
+
+        NES server never sends unsolicited data, so an idle socket which
+        polls readable or reports hang-up/error has been closed by the peer.
+        """
+        if conn.state != NES_REMOTE_CONNECTED or conn.socket_fd < 0:
+            return False
+        poller = select.poll()
+        poller.register(conn.socket_fd, select.POLLIN | select.POLLPRI)
+        try:
+            return not poller.poll(0)
+        except OSError:
+            return False
+
+    def acquire(self):
+        """ get connected session from the pool, returns None on failure """
+        self._slots.acquire()
+        conn = None
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+        if conn is not None:
+            if self.is_alive(conn):
+                with self._lock:
+                    self.stats["reuses"] += 1
+                return conn
+            _LOG.info("NES session fd %s is stale, reconnecting", conn.socket_fd)
+            self._close(conn)
+            with self._lock:
+                self.stats["reconnects"] += 1
+        conn = self._open()
+        if conn is None:
+            self._slots.release()
+        return conn
+
+    def release(self, conn, broken=False):
+        """ return session to the pool, broken sessions are closed """
+        if broken or conn.state != NES_REMOTE_CONNECTED:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append(conn)
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def session(self):
+        """ session context manager, yields None if NES is unreachable """
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            if conn is not None:
+                self.release(conn, broken=True)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.release(conn)
+
+    def call(self, func, *args):
+        """ run NES API function on a pooled session
+
+        The session is passed as the first argument. If the call fails and
+        the session turns out to be disconnected, the call is retried once
+        on a new session.
+        """
+        for attempt in range(2):
+            with self.session() as conn:
+                if conn is None:
+                    return NES_FAIL
+                start = time.monotonic()
+                ret = func(ctypes.byref(conn), *args)
+                if NES_SUCCESS != ret and self.expired(conn, start):
+                    # NES may be hung, not retried
+                    return ret
+                if NES_SUCCESS == ret or self.is_alive(conn):
+                    return ret
+                conn.state = NES_REMOTE_INVALID
+                if attempt == 0:
+                    with self._lock:
+                        self.stats["reconnects"] += 1
+                    _LOG.info("NES session lost, retrying on a new one")
+        return ret
+
+    def close(self):
+        """ close all idle sessions """
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            self._close(conn)
+
 def make_parser():
     """ make parser function """
-    log_levels = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
-    levels_str = "{0:s} or {1:s}".format(", ".join(log_levels[:-1]), log_levels[-1])
-
     parser = argparse.ArgumentParser()
-
-    parser.add_argument(
-        "-v", "--verbosity", action="store", metavar="LEVEL", dest="verbosity", default="INFO",
-        choices=log_levels,
-        help="Application diagnostic output verbosity ({0:s})".format(levels_str))
-    parser.add_argument(
-        "-c", "--config", action="store", metavar="CONFIG_PATH", dest="nes_cfg_path",
-        default="nes.cfg",
-        help="NEV SDK config file path")
-    parser.add_argument(
-        "-f", "--filter", action="store", metavar="NAME_FILTER", dest="name_filter",
-        default="mec-app",
-        help="Only add KNI interfaces to a POD which name starts with name_filter")
-    parser.add_argument(
-        "-l", "--library", action="store", metavar="LIB_PATH", dest="nes_api_lib_path",
-        default="../build/libnes_api_shared.so",
-        help="nes_api shared library file path")
-    parser.add_argument(
-        "-p", "--log-path", action="store", metavar="LOG_PATH", dest="log_path",
-        default="/var/log/nes_kni.log",
-        help="Log file path")
-
+    event_fanout.add_common_options(parser, "/var/log/nes_kni.log")
+    KniHandler.add_options(parser)
     return parser
 
 def setup_logger(options):
     """ setup logger function """
-    log_fmt = "KNI DAEMON: [%(levelname)s] %(module)s(%(lineno)d): %(message)s"
-    ts_fmt = "%Y-%m-%dT%H:%M:%S"
-
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(log_fmt, ts_fmt))
-    root_logger = logging.getLogger('')
-    root_logger.addHandler(handler)
-    root_logger.setLevel(options.verbosity)
-    return root_logger
+    return event_fanout.setup_logger(options, "KNI DAEMON")
 
 def nes_disconnect(nes_context):
     """ nes disconnect function """
-    try:
-        return NES_SUCCESS == nes_context.lib.nes_conn_close(nes_context.conn_ptr)
-    except RuntimeError as err:
-        _LOG.critical("nes_api library error\n {}" .format(err))
-        return False
+    if nes_context.batcher is not None:
+        nes_context.batcher.stop()
+    if nes_context.pool is not None:
+        nes_context.pool.close()
+    if nes_context.client is not None:
+        nes_context.client.close()
     return True
 
-def nes_lib_load(nes_api_lib_path, nes_cfg_path):
+def nes_read_ctrl_socket(nes_cfg_path):
+    """ read NES control socket path from the config file """
+    # Use ConfigParser with `strict` disabled as nes config file
+    # might contain duplicated keys(route) that are not used here
+    config = configparser.ConfigParser(strict=False)
+    config.read(nes_cfg_path)
+    try:
+        unix_sock_path = config['NES_SERVER']['ctrl_socket']
+        _LOG.debug("nes_api unix socket path: %s", unix_sock_path)
+    except KeyError as err:
+        _LOG.critical("Failed to get unix socket path\n %s", err)
+        return None
+    return unix_sock_path
+
+def nes_read_kni_max(nes_cfg_path):
+    """ read the maximum number of NES KNI devices from the config file, 0 if not set """
+    config = configparser.ConfigParser(strict=False)
+    config.read(nes_cfg_path)
+    try:
+        return int(config['KNI']['max'])
+    except (KeyError, ValueError) as err:
+        _LOG.debug("No KNI device limit in %s: %s", nes_cfg_path, err)
+        return 0
+
+def nes_lib_load(nes_api_lib_path, nes_cfg_path, pool_size=NES_POOL_SIZE):
     """ nes lib load function """
     if not os.path.isfile(nes_api_lib_path):
-        _LOG.critical("nes_api shared library file {} does not exist".format(nes_api_lib_path))
+        _LOG.critical("nes_api shared library file %s does not exist", nes_api_lib_path)
         return None
 
     if not os.path.isfile(nes_cfg_path):
-        _LOG.critical("NES config file {} does not exist".format(nes_cfg_path))
+        _LOG.critical("NES config file %s does not exist", nes_cfg_path)
+        return None
+
+    unix_sock_path = nes_read_ctrl_socket(nes_cfg_path)
+    if unix_sock_path is None:
         return None
 
     try:
-        nes_context = NesContext(ctypes.CDLL(nes_api_lib_path), nes_cfg_path)
-    except RuntimeError as err:
-        _LOG.critical("nes_api library error\n {}".format(err))
+        nes_context = NesContext(ctypes.CDLL(nes_api_lib_path), nes_cfg_path,
+                                 unix_sock_path, pool_size)
+    except (RuntimeError, OSError) as err:
+        _LOG.critical("nes_api library error\n %s", err)
         return None
     return nes_context
 
+def nes_client_load(nes_cfg_path, async_mode=False):
+    """ NES context speaking the control protocol itself, without nes_api """
+    if not os.path.isfile(nes_cfg_path):
+        _LOG.critical("NES config file %s does not exist", nes_cfg_path)
+        return None
 
-def nes_connect(nes_context):
-    """ new connect function """
-    unix_sock_path = ctypes.c_char_p()
-
-    if not os.path.isfile(nes_context.cfg_path):
-        _LOG.critical("NES config file {} does not exist".format(nes_context.cfg_path))
-        return False
-
-    # Use ConfigParser with `strict` disabled as nes config file
-    # might contain duplicated keys(route) that are not used here
-    config = configparser.ConfigParser(strict=False)
-    config.read(nes_context.cfg_path)
-    try:
-        unix_sock_path.value = config['NES_SERVER']['ctrl_socket'].encode('utf-8')
-        _LOG.debug("nes_api unix socket path: {}".format(unix_sock_path.value))
-    except KeyError as err:
-        _LOG.critical("Failed to get unix socket path\n {}".format(err))
-        return False
+    unix_sock_path = nes_read_ctrl_socket(nes_cfg_path)
+    if unix_sock_path is None:
+        return None
 
-    nes_context.conn = NesRemoteT()
-    nes_context.conn_ptr = ctypes.pointer(nes_context.conn)
-    try:
-        return NES_SUCCESS == nes_context.lib.nes_conn_start(nes_context.conn_ptr, unix_sock_path)
-    except RuntimeError as err:
-        _LOG.critical("nes_api library error\n {}".format(err))
-        return False
-    return True
+    nes_context = NesContext(None, nes_cfg_path, unix_sock_path)
+    nes_context.client = nes_client.NesClient(unix_sock_path, deadlines.timeout("nes"))
+    if async_mode:
+        nes_context.aclient = nes_client.AsyncNesClient(unix_sock_path,
+                                                        deadlines.timeout("nes"))
+    return nes_context
 
-def docker_connect():
-    """ docker connect function """
-    docker_cli = docker.from_env()
-    try:
-        docker_cli.ping()
-    except docker.errors.APIError as err:
-        _LOG.critical("Failed to connect to docker server\n {}".format(err))
-        return None
-    return docker_cli
+def routes_reload_handler(route_manager, routes_path, prune):
+    """ make SIGHUP handler applying the routes file in the background """
+    def handler(signum, frame): # pylint: disable=unused-argument
+        _LOG.info("Reloading NES routes from %s", routes_path)
+        thread = threading.Thread(target=route_manager.apply_file, args=(routes_path, prune),
+                                  name="nes-routes")
+        thread.daemon = True
+        thread.start()
+    return handler
 
 def modify_kni_interface(nes_context, dev_id, delete_if):
     """ modify kni interface function """
     ret = NES_FAIL
-
-    if not nes_connect(nes_context):
-        _LOG.info("Failed to connect do nes server")
-        return (ret, "")
-
-    try:
-        created_if_name = ctypes.create_string_buffer(KNI_NAMESIZE)
-        dev_id_name = ctypes.create_string_buffer(dev_id.encode('utf-8'))
-    except TypeError as err:
-        _LOG.critical("ctypes create_string_buffer error\n {}".format(err))
-        return (ret, "")
-
-    try:
-        if delete_if:
-            ret = nes_context.lib.nes_kni_del(nes_context.conn_ptr, dev_id_name, created_if_name)
-        else:
-            ret = nes_context.lib.nes_kni_add(nes_context.conn_ptr, dev_id_name, created_if_name)
-    except RuntimeError as err:
-        _LOG.critical("nes_api library error\n {}".format(err))
-
-    if not nes_disconnect(nes_context):
-        _LOG.info("Failed to disconnect from nes server")
-
-    return (ret, created_if_name.value.decode("utf-8"))
+    start = time.monotonic()
+    if nes_context.client is not None:
+        client = nes_context.client
+        ret, if_name = (client.kni_del if delete_if else client.kni_add)(dev_id)
+    elif nes_context.batcher is not None:
+        ret, if_name = nes_context.batcher.modify(dev_id, delete_if)
+    else:
+        try:
+            created_if_name = ctypes.create_string_buffer(KNI_NAMESIZE)
+            dev_id_name = ctypes.create_string_buffer(dev_id.encode('utf-8'))
+        except TypeError as err:
+            _LOG.critical("ctypes create_string_buffer error\n %s", err)
+            return (ret, "")
+        func = nes_context.lib.nes_kni_del if delete_if else nes_context.lib.nes_kni_add
+        try:
+            ret = nes_context.pool.call(func, dev_id_name, created_if_name)
+        except RuntimeError as err:
+            _LOG.critical("nes_api library error\n %s", err)
+        if_name = created_if_name.value.decode("utf-8")
+    metrics.observe_stage("nes_kni_del" if delete_if else "nes_kni_add", start,
+                          NES_SUCCESS == ret)
+
+    return (ret, if_name)
+
+async def modify_kni_interface_async(nes_context, dev_id, delete_if):
+    """ modify kni interface function for the asyncio mode """
+    if nes_context.aclient is None:
+        return await async_core.run_blocking(modify_kni_interface, nes_context, dev_id,
+                                             delete_if)
+    client = nes_context.aclient
+    start = time.monotonic()
+    ret, if_name = await (client.kni_del if delete_if else client.kni_add)(dev_id)
+    metrics.observe_stage("nes_kni_del" if delete_if else "nes_kni_add", start,
+                          NES_SUCCESS == ret)
+    return (ret, if_name)
 
 def add_kni_interface(nes_context, dev_id):
     """ add kni interface function """
     ret, if_name = modify_kni_interface(nes_context, dev_id, False)
     if NES_SUCCESS != ret:
-        _LOG.error("Failed to create the KNI inteface for {}".format(dev_id))
+        _LOG.error("Failed to create the KNI inteface for %s", dev_id)
 
-    _LOG.debug("Created KNI inteface {} for {}".format(if_name, dev_id))
+    _LOG.debug("Created KNI inteface %s for %s", if_name, dev_id)
     return if_name
 
 def del_kni_interface(nes_context, dev_id):
     """ delete kni interface function """
     ret, if_name = modify_kni_interface(nes_context, dev_id, True)
     if NES_SUCCESS != ret:
-        _LOG.error("Failed to remove the KNI inteface for {}".format(dev_id))
+        _LOG.error("Failed to remove the KNI inteface for %s", dev_id)
     else:
-        _LOG.debug("Removed KNI inteface {} for {}".format(if_name, dev_id))
+        _LOG.debug("Removed KNI inteface %s for %s", if_name, dev_id)
     return if_name
 
-def run_command(command, expected_output):
-    """ run command function """
-    try:
-        ret = subprocess.check_output(command).decode("utf-8")
-    except subprocess.CalledProcessError as err:
-        _LOG.error("\"{}\" failed[{}]: {}".format(' '.join(err.cmd), err.returncode, err.output))
-        return False
-    return expected_output in ret
+async def add_kni_interface_async(nes_context, dev_id):
+    """ add kni interface function for the asyncio mode """
+    ret, if_name = await modify_kni_interface_async(nes_context, dev_id, False)
+    if NES_SUCCESS != ret:
+        _LOG.error("Failed to create the KNI inteface for %s", dev_id)
+
+    _LOG.debug("Created KNI inteface %s for %s", if_name, dev_id)
+    return if_name
+
+async def del_kni_interface_async(nes_context, dev_id):
+    """ delete kni interface function for the asyncio mode """
+    ret, if_name = await modify_kni_interface_async(nes_context, dev_id, True)
+    if NES_SUCCESS != ret:
+        _LOG.error("Failed to remove the KNI inteface for %s", dev_id)
+    else:
+        _LOG.debug("Removed KNI inteface %s for %s", if_name, dev_id)
+    return if_name
+
+def check_kni_capacity():
+    """ report capacity exhaustion when NES may refuse a KNI device for lack of room """
+    if _KNI_CAPACITY["max"] and _STORE is not None and \
+            _STORE.snapshot()["records"] >= _KNI_CAPACITY["max"]:
+        _KNI_CAPACITY["exhausted"] += 1
+        _LOG.error("KNI capacity exhausted: all %s NES KNI devices are in use",
+                   _KNI_CAPACITY["max"])
+
+def kni_dev_id(pod_id):
+    """ NES device ID of the KNI interface of the sandbox, a pool one if it was pooled """
+    record = _STORE.get(pod_id) if _STORE is not None else None
+    return (record.get("dev_id") or pod_id) if record is not None else pod_id
+
+def create_kni_interface(nes_context, pod_id):
+    """ KNI interface for the sandbox, from the pool if enabled, returns (dev_id, if_name) """
+    if _POOL is None:
+        created_if = add_kni_interface(nes_context, pod_id)
+        if not created_if:
+            check_kni_capacity()
+        return pod_id, created_if
+    device = _POOL.acquire()
+    return device if device is not None else (None, "")
+
+async def create_kni_interface_async(nes_context, pod_id):
+    """ create KNI interface function for the asyncio mode """
+    if _POOL is not None:
+        return await async_core.run_blocking(create_kni_interface, nes_context, pod_id)
+    created_if = await add_kni_interface_async(nes_context, pod_id)
+    if not created_if:
+        check_kni_capacity()
+    return pod_id, created_if
+
+def remove_kni_interface(nes_context, pod_id):
+    """ delete KNI interface of the sandbox, returns its name """
+    dev_id = kni_dev_id(pod_id)
+    removed_if = del_kni_interface(nes_context, dev_id)
+    if removed_if and _POOL is not None:
+        _POOL.release(dev_id)
+    return removed_if
+
+async def remove_kni_interface_async(nes_context, pod_id):
+    """ remove KNI interface function for the asyncio mode """
+    dev_id = kni_dev_id(pod_id)
+    removed_if = await del_kni_interface_async(nes_context, dev_id)
+    if removed_if and _POOL is not None:
+        _POOL.release(dev_id)
+    return removed_if
 
 def move_if(dst_ip_ns_path, if_name):
     """ move if function """
-    command_prefix = ["ip",
-                      "link",
-                      "set",
-                      if_name,
-                      "netns"]
-
-    move_to_host = command_prefix + [_HOST_NS]
-
-    move_to_dst = ["nsenter",
-                   "--mount=" + _HOST_NS_MNT,
-                   "--net=" + _HOST_NS] + \
-                    command_prefix + \
-                    [dst_ip_ns_path]
-
-    if not run_command(move_to_host, ""):
-        _LOG.error("Failed to move {} to the default namespace".format(if_name))
-        return False
-    if not run_command(move_to_dst, ""):
-        _LOG.error("Failed to move {} to {} namespace".format(if_name, dst_ip_ns_path))
-        return False
-    return True
+    return _LINK.move_link(if_name, dst_ip_ns_path)
 
 def docker_create_if(nes_context, pod_id, ip_ns_path):
     """ docker create if function """
-    created_if = add_kni_interface(nes_context, pod_id)
+    dev_id, created_if = create_kni_interface(nes_context, pod_id)
     if not created_if:
-        _LOG.error("Failed to create an interface from {}, namespace[{}]"
-                   .format(pod_id, ip_ns_path))
+        _LOG.error("Failed to create an interface from %s, namespace[%s]", pod_id, ip_ns_path)
         return False
+    debug_hooks.trace_step(KniHandler.name, pod_id,
+                           "nes_kni_add" if _POOL is None else "kni_pool")
     if not move_if(ip_ns_path, created_if):
-        _LOG.error("Failed to move {} to {} namespace".format(created_if, ip_ns_path))
+        _LOG.error("Failed to move %s to %s namespace", created_if, ip_ns_path)
+        record_attachment(pod_id, ip_ns_path, created_if, None, dev_id)
         return False
-    _LOG.info("{} attached to {}, namespace[{}]".format(created_if, pod_id, ip_ns_path))
+    debug_hooks.trace_step(KniHandler.name, pod_id, "move_if")
+    record_attachment(pod_id, ip_ns_path, created_if, sandbox_lifecycle.ATTACHED, dev_id)
+    _LOG.info("%s attached to %s, namespace[%s]", created_if, pod_id, ip_ns_path)
     return True
 
 def docker_delete_if(nes_context, pod_id, ip_ns_path):
     """ docker delete if function """
-    removed_if = del_kni_interface(nes_context, pod_id)
+    removed_if = remove_kni_interface(nes_context, pod_id)
     if not removed_if:
-        _LOG.error("Failed to remove an interface for {}, namespace[{}]".format(pod_id, ip_ns_path))
+        _LOG.error("Failed to remove an interface for %s, namespace[%s]", pod_id, ip_ns_path)
+        if _STORE is not None and _STORE.get(pod_id) is not None:
+            _STORE.update(pod_id, state=None)
         return False
-    _LOG.info("{} removed from {}, namespace[{}]".format(removed_if, pod_id, ip_ns_path))
+    debug_hooks.trace_step(KniHandler.name, pod_id, "nes_kni_del")
+    if _STORE is not None:
+        _STORE.remove(pod_id)
+    _LOG.info("%s removed from %s, namespace[%s]", removed_if, pod_id, ip_ns_path)
     return True
 
-def filter_name(pod_name, name_filter):
-    """ filter name function """
-    ret = pod_name.startswith(name_filter)
-    if not ret:
-        _LOG.debug("{} name doesn't start with {}, not processing.".format(pod_name, name_filter))
-    return ret
+def record_attachment(pod_id, ip_ns_path, kni_if, state, dev_id=None):
+    """ save KNI interface of the sandbox, state None if it may not be attached
 
-def check_if_uuid(uuid_string):
-    """ check if uuid function """
-    regex = re.compile('^[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}$'
-                       , re.I)
-    return bool(regex.match(uuid_string))
+    dev_id is only recorded for pooled interfaces, others use the sandbox ID.
+    """
+    if _STORE is None:
+        return
+    if dev_id is not None and dev_id != pod_id:
+        _STORE.update(pod_id, netns=ip_ns_path, kni_if=kni_if, state=state, dev_id=dev_id)
+    else:
+        _STORE.update(pod_id, netns=ip_ns_path, kni_if=kni_if, state=state)
 
-def docker_poll(nes_context, docker_cli, name_filter):
-    """ docker poll function """
-    events = docker_cli.events(decode=True)
+def collect_attachment(nes_context, pod_id):
+    """ delete KNI interface of a sandbox which is gone
 
-    for event in events:
-        try:
-            if event['Type'] == 'container':
-
-                if 'io.kubernetes.docker.type' in event['Actor']['Attributes']:
-                    if event['Actor']['Attributes']['io.kubernetes.docker.type'] != 'container':
-                        continue
-                    sandbox_id = event['Actor']['Attributes']['io.kubernetes.sandbox.id']
-                    pod_name = event['Actor']['Attributes']['io.kubernetes.pod.name']
-                    if not filter_name(pod_name, "app"):
-                        continue
-                else:
-                    sandbox_id = event['Actor']['ID']
-                    pod_name = event['Actor']['Attributes']['name']
-                    if not filter_name(pod_name, name_filter) and not check_if_uuid(pod_name):
-                        continue
-
-                sandbox = docker_cli.containers.get(sandbox_id)
-                ip_ns_path = sandbox.attrs['NetworkSettings']['SandboxKey']
-
-                if event['Action'] == 'start':
-                    _LOG.debug("New container started {}".format(pod_name))
-                    del_kni_interface(nes_context, sandbox_id) # clear if already exists
-                    if not docker_create_if(nes_context, sandbox_id, ip_ns_path):
-                        _LOG.error("Failed to attach the interface to {}".format(pod_name))
-
-                elif event['Action'] == 'kill' and int(
-                        event['Actor']['Attributes']['signal']) == signal.SIGTERM:
-                    _LOG.debug("%s container stopped", pod_name)
-                    if not docker_delete_if(nes_context, sandbox_id, ip_ns_path):
-                        _LOG.error("Failed to remove the interface from {}".format(pod_name))
+    Its record is only dropped once NES deleted the interface, otherwise
+    it is kept for the next reconcile to try again.
+    """
+    return docker_delete_if(nes_context, pod_id, link_backend.HOST_NS)
 
-        except RuntimeError as err:
-            _LOG.critical("Docker events error {}".format(err))
-            _LOG.critical(traceback.format_exc())
+def probe_kni_interface(nes_context, dev_id):
+    """ delete KNI interface of dev_id if NES holds one, returns its name or None """
+    ret, if_name = modify_kni_interface(nes_context, dev_id, True)
+    return if_name if NES_SUCCESS == ret else None
+
+def event_state(event):
+    """ interface state the event asks for, None if it is not handled """
+    if event['Action'] == 'start':
+        return sandbox_lifecycle.ATTACHED
+    if event['Action'] == 'kill' and int(
+            event['Actor']['Attributes']['signal']) == signal.SIGTERM:
+        return sandbox_lifecycle.DETACHED
+    return None
+
+def handle_event(nes_context, sandboxes, event, sandbox_id, pod_name, previous=None):
+    """ handle event function, returns success """
+    log = daemon_logging.sandbox_log(_LOG, sandbox_id, pod_name)
+    debug_hooks.trace_step(KniHandler.name, sandbox_id, "started")
+    success = None
+
+    if event['Action'] == 'start':
+        ip_ns_path = sandboxes.ns_path(sandbox_id)
+        debug_hooks.trace_step(KniHandler.name, sandbox_id, "netns")
+        log.debug("New container started %s", pod_name)
+        if previous == sandbox_lifecycle.DETACHED:
+            metrics.OPERATIONS_SAVED.labels("defensive_delete").inc()
+        else:
+            remove_kni_interface(nes_context, sandbox_id) # clear if already exists
+        success = docker_create_if(nes_context, sandbox_id, ip_ns_path)
+        metrics.observe_event(event, success, KniHandler.name)
+        if not success:
+            log.error("Failed to attach the interface to %s", pod_name)
+
+    elif event['Action'] == 'kill' and int(
+            event['Actor']['Attributes']['signal']) == signal.SIGTERM:
+        log.debug("%s container stopped", pod_name)
+        # the namespace may be gone with the container, it is only logged
+        success = docker_delete_if(nes_context, sandbox_id,
+                                   sandboxes.cached_ns_path(sandbox_id))
+        metrics.observe_event(event, success, KniHandler.name)
+        if not success:
+            log.error("Failed to remove the interface from %s", pod_name)
+    debug_hooks.trace_step(KniHandler.name, sandbox_id, "done")
+    return success
+
+async def docker_create_if_async(nes_context, pod_id, ip_ns_path):
+    """ docker create if function for the asyncio mode """
+    dev_id, created_if = await create_kni_interface_async(nes_context, pod_id)
+    if not created_if:
+        _LOG.error("Failed to create an interface from %s, namespace[%s]", pod_id, ip_ns_path)
+        return False
+    debug_hooks.trace_step(KniHandler.name, pod_id,
+                           "nes_kni_add" if _POOL is None else "kni_pool")
+    if not await _ALINK.call("move_link", created_if, ip_ns_path):
+        _LOG.error("Failed to move %s to %s namespace", created_if, ip_ns_path)
+        record_attachment(pod_id, ip_ns_path, created_if, None, dev_id)
+        return False
+    debug_hooks.trace_step(KniHandler.name, pod_id, "move_if")
+    record_attachment(pod_id, ip_ns_path, created_if, sandbox_lifecycle.ATTACHED, dev_id)
+    _LOG.info("%s attached to %s, namespace[%s]", created_if, pod_id, ip_ns_path)
+    return True
 
+async def handle_event_async(nes_context, sandboxes, event, sandbox_id, pod_name,
+                             previous=None):
+    """ handle event function for the asyncio mode, returns success """
+    log = daemon_logging.sandbox_log(_LOG, sandbox_id, pod_name)
+    debug_hooks.trace_step(KniHandler.name, sandbox_id, "started")
+    success = None
+
+    if event['Action'] == 'start':
+        ip_ns_path = await sandboxes.ns_path_async(sandbox_id)
+        debug_hooks.trace_step(KniHandler.name, sandbox_id, "netns")
+        log.debug("New container started %s", pod_name)
+        if previous == sandbox_lifecycle.DETACHED:
+            metrics.OPERATIONS_SAVED.labels("defensive_delete").inc()
+        else:
+            await remove_kni_interface_async(nes_context, sandbox_id)
+        success = await docker_create_if_async(nes_context, sandbox_id, ip_ns_path)
+        metrics.observe_event(event, success, KniHandler.name)
+        if not success:
+            log.error("Failed to attach the interface to %s", pod_name)
+
+    elif event['Action'] == 'kill' and int(
+            event['Actor']['Attributes']['signal']) == signal.SIGTERM:
+        log.debug("%s container stopped", pod_name)
+        success = await async_core.run_blocking(docker_delete_if, nes_context, sandbox_id,
+                                                sandboxes.cached_ns_path(sandbox_id))
+        metrics.observe_event(event, success, KniHandler.name)
+        if not success:
+            log.error("Failed to remove the interface from %s", pod_name)
+    debug_hooks.trace_step(KniHandler.name, sandbox_id, "done")
+    return success
+
+def reconcile_sandbox(nes_context, sandboxes, lifecycle, sandbox_id, pod_name):
+    """ attach KNI interface to running sandbox unless it already has one """
+    ip_ns_path = sandboxes.ns_path(sandbox_id)
+    record = _STORE.get(sandbox_id) if _STORE is not None else None
+    if record is not None and record.get("state") == sandbox_lifecycle.ATTACHED and \
+            record.get("netns") == ip_ns_path:
+        _LOG.debug("%s has KNI interface %s", pod_name, record.get("kni_if"))
+        metrics.OPERATIONS_SAVED.labels("probe").inc()
+        lifecycle.set_state(sandbox_id, sandbox_lifecycle.ATTACHED)
+        return
+    links = _LINK.list_links(ip_ns_path)
+    if links is not None and any(name.startswith(KNI_IF_PREFIX) for name in links):
+        _LOG.debug("%s already has KNI interface", pod_name)
+        lifecycle.set_state(sandbox_id, sandbox_lifecycle.ATTACHED)
+        return
+    _LOG.info("Attaching missing KNI interface to %s", pod_name)
+    if handle_event(nes_context, sandboxes, {'Action': 'start'}, sandbox_id, pod_name):
+        lifecycle.set_state(sandbox_id, sandbox_lifecycle.ATTACHED)
+
+def reconcile(nes_context, sandboxes, selector, lifecycle):
+    """ reconcile KNI interfaces with containers running on the node
+
+    Running sandboxes without KNI interface get one, those recorded as
+    attached to their current namespace are not probed. Recorded sandboxes
+    which are gone have their KNI interface removed. NES does not tell which
+    device ID other KNI interfaces left in the host namespace belong to, so
+    while there are any, NES is asked to delete the interface of each
+    stopped sandbox. Pool interfaces are left to the pool. Afterwards
+    sandboxes not seen yet are known to have no KNI interface.
+    """
+    docker_cli = sandboxes.docker_cli
+    dispatcher = lifecycle.dispatcher
+    targets = docker_events.running_targets(docker_cli, selector)
+    for sandbox_id, pod_name in targets.items():
+        lifecycle.set_state(sandbox_id, None)
+        dispatcher.submit_call(sandbox_id, reconcile_sandbox, nes_context, sandboxes,
+                               lifecycle, sandbox_id, pod_name)
+    lifecycle.initial = sandbox_lifecycle.DETACHED
+
+    recorded = {}
+    for record in _STORE.records() if _STORE is not None else ():
+        recorded[record["id"]] = record.get("kni_if")
+        if record["id"] in targets:
+            continue
+        _LOG.info("Removing KNI interface %s of gone sandbox %s",
+                  record.get("kni_if"), record["id"])
+        dispatcher.submit_call(record["id"], collect_attachment, nes_context, record["id"])
+
+    host_links = _LINK.list_links(link_backend.HOST_NS)
+    if not host_links:
+        return len(targets)
+    known = set(recorded.values())
+    if _POOL is not None:
+        known.update(_POOL.if_names())
+    orphans = {name: mac for name, mac in host_links.items()
+               if name.startswith(KNI_IF_PREFIX) and name not in known}
+    if not orphans:
+        return len(targets)
+
+    for container in docker_cli.containers.list(all=True):
+        attributes = dict(container.labels)
+        attributes['name'] = container.name
+        target = docker_events.sandbox_target(attributes, container.id, selector,
+                                              sandboxes.pod_labels)
+        if target is None or target[0] in targets or target[0] in recorded:
+            continue
+        if_name = probe_kni_interface(nes_context, target[0])
+        if if_name is not None:
+            orphans.pop(if_name, None)
+            _LOG.info("Removed orphaned KNI interface %s of %s", if_name, target[1])
+        if not orphans:
+            break
+    for if_name, mac in orphans.items():
+        _LOG.warning("KNI interface %s [%s] has no known sandbox", if_name, mac)
+    return len(targets)
+
+class KniHandler(event_fanout.Handler):
+    """ NES KNI interfaces of the selected sandboxes """
+    name = "kni"
+    description = "NES KNI interfaces"
+    actions = EVENT_ACTIONS
+
+    def __init__(self, options):
+        event_fanout.Handler.__init__(self, options)
+        self.nes_context = None
+        self.sampler = None
+
+    @staticmethod
+    def add_options(parser):
+        """ add options of the handler to the parser """
+        parser.add_argument(
+            "-c", "--config", action="store", metavar="CONFIG_PATH", dest="nes_cfg_path",
+            default="nes.cfg",
+            help="NEV SDK config file path")
+        parser.add_argument(
+            "-l", "--library", action="store", metavar="LIB_PATH", dest="nes_api_lib_path",
+            default="../build/libnes_api_shared.so",
+            help="nes_api shared library file path")
+        parser.add_argument(
+            "--nes-client", action="store", metavar="CLIENT", dest="nes_client",
+            default="library", choices=NES_CLIENTS,
+            help="Talk to NES through the nes_api shared library or the built-in protocol "
+            "client, which needs no library and pipelines requests on one connection "
+            "({})".format(", ".join(NES_CLIENTS)))
+        parser.add_argument(
+            "-s", "--nes-sessions", action="store", metavar="SESSIONS", dest="nes_sessions",
+            type=int, default=NES_POOL_SIZE,
+            help="Maximum number of pooled NES control sessions")
+        parser.add_argument(
+            "--kni-batch", action="store", metavar="COUNT", dest="kni_batch",
+            type=int, default=0,
+            help="Send up to COUNT KNI requests back-to-back on one NES session, "
+            "disabled when 0")
+        parser.add_argument(
+            "--kni-batch-window", action="store", metavar="SECONDS", dest="kni_batch_window",
+            type=float, default=nes_kni_batch.DEFAULT_WINDOW,
+            help="Time a KNI request waits for others to join its batch")
+        parser.add_argument(
+            "--kni-pool", action="store", metavar="SIZE", dest="kni_pool",
+            type=int, default=0,
+            help="Keep up to SIZE KNI interfaces created ahead of container starts, within "
+            "the [KNI] max of the NES config. Disabled by default")
+        parser.add_argument(
+            "--kni-pool-low", action="store", metavar="COUNT", dest="kni_pool_low",
+            type=int, default=None,
+            help="Refill the KNI pool once fewer than COUNT interfaces are idle, half of its "
+            "size by default")
+        parser.add_argument(
+            "-t", "--stats-interval", action="store", metavar="SECONDS", dest="stats_interval",
+            type=float, default=0,
+            help="Sample NES device and ring statistics every SECONDS, disabled when 0")
+        parser.add_argument(
+            "--stats-history", action="store", metavar="SAMPLES", dest="stats_history",
+            type=int, default=nes_stats.DEFAULT_HISTORY,
+            help="Number of NES statistics samples kept in memory")
+        parser.add_argument(
+            "--stats-output", action="store", metavar="PATH", dest="stats_output",
+            default=None,
+            help="Append NES statistics rates as JSON lines to PATH")
+        parser.add_argument(
+            "-r", "--routes", action="store", metavar="ROUTES_PATH", dest="routes_path",
+            default=None,
+            help="Apply NES traffic routes from ROUTES_PATH (lines of MAC LOOKUP_KEYS) at "
+            "start and on SIGHUP")
+        parser.add_argument(
+            "--keep-routes", action="store_false", dest="routes_prune",
+            help="Do not remove NES routes missing from ROUTES_PATH")
+
+    def start(self, link):
+        """ load nes_api and the recorded attachments """
+        global _LINK, _ALINK, _POOL, _STORE # pylint: disable=global-statement
+        options = self.options
+        _LINK = link
+        _ALINK = link_backend.AsyncLinkBackend(_LINK)
+        _STORE = attachment_store.AttachmentStore(
+            os.path.join(options.state_dir, "kni_attachments.log"))
+        _LOG.info("Loaded %s recorded attachments", _STORE.load())
+        metrics.register_stats("nts_kni_attachments", "Recorded KNI sandbox attachments",
+                               _STORE.snapshot)
+
+        if options.nes_client == "python":
+            self.nes_context = nes_client_load(options.nes_cfg_path, options.async_mode)
+        else:
+            self.nes_context = nes_lib_load(options.nes_api_lib_path, options.nes_cfg_path,
+                                            options.nes_sessions)
+        if not self.nes_context:
+            _LOG.info("Failed to set up the %s NES client", options.nes_client)
+            return True
+        nes_context = self.nes_context
+        if nes_context.client is not None:
+            metrics.register_stats("nts_nes_client", "NES control protocol client",
+                                   nes_context.client.stats)
+            if nes_context.aclient is not None:
+                metrics.register_stats("nts_nes_async_client",
+                                       "NES control protocol client of the asyncio mode",
+                                       nes_context.aclient.stats)
+            if options.kni_batch > 0:
+                _LOG.info("KNI requests are pipelined by the NES client, not batching them")
+        else:
+            metrics.register_stats("nts_nes_sessions", "NES control sessions",
+                                   nes_context.pool.stats)
+        _KNI_CAPACITY["max"] = nes_read_kni_max(options.nes_cfg_path)
+        metrics.register_stats("nts_kni_capacity", "NES KNI device capacity", _KNI_CAPACITY)
+        pool_path = os.path.join(options.state_dir, "kni_pool.json")
+        in_use = [record.get("dev_id") or record["id"] for record in _STORE.records()]
+        if options.kni_pool > 0:
+            low = options.kni_pool_low
+            _POOL = kni_pool.KniPool(
+                options.kni_pool, max(1, options.kni_pool // 2) if low is None else low,
+                _KNI_CAPACITY["max"], lambda dev_id: add_kni_interface(nes_context, dev_id),
+                lambda dev_id: bool(del_kni_interface(nes_context, dev_id)),
+                in_use, pool_path)
+            metrics.register_stats("nts_kni_pool", "Warm KNI pool", _POOL.snapshot)
+        elif os.path.exists(pool_path):
+            _LOG.info("Deleted %s KNI interfaces of the disabled pool", kni_pool.reclaim(
+                pool_path, lambda dev_id: bool(del_kni_interface(nes_context, dev_id)), in_use))
+        if options.kni_batch > 0 and nes_context.client is None:
+            nes_context.batcher = nes_kni_batch.KniBatcher(nes_context.lib, nes_context.pool,
+                                                           options.kni_batch_window,
+                                                           options.kni_batch)
+            metrics.register_stats("nts_nes_kni_batch", "Batched NES KNI requests",
+                                   nes_context.batcher.stats)
+        if options.stats_interval > 0:
+            self.sampler = nes_stats.NesStatsSampler(nes_context.lib, nes_context.pool,
+                                                     options.stats_interval,
+                                                     options.stats_history,
+                                                     options.stats_output,
+                                                     nes_context.client)
+            metrics.REGISTRY.register(self.sampler)
+            self.sampler.start()
+        if options.routes_path:
+            route_manager = nes_routes.RouteManager(nes_context.lib, nes_context.pool,
+                                                    client=nes_context.client)
+            route_manager.apply_file(options.routes_path, options.routes_prune)
+            signal.signal(signal.SIGHUP, routes_reload_handler(
+                route_manager, options.routes_path, options.routes_prune))
+        return True
+
+    def event_state(self, event):
+        """ interface state the event asks for, None if it is not handled """
+        return event_state(event)
+
+    def event_args(self, sandboxes, event, sandbox_id, pod_name):
+        """ handle_event arguments of the event """
+        return (self.nes_context, sandboxes, event, sandbox_id, pod_name)
+
+    handle_event = staticmethod(handle_event)
+    handle_event_async = staticmethod(handle_event_async)
+
+    def reconcile(self, sandboxes, selector, lifecycle):
+        """ sync KNI interfaces with the running sandboxes, returns their number """
+        return reconcile(self.nes_context, sandboxes, selector, lifecycle)
+
+    def started(self):
+        """ fill the KNI pool once the interfaces are reconciled """
+        if _POOL is not None:
+            _POOL.fill()
+
+    def stop(self):
+        """ stop sampling and the KNI pool, close NES sessions and the attachments log """
+        if _POOL is not None:
+            _POOL.stop()
+            _LOG.info("KNI pool stats: %s", _POOL.snapshot())
+        if self.sampler is not None:
+            self.sampler.stop()
+            _LOG.info("NES statistics sampler stats: %s", self.sampler.stats)
+        if _STORE is not None:
+            _STORE.close()
+            _LOG.info("KNI attachments stats: %s", _STORE.snapshot())
+        if self.nes_context:
+            nes_disconnect(self.nes_context)
+            if self.nes_context.batcher is not None:
+                _LOG.info("KNI batch stats: %s", self.nes_context.batcher.stats)
+            if self.nes_context.client is not None:
+                _LOG.info("NES client stats: %s", self.nes_context.client.stats)
+            else:
+                _LOG.info("NES sessions stats: %s", self.nes_context.pool.stats)
 
 def main(options):
     """ main """
-    docker_cli = docker_connect()
-    if not docker_cli:
-        _LOG.info("Failed to connect do docker server")
-
-    signal.signal(signal.SIGINT, signal_handler)
-
-    nes_context = nes_lib_load(options.nes_api_lib_path, options.nes_cfg_path)
-    if not nes_context:
-        _LOG.info("Failed to load nes_api library")
+    return event_fanout.main(options, [KniHandler(options)])
 
-    _LOG.info("[Started]")
-    _LOG.info("Waiting for containers events")
-    docker_poll(nes_context, docker_cli, options.name_filter)
 
 if __name__ == '__main__':
     OPTIONS = make_parser().parse_args()
-    _LOG = setup_logger(OPTIONS)
+    setup_logger(OPTIONS)
     sys.exit(main(OPTIONS))
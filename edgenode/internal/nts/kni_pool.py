@@ -0,0 +1,312 @@
+# coding: utf-8
+""" pool of NES KNI interfaces created ahead of container starts """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import collections
+import json
+import logging
+import os
+import threading
+
+# pool device IDs are 12 hex digits, telling them apart from sandbox IDs
+POOL_DEV_PREFIX = "024b4e49"
+MAX_POOL_DEVICES = 0x10000
+# consecutive failed creations after which refilling waits for the next acquire
+MAX_CREATE_FAILURES = 3
+
+_LOG = logging.getLogger(__name__)
+
+
+def pool_dev_id(index):
+    """ NES device ID of pool device index """
+    return "{}{:04x}".format(POOL_DEV_PREFIX, index)
+
+def pool_index(dev_id):
+    """ index of a pool device ID, None if it is not one """
+    if not dev_id or len(dev_id) != len(POOL_DEV_PREFIX) + 4 or \
+            not dev_id.startswith(POOL_DEV_PREFIX):
+        return None
+    try:
+        return int(dev_id[len(POOL_DEV_PREFIX):], 16)
+    except ValueError:
+        return None
+
+def load_devices(state_path):
+    """ interface names by device ID saved to the state file of a pool, empty if there is none
+
+    Names of interfaces still being created are empty.
+    """
+    try:
+        with open(state_path) as state_file:
+            devices = json.load(state_file)
+    except (OSError, ValueError) as err:
+        _LOG.debug("No KNI pool state loaded from %s: %s", state_path, err)
+        return {}
+    if not isinstance(devices, dict):
+        return {}
+    return {dev_id: if_name for dev_id, if_name in devices.items()
+            if pool_index(dev_id) is not None}
+
+def reclaim(state_path, destroy, in_use=()):
+    """ delete the devices a pool left in NES and its state file, returns the number deleted
+
+    Used once the pool is disabled, the devices of in_use are kept.
+    """
+    reclaimed = 0
+    for dev_id in sorted(set(load_devices(state_path)) - set(in_use)):
+        if destroy(dev_id):
+            reclaimed += 1
+    try:
+        os.unlink(state_path)
+    except OSError:
+        pass
+    return reclaimed
+
+
+class KniPool():
+    """ KNI interfaces created by NES and parked in the host namespace
+
+    create(dev_id) asks NES for the KNI interface of a device ID and returns
+    its name, "" on failure; destroy(dev_id) deletes it and returns success.
+    Once fill() is called, a background thread fills the pool up to size
+    interfaces, and refills it whenever fewer than low are idle. An acquire
+    finding the pool empty creates the interface on the spot. Interfaces
+    are not reused: the sandbox's one is deleted on detach and release()
+    gives its capacity back.
+
+    NES holds at most capacity KNI devices ([KNI] max of its config), idle
+    and in use ones alike, so the pool is only filled as far as the devices
+    in use leave room for. in_use are the device IDs of interfaces already
+    given to sandboxes, pooled or not.
+
+    Device IDs idle or being created are saved to state_path with their
+    interface names. NES keeps
+    them when the daemon exits without stop(), so those left by an earlier
+    run are deleted by the background thread before it creates any.
+    """
+    def __init__(self, size, low, capacity, create, destroy, in_use=(), state_path=None):
+        self.size = size
+        self.low = low
+        self.capacity = capacity
+        self._create = create
+        self._destroy = destroy
+        self._idle = collections.deque()
+        self._in_use = set(in_use)
+        self._creating = set()
+        self._next_index = 0
+        self._cond = threading.Condition()
+        self._requested = False
+        self._stopping = False
+        self._limited = False
+        self.state_path = state_path
+        self._saved = None
+        self._leftover = {}
+        for dev_id, if_name in (load_devices(state_path) if state_path else {}).items():
+            if dev_id not in self._in_use:
+                self._leftover[dev_id] = if_name
+        self.stats = {"hits": 0, "misses": 0, "exhausted": 0, "created": 0,
+                      "create_failed": 0, "leftover": 0, "reclaimed": 0}
+        self._thread = threading.Thread(target=self._refill, name="kni-pool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def snapshot(self):
+        """ stats with the current number of idle and in use interfaces and the capacity """
+        with self._cond:
+            stats = dict(self.stats)
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = len(self._in_use)
+            stats["capacity"] = self.capacity
+        return stats
+
+    def if_names(self):
+        """ names of the idle interfaces, and of those left by an earlier run not deleted yet """
+        with self._cond:
+            return {device[1] for device in self._idle} | \
+                {if_name for if_name in self._leftover.values() if if_name}
+
+    def _save(self):
+        """ write the device IDs held by the pool to the state file, called with the lock held """
+        if self.state_path is None:
+            return
+        devices = dict(self._leftover)
+        devices.update((dev_id, "") for dev_id in self._creating)
+        devices.update(self._idle)
+        if devices == self._saved:
+            return
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as state_file:
+                json.dump(devices, state_file, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+            self._saved = devices
+        except OSError as err:
+            _LOG.error("Failed to save KNI pool state to %s: %s", self.state_path, err)
+
+    def _devices(self):
+        """ number of NES devices held or being created, called with the lock held """
+        return len(self._idle) + len(self._in_use) + len(self._creating) + len(self._leftover)
+
+    def _free(self):
+        """ number of devices NES may still create, called with the lock held """
+        return self.capacity - self._devices() if self.capacity else MAX_POOL_DEVICES
+
+    def _next_dev_id(self):
+        """ pool device ID not held, called with the lock held, None if all are """
+        taken = {device[0] for device in self._idle} | self._in_use | self._creating | \
+            set(self._leftover)
+        for _ in range(MAX_POOL_DEVICES):
+            dev_id = pool_dev_id(self._next_index)
+            self._next_index = (self._next_index + 1) % MAX_POOL_DEVICES
+            if dev_id not in taken:
+                return dev_id
+        return None
+
+    def acquire(self):
+        """ (device ID, interface name) of an idle or new interface, None on failure
+
+        The interface is accounted in use until released.
+        """
+        with self._cond:
+            while not self._idle and (self._creating or self._leftover) and \
+                    self._free() <= 0 and not self._stopping:
+                # the room left is taken by interfaces being created or deleted, wait
+                self._cond.wait()
+            device = self._idle.popleft() if self._idle else None
+            if len(self._idle) < self.low or device is None:
+                self._requested = True
+                self._cond.notify_all()
+            if device is not None:
+                self.stats["hits"] += 1
+                self._in_use.add(device[0])
+                self._save()
+                return device
+            self.stats["misses"] += 1
+            dev_id = self._next_dev_id() if self._free() > 0 else None
+            if dev_id is None:
+                self.stats["exhausted"] += 1
+                _LOG.error("KNI capacity exhausted: all %s NES KNI devices are in use",
+                           self.capacity)
+                return None
+            self._creating.add(dev_id)
+            self._save()
+        if_name = self._create(dev_id)
+        with self._cond:
+            self._creating.discard(dev_id)
+            self._cond.notify_all()
+            if if_name:
+                self.stats["created"] += 1
+                self._in_use.add(dev_id)
+            else:
+                self.stats["create_failed"] += 1
+            self._save()
+        return (dev_id, if_name) if if_name else None
+
+    def release(self, dev_id):
+        """ give back the capacity of the deleted interface of a device ID """
+        with self._cond:
+            self._in_use.discard(dev_id)
+            if self._limited and len(self._idle) < self.size:
+                self._requested = True
+                self._cond.notify_all()
+
+    def _wanted(self):
+        """ device IDs to create to fill the pool, called with the lock held """
+        missing = self.size - len(self._idle) - len(self._creating)
+        room = self._free()
+        limited = room < missing
+        if limited and not self._limited:
+            _LOG.warning("KNI capacity nearly exhausted: %s of %s NES KNI devices in use, "
+                         "%s idle in the pool", len(self._in_use), self.capacity,
+                         len(self._idle))
+        self._limited = limited
+        wanted = []
+        for _ in range(max(0, min(missing, room))):
+            dev_id = self._next_dev_id()
+            if dev_id is None:
+                break
+            self._creating.add(dev_id)
+            wanted.append(dev_id)
+        self._save()
+        return wanted
+
+    def _reclaim_leftover(self):
+        """ delete the devices left in NES by an earlier run """
+        with self._cond:
+            leftover = sorted(self._leftover)
+        if leftover:
+            _LOG.info("Deleting %s KNI pool interfaces left by an earlier run", len(leftover))
+        for dev_id in leftover:
+            if self._stopping:
+                return
+            # a failure means NES does not hold the device, it restarted meanwhile
+            destroyed = self._destroy(dev_id)
+            with self._cond:
+                self._leftover.pop(dev_id, None)
+                if destroyed:
+                    self.stats["leftover"] += 1
+                self._save()
+                self._cond.notify_all()
+
+    def _refill(self):
+        self._reclaim_leftover()
+        while True:
+            with self._cond:
+                while not self._stopping and not self._requested:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                self._requested = False
+                wanted = self._wanted()
+            failures = 0
+            for index, dev_id in enumerate(wanted):
+                if_name = "" if self._stopping else self._create(dev_id)
+                with self._cond:
+                    self._creating.discard(dev_id)
+                    self._cond.notify_all()
+                    if if_name:
+                        self.stats["created"] += 1
+                        self._idle.append((dev_id, if_name))
+                        failures = 0
+                    else:
+                        self._save()
+                        if not self._stopping:
+                            # NES may hold the device ID already, it is skipped next time
+                            self.stats["create_failed"] += 1
+                            failures += 1
+                if failures >= MAX_CREATE_FAILURES:
+                    _LOG.error("Failed to create %s KNI pool interfaces in a row, "
+                               "refilling paused", failures)
+                    with self._cond:
+                        self._creating.difference_update(wanted[index + 1:])
+                        self._save()
+                        self._cond.notify_all()
+                    break
+
+    def fill(self):
+        """ start filling up to size """
+        with self._cond:
+            self._requested = True
+            self._cond.notify_all()
+
+    def stop(self):
+        """ stop refilling and delete idle interfaces """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for dev_id, if_name in idle:
+            destroyed = self._destroy(dev_id)
+            with self._cond:
+                if destroyed:
+                    self.stats["reclaimed"] += 1
+                else:
+                    # kept in the state file to be deleted by the next run
+                    _LOG.warning("Failed to delete idle KNI pool interface %s", if_name)
+                    self._leftover[dev_id] = if_name
+                self._save()
+        _LOG.info("Reclaimed %s idle KNI interfaces", self.stats["reclaimed"])
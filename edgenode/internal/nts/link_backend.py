@@ -0,0 +1,724 @@
+# coding: utf-8
+""" network link backends """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import queue
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import async_core
+import deadlines
+import metrics
+
+HOST_NS = "/var/run/docker/netns/default"
+HOST_NS_MNT = "/var/host_ns/mnt"
+
+BACKENDS = ("subprocess", "netlink")
+# number of sandbox network namespace files kept open
+NETNS_CACHE_SIZE = 256
+
+_LOG = logging.getLogger(__name__)
+
+# rtnetlink constants, see linux/netlink.h, linux/rtnetlink.h and linux/if_link.h
+_NETLINK_ROUTE = 0
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_NLM_F_REQUEST = 0x1
+_NLM_F_ACK = 0x4
+_NLM_F_DUMP = 0x300
+_NLM_F_EXCL = 0x200
+_NLM_F_CREATE = 0x400
+_RTM_NEWLINK = 16
+_RTM_DELLINK = 17
+_RTM_GETLINK = 18
+_IFLA_ADDRESS = 1
+_IFLA_IFNAME = 3
+_IFLA_MTU = 4
+_IFLA_LINKINFO = 18
+_IFLA_NET_NS_FD = 28
+_IFLA_NUM_TX_QUEUES = 31
+_IFLA_NUM_RX_QUEUES = 32
+_IFLA_INFO_KIND = 1
+_IFLA_INFO_DATA = 2
+_VETH_INFO_PEER = 1
+_NLA_F_NESTED = 0x8000
+_IFF_UP = 0x1
+_AF_UNSPEC = 0
+
+_CLONE_NEWNET = 0x40000000
+_NS_GET_NSTYPE = 0xb703
+
+_NLMSGHDR = struct.Struct("=LHHLL")
+_IFINFOMSG = struct.Struct("=BxHiII")
+_RTATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+
+
+def _check_output(command):
+    """ command output, the command is killed at the command deadline """
+    try:
+        return subprocess.check_output(command, timeout=deadlines.timeout("command"))
+    except subprocess.TimeoutExpired:
+        raise deadlines.expired("command", "\"{}\"".format(' '.join(command))) from None
+
+def command_output(command, retry=False):
+    """ run command and return its output, None on failure
+
+    A command timing out is retried if retry is set, which only idempotent
+    commands may be.
+    """
+    retryable = (deadlines.DeadlineExceeded,) if retry else ()
+    try:
+        output = deadlines.call("command", _check_output, command, retryable=retryable)
+    except subprocess.CalledProcessError as err:
+        _LOG.error("\"%s\" failed[%s]: %s", ' '.join(err.cmd), err.returncode, err.output)
+        return None
+    except deadlines.DeadlineExceeded as err:
+        _LOG.error("%s", err)
+        return None
+    except OSError as err:
+        _LOG.error("Failed to run \"%s\": %s", ' '.join(command), err)
+        return None
+    return output.decode("utf-8")
+
+def run_command(command, expected_output, retry=False):
+    """ run command function """
+    output = command_output(command, retry)
+    return output is not None and expected_output in output
+
+def host_ns_command(command):
+    """ prefix command to be run in the host mount and network namespace """
+    return ["nsenter",
+            "--mount=" + HOST_NS_MNT,
+            "--net=" + HOST_NS] + command
+
+
+def run_steps(steps):
+    """ run (stage, command, error message) steps until one fails """
+    for stage, command, error in steps:
+        start = time.monotonic()
+        success = run_command(command, "")
+        metrics.observe_stage(stage, start, success)
+        if not success:
+            if error:
+                _LOG.error("%s", error)
+            return False
+    return True
+
+async def _communicate(command):
+    """ (return code, output) of the command, which is killed if cancelled """
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+    try:
+        output, _ = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, output
+
+async def run_command_async(command, expected_output, retry=False):
+    """ run command function for the asyncio mode """
+    retryable = (deadlines.DeadlineExceeded,) if retry else ()
+    try:
+        returncode, output = await deadlines.call_async(
+            "command", _communicate, command, retryable=retryable,
+            what="\"{}\"".format(' '.join(command)))
+    except deadlines.DeadlineExceeded as err:
+        _LOG.error("%s", err)
+        return False
+    except OSError as err:
+        _LOG.error("Failed to run \"%s\": %s", ' '.join(command), err)
+        return False
+    if returncode:
+        _LOG.error("\"%s\" failed[%s]: %s", ' '.join(command), returncode, output)
+        return False
+    return expected_output in output.decode("utf-8")
+
+def veth_options(mtu=None, queues=None):
+    """ ip link options setting the MTU and number of TX and RX queues of a veth end """
+    options = []
+    if mtu:
+        options += ["mtu", str(mtu)]
+    if queues:
+        options += ["numtxqueues", str(queues), "numrxqueues", str(queues)]
+    return options
+
+def offload_steps(if_name, features):
+    """ steps turning offload features (name -> enabled) of a daemon namespace link on or off
+
+    The netlink backend runs ethtool as well, features are set by ioctl only.
+    """
+    return [("link_offloads",
+             ["ethtool", "-K", if_name] + [arg for feature, enabled in sorted(features.items())
+                                           for arg in (feature, "on" if enabled else "off")],
+             "Failed to set offloads of {}".format(if_name))]
+
+async def run_steps_async(steps):
+    """ run (stage, command, error message) steps until one fails, for the asyncio mode """
+    for stage, command, error in steps:
+        start = time.monotonic()
+        success = await run_command_async(command, "")
+        metrics.observe_stage(stage, start, success)
+        if not success:
+            if error:
+                _LOG.error("%s", error)
+            return False
+    return True
+
+
+def open_netns(ns_path):
+    """ open network namespace file, checking it really is one """
+    ns_fd = os.open(ns_path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        ns_type = fcntl.ioctl(ns_fd, _NS_GET_NSTYPE)
+    except OSError:
+        ns_type = None
+    if ns_type != _CLONE_NEWNET:
+        os.close(ns_fd)
+        raise OSError(errno.EINVAL, "{} is not a network namespace".format(ns_path))
+    return ns_fd
+
+
+class NetnsCache():
+    """ bounded LRU cache of open network namespace files
+
+    Namespaces are opened on first use and kept open, the pinned ones (the
+    host namespace) until close(), the others until they are forgotten or
+    evicted by newer ones. An open file keeps its namespace alive, so the
+    namespace of a destroyed sandbox has to be forgotten. Files are leased
+    by fd() and closed only once no lease is left.
+    """
+    def __init__(self, size=NETNS_CACHE_SIZE, pinned=(HOST_NS,)):
+        self.size = size
+        self.pinned = frozenset(pinned)
+        # path -> [fd, leases, dropped]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "forgotten": 0}
+
+    def _drop(self, entry):
+        """ drop entry taken out of the cache, called with the lock held """
+        entry[2] = True
+        if not entry[1]:
+            os.close(entry[0])
+
+    def _lease(self, ns_path):
+        with self._lock:
+            entry = self._entries.get(ns_path)
+            if entry is not None:
+                self._entries.move_to_end(ns_path)
+                entry[1] += 1
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+        ns_fd = open_netns(ns_path)
+        with self._lock:
+            entry = self._entries.get(ns_path)
+            if entry is not None:
+                # opened by another thread meanwhile
+                os.close(ns_fd)
+                entry[1] += 1
+                return entry
+            entry = self._entries[ns_path] = [ns_fd, 1, False]
+            unpinned = [path for path in self._entries if path not in self.pinned]
+            for path in unpinned[:max(0, len(unpinned) - self.size)]:
+                self._drop(self._entries.pop(path))
+                self.stats["evictions"] += 1
+            return entry
+
+    def _unlease(self, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[2] and not entry[1]:
+                os.close(entry[0])
+
+    @contextlib.contextmanager
+    def fd(self, ns_path):
+        """ lease file descriptor of ns_path namespace, raises OSError if it cannot be opened """
+        entry = self._lease(ns_path)
+        try:
+            yield entry[0]
+        finally:
+            self._unlease(entry)
+
+    def forget(self, ns_path):
+        """ close ns_path namespace file once its leases are returned """
+        if ns_path in self.pinned:
+            return
+        with self._lock:
+            entry = self._entries.pop(ns_path, None)
+            if entry is not None:
+                self._drop(entry)
+                self.stats["forgotten"] += 1
+
+    def snapshot(self):
+        """ stats with the number of open namespace files """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["open"] = len(self._entries)
+        return stats
+
+    def close(self):
+        """ close all namespace files once their leases are returned """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            for entry in entries:
+                self._drop(entry)
+
+
+class SubprocessLinkBackend():
+    """ link operations done by forking ip/nsenter
+
+    Every operation is described by its (stage, command, error message) steps,
+    so it can be run both by the blocking daemon loop and the asyncio one.
+    Stages name the steps in the latency metrics.
+    """
+    name = "subprocess"
+
+    @staticmethod
+    def _add_veth_steps(if_name, peer_name, mtu=None, queues=None):
+        options = veth_options(mtu, queues)
+        return [("link_add_veth",
+                 ["ip", "link", "add", if_name] + options +
+                 ["type", "veth", "peer", "name", peer_name] + options, None)]
+
+    @staticmethod
+    def _delete_link_steps(if_name):
+        return [("link_delete", ["ip", "link", "delete", if_name], None)]
+
+    @staticmethod
+    def _rename_link_steps(if_name, new_name):
+        return [("link_rename", ["ip", "link", "set", "dev", if_name, "name", new_name], None)]
+
+    @staticmethod
+    def _move_link_to_host_steps(if_name):
+        return [("link_move_to_host", ["ip", "link", "set", if_name, "netns", HOST_NS], None)]
+
+    @staticmethod
+    def _move_link_from_host_steps(if_name, dst_ns_path):
+        return [("link_move_from_host",
+                 host_ns_command(["ip", "link", "set", if_name, "netns", dst_ns_path]), None)]
+
+    @staticmethod
+    def _move_link_steps(if_name, dst_ns_path):
+        return [("link_move_to_host", ["ip", "link", "set", if_name, "netns", HOST_NS],
+                 "Failed to move {} to the default namespace".format(if_name)),
+                ("link_move_from_host",
+                 host_ns_command(["ip", "link", "set", if_name, "netns", dst_ns_path]),
+                 "Failed to move {} to {} namespace".format(if_name, dst_ns_path))]
+
+    @staticmethod
+    def _set_link_up_steps(if_name):
+        return [("link_up", host_ns_command(["ip", "link", "set", if_name, "up"]), None)]
+
+    _set_offloads_steps = staticmethod(offload_steps)
+
+    def add_veth(self, if_name, peer_name, mtu=None, queues=None):
+        """ create veth pair in the daemon namespace, MTU and queues set on both ends """
+        return run_steps(self._add_veth_steps(if_name, peer_name, mtu, queues))
+
+    def delete_link(self, if_name):
+        """ delete link from the daemon namespace """
+        return run_steps(self._delete_link_steps(if_name))
+
+    def rename_link(self, if_name, new_name):
+        """ rename link in the daemon namespace """
+        return run_steps(self._rename_link_steps(if_name, new_name))
+
+    def move_link_to_host(self, if_name):
+        """ move link from the daemon namespace to the host namespace """
+        return run_steps(self._move_link_to_host_steps(if_name))
+
+    def move_link_from_host(self, if_name, dst_ns_path):
+        """ move link from the host namespace to dst_ns_path """
+        return run_steps(self._move_link_from_host_steps(if_name, dst_ns_path))
+
+    def move_link(self, if_name, dst_ns_path):
+        """ move link from the daemon namespace to dst_ns_path through the host namespace """
+        return run_steps(self._move_link_steps(if_name, dst_ns_path))
+
+    def set_link_up(self, if_name):
+        """ bring link in the host namespace up """
+        return run_steps(self._set_link_up_steps(if_name))
+
+    def set_offloads(self, if_name, features):
+        """ turn offload features of a link in the daemon namespace on or off """
+        return run_steps(self._set_offloads_steps(if_name, features))
+
+    @staticmethod
+    def list_links(ns_path):
+        """ map link names in ns_path namespace to their MAC addresses, None on failure """
+        output = command_output(["nsenter", "--mount=" + HOST_NS_MNT, "--net=" + ns_path,
+                                 "ip", "-o", "link", "show"], retry=True)
+        if output is None:
+            return None
+        links = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            name = fields[1].rstrip(":").split("@")[0]
+            mac = ""
+            if "link/ether" in fields:
+                mac = fields[fields.index("link/ether") + 1]
+            links[name] = mac
+        return links
+
+    def forget_netns(self, ns_path):
+        """ nothing is kept open per namespace """
+
+    def close(self):
+        """ nothing to release """
+
+
+class HostNetlinkHelper():
+    """ thread serving rtnetlink requests in the host network namespace
+
+    The thread enters the namespace once and keeps a single rtnetlink socket
+    there, callers hand their requests over by call(), so a host request
+    costs a queue round trip instead of two setns() calls and a new socket.
+    The kernel serializes link changes anyway, one socket loses nothing.
+    """
+    def __init__(self, netns, setns):
+        self._netns = netns
+        self._setns = setns
+        self._requests = queue.SimpleQueue() if hasattr(queue, "SimpleQueue") else queue.Queue()
+        self._started = threading.Event()
+        self._error = None
+        self.failed = False
+        self.stats = {"requests": 0}
+        self._thread = threading.Thread(target=self._serve, name="netlink-host-ns")
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+
+    def _serve(self):
+        try:
+            with self._netns.fd(HOST_NS) as ns_fd:
+                self._setns(ns_fd)
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+        except OSError as err:
+            self._error = err
+            self.failed = True
+            return
+        finally:
+            self._started.set()
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    return
+                self.stats["requests"] += 1
+                try:
+                    request.value = request.func(sock, *request.args)
+                except OSError as err:
+                    request.error = err
+                request.done.release()
+        finally:
+            sock.close()
+
+    def call(self, func, *args):
+        """ run func(socket, *args) in the helper thread, raises OSError it raised """
+        if self._error is not None:
+            raise self._error
+        request = _HelperRequest(func, args)
+        self._requests.put(request)
+        request.done.acquire()
+        if request.error is not None:
+            raise request.error
+        return request.value
+
+    def stop(self):
+        """ stop the thread, later calls fail """
+        if self._error is None:
+            self._error = OSError(errno.ESHUTDOWN, "host namespace helper stopped")
+            self._requests.put(None)
+        self._thread.join()
+
+
+class _HelperRequest():
+    """ request handed over to the helper thread """
+    __slots__ = ("func", "args", "value", "error", "done")
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        # released by the helper thread once the request is done
+        self.done = threading.Lock()
+        self.done.acquire()
+
+
+class NetlinkLinkBackend():
+    """ link operations done in-process over rtnetlink
+
+    Network namespaces are referenced by their file, so the namespace paths
+    (e.g. /var/run/docker/netns) must be visible in the daemon mount namespace.
+    Namespace files are kept open in a NetnsCache. Requests to the daemon
+    namespace go over a socket kept by each thread, those to the host
+    namespace are handed to a HostNetlinkHelper and those to a sandbox
+    namespace over a netlink socket created inside it by the calling thread.
+    """
+    name = "netlink"
+
+    def __init__(self, netns_cache_size=NETNS_CACHE_SIZE):
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._setns = libc.setns
+        self._setns.argtypes = (ctypes.c_int, ctypes.c_int)
+        self._setns.restype = ctypes.c_int
+        self.netns = NetnsCache(netns_cache_size)
+        self._own_ns = os.open("/proc/self/ns/net", os.O_RDONLY | os.O_CLOEXEC)
+        self._local = threading.local()
+        self._host = None
+        self._host_lock = threading.Lock()
+
+    def _next_seq(self):
+        with self._seq_lock:
+            self._seq = (self._seq + 1) & 0xffffffff
+            return self._seq
+
+    @staticmethod
+    def _attr(attr_type, data):
+        """ pack rtattr with 4 byte aligned payload """
+        length = _RTATTR.size + len(data)
+        return _RTATTR.pack(length, attr_type) + data + b"\0" * ((4 - length % 4) % 4)
+
+    @classmethod
+    def _ifname_attr(cls, if_name):
+        return cls._attr(_IFLA_IFNAME, if_name.encode("utf-8") + b"\0")
+
+    def _call_setns(self, ns_fd):
+        if self._setns(ns_fd, _CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def _socket(self, ns_path):
+        """ open rtnetlink socket in ns_path namespace """
+        with self.netns.fd(ns_path) as ns_fd:
+            self._call_setns(ns_fd)
+            try:
+                return socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+            finally:
+                self._call_setns(self._own_ns)
+
+    def _own_socket(self):
+        """ rtnetlink socket of the calling thread in the daemon namespace """
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = self._local.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                                    _NETLINK_ROUTE)
+        return sock
+
+    def _host_helper(self):
+        """ helper in the host namespace, restarted if it could not enter it before """
+        with self._host_lock:
+            if self._host is None or self._host.failed:
+                self._host = HostNetlinkHelper(self.netns, self._call_setns)
+            return self._host
+
+    def _request(self, msg_type, flags, ifi_flags, ifi_change, attrs, ns_path=None, index=0):
+        """ send link request and return payloads of the kernel replies
+
+        Waits for the acknowledgement, or for the end of a dump request.
+        """
+        seq = self._next_seq()
+        payload = _IFINFOMSG.pack(_AF_UNSPEC, 0, index, ifi_flags, ifi_change) + attrs
+        msg = _NLMSGHDR.pack(_NLMSGHDR.size + len(payload), msg_type,
+                             _NLM_F_REQUEST | _NLM_F_ACK | flags, seq, 0) + payload
+        if ns_path is None:
+            return self._exchange(self._own_socket(), msg, seq)
+        if ns_path == HOST_NS:
+            return self._host_helper().call(self._exchange, msg, seq)
+        sock = self._socket(ns_path)
+        try:
+            return self._exchange(sock, msg, seq)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _exchange(sock, msg, seq):
+        """ send request over sock and collect its replies """
+        replies = []
+        sock.send(msg)
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + _NLMSGHDR.size <= len(data):
+                length, rsp_type, _, rsp_seq, _ = _NLMSGHDR.unpack_from(data, offset)
+                if length < _NLMSGHDR.size:
+                    break
+                if rsp_seq == seq:
+                    if rsp_type == _NLMSG_ERROR:
+                        error, = _NLMSGERR.unpack_from(data, offset + _NLMSGHDR.size)
+                        if error:
+                            raise OSError(-error, os.strerror(-error))
+                        return replies
+                    if rsp_type == _NLMSG_DONE:
+                        return replies
+                    replies.append(data[offset + _NLMSGHDR.size:offset + length])
+                offset += (length + 3) & ~3
+
+    @staticmethod
+    def _parse_attrs(data, offset):
+        """ map rtattr types to payloads """
+        attrs = {}
+        while offset + _RTATTR.size <= len(data):
+            length, attr_type = _RTATTR.unpack_from(data, offset)
+            if length < _RTATTR.size:
+                break
+            attrs[attr_type & ~_NLA_F_NESTED] = data[offset + _RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+
+    def _run(self, stage, description, msg_type, flags, ifi_flags, ifi_change, attrs,
+             ns_path=None, index=0):
+        """ run request logging failures like run_command does """
+        start = time.monotonic()
+        try:
+            self._request(msg_type, flags, ifi_flags, ifi_change, attrs, ns_path, index)
+        except OSError as err:
+            metrics.observe_stage(stage, start, False)
+            _LOG.error("netlink %s failed: %s", description, err)
+            return False
+        metrics.observe_stage(stage, start)
+        return True
+
+    def add_veth(self, if_name, peer_name, mtu=None, queues=None):
+        """ create veth pair in the daemon namespace, MTU and queues set on both ends """
+        link = b""
+        if mtu:
+            link += self._attr(_IFLA_MTU, struct.pack("=I", mtu))
+        if queues:
+            link += self._attr(_IFLA_NUM_TX_QUEUES, struct.pack("=I", queues)) + \
+                self._attr(_IFLA_NUM_RX_QUEUES, struct.pack("=I", queues))
+        peer = _IFINFOMSG.pack(_AF_UNSPEC, 0, 0, 0, 0) + self._ifname_attr(peer_name) + link
+        info = self._attr(_IFLA_INFO_KIND, b"veth") + \
+            self._attr(_IFLA_INFO_DATA | _NLA_F_NESTED,
+                       self._attr(_VETH_INFO_PEER | _NLA_F_NESTED, peer))
+        attrs = self._ifname_attr(if_name) + link + \
+            self._attr(_IFLA_LINKINFO | _NLA_F_NESTED, info)
+        return self._run("link_add_veth", "add veth {}/{}".format(if_name, peer_name), _RTM_NEWLINK,
+                         _NLM_F_CREATE | _NLM_F_EXCL, 0, 0, attrs)
+
+    def delete_link(self, if_name):
+        """ delete link from the daemon namespace """
+        return self._run("link_delete", "delete {}".format(if_name), _RTM_DELLINK, 0, 0, 0,
+                         self._ifname_attr(if_name))
+
+    def rename_link(self, if_name, new_name):
+        """ rename link in the daemon namespace """
+        try:
+            index = socket.if_nametoindex(if_name)
+        except OSError as err:
+            _LOG.error("netlink rename %s failed: %s", if_name, err)
+            return False
+        # the link is looked up by its index, the name attribute is the new name
+        return self._run("link_rename", "rename {} to {}".format(if_name, new_name),
+                         _RTM_NEWLINK, 0, 0, 0, self._ifname_attr(new_name), index=index)
+
+    def move_link_ns(self, if_name, dst_ns_path, src_ns_path=None, stage="link_move"):
+        """ move link from src_ns_path (daemon namespace by default) to dst_ns_path """
+        try:
+            with self.netns.fd(dst_ns_path) as dst_fd:
+                attrs = self._ifname_attr(if_name) + \
+                    self._attr(_IFLA_NET_NS_FD, struct.pack("=I", dst_fd))
+                return self._run(stage, "move {} to {}".format(if_name, dst_ns_path),
+                                 _RTM_NEWLINK, 0, 0, 0, attrs, src_ns_path)
+        except OSError as err:
+            _LOG.error("Failed to open namespace %s: %s", dst_ns_path, err)
+            return False
+
+    def move_link_to_host(self, if_name):
+        """ move link from the daemon namespace to the host namespace """
+        return self.move_link_ns(if_name, HOST_NS, stage="link_move_to_host")
+
+    def move_link_from_host(self, if_name, dst_ns_path):
+        """ move link from the host namespace to dst_ns_path """
+        return self.move_link_ns(if_name, dst_ns_path, HOST_NS, stage="link_move_from_host")
+
+    def move_link(self, if_name, dst_ns_path):
+        """ move link from the daemon namespace straight to dst_ns_path """
+        return self.move_link_ns(if_name, dst_ns_path)
+
+    _set_offloads_steps = staticmethod(offload_steps)
+
+    def set_offloads(self, if_name, features):
+        """ turn offload features of a link in the daemon namespace on or off """
+        return run_steps(self._set_offloads_steps(if_name, features))
+
+    def set_link_up(self, if_name):
+        """ bring link in the host namespace up """
+        return self._run("link_up", "set {} up".format(if_name), _RTM_NEWLINK, 0, _IFF_UP, _IFF_UP,
+                         self._ifname_attr(if_name), HOST_NS)
+
+    def list_links(self, ns_path):
+        """ map link names in ns_path namespace to their MAC addresses, None on failure """
+        try:
+            replies = self._request(_RTM_GETLINK, _NLM_F_DUMP, 0, 0, b"", ns_path)
+        except OSError as err:
+            _LOG.error("netlink list links in %s failed: %s", ns_path, err)
+            return None
+        links = {}
+        for reply in replies:
+            attrs = self._parse_attrs(reply, _IFINFOMSG.size)
+            if _IFLA_IFNAME not in attrs:
+                continue
+            name = attrs[_IFLA_IFNAME].rstrip(b"\0").decode("utf-8")
+            links[name] = ":".join("{:02x}".format(byte) for byte in attrs.get(_IFLA_ADDRESS, b""))
+        return links
+
+    def forget_netns(self, ns_path):
+        """ close file of the namespace of a destroyed sandbox """
+        self.netns.forget(ns_path)
+
+    def close(self):
+        """ stop the host namespace helper and close namespace files """
+        with self._host_lock:
+            if self._host is not None:
+                self._host.stop()
+        self.netns.close()
+
+
+class AsyncLinkBackend():
+    """ coroutine interface over a link backend
+
+    Subprocess operations run their commands with asyncio subprocesses,
+    in-process (netlink) operations block on setns() and socket I/O, so
+    they are run on the core executor.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def call(self, operation, *args):
+        """ run backend operation by name """
+        steps = getattr(self.backend, "_{}_steps".format(operation), None)
+        if steps is None:
+            return await async_core.run_blocking(getattr(self.backend, operation), *args)
+        return await run_steps_async(steps(*args))
+
+
+def make_backend(name, netns_cache_size=NETNS_CACHE_SIZE):
+    """ create link backend by name """
+    if name == NetlinkLinkBackend.name:
+        return NetlinkLinkBackend(netns_cache_size)
+    if name == SubprocessLinkBackend.name:
+        return SubprocessLinkBackend()
+    raise ValueError("Unknown link backend {}".format(name))
@@ -0,0 +1,350 @@
+# coding: utf-8
+""" daemon metrics in Prometheus text format """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import bisect
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import time
+
+# seconds, from 100us NES round trips to multi-second attaches
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_LOG = logging.getLogger(__name__)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Sharded():
+    """ values kept in one preallocated list per thread
+
+    Writers only touch the list of their own thread, so recording needs no
+    lock; readers sum all lists at scrape time.
+    """
+    def __init__(self, size, initial):
+        self._size = size
+        self._initial = initial
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()
+
+    def shard(self):
+        """ list of the calling thread """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [self._initial] * self._size
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def totals(self):
+        """ element-wise sum over all threads """
+        with self._shards_lock:
+            shards = list(self._shards)
+        totals = [self._initial] * self._size
+        for shard in shards:
+            for index, value in enumerate(shard):
+                totals[index] += value
+        return totals
+
+
+class _CounterChild(_Sharded):
+    def __init__(self):
+        _Sharded.__init__(self, 1, 0)
+
+    def inc(self, amount=1):
+        """ increase counter """
+        self.shard()[0] += amount
+
+    def value(self):
+        """ current value """
+        return self.totals()[0]
+
+
+class _HistogramChild(_Sharded):
+    def __init__(self, bounds):
+        # bucket counts followed by +Inf bucket and the sum of observed values
+        _Sharded.__init__(self, len(bounds) + 2, 0)
+        self.bounds = bounds
+
+    def observe(self, value):
+        """ record observed value """
+        shard = self.shard()
+        shard[bisect.bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self):
+        """ (cumulative bucket counts, count, sum) """
+        totals = self.totals()
+        cumulative = []
+        count = 0
+        for bucket in totals[:-1]:
+            count += bucket
+            cumulative.append(count)
+        return cumulative, count, totals[-1]
+
+
+class _Family():
+    """ metric with a fixed set of label names """
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """ child metric for the label values """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    self._children[values] = child
+        return child
+
+    def children(self):
+        """ snapshot of (label values, child) """
+        with self._lock:
+            return sorted(self._children.items())
+
+    def render(self):
+        """ Prometheus text exposition lines """
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Family):
+    """ monotonically increasing counter """
+    metric_type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """ increase counter without labels """
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, values),
+                                 _format_value(child.value()))
+                for values, child in self.children()]
+
+
+class Histogram(_Family):
+    """ histogram with preallocated buckets """
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        _Family.__init__(self, name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        """ record value without labels """
+        self.labels().observe(value)
+
+    def _samples(self):
+        samples = []
+        for values, child in self.children():
+            cumulative, count, total = child.snapshot()
+            for bound, bucket in zip(self.bounds + (float("inf"),), cumulative):
+                samples.append("{}_bucket{} {}".format(
+                    self.name,
+                    _format_labels(self.labelnames, values,
+                                   'le="{}"'.format(_format_value(bound))),
+                    bucket))
+            labels = _format_labels(self.labelnames, values)
+            samples.append("{}_count{} {}".format(self.name, labels, count))
+            samples.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+        return samples
+
+
+class Gauge(_Family):
+    """ gauge read from a callback at scrape time """
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, func=None):
+        _Family.__init__(self, name, documentation)
+        self.func = func
+
+    def set_function(self, func):
+        """ set callback returning the gauge value """
+        self.func = func
+
+    def _new_child(self):
+        raise TypeError("callback gauges have no labels")
+
+    def _samples(self):
+        if self.func is None:
+            return []
+        return ["{} {}".format(self.name, _format_value(self.func()))]
+
+
+class StatsGauges():
+    """ expose a dict of numeric stats as gauges named prefix_key """
+    def __init__(self, prefix, documentation, stats):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.stats = stats
+
+    def render(self):
+        """ Prometheus text exposition lines """
+        stats = self.stats() if callable(self.stats) else dict(self.stats)
+        lines = []
+        for key, value in sorted(stats.items()):
+            name = "{}_{}".format(self.prefix, key)
+            lines.extend(["# HELP {} {} ({})".format(name, self.documentation, key),
+                          "# TYPE {} gauge".format(name),
+                          "{} {}".format(name, _format_value(value))])
+        return lines
+
+
+class Registry():
+    """ set of metrics rendered together """
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """ add metric, returns it """
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Prometheus text exposition of all metrics """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "nts_stage_duration_seconds", "Duration of interface attach/detach stages", ("stage",)))
+STAGE_FAILURES = REGISTRY.register(Counter(
+    "nts_stage_failures_total", "Failed interface attach/detach stages", ("stage",)))
+EVENT_LATENCY = REGISTRY.register(Histogram(
+    "nts_event_ready_duration_seconds", "Time from docker event to interface ready",
+    ("handler", "action")))
+EVENT_FAILURES = REGISTRY.register(Counter(
+    "nts_event_failures_total", "Docker events whose handling failed",
+    ("handler", "action")))
+OPERATIONS_SAVED = REGISTRY.register(Counter(
+    "nts_operations_saved_total", "Interface operations avoided by tracking sandbox state",
+    ("reason",)))
+OPERATION_TIMEOUTS = REGISTRY.register(Counter(
+    "nts_operation_timeouts_total", "Blocking operations abandoned at their deadline",
+    ("operation",)))
+OPERATION_RETRIES = REGISTRY.register(Counter(
+    "nts_operation_retries_total", "Retries of failed or timed out operations", ("operation",)))
+WATCHDOG_STALLS = REGISTRY.register(Counter(
+    "nts_watchdog_stalls_total", "Event handlers or event loops found stalled by the watchdog",
+    ("source",)))
+ATTACH_PROFILES = REGISTRY.register(Counter(
+    "nts_attach_profile_total", "Sandboxes attached by attach profile", ("profile",)))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "nts_event_queue_depth", "Docker events waiting or being processed"))
+
+
+def register_stats(prefix, documentation, stats):
+    """ expose stats dict (or function returning one) as gauges """
+    return REGISTRY.register(StatsGauges(prefix, documentation, stats))
+
+def observe_stage(stage, start, success=True):
+    """ record stage started at start (time.monotonic()) """
+    STAGE_LATENCY.labels(stage).observe(time.monotonic() - start)
+    if not success:
+        STAGE_FAILURES.labels(stage).inc()
+
+def observe_event(event, success=True, handler=""):
+    """ record docker event handled, latency is measured from the event time """
+    if not success:
+        EVENT_FAILURES.labels(handler, event['Action']).inc()
+        return
+    time_nano = event.get('timeNano')
+    if time_nano is not None:
+        EVENT_LATENCY.labels(handler, event['Action']).observe(time.time() - time_nano / 1e9)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self): # pylint: disable=invalid-name
+        """ serve metrics """
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        _LOG.debug("metrics: " + format, *args)
+
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def start_server(address, registry=REGISTRY):
+    """ serve metrics on "host:port" or unix socket path in a background thread """
+    if "/" in address:
+        server = _UnixMetricsServer(address, _MetricsHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = _TCPMetricsServer((host or "127.0.0.1", int(port)), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    _LOG.info("Serving metrics on %s", address)
+    return server
@@ -0,0 +1,673 @@
+# coding: utf-8
+""" NES control protocol client, without the nes_api shared library """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import collections
+import ctypes
+import logging
+import socket
+import struct
+import threading
+
+import deadlines
+import nes_routes
+import nes_stats
+
+NES_SUCCESS = 0
+NES_FAIL = 1
+
+# nes_api_msg_t header: message_type, function_id, data_size, see
+# libs/libnes_api/libnes_api_protocol.h
+MSG_HEADER = struct.Struct("=HHH")
+MSG_REQUEST, MSG_RESPONSE, MSG_ERROR = 0, 1, 2
+FUNC_STATS_DEV_ALL = 0
+FUNC_STATS_DEV = 1
+FUNC_MAC_ADDRESS_GET = 3
+FUNC_ADD_ROUTE = 4
+FUNC_ADD_MIRROR = 5
+FUNC_DEL_ROUTE = 7
+FUNC_ROUTE_CLEAR_ALL = 8
+FUNC_STATS_CLEAR_ALL = 9
+FUNC_STATS_RING_ALL = 10
+FUNC_STATS_RING = 11
+FUNC_ADD_KNI = 12
+FUNC_DEL_KNI = 13
+FUNC_ROUTE_LIST = 14
+
+KNI_NAMESIZE = 32
+NES_MAX_KNI_ENTRY_LEN = 64
+ETHER_ADDR_LEN = 6
+# largest request: route add with the MAC address and the lookup keys
+MAX_REQUEST_SIZE = MSG_HEADER.size + ETHER_ADDR_LEN + nes_routes.NES_MAX_LOOKUP_ENTRY_LEN + 1
+# size of the per client buffer NES reads requests into, a read filling it
+# makes NES drop the client, see MAX_BUFFER_SIZE in daemon/ctrl/nes_ctrl.c
+NES_BUFFER_SIZE = 512
+# bytes of requests sent to a connection and not answered yet
+MAX_IN_FLIGHT = NES_BUFFER_SIZE - 1
+CALL_TIMEOUT = 5.0
+
+_U8 = struct.Struct("=B")
+_U16 = struct.Struct("=H")
+_INT = struct.Struct("=i")
+# nes_route_list_req_t: entry_offset, max_entry_cnt
+_ROUTE_LIST_REQ = struct.Struct("=HH")
+_NUL = b"\0"
+
+_LOG = logging.getLogger(__name__)
+
+
+def _put_string(buf, offset, text, limit):
+    """ write text truncated to limit and NUL terminated as the C client does, returns size """
+    data = text.encode("utf-8")[:limit]
+    end = offset + len(data)
+    buf[offset:end] = data
+    buf[end] = 0
+    return len(data) + 1
+
+def _encode_none(buf, offset): # pylint: disable=unused-argument
+    return 0
+
+def _encode_u8(buf, offset, value):
+    _U8.pack_into(buf, offset, value)
+    return _U8.size
+
+def _encode_u16(buf, offset, value):
+    _U16.pack_into(buf, offset, value)
+    return _U16.size
+
+def _encode_kni(buf, offset, dev_id):
+    return _put_string(buf, offset, dev_id, NES_MAX_KNI_ENTRY_LEN)
+
+def _encode_route(buf, offset, mac, lookup):
+    buf[offset:offset + ETHER_ADDR_LEN] = mac
+    return ETHER_ADDR_LEN + _put_string(buf, offset + ETHER_ADDR_LEN, lookup,
+                                        nes_routes.NES_MAX_LOOKUP_ENTRY_LEN)
+
+def _encode_lookup(buf, offset, lookup):
+    return _put_string(buf, offset, lookup, nes_routes.NES_MAX_LOOKUP_ENTRY_LEN)
+
+def _encode_route_list(buf, offset, entry_offset, max_entry_cnt):
+    _ROUTE_LIST_REQ.pack_into(buf, offset, entry_offset, max_entry_cnt)
+    return _ROUTE_LIST_REQ.size
+
+
+def _decode_kni(message_type, data):
+    """ (ret, interface name) of a KNI add/del response """
+    if message_type == MSG_ERROR or len(data) != KNI_NAMESIZE:
+        return (NES_FAIL, "")
+    return (NES_SUCCESS, bytes(data).split(_NUL, 1)[0].decode("utf-8"))
+
+def _decode_int(message_type, data):
+    """ enum NES_ERROR of the response """
+    if message_type == MSG_ERROR or len(data) != _INT.size:
+        return NES_FAIL
+    return _INT.unpack_from(data)[0]
+
+def _struct_decoder(struct_type):
+    size = ctypes.sizeof(struct_type)
+    def decode(message_type, data):
+        """ struct of the response, None on error """
+        if message_type == MSG_ERROR or len(data) != size:
+            return None
+        return struct_type.from_buffer_copy(data)
+    return decode
+
+def _array_decoder(struct_type):
+    size = ctypes.sizeof(struct_type)
+    def decode(message_type, data):
+        """ ctypes array of the structs in the response, None on error """
+        if message_type == MSG_ERROR:
+            return None
+        count = len(data) // size
+        return (struct_type * count).from_buffer_copy(data[:count * size])
+    return decode
+
+def _decode_mac(message_type, data):
+    """ MAC address bytes, None on error """
+    if message_type == MSG_ERROR or len(data) != ETHER_ADDR_LEN:
+        return None
+    return bytes(data)
+
+# function ID: (request data encoder, response decoder)
+_CODECS = {
+    FUNC_ADD_KNI: (_encode_kni, _decode_kni),
+    FUNC_DEL_KNI: (_encode_kni, _decode_kni),
+    FUNC_STATS_DEV_ALL: (_encode_none, _array_decoder(nes_stats.NesApiDevT)),
+    FUNC_STATS_RING_ALL: (_encode_none, _array_decoder(nes_stats.NesApiRingT)),
+    FUNC_STATS_DEV: (_encode_u16, _struct_decoder(nes_stats.NesDevStatsT)),
+    FUNC_STATS_RING: (_encode_u16, _struct_decoder(nes_stats.NesRingStatsT)),
+    FUNC_STATS_CLEAR_ALL: (_encode_none, _decode_int),
+    FUNC_MAC_ADDRESS_GET: (_encode_u8, _decode_mac),
+    FUNC_ADD_ROUTE: (_encode_route, _decode_int),
+    FUNC_ADD_MIRROR: (_encode_route, _decode_int),
+    FUNC_DEL_ROUTE: (_encode_lookup, _decode_int),
+    FUNC_ROUTE_CLEAR_ALL: (_encode_none, _decode_int),
+    FUNC_ROUTE_LIST: (_encode_route_list, _array_decoder(nes_routes.NesRouteDataT)),
+}
+
+def failure(function_id):
+    """ result of a request which got no response """
+    return _CODECS[function_id][1](MSG_ERROR, b"")
+
+
+class RequestBuffer():
+    """ preallocated buffer the requests of a pipeline are framed into """
+    def __init__(self, limit=MAX_IN_FLIGHT):
+        if limit < MAX_REQUEST_SIZE:
+            raise ValueError("request buffer of {} bytes can not hold every request"
+                             .format(limit))
+        self.limit = limit
+        # room to frame one more request before knowing whether it fits
+        self.data = bytearray(limit + MAX_REQUEST_SIZE)
+        self.view = memoryview(self.data)
+        self.size = 0
+
+    def add(self, function_id, args, room=None):
+        """ frame request after the ones already in the buffer
+
+        Returns the size of the request, or 0 if the buffer would hold more
+        than room bytes (its limit by default) with it.
+        """
+        offset = self.size
+        data_size = _CODECS[function_id][0](self.data, offset + MSG_HEADER.size, *args)
+        end = offset + MSG_HEADER.size + data_size
+        if end > (self.limit if room is None else min(room, self.limit)):
+            return 0
+        MSG_HEADER.pack_into(self.data, offset, MSG_REQUEST, function_id, data_size)
+        self.size = end
+        return end - offset
+
+    def clear(self):
+        """ drop framed requests """
+        self.size = 0
+
+
+class _NesApi():
+    """ NES API calls, each returns what _request() does with the result of the call
+
+    Results follow nes_api: KNI calls give (ret, interface name), route and
+    clear calls give the NES_ERROR code, list and stats calls give ctypes
+    arrays and structs of nes_stats and nes_routes, or None on failure.
+    """
+    def _request(self, function_id, *args):
+        raise NotImplementedError
+
+    def kni_add(self, dev_id):
+        """ nes_kni_add """
+        return self._request(FUNC_ADD_KNI, dev_id)
+
+    def kni_del(self, dev_id):
+        """ nes_kni_del """
+        return self._request(FUNC_DEL_KNI, dev_id)
+
+    def stats_all_dev(self):
+        """ nes_stats_all_dev """
+        return self._request(FUNC_STATS_DEV_ALL)
+
+    def stats_all_ring(self):
+        """ nes_stats_all_ring """
+        return self._request(FUNC_STATS_RING_ALL)
+
+    def stats_dev(self, index):
+        """ nes_stats_dev """
+        return self._request(FUNC_STATS_DEV, index)
+
+    def stats_ring(self, index):
+        """ nes_stats_ring """
+        return self._request(FUNC_STATS_RING, index)
+
+    def stats_clear_all(self):
+        """ nes_clear_all_stats """
+        return self._request(FUNC_STATS_CLEAR_ALL)
+
+    def mac_address(self, port):
+        """ nes_dev_port_mac_addr, as bytes """
+        return self._request(FUNC_MAC_ADDRESS_GET, port)
+
+    def route_add(self, mac, lookup):
+        """ nes_route_add of MAC address bytes and lookup keys string """
+        return self._request(FUNC_ADD_ROUTE, mac, lookup)
+
+    def route_add_mirror(self, mac, lookup):
+        """ nes_route_add_mirror """
+        return self._request(FUNC_ADD_MIRROR, mac, lookup)
+
+    def route_remove(self, lookup):
+        """ nes_route_remove, removes mirror routes as well """
+        return self._request(FUNC_DEL_ROUTE, lookup)
+
+    def route_clear_all(self):
+        """ nes_route_clear_all """
+        return self._request(FUNC_ROUTE_CLEAR_ALL)
+
+    def route_list(self, entry_offset, max_entry_cnt):
+        """ nes_route_list """
+        return self._request(FUNC_ROUTE_LIST, entry_offset, max_entry_cnt)
+
+
+class _Pending():
+    """ request waiting for its response, read into the buffer into if given """
+    __slots__ = ("function_id", "size", "result", "done", "into")
+
+    def __init__(self, function_id, size, into=None):
+        self.function_id = function_id
+        self.size = size
+        self.result = None
+        self.done = False
+        self.into = into
+
+
+class _Connection():
+    """ socket and the requests sent on it, in the order NES answers them """
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = collections.deque()
+        self.recv_lock = threading.Lock()
+        self.header = bytearray(MSG_HEADER.size)
+        self.header_view = memoryview(self.header)
+        # request bytes sent and answered, sent changes with the send lock
+        # held and answered with the receive lock
+        self.sent = 0
+        self.answered = 0
+
+    def in_flight(self):
+        """ bytes of the requests NES did not answer yet """
+        return self.sent - self.answered
+
+    def shutdown(self):
+        """ wake up and fail the callers reading """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def fail_pending(self):
+        """ complete waiting requests with failures, called holding the receive lock """
+        while self.pending:
+            pending = self.pending.popleft()
+            pending.result = None if pending.into is not None else \
+                failure(pending.function_id)
+            pending.done = True
+
+
+def _recv_exactly(sock, view):
+    while view:
+        size = sock.recv_into(view)
+        if not size:
+            raise ConnectionError("NES closed the connection")
+        view = view[size:]
+
+
+class NesClient(_NesApi):
+    """ NES control client over the ctrl_socket, usable from many threads
+
+    NES answers the requests of a connection in order, so callers frame
+    their requests into a preallocated buffer and send them without waiting
+    for the responses of the others; whichever caller reads next hands each
+    response to the request at the head of the queue. NES drops a client
+    sending more than its read buffer holds, so no more than max_in_flight
+    bytes of requests are left unanswered on a connection, callers read
+    responses until theirs fit. A connection lost is reopened by the next
+    call; the call which found it lost when sending is retried once on the
+    new one.
+    """
+    def __init__(self, socket_path, timeout=CALL_TIMEOUT, max_in_flight=MAX_IN_FLIGHT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.stats = {"connects": 0, "reconnects": 0, "failures": 0, "requests": 0,
+                      "errors": 0, "pipelined": 0, "waits": 0}
+        self._conn = None
+        self._buffer = RequestBuffer(max_in_flight)
+        self._send_lock = threading.Lock()
+
+    def connect(self):
+        """ open connection unless open, returns success """
+        with self._send_lock:
+            return self._connect() is not None
+
+    def _connect(self):
+        """ current connection, opened if needed, None on failure """
+        if self._conn is not None:
+            return self._conn
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as err:
+            sock.close()
+            self.stats["failures"] += 1
+            _LOG.error("Failed to connect to NES at %s: %s", self.socket_path, err)
+            return None
+        self._conn = _Connection(sock)
+        self.stats["connects"] += 1
+        return self._conn
+
+    def _drop(self, conn):
+        """ stop using the connection, its pending requests fail """
+        if self._conn is conn:
+            self._conn = None
+        conn.shutdown()
+
+    def close(self):
+        """ close connection, pending requests fail """
+        with self._send_lock:
+            conn = self._conn
+            self._conn = None
+        if conn is not None:
+            conn.shutdown()
+            with conn.recv_lock:
+                conn.sock.close()
+                conn.fail_pending()
+
+    def _request(self, function_id, *args):
+        return self.call_many(((function_id, args),))[0]
+
+    def call_into(self, function_id, into):
+        """ send a request without arguments, its response data is read into the buffer
+
+        into is a writable buffer, e.g. a ctypes array, data beyond its size
+        is dropped. Returns the size of the response data, None on failure.
+        """
+        return self.call_many(((function_id, ()),), memoryview(into).cast("B"))[0]
+
+    def stats_all_dev_into(self, into):
+        """ nes_stats_all_dev read into a nes_stats.NesApiDevT array, see call_into() """
+        return self.call_into(FUNC_STATS_DEV_ALL, into)
+
+    def stats_all_ring_into(self, into):
+        """ nes_stats_all_ring read into a nes_stats.NesApiRingT array, see call_into() """
+        return self.call_into(FUNC_STATS_RING_ALL, into)
+
+    def call_many(self, requests, into=None):
+        """ send (function ID, args) requests pipelined, returns their results in order
+
+        With into, the response of the single request is read into it.
+        """
+        results = []
+        start = 0
+        while start < len(requests):
+            conn, batch, end = self._send(requests, start, into)
+            if conn is None:
+                results.extend(None if into is not None else failure(function_id)
+                               for function_id, _ in requests[start:end])
+            else:
+                self._wait(conn, batch[-1])
+                results.extend(pending.result for pending in batch)
+            start = end
+        return results
+
+    def _send(self, requests, start, into=None):
+        """ frame and send the requests from start on which fit in the buffer
+
+        Returns (connection, pending entries, index of the first request not
+        sent), the connection and entries are None on failure.
+        """
+        buf = self._buffer
+        with self._send_lock:
+            buf.clear()
+            sizes = []
+            for function_id, args in requests[start:]:
+                size = buf.add(function_id, args)
+                if not size:
+                    break
+                sizes.append(size)
+            end = start + len(sizes)
+            for attempt in range(2):
+                conn = self._connect()
+                if conn is None:
+                    break
+                if not self._make_room(conn, buf.size):
+                    continue
+                batch = [_Pending(function_id, size, into)
+                         for (function_id, _), size in zip(requests[start:end], sizes)]
+                # queued before sending, another caller may read the responses first
+                queued = len(conn.pending)
+                conn.pending.extend(batch)
+                conn.sent += buf.size
+                try:
+                    conn.sock.sendall(buf.view[:buf.size])
+                except OSError as err:
+                    self._drop(conn)
+                    if attempt == 0:
+                        self.stats["reconnects"] += 1
+                        _LOG.info("NES connection lost (%s), retrying on a new one", err)
+                    else:
+                        _LOG.error("Failed to send NES request: %s", err)
+                    continue
+                self.stats["requests"] += len(batch)
+                if queued or len(batch) > 1:
+                    self.stats["pipelined"] += len(batch)
+                return conn, batch, end
+        return None, None, end
+
+    def _make_room(self, conn, size):
+        """ read responses until size more bytes of requests may be sent, returns success """
+        while conn.in_flight() + size > self.max_in_flight:
+            with conn.recv_lock:
+                # another caller may have read them meanwhile
+                if conn.in_flight() + size <= self.max_in_flight:
+                    break
+                self.stats["waits"] += 1
+                if not self._read_one(conn):
+                    return False
+        return True
+
+    def _wait(self, conn, last):
+        """ read responses of the connection until the last request got its own """
+        with conn.recv_lock:
+            while not last.done:
+                if not self._read_one(conn):
+                    break
+
+    def _read_one(self, conn):
+        """ read one response and complete the oldest request, returns success """
+        try:
+            _recv_exactly(conn.sock, conn.header_view)
+            message_type, function_id, data_size = MSG_HEADER.unpack(conn.header)
+            into = conn.pending[0].into if conn.pending else None
+            if into is None:
+                data = bytearray(data_size)
+                _recv_exactly(conn.sock, memoryview(data))
+            else:
+                stored = min(data_size, len(into))
+                _recv_exactly(conn.sock, into[:stored])
+                if data_size > stored:
+                    _recv_exactly(conn.sock, memoryview(bytearray(data_size - stored)))
+        except OSError as err:
+            # the stream can not be matched to the requests any more
+            if isinstance(err, socket.timeout):
+                err = deadlines.expired("nes", "NES response")
+            _LOG.error("NES connection failed: %s", err)
+            self._drop(conn)
+            conn.sock.close()
+            conn.fail_pending()
+            return False
+        pending = conn.pending.popleft()
+        conn.answered += pending.size
+        if pending.function_id != function_id:
+            _LOG.warning("NES answered request %s with function %s", pending.function_id,
+                         function_id)
+        if message_type == MSG_ERROR:
+            self.stats["errors"] += 1
+        if pending.into is not None:
+            pending.result = None if message_type == MSG_ERROR else data_size
+        else:
+            pending.result = _CODECS[pending.function_id][1](message_type, data)
+        pending.done = True
+        return True
+
+
+class AsyncNesClient(_NesApi):
+    """ NES control client for the asyncio mode
+
+    API calls return futures. Requests made in one event loop iteration
+    are framed into a preallocated buffer and written at once, a reader
+    task completes the futures in the order NES answers. Requests which
+    would leave more than max_in_flight bytes unanswered on the connection
+    stay queued until responses make room for them. The connection is
+    opened by the first call and reopened by the call after it was lost, or
+    dropped because requests were not answered within timeout seconds.
+    """
+    def __init__(self, socket_path, timeout=CALL_TIMEOUT, max_in_flight=MAX_IN_FLIGHT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.stats = {"connects": 0, "reconnects": 0, "failures": 0, "requests": 0,
+                      "errors": 0, "pipelined": 0, "waits": 0}
+        self._buffer = RequestBuffer(max_in_flight)
+        # (function ID, future, request size) written and not answered
+        self._pending = collections.deque()
+        self._in_flight = 0
+        # (function ID, args, future) not written yet
+        self._queued = collections.deque()
+        self._writer = None
+        self._reader_task = None
+        self._connecting = None
+        self._flush_scheduled = False
+
+    async def connect(self):
+        """ open connection unless open, returns success """
+        if self._writer is not None:
+            return True
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        try:
+            return await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _open(self):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        except OSError as err:
+            self.stats["failures"] += 1
+            _LOG.error("Failed to connect to NES at %s: %s", self.socket_path, err)
+            return False
+        if self.stats["connects"]:
+            self.stats["reconnects"] += 1
+        self.stats["connects"] += 1
+        self._writer = writer
+        self._pending = collections.deque()
+        self._in_flight = 0
+        self._reader_task = asyncio.ensure_future(self._read(reader, writer, self._pending))
+        return True
+
+    def _request(self, function_id, *args):
+        future = asyncio.get_event_loop().create_future()
+        if self._writer is None:
+            return asyncio.ensure_future(self._connect_and_queue(future, function_id, args))
+        self._queue(future, function_id, args)
+        return future
+
+    async def _connect_and_queue(self, future, function_id, args):
+        if not await self.connect():
+            return failure(function_id)
+        self._queue(future, function_id, args)
+        return await future
+
+    def _queue(self, future, function_id, args):
+        self._queued.append((function_id, args, future))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        """ write the queued requests which fit in the room NES has left """
+        self._flush_scheduled = False
+        if not self._queued:
+            return
+        if self._writer is None:
+            while self._queued:
+                function_id, _, future = self._queued.popleft()
+                if not future.done():
+                    future.set_result(failure(function_id))
+            return
+        buf = self._buffer
+        buf.clear()
+        room = self.max_in_flight - self._in_flight
+        written = []
+        for function_id, args, future in self._queued:
+            size = buf.add(function_id, args, room)
+            if not size:
+                break
+            written.append((function_id, future, size))
+        for _ in written:
+            self._queued.popleft()
+        if self._queued:
+            # the reader flushes again when responses make room
+            self.stats["waits"] += 1
+        if not written:
+            return
+        if len(written) > 1 or self._pending:
+            self.stats["pipelined"] += len(written)
+        self.stats["requests"] += len(written)
+        self._pending.extend(written)
+        self._in_flight += buf.size
+        # the transport may keep what it could not send yet, give it a copy
+        self._writer.write(bytes(buf.view[:buf.size]))
+        buf.clear()
+        if self.timeout is not None:
+            asyncio.get_event_loop().call_later(self.timeout, self._expire, self._writer,
+                                                written[-1])
+
+    def _expire(self, writer, last):
+        """ drop the connection if the last request written was not answered in time """
+        function_id, future, _ = last
+        if future.done() or self._writer is not writer:
+            return
+        _LOG.error("%s, dropping the NES connection", deadlines.expired(
+            "nes", "NES response to function {}".format(function_id)))
+        # the reader fails the pending requests
+        self._writer = None
+        writer.close()
+
+    async def _read(self, reader, writer, pending):
+        """ complete the pending requests of the connection with its responses """
+        try:
+            while True:
+                header = await reader.readexactly(MSG_HEADER.size)
+                message_type, function_id, data_size = MSG_HEADER.unpack(header)
+                data = await reader.readexactly(data_size) if data_size else b""
+                if not pending:
+                    _LOG.warning("Unexpected NES response to function %s", function_id)
+                    continue
+                expected, future, size = pending.popleft()
+                if message_type == MSG_ERROR:
+                    self.stats["errors"] += 1
+                if not future.done():
+                    future.set_result(_CODECS[expected][1](message_type, data))
+                if self._writer is writer:
+                    self._in_flight -= size
+                    if self._queued:
+                        self._schedule_flush()
+        except (asyncio.IncompleteReadError, OSError) as err:
+            _LOG.error("NES connection failed: %s", err)
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            while pending:
+                expected, future, _ = pending.popleft()
+                if not future.done():
+                    future.set_result(failure(expected))
+            # requests waiting for room fail, or go to a connection opened meanwhile
+            if self._queued:
+                self._schedule_flush()
+
+    async def close(self):
+        """ close connection, pending requests fail """
+        writer = self._writer
+        self._writer = None
+        if writer is not None:
+            writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.wait([self._reader_task])
+            self._reader_task = None
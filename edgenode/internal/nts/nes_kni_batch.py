@@ -0,0 +1,163 @@
+# coding: utf-8
+""" micro-batching of NES KNI add/del requests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import collections
+import ctypes
+import logging
+import threading
+import time
+
+NES_SUCCESS = 0
+NES_FAIL = 1
+KNI_NAMESIZE = 32
+# nes_remote_state_t of libs/libnes_api/libnes_api.h, sessions found broken are invalid
+NES_REMOTE_INVALID = 0
+NES_REMOTE_CONNECTED = 1
+NES_REMOTE_DISCONNECTED = 2
+# seconds a request waits for others to join its batch
+DEFAULT_WINDOW = 0.01
+DEFAULT_MAX_BATCH = 32
+
+_LOG = logging.getLogger(__name__)
+
+
+class _Request():
+    """ KNI request waiting for its result """
+    __slots__ = ("delete_if", "dev_id", "queued", "retried", "ret", "if_name", "done")
+
+    def __init__(self, delete_if, dev_id):
+        self.delete_if = delete_if
+        self.dev_id = dev_id
+        self.queued = time.monotonic()
+        self.retried = False
+        self.ret = NES_FAIL
+        self.if_name = ""
+        self.done = threading.Event()
+
+    def finish(self, ret, if_name=""):
+        """ hand result over to the caller """
+        self.ret = ret
+        self.if_name = if_name
+        self.done.set()
+
+
+class KniBatcher():
+    """ KNI add/del requests sent back-to-back over one NES session
+
+    Requests arriving within window seconds of the oldest queued one, up to
+    max_batch of them, are run in arrival order on a single session taken
+    from the pool, and each caller gets the result of its own request. A
+    request failing on a live session fails alone. If the session is lost,
+    the failed request is retried once and the rest of the batch continues
+    on a new session.
+    """
+    def __init__(self, lib, pool, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.lib = lib
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self.stats = {"batches": 0, "requests": 0, "failed": 0, "max_batch": 0,
+                      "sessions_lost": 0}
+        self._thread = threading.Thread(target=self._run, name="nes-kni-batch")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def modify(self, dev_id, delete_if):
+        """ run nes_kni_del or nes_kni_add for dev_id, returns (result, interface name) """
+        request = _Request(delete_if, dev_id)
+        with self._cond:
+            if self._stopping:
+                return NES_FAIL, ""
+            self._queue.append(request)
+            if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                self._cond.notify()
+        request.done.wait()
+        return request.ret, request.if_name
+
+    def _take(self):
+        """ wait for the next batch, None once stopped and drained """
+        with self._cond:
+            while not self._queue and not self._stopping:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            deadline = self._queue[0].queued + self.window
+            while len(self._queue) < self.max_batch and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue),
+                                                             self.max_batch))]
+
+    def _call(self, conn, request):
+        """ run request on the session, returns (result, interface name) """
+        func = self.lib.nes_kni_del if request.delete_if else self.lib.nes_kni_add
+        if_name = ctypes.create_string_buffer(KNI_NAMESIZE)
+        try:
+            ret = func(ctypes.byref(conn), ctypes.create_string_buffer(
+                request.dev_id.encode("utf-8")), if_name)
+        except RuntimeError as err:
+            _LOG.critical("nes_api library error\n %s", err)
+            return NES_FAIL, ""
+        return ret, if_name.value.decode("utf-8")
+
+    def _send(self, pending):
+        """ run requests on as few sessions as possible """
+        while pending:
+            with self.pool.session() as conn:
+                if conn is None:
+                    _LOG.error("NES is unreachable, failing %s KNI requests", len(pending))
+                    return
+                while pending:
+                    request = pending[0]
+                    start = time.monotonic()
+                    ret, if_name = self._call(conn, request)
+                    if NES_SUCCESS != ret and self.pool.expired(conn, start):
+                        # NES may be hung, the request is not retried on the next session
+                        pending.popleft().finish(ret, if_name)
+                        break
+                    if NES_SUCCESS == ret or self.pool.is_alive(conn):
+                        pending.popleft().finish(ret, if_name)
+                        continue
+                    # released as broken, the next session is a new one
+                    conn.state = NES_REMOTE_INVALID
+                    self.stats["sessions_lost"] += 1
+                    if request.retried:
+                        pending.popleft().finish(ret, if_name)
+                    else:
+                        request.retried = True
+                        _LOG.info("NES session lost, continuing %s KNI requests on a new one",
+                                  len(pending))
+                    break
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            try:
+                self._send(collections.deque(batch))
+            finally:
+                failed = 0
+                for request in batch:
+                    if not request.done.is_set():
+                        request.finish(NES_FAIL)
+                    if NES_SUCCESS != request.ret:
+                        failed += 1
+                self.stats["batches"] += 1
+                self.stats["requests"] += len(batch)
+                self.stats["failed"] += failed
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+
+    def stop(self):
+        """ run requests already queued and stop, later ones fail """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
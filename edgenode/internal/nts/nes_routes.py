@@ -0,0 +1,451 @@
+# coding: utf-8
+""" bulk NES traffic route management """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import ctypes
+import ctypes.util
+import logging
+import socket
+import threading
+import time
+
+import metrics
+import nes_stats
+
+NES_SUCCESS = 0
+NES_FAIL = 1
+ROUTES_LIST_MAX_CNT = 1024
+NES_MAX_LOOKUP_ENTRY_LEN = 220
+MAX_LOOKUP_ENTRIES = 10
+ACL_MAX_PRIORITY = 0x1FFFFFFF
+NTS_ENCAP_GTPU_FLAG = 1 << 1
+
+# nes_route_data_t fields, see libs/libnes_api/nes_api_common.h; a route is kept
+# as the tuple of their values
+FIELDS = ("prio", "encap_proto", "qci_min", "qci_max", "spid_min", "spid_max",
+          "teid_min", "teid_max", "enb_ip", "enb_ip_mask", "epc_ip", "epc_ip_mask",
+          "ue_ip", "ue_ip_mask", "srv_ip", "srv_ip_mask", "ue_port_min", "ue_port_max",
+          "srv_port_min", "srv_port_max")
+_INDEX = {name: index for index, name in enumerate(FIELDS)}
+
+# lookup keys: (name, kind, first field, upper limit), in the order they are written
+_RANGE, _IP = "range", "ip"
+LOOKUP_KEYS = (("qci", _RANGE, "qci_min", 0xFF), ("spid", _RANGE, "spid_min", 0xFF),
+               ("teid", _RANGE, "teid_min", 0xFFFFFFFF), ("enb_ip", _IP, "enb_ip", 32),
+               ("epc_ip", _IP, "epc_ip", 32), ("ue_ip", _IP, "ue_ip", 32),
+               ("srv_ip", _IP, "srv_ip", 32), ("ue_port", _RANGE, "ue_port_min", 0xFFFF),
+               ("srv_port", _RANGE, "srv_port_min", 0xFFFF))
+_KEYS = {key[0]: key for key in LOOKUP_KEYS}
+# keys NES ignores for routes without GTP-U encapsulation
+_GTPU_KEYS = ("qci", "spid", "teid", "enb_ip", "epc_ip")
+
+# route with nothing but the priority set, i.e. matching any traffic
+DEFAULT_FIELDS = (0, NTS_ENCAP_GTPU_FLAG, 0, 0xFF, 0, 0xFF, 0, 0xFFFFFFFF, 0, 0, 0, 0,
+                  0, 0, 0, 0, 0, 0xFFFF, 0, 0xFFFF)
+
+# NES adds each route together with its reverse, matching the traffic in the
+# other direction: source and destination fields are swapped
+_REVERSE = list(range(len(FIELDS)))
+for _src, _dst in (("enb_ip", "epc_ip"), ("enb_ip_mask", "epc_ip_mask"), ("ue_ip", "srv_ip"),
+                   ("ue_ip_mask", "srv_ip_mask"), ("ue_port_min", "srv_port_min"),
+                   ("ue_port_max", "srv_port_max")):
+    _REVERSE[_INDEX[_src]], _REVERSE[_INDEX[_dst]] = _INDEX[_dst], _INDEX[_src]
+
+_LOG = logging.getLogger(__name__)
+
+
+class NesRouteDataT(ctypes.Structure):
+    """ nes_route_data_t """
+    _pack_ = 1
+    _fields_ = [("prio", ctypes.c_int)] + \
+        [(name, ctypes.c_uint8) for name in FIELDS[1:6]] + \
+        [(name, ctypes.c_uint32) for name in FIELDS[6:16]] + \
+        [(name, ctypes.c_uint16) for name in FIELDS[16:]] + \
+        [("dst_mac_addr", nes_stats.EtherAddr)]
+
+
+def bind_route_api(lib):
+    """ set result types of the nes_api route functions """
+    for func in (lib.nes_route_add, lib.nes_route_add_mirror, lib.nes_route_remove,
+                 lib.nes_route_remove_mirror, lib.nes_route_list, lib.nes_route_clear_all):
+        func.restype = ctypes.c_int
+
+
+def _parse_uint(text, limit):
+    """ unsigned number as strtoul() with base 0 reads it """
+    text = text.strip()
+    base = 16 if text[:2].lower() == "0x" else 8 if len(text) > 1 and text[0] == "0" else 10
+    value = int(text, base)
+    if value < 0 or value > limit:
+        raise ValueError("{} is out of range 0-{}".format(text, limit))
+    return value
+
+def _parse_value(kind, value, limit):
+    if kind == _IP:
+        address, sep, mask = value.partition("/")
+        mask = _parse_uint(mask, limit) if sep else limit
+        try:
+            packed = socket.inet_aton(address.strip())
+        except OSError:
+            raise ValueError("Invalid IP address {}".format(address))
+        return int.from_bytes(packed, "big"), mask
+    low, sep, high = value.partition("-")
+    low = _parse_uint(low, limit)
+    return low, _parse_uint(high, limit) if sep else low
+
+def parse_lookup(lookup):
+    """ route fields tuple of a lookup keys string, raises ValueError
+
+    Follows nts_acl_cfg_lookup_prepare(): keys which are not given match
+    any value, routes are GTP-U encapsulated unless encap_proto:noencap is
+    given and in that case the GTP-U keys are ignored.
+    """
+    if len(lookup) > NES_MAX_LOOKUP_ENTRY_LEN:
+        raise ValueError("Lookup keys longer than {} characters"
+                         .format(NES_MAX_LOOKUP_ENTRY_LEN))
+    entries = lookup.split(",")
+    if len(entries) > MAX_LOOKUP_ENTRIES:
+        raise ValueError("More than {} lookup keys".format(MAX_LOOKUP_ENTRIES))
+    pairs = []
+    for entry in entries:
+        name, sep, value = entry.partition(":")
+        if not sep or ":" in value:
+            raise ValueError("Unable to parse lookup key {}".format(entry.strip()))
+        pairs.append((name.strip(), value.strip()))
+    encap = [value for name, value in pairs if name == "encap_proto"]
+    if len(pairs) - bool(encap) < 2:
+        raise ValueError("Not enough lookup keys")
+    fields = list(DEFAULT_FIELDS)
+    if encap:
+        if encap[0] not in ("gtpu", "noencap"):
+            raise ValueError("Unknown encap_proto {}".format(encap[0]))
+        fields[_INDEX["encap_proto"]] = NTS_ENCAP_GTPU_FLAG if encap[0] == "gtpu" else 0
+    pure_ip = not fields[_INDEX["encap_proto"]]
+    for name, value in pairs:
+        if name == "prio":
+            fields[_INDEX["prio"]] = _parse_uint(value, ACL_MAX_PRIORITY)
+            continue
+        if name == "encap_proto" or (pure_ip and name in _GTPU_KEYS):
+            continue
+        if name not in _KEYS:
+            raise ValueError("Unknown lookup key {}".format(name))
+        _, kind, first, limit = _KEYS[name]
+        index = _INDEX[first]
+        fields[index], fields[index + 1] = _parse_value(kind, value, limit)
+    return tuple(fields)
+
+def format_lookup(fields):
+    """ lookup keys string selecting the route fields tuple """
+    keys = ["prio:{}".format(fields[0])]
+    if not fields[_INDEX["encap_proto"]]:
+        keys.append("encap_proto:noencap")
+    for name, kind, first, _ in LOOKUP_KEYS:
+        index = _INDEX[first]
+        value, extent = fields[index], fields[index + 1]
+        if value == DEFAULT_FIELDS[index] and extent == DEFAULT_FIELDS[index + 1]:
+            continue
+        if kind == _IP:
+            address = socket.inet_ntoa(value.to_bytes(4, "big"))
+            keys.append("{}:{}/{}".format(name, address, extent))
+        else:
+            keys.append("{}:{}-{}".format(name, value, extent))
+    if len(keys) < 2 or keys[-1] == "encap_proto:noencap":
+        # NES wants one key besides prio, give the default explicitly
+        keys.append("srv_port:0-65535")
+    return ",".join(keys)
+
+def parse_mac(text):
+    """ bytes of XX:XX:XX:XX:XX:XX MAC address, raises ValueError """
+    octets = text.strip().split(":")
+    if len(octets) != 6 or not all(0 < len(octet) <= 2 for octet in octets):
+        raise ValueError("Invalid MAC address {}".format(text.strip()))
+    return bytes(int(octet, 16) for octet in octets)
+
+def format_mac(mac):
+    """ XX:XX:XX:XX:XX:XX form of MAC address bytes """
+    return ":".join("{:02x}".format(octet) for octet in mac)
+
+
+class Route():
+    """ route of the traffic matching the lookup fields to the destination MAC """
+    def __init__(self, fields, mac):
+        self.fields = fields
+        self.mac = mac
+        reverse = tuple(fields[index] for index in _REVERSE)
+        # the same for a route and its reverse, the pair is added and removed at once
+        self.key = min(fields, reverse)
+
+    @classmethod
+    def parse(cls, mac, lookup):
+        """ route of MAC address and lookup keys strings, raises ValueError """
+        mac = parse_mac(mac)
+        return cls(parse_lookup(lookup), mac)
+
+    @classmethod
+    def from_data(cls, data):
+        """ route of nes_route_data_t """
+        return cls(tuple(getattr(data, name) for name in FIELDS),
+                   bytes(data.dst_mac_addr.ether_addr_octet))
+
+    @property
+    def lookup(self):
+        """ lookup keys string """
+        return format_lookup(self.fields)
+
+    def __str__(self):
+        return "{} {}".format(format_mac(self.mac), self.lookup)
+
+
+def read_routes(path):
+    """ read routes file, returns (routes, [(line, error)])
+
+    Each line holds the destination MAC and the lookup keys as given to
+    nes_client "route add", e.g.
+      00:11:22:33:44:55 prio:99,encap_proto:noencap,srv_ip:192.168.10.11/32
+    Empty lines and lines starting with # or ; are skipped.
+    """
+    routes = []
+    errors = []
+    with open(path) as routes_file:
+        for number, line in enumerate(routes_file, 1):
+            line = line.strip()
+            if not line or line[0] in "#;":
+                continue
+            mac, _, lookup = line.partition(" ")
+            try:
+                routes.append(Route.parse(mac, lookup.strip()))
+            except ValueError as err:
+                errors.append(("{}:{}: {}".format(path, number, line), str(err)))
+    return routes, errors
+
+
+class RouteReport():
+    """ outcome of a routes apply, one entry per route touched """
+    ACTIONS = ("added", "removed", "replaced", "unchanged")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.ACTIONS, 0)
+        self.counts["failed"] = 0
+        self.failures = []
+        self.duration = 0.0
+
+    def record(self, action, route, error=None):
+        """ count route outcome, error is set for failed ones """
+        if error is None:
+            self.counts[action] += 1
+            return
+        self.counts["failed"] += 1
+        self.failures.append((action, str(route), error))
+
+    @property
+    def success(self):
+        """ check if every route was applied """
+        return not self.failures
+
+    def as_dict(self):
+        """ report as dict """
+        report = dict(self.counts)
+        report["duration"] = self.duration
+        report["failures"] = [{"action": action, "route": route, "error": error}
+                              for action, route, error in self.failures]
+        return report
+
+    def log(self):
+        """ log summary and failed routes """
+        for action, route, error in self.failures:
+            _LOG.error("Route %s failed: %s [%s]", action, error, route)
+        _LOG.info("Routes applied in {:.3f}s: {}".format(
+            self.duration, ", ".join("{} {}".format(count, name)
+                                     for name, count in self.counts.items())))
+
+
+class RouteManager():
+    """ apply desired NES route sets
+
+    A whole apply runs on one pooled NES session: the routes NES holds are
+    streamed page by page and diffed against the desired set, then the
+    stale ones are removed and the missing ones added. A route whose
+    destination changed is replaced. Mirror routes are listed by NES like
+    any other route, so they are pruned as well unless part of the set.
+    Given the NES protocol client, it is used instead of lib and pool.
+    """
+    def __init__(self, lib, pool, page_size=ROUTES_LIST_MAX_CNT, client=None):
+        if client is None:
+            bind_route_api(lib)
+        self.lib = lib
+        self.pool = pool
+        self.client = client
+        self.page_size = min(page_size, ROUTES_LIST_MAX_CNT)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._free = ctypes.CDLL(ctypes.util.find_library("c")).free
+        self._free.argtypes = (ctypes.c_void_p,)
+
+    def _call(self, stage, func, *args):
+        """ run NES API function on the batch session, reconnecting once if it was lost """
+        start = time.monotonic()
+        if self.client is not None:
+            ret = func(*args)
+            metrics.observe_stage(stage, start, NES_SUCCESS == ret)
+            return ret
+        ret = NES_FAIL
+        for _ in range(2):
+            if self._conn is None:
+                self._conn = self.pool.acquire()
+                if self._conn is None:
+                    break
+            call_start = time.monotonic()
+            ret = func(ctypes.byref(self._conn), *args)
+            if NES_SUCCESS != ret and self.pool.expired(self._conn, call_start):
+                self._release()
+                break
+            if NES_SUCCESS == ret or self.pool.is_alive(self._conn):
+                break
+            _LOG.info("NES session lost, retrying on a new one")
+            self.pool.release(self._conn, broken=True)
+            self._conn = None
+        metrics.observe_stage(stage, start, NES_SUCCESS == ret)
+        return ret
+
+    def _release(self):
+        if self._conn is not None:
+            self.pool.release(self._conn)
+            self._conn = None
+
+    def list_routes(self):
+        """ generator of the routes NES holds, read one page at a time
+
+        Raises RuntimeError if a page can not be read.
+        """
+        if self.client is not None:
+            yield from self._list_client_routes()
+            return
+        page = ctypes.POINTER(NesRouteDataT)()
+        count = ctypes.c_uint16()
+        offset = 0
+        while True:
+            if NES_SUCCESS != self._call("nes_route_list", self.lib.nes_route_list,
+                                         ctypes.c_uint16(offset),
+                                         ctypes.c_uint16(self.page_size),
+                                         ctypes.byref(page), ctypes.byref(count)):
+                raise RuntimeError("Failed to list NES routes at offset {}".format(offset))
+            try:
+                for index in range(count.value):
+                    yield Route.from_data(page[index])
+            finally:
+                if page:
+                    self._free(page)
+                    page = ctypes.POINTER(NesRouteDataT)()
+            offset += count.value
+            if count.value < self.page_size:
+                return
+            if offset > 0xFFFF:
+                raise RuntimeError("More than {} NES routes".format(0xFFFF))
+
+    def _list_client_routes(self):
+        offset = 0
+        while True:
+            start = time.monotonic()
+            page = self.client.route_list(offset, self.page_size)
+            metrics.observe_stage("nes_route_list", start, page is not None)
+            if page is None:
+                raise RuntimeError("Failed to list NES routes at offset {}".format(offset))
+            for data in page:
+                yield Route.from_data(data)
+            offset += len(page)
+            if len(page) < self.page_size:
+                return
+            if offset > 0xFFFF:
+                raise RuntimeError("More than {} NES routes".format(0xFFFF))
+
+    def _add(self, route):
+        if self.client is not None:
+            return NES_SUCCESS == self._call("nes_route_add", self.client.route_add, route.mac,
+                                             route.lookup)
+        mac = nes_stats.EtherAddr()
+        mac.ether_addr_octet[:] = route.mac
+        keys = ctypes.create_string_buffer(route.lookup.encode("utf-8"))
+        return NES_SUCCESS == self._call("nes_route_add", self.lib.nes_route_add, mac, keys, -1)
+
+    def _remove(self, route):
+        if self.client is not None:
+            return NES_SUCCESS == self._call("nes_route_remove", self.client.route_remove,
+                                             route.lookup)
+        keys = ctypes.create_string_buffer(route.lookup.encode("utf-8"))
+        return NES_SUCCESS == self._call("nes_route_remove", self.lib.nes_route_remove, keys)
+
+    def apply(self, desired, prune=True):
+        """ make NES hold the desired routes, returns RouteReport
+
+        With prune, routes NES holds which are not desired are removed.
+        """
+        report = RouteReport()
+        start = time.monotonic()
+        wanted = {}
+        for route in desired:
+            other = wanted.setdefault(route.key, route)
+            if other.mac != route.mac:
+                report.record("invalid", route, "Conflicts with {}".format(other))
+        with self._lock:
+            try:
+                stale, present = self._diff(wanted, prune)
+            except RuntimeError as err:
+                self._release()
+                report.record("list", "NES routes", str(err))
+                report.duration = time.monotonic() - start
+                return report
+            try:
+                for route in stale:
+                    report.record("removed", route,
+                                  None if self._remove(route) else "NES rejected removal")
+                for key, route in wanted.items():
+                    mac = present.get(key)
+                    if mac == route.mac:
+                        report.record("unchanged", route)
+                        continue
+                    action = "added" if mac is None else "replaced"
+                    if mac is not None and not self._remove(route):
+                        report.record(action, route, "NES rejected removal of the old route")
+                        continue
+                    report.record(action, route, None if self._add(route) else
+                                  "NES rejected route, it may overlap another one")
+            finally:
+                self._release()
+        report.duration = time.monotonic() - start
+        return report
+
+    def _diff(self, wanted, prune):
+        """ stream NES routes, returns (stale routes, {key: MAC} of the desired ones present) """
+        stale = {}
+        present = {}
+        for route in self.list_routes():
+            if route.key in wanted:
+                present[route.key] = route.mac
+            elif prune:
+                # a route and its reverse share the key, remove the pair once
+                stale.setdefault(route.key, route)
+        return list(stale.values()), present
+
+    def apply_file(self, path, prune=True):
+        """ apply routes file, returns RouteReport """
+        try:
+            routes, errors = read_routes(path)
+        except OSError as err:
+            report = RouteReport()
+            report.record("invalid", path, str(err))
+            report.log()
+            return report
+        if errors and prune:
+            # removing routes of the lines which failed to parse would cut traffic
+            report = RouteReport()
+            for line, error in errors:
+                report.record("invalid", line, error)
+            _LOG.error("Not applying %s, it has invalid routes", path)
+            report.log()
+            return report
+        report = self.apply(routes, prune)
+        for line, error in errors:
+            report.record("invalid", line, error)
+        report.log()
+        return report
@@ -0,0 +1,393 @@
+# coding: utf-8
+""" NES device and ring statistics sampler """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CTRL_NAME_SIZE = 15
+DEFAULT_INTERVAL = 1.0
+DEFAULT_HISTORY = 60
+MAX_DEVICES = 64
+MAX_RINGS = 256
+
+# nes_dev_stats_t and nes_ring_stats_t fields, see libs/libnes_api/nes_api_common.h
+DEV_COUNTERS = ("rcv_cnt", "snd_cnt", "drp_cnt_1", "drp_cnt_2", "rcv_bytes", "snd_bytes",
+                "drp_bytes_1", "ip_fragment")
+RING_COUNTERS = ("rcv_cnt", "snd_cnt", "drp_cnt_1", "drp_cnt_2")
+DEV_DROPS = ("drp_cnt_1", "drp_cnt_2")
+RING_DROPS = ("drp_cnt_1", "drp_cnt_2")
+
+_LOG = logging.getLogger(__name__)
+
+
+class NesDevStatsT(ctypes.Structure):
+    """ nes_dev_stats_t """
+    _pack_ = 1
+    _fields_ = [(name, ctypes.c_uint64) for name in DEV_COUNTERS]
+
+class NesRingStatsT(ctypes.Structure):
+    """ nes_ring_stats_t """
+    _pack_ = 1
+    _fields_ = [(name, ctypes.c_uint64) for name in RING_COUNTERS]
+
+class EtherAddr(ctypes.Structure):
+    """ struct ether_addr """
+    _fields_ = [("ether_addr_octet", ctypes.c_ubyte * 6)]
+
+class NesApiDevT(ctypes.Structure):
+    """ nes_api_dev_t """
+    _fields_ = [("name", ctypes.c_char * CTRL_NAME_SIZE),
+                ("index", ctypes.c_uint16),
+                ("macaddr", EtherAddr),
+                ("stats", NesDevStatsT)]
+
+class NesApiRingT(ctypes.Structure):
+    """ nes_api_ring_t """
+    _pack_ = 1
+    _fields_ = [("name", ctypes.c_char * CTRL_NAME_SIZE),
+                ("index", ctypes.c_uint16),
+                ("stats", NesRingStatsT)]
+
+class NesSqNodeT(ctypes.Structure):
+    """ nes_sq_node_t """
+
+NesSqNodeT._fields_ = [("data", ctypes.c_void_p),
+                       ("next", ctypes.POINTER(NesSqNodeT))]
+
+class NesSqT(ctypes.Structure):
+    """ nes_sq_t """
+    _fields_ = [("head", ctypes.POINTER(NesSqNodeT)),
+                ("tail", ctypes.POINTER(NesSqNodeT)),
+                ("cnt", ctypes.c_int)]
+
+_NES_SQ_P = ctypes.POINTER(NesSqT)
+
+
+def bind_stats_api(lib):
+    """ set result types of the nes_api stats functions """
+    lib.nes_stats_all_dev.restype = _NES_SQ_P
+    lib.nes_stats_all_ring.restype = _NES_SQ_P
+    lib.nes_stats_dev.restype = ctypes.c_int
+    lib.nes_stats_ring.restype = ctypes.c_int
+    lib.nes_sq_dtor_free.restype = None
+
+
+class StatsTable():
+    """ counters of one kind of NES objects (devices or rings)
+
+    The list returned by NES is copied into a preallocated ctypes array,
+    or read straight into it by the protocol client, and its counters into
+    a preallocated ring of samples. Rates are the
+    deltas between the last two samples divided by the time between them;
+    a row whose counters went back (object re-created) reports no rate.
+    With NumPy the samples are views of the ctypes array and all deltas
+    and rates are computed in place, without NumPy plain lists are used.
+    """
+    def __init__(self, kind, struct, counters, drops, size, history):
+        self.kind = kind
+        self.struct = struct
+        self.counters = counters
+        self.drops = tuple(counters.index(name) for name in drops)
+        self.size = size
+        self.history = history
+        self.raw = (struct * size)()
+        self.count = 0
+        self.samples = 0
+        self.times = [0.0] * history
+        self.counts = [0] * history
+        self.valid = False
+        if numpy is not None:
+            self._init_numpy()
+        else:
+            self._values = [[[0] * len(counters) for _ in range(size)] for _ in range(history)]
+            self._rates = [[0.0] * len(counters) for _ in range(size)]
+            self._index = [[0] * size for _ in range(history)]
+
+    def _init_numpy(self):
+        dtype = numpy.dtype({"names": ["name", "index", "stats"],
+                             "formats": ["S{}".format(CTRL_NAME_SIZE), "<u2",
+                                         ("<u8", (len(self.counters),))],
+                             "offsets": [0, self.struct.index.offset, self.struct.stats.offset],
+                             "itemsize": ctypes.sizeof(self.struct)})
+        self.view = numpy.frombuffer(self.raw, dtype=dtype)
+        shape = (self.size, len(self.counters))
+        self._values = numpy.zeros((self.history,) + shape, dtype=numpy.uint64)
+        self._index = numpy.zeros((self.history, self.size), dtype=numpy.uint16)
+        self._delta = numpy.zeros(shape, dtype=numpy.uint64)
+        self._reset = numpy.zeros(shape, dtype=bool)
+        self._rates = numpy.zeros(shape, dtype=numpy.float64)
+        self._changed = numpy.zeros(self.size, dtype=bool)
+
+    def fill(self, sq_list):
+        """ copy NES list elements into the raw array, returns their number """
+        count = 0
+        item_size = ctypes.sizeof(self.struct)
+        node = sq_list.contents.head
+        while node and count < self.size:
+            ctypes.memmove(ctypes.addressof(self.raw) + count * item_size, node.contents.data,
+                           item_size)
+            count += 1
+            node = node.contents.next
+        if node:
+            _LOG.warning("More than %s NES %s, ignoring the rest", self.size, self.kind)
+        self.count = count
+        return count
+
+    def fill_size(self, data_size):
+        """ take the structs of a response of data_size bytes read into the raw array,
+        returns their number
+        """
+        total = data_size // ctypes.sizeof(self.struct)
+        if total > self.size:
+            _LOG.warning("More than %s NES %s, ignoring the rest", self.size, self.kind)
+        self.count = min(total, self.size)
+        return self.count
+
+    def record(self, timestamp):
+        """ store counters of the raw array as a new sample and update rates """
+        slot = self.samples % self.history
+        prev = (self.samples - 1) % self.history
+        count = self.count
+        self.times[slot] = timestamp
+        self.counts[slot] = count
+        if numpy is not None:
+            numpy.copyto(self._values[slot], self.view["stats"])
+            numpy.copyto(self._index[slot], self.view["index"])
+        else:
+            values = self._values[slot]
+            index = self._index[slot]
+            for row in range(count):
+                item = self.raw[row]
+                index[row] = item.index
+                stats = item.stats
+                out = values[row]
+                for column, name in enumerate(self.counters):
+                    out[column] = getattr(stats, name)
+        self.samples += 1
+        self.valid = self.samples > 1 and self.counts[prev] == count and \
+            timestamp > self.times[prev]
+        if self.valid:
+            self._update_rates(slot, prev, count, 1.0 / (timestamp - self.times[prev]))
+
+    def _update_rates(self, slot, prev, count, inverse_interval):
+        if numpy is not None:
+            current = self._values[slot]
+            previous = self._values[prev]
+            numpy.subtract(current, previous, out=self._delta)
+            numpy.less(current, previous, out=self._reset)
+            numpy.not_equal(self._index[slot], self._index[prev], out=self._changed)
+            self._reset |= self._changed[:, None]
+            numpy.copyto(self._delta, 0, where=self._reset)
+            numpy.multiply(self._delta, inverse_interval, out=self._rates)
+            return
+        current = self._values[slot]
+        previous = self._values[prev]
+        index = self._index[slot]
+        for row in range(count):
+            rates = self._rates[row]
+            same = index[row] == self._index[prev][row]
+            for column in range(len(self.counters)):
+                delta = current[row][column] - previous[row][column]
+                rates[column] = delta * inverse_interval if same and delta > 0 else 0.0
+
+    def name(self, row):
+        """ name of the object in the row """
+        return self.raw[row].name.decode("utf-8", "replace")
+
+    def value(self, row, column):
+        """ last sampled counter """
+        return int(self._values[(self.samples - 1) % self.history][row][column])
+
+    def rate(self, row, column):
+        """ per second rate of the counter over the last interval """
+        return float(self._rates[row][column])
+
+    def dropping(self):
+        """ names of the objects which dropped packets in the last interval """
+        if not self.valid:
+            return []
+        return [self.name(row) for row in range(self.count)
+                if any(self._rates[row][column] > 0 for column in self.drops)]
+
+    def series(self, row, column):
+        """ (time, value) samples of a counter still held in the history """
+        start = max(0, self.samples - self.history)
+        return [(self.times[slot], int(self._values[slot][row][column]))
+                for slot in (sample % self.history for sample in range(start, self.samples))
+                if row < self.counts[slot]]
+
+    def snapshot(self):
+        """ {name: {counter: rate}} of the last interval """
+        if not self.valid:
+            return {}
+        return {self.name(row): {name: self.rate(row, column)
+                                 for column, name in enumerate(self.counters)}
+                for row in range(self.count)}
+
+    def render(self, prefix):
+        """ Prometheus text exposition lines """
+        lines = []
+        for column, counter in enumerate(self.counters):
+            total = "{}_{}_total".format(prefix, counter)
+            rate = "{}_{}_rate".format(prefix, counter)
+            lines.extend(["# HELP {} NES {} {} counter".format(total, self.kind, counter),
+                          "# TYPE {} counter".format(total)])
+            lines.extend('{}{{{}="{}"}} {}'.format(total, self.kind, self.name(row),
+                                                   self.value(row, column))
+                         for row in range(self.count))
+            if not self.valid:
+                continue
+            lines.extend(["# HELP {} NES {} {} per second".format(rate, self.kind, counter),
+                          "# TYPE {} gauge".format(rate)])
+            lines.extend('{}{{{}="{}"}} {}'.format(rate, self.kind, self.name(row),
+                                                   self.rate(row, column))
+                         for row in range(self.count))
+        return lines
+
+
+class NesStatsSampler():
+    """ sample all NES device and ring counters at a fixed interval
+
+    Runs in its own thread on a session of the NES connection pool, or on
+    the NES protocol client when one is given instead of the library.
+    """
+    def __init__(self, lib, pool, interval=DEFAULT_INTERVAL, history=DEFAULT_HISTORY,
+                 output_path=None, client=None):
+        if client is None:
+            bind_stats_api(lib)
+            self._list_dev, self._list_ring = lib.nes_stats_all_dev, lib.nes_stats_all_ring
+        else:
+            self._list_dev = client.stats_all_dev_into
+            self._list_ring = client.stats_all_ring_into
+        self.lib = lib
+        self.pool = pool
+        self.client = client
+        self.interval = interval
+        self.output_path = output_path
+        self.devices = StatsTable("device", NesApiDevT, DEV_COUNTERS, DEV_DROPS,
+                                  MAX_DEVICES, history)
+        self.rings = StatsTable("ring", NesApiRingT, RING_COUNTERS, RING_DROPS,
+                                MAX_RINGS, history)
+        self.stats = {"samples": 0, "failures": 0, "overruns": 0}
+        self._dev_stats = NesDevStatsT()
+        self._ring_stats = NesRingStatsT()
+        self._free = ctypes.CDLL(ctypes.util.find_library("c")).free
+        self._free.argtypes = (ctypes.c_void_p,)
+        self._stop = threading.Event()
+        self._thread = None
+        self._output = None
+
+    def _read_list(self, func, table):
+        """ fetch NES list and copy it into the table """
+        if self.client is not None:
+            data_size = func(table.raw)
+            if data_size is None:
+                return False
+            table.fill_size(data_size)
+            return True
+        sq_list = self.pool.call(func)
+        # the pool reports an unreachable NES with an error code instead of a list
+        if not isinstance(sq_list, _NES_SQ_P) or not sq_list:
+            return False
+        try:
+            table.fill(sq_list)
+        finally:
+            self.lib.nes_sq_dtor_free(sq_list)
+            self._free(sq_list)
+        return True
+
+    def dev_stats(self, index):
+        """ counters of one device, None on failure """
+        if self.client is not None:
+            stats = self.client.stats_dev(index)
+            return None if stats is None else \
+                {name: getattr(stats, name) for name in DEV_COUNTERS}
+        if self.pool.call(self.lib.nes_stats_dev, ctypes.c_uint16(index),
+                          ctypes.byref(self._dev_stats)) != 0:
+            return None
+        return {name: getattr(self._dev_stats, name) for name in DEV_COUNTERS}
+
+    def ring_stats(self, index):
+        """ counters of one ring, None on failure """
+        if self.client is not None:
+            stats = self.client.stats_ring(index)
+            return None if stats is None else \
+                {name: getattr(stats, name) for name in RING_COUNTERS}
+        if self.pool.call(self.lib.nes_stats_ring, ctypes.c_uint16(index),
+                          ctypes.byref(self._ring_stats)) != 0:
+            return None
+        return {name: getattr(self._ring_stats, name) for name in RING_COUNTERS}
+
+    def sample(self):
+        """ take one sample of all devices and rings """
+        now = time.monotonic()
+        if not self._read_list(self._list_dev, self.devices) or \
+                not self._read_list(self._list_ring, self.rings):
+            self.stats["failures"] += 1
+            _LOG.error("Failed to read NES statistics")
+            return False
+        self.devices.record(now)
+        self.rings.record(now)
+        self.stats["samples"] += 1
+        for table in (self.devices, self.rings):
+            dropping = table.dropping()
+            if dropping:
+                _LOG.warning("NES %s dropping packets: %s", table.kind, ", ".join(dropping))
+        if self._output is not None:
+            self._export(time.time())
+        return True
+
+    def _export(self, timestamp):
+        """ append rates of the last interval to the time series file """
+        if not self.devices.valid:
+            return
+        record = {"time": timestamp, "devices": self.devices.snapshot(),
+                  "rings": self.rings.snapshot()}
+        self._output.write(json.dumps(record, sort_keys=True) + "\n")
+        self._output.flush()
+
+    def render(self):
+        """ Prometheus text exposition lines """
+        return self.devices.render("nts_nes_dev") + self.rings.render("nts_nes_ring")
+
+    def _run(self):
+        deadline = time.monotonic()
+        while True:
+            deadline += self.interval
+            self.sample()
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                self.stats["overruns"] += 1
+                deadline = time.monotonic()
+                delay = 0
+            if self._stop.wait(delay):
+                return
+
+    def start(self):
+        """ start sampling thread """
+        if self.output_path:
+            self._output = open(self.output_path, "a")
+        self._thread = threading.Thread(target=self._run, name="nes-stats")
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info("Sampling NES statistics every %ss", self.interval)
+
+    def stop(self):
+        """ stop sampling thread """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._output is not None:
+            self._output.close()
+            self._output = None
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# coding: utf-8
+""" nts docker daemon, KNI and OvS interfaces from one docker event stream """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import logging
+import sys
+import event_fanout
+import kni_docker_daemon
+import ovs_docker_daemon
+
+HANDLERS = (kni_docker_daemon.KniHandler, ovs_docker_daemon.OvsHandler)
+
+_LOG = logging.getLogger(__name__)
+
+
+def make_parser():
+    """ make parser function """
+    parser = argparse.ArgumentParser()
+    event_fanout.add_common_options(parser, "/var/log/nts_docker_daemon.log")
+    for handler in HANDLERS:
+        parser.add_argument(
+            "--" + handler.name, action="store_true", dest="enable_" + handler.name,
+            help="Manage {} of the containers".format(handler.description))
+    for handler in HANDLERS:
+        handler.add_options(parser)
+    return parser
+
+def setup_logger(options):
+    """ setup logger function """
+    return event_fanout.setup_logger(options, "NTS DAEMON")
+
+def main(options):
+    """ main """
+    handlers = [handler(options) for handler in HANDLERS
+                if getattr(options, "enable_" + handler.name)]
+    if not handlers:
+        _LOG.info("No handlers enabled - shutting down")
+        return 0
+    _LOG.info("Enabled handlers: %s", ", ".join(handler.name for handler in handlers))
+    return event_fanout.main(options, handlers)
+
+if __name__ == '__main__':
+    OPTIONS = make_parser().parse_args()
+    setup_logger(OPTIONS)
+    sys.exit(main(OPTIONS))
@@ -5,283 +5,691 @@
 # Copyright (c) 2019-2020 Intel Corporation
 
 import argparse
+import functools
 import logging
-import subprocess
-import signal
+import os
+import string
 import sys
-import re
-import docker
+import time
+import async_core
+import attach_profile
+import attachment_store
+import daemon_logging
+import debug_hooks
+import docker_events
+import event_fanout
+import link_backend
+import metrics
+import ovsdb_client
+import pod_selector
+import sandbox_lifecycle
+import veth_pool
+
+
+OVS_VSCTL = "/usr/local/bin/ovs-vsctl"
+OVS_IF_PREFIX = "ve1-"
+EVENT_ACTIONS = ("start", "die", "destroy")
+
+_LOG = logging.getLogger(__name__)
+_LINK = None
+_ALINK = None
+_OVSDB = None
+_POOL = None
+_STORE = None
+_PROFILES = None
 
 
-_HOST_NS = "/var/run/docker/netns/default"
-_HOST_NS_MNT = "/var/host_ns/mnt"
-_LOG = None
-
-
-def signal_handler():
-    """ signal handling function """
-    _LOG.info("Quiting")
-    sys.exit(0)
-
 def make_parser():
     """ make parser function """
-    log_levels = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
-    levels_str = "{0:s} or {1:s}".format(", ".join(log_levels[:-1]), log_levels[-1])
-
     parser = argparse.ArgumentParser()
-
-    parser.add_argument(
-        "-v", "--verbosity", action="store", metavar="LEVEL", dest="verbosity", default="INFO",
-        choices=log_levels,
-        help="Application diagnostic output verbosity ({0:s})".format(levels_str))
-    parser.add_argument(
-        "-f", "--filter", action="store", metavar="NAME_FILTER", dest="name_filter",
-        default="mec-app",
-        help="Only add KNI interfaces to a POD which name starts with name_filter")
-    parser.add_argument(
-        "-p", "--log-path", action="store", metavar="LOG_PATH", dest="log_path",
-        default="/var/log/ovs_daemon.log",
-        help="Log file path")
-    parser.add_argument(
-        "-b", "--bridge", action="store", metavar="BRIDGE_NAME", dest="bridge_name",
-        default="br0",
-        help="OvS bridge name")
+    event_fanout.add_common_options(parser, "/var/log/ovs_daemon.log")
     parser.add_argument(
         "-e", "--enable", action="store", metavar="ENABLE", dest="enable",
         default="false",
         help="Enable script working")
-
+    OvsHandler.add_options(parser)
     return parser
 
 def setup_logger(options):
     """ setup logger function """
-    log_fmt = "OVS DAEMON: [%(levelname)s] %(module)s(%(lineno)d): %(message)s"
-    ts_fmt = "%Y-%m-%dT%H:%M:%S"
-
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(log_fmt, ts_fmt))
-    root_logger = logging.getLogger('')
-    root_logger.addHandler(handler)
-    root_logger.setLevel(options.verbosity)
-    return root_logger
-
-
-
-def docker_connect():
-    """ docker connect function """
-    docker_cli = docker.from_env()
-    try:
-        docker_cli.ping()
-    except docker.errors.APIError as err:
-        _LOG.critical("Failed to connect to docker server\n {}".format(err))
-        return None
-    return docker_cli
+    return event_fanout.setup_logger(options, "OVS DAEMON")
 
 def create_veth_pair_names(docker_name, name_filter):
     """ create veth pair names function """
     if docker_name.startswith(name_filter):
         offset = len(name_filter)
-        return "ve1-"+docker_name[offset:offset+9], "ve2-"+docker_name[offset:offset+9]
+        return OVS_IF_PREFIX+docker_name[offset:offset+9], "ve2-"+docker_name[offset:offset+9]
 
-    return "ve1-"+docker_name[:9], "ve2-"+docker_name[:9]
+    return OVS_IF_PREFIX+docker_name[:9], "ve2-"+docker_name[:9]
 
 
-def run_command(command, expected_output):
-    """ run command function """
-    try:
-        ret = subprocess.check_output(command).decode("utf-8")
-    except subprocess.CalledProcessError as err:
-        _LOG.error("\"{}\" failed[{}]: {}".format(' '.join(err.cmd), err.returncode, err.output))
-        return False
-    return expected_output in ret
+def reserve_veth_pair_names(sandbox_id, ip_ns_path, docker_name, name_filter, bridge_name):
+    """ veth pair names for the sandbox, not recorded for another sandbox
+
+    create_veth_pair_names() truncates the container name, so different
+    containers may get the same names; those get a digit appended.
+    """
+    ovs_if, dst_if = create_veth_pair_names(docker_name, name_filter)
+    if _STORE is None:
+        return ovs_if, dst_if
+    for suffix in ("",) + tuple(string.digits):
+        owners = (_STORE.by_interface(ovs_if + suffix), _STORE.by_interface(dst_if + suffix))
+        if all(owner is None or owner["id"] == sandbox_id for owner in owners):
+            ovs_if, dst_if = ovs_if + suffix, dst_if + suffix
+            break
+    else:
+        _LOG.warning("Interface names %s/%s of %s are all taken", ovs_if, dst_if, docker_name)
+    _STORE.update(sandbox_id, pod=docker_name, netns=ip_ns_path, host_if=ovs_if,
+                  container_if=dst_if, bridge=bridge_name, state=None)
+    return ovs_if, dst_if
+
+def record_attachment(sandbox_id, docker_name, ovs_if, profile=attach_profile.PLAIN):
+    """ mark sandbox attached, with its pool port if it got one, and count its profile """
+    metrics.ATTACH_PROFILES.labels(profile.name).inc()
+    if _STORE is not None:
+        pool_if = _POOL.port_of(docker_name) if _POOL is not None else None
+        _STORE.update(sandbox_id, host_if=pool_if or ovs_if, state=sandbox_lifecycle.ATTACHED,
+                      profile=profile.name)
+
+def record_detachment(sandbox_id, success):
+    """ drop record of a detached sandbox, or mark it unknown if detaching failed """
+    if _STORE is None or sandbox_id is None:
+        return
+    if success:
+        _STORE.remove(sandbox_id)
+    elif _STORE.get(sandbox_id) is not None:
+        _STORE.update(sandbox_id, state=None)
+
+def detached_port(docker_name, name_filter, sandbox_id=None):
+    """ bridge port of the container to delete, as recorded when it was attached """
+    record = _STORE.get(sandbox_id) if _STORE is not None and sandbox_id is not None else None
+    pool_if = _POOL.release(docker_name) if _POOL is not None else None
+    if record is not None and record.get("host_if"):
+        return record["host_if"]
+    if pool_if is not None:
+        return pool_if
+    ovs_if, _ = create_veth_pair_names(docker_name, name_filter)
+    return ovs_if
+
+def default_profile():
+    """ profile of the sandboxes not selecting another one, and of the veth pool pairs """
+    return _PROFILES.default if _PROFILES is not None else attach_profile.PLAIN
+
+def profile_labels(event):
+    """ labels of the event container naming its profile, None if its pod labels do
+
+    Kubernetes pod labels are only carried by the pod sandbox, and events
+    submitted by reconcile() carry no labels at all.
+    """
+    attributes = event.get('Actor', {}).get('Attributes')
+    if attributes is None:
+        return None
+    if _PROFILES.label_key not in attributes and \
+            attributes.get(pod_selector.K8S_TYPE_LABEL) == 'container':
+        return None
+    return attributes
+
+def select_profile(sandboxes, event, sandbox_id):
+    """ attach profile of the sandbox """
+    if _PROFILES is None or not _PROFILES.selectable:
+        return default_profile()
+    labels = profile_labels(event)
+    if labels is None:
+        labels = sandboxes.pod_labels(sandbox_id)
+    return _PROFILES.select(labels)
+
+async def select_profile_async(sandboxes, event, sandbox_id):
+    """ attach profile of the sandbox for the asyncio mode """
+    if _PROFILES is None or not _PROFILES.selectable:
+        return default_profile()
+    labels = profile_labels(event)
+    if labels is None:
+        labels = await async_core.run_blocking(sandboxes.pod_labels, sandbox_id)
+    return _PROFILES.select(labels)
 
 def move_if(dst_ip_ns_path, if_name):
     """ move if function """
-    command_prefix = ["ip",
-                      "link",
-                      "set",
-                      if_name,
-                      "netns"]
-
-    move_to_host = command_prefix + [_HOST_NS]
-
-    move_to_dst = ["nsenter",
-                   "--mount=" + _HOST_NS_MNT,
-                   "--net=" + _HOST_NS] + \
-                    command_prefix + \
-                    [dst_ip_ns_path]
-
-    if not run_command(move_to_host, ""):
-        _LOG.error("Failed to move {} to the default namespace".format(if_name))
-        return False
-
-    if not run_command(move_to_dst, ""):
-        _LOG.error("Failed to move {} to {} namespace".format(if_name, dst_ip_ns_path))
-        return False
+    return _LINK.move_link(if_name, dst_ip_ns_path)
 
-    return True
+def move_if_to_host(if_name, bridge_name, profile=attach_profile.PLAIN):
+    """ move if to host function, the port gets the OVS columns of the profile """
+    add_to_ovs = link_backend.host_ns_command(
+        [OVS_VSCTL, "--may-exist", "add-port", bridge_name, if_name] +
+        profile.vsctl_args(if_name))
 
-def move_if_to_host(if_name, bridge_name):
-    """ move if to host function """
-    command_prefix = ["ip",
-                      "link",
-                      "set",
-                      if_name,
-                      "netns"]
-
-    move_to_host = command_prefix + [_HOST_NS]
-
-    add_to_ovs = ["nsenter",
-                  "--mount=" + _HOST_NS_MNT,
-                  "--net=" + _HOST_NS] + \
-    ["/usr/local/bin/ovs-vsctl", "add-port", bridge_name, if_name]
-
-    if not run_command(move_to_host, ""):
-        _LOG.error("Failed to move {} to the default namespace".format(if_name))
+    if not _LINK.move_link_to_host(if_name):
+        _LOG.error("Failed to move %s to the default namespace", if_name)
         return False
 
-    if not run_command(add_to_ovs, ""):
+    start = time.monotonic()
+    if _OVSDB is not None:
+        success = _OVSDB.add_port(bridge_name, if_name, profile.ovs)
+    else:
+        success = link_backend.run_command(add_to_ovs, "", retry=True)
+    metrics.observe_stage("ovs_add_port", start, success)
+    if not success:
         _LOG.error("Failed to add interface to ovs")
         return False
 
     return True
 
-def bring_if_up(docker_name, name_filter):
+def bring_if_up(docker_name, name_filter, ovs_if=None):
     """ bring if up function """
-    ovs_if = create_veth_pair_names(docker_name, name_filter)
-    bring_up = ["nsenter",
-                "--mount=" + _HOST_NS_MNT,
-                "--net=" + _HOST_NS] + \
-    ["ip", "link", "set", ovs_if, "up"]
-
-    if not run_command(bring_up, ""):
-        _LOG.error("Failed to bring interface {} up".format(ovs_if))
+    if _POOL is not None and _POOL.port_of(docker_name) is not None:
+        # pool pairs are up since they were created
+        return True
+    if ovs_if is None:
+        ovs_if, _ = create_veth_pair_names(docker_name, name_filter)
+
+    if not _LINK.set_link_up(ovs_if):
+        _LOG.error("Failed to bring interface %s up", ovs_if)
         return False
 
     return True
 
-def docker_create_if(docker_name, dst_ip_ns_path, bridge_name, name_filter):
-    """ docker create if function """
-    ovs_if, dst_if = create_veth_pair_names(docker_name, name_filter)
-    create_veth_pair = ["ip",
-                        "link",
-                        "add",
-                        ovs_if,
-                        "type",
-                        "veth",
-                        "peer",
-                        "name",
-                        dst_if]
-
-    if not run_command(create_veth_pair, ""):
-        _LOG.error("Failed to create veth pair with names vethp1/2" + docker_name)
+def set_offloads(profile, if_names):
+    """ apply offloads of the profile to the links, returns success """
+    return all(_LINK.set_offloads(if_name, profile.offloads) for if_name in if_names) \
+        if profile.offloads else True
+
+def docker_create_if(docker_name, dst_ip_ns_path, bridge_name, name_filter, names=None,
+                     profile=attach_profile.PLAIN):
+    """ docker create if function
+
+    The pair is set up as the profile says before it is up, pool pairs are
+    only handed out for the default profile they were created with.
+    """
+    ovs_if, dst_if = names or create_veth_pair_names(docker_name, name_filter)
+    pair = _POOL.acquire(docker_name) \
+        if _POOL is not None and profile is default_profile() else None
+    if pair is not None:
+        return attach_pool_pair(docker_name, pair, dst_ip_ns_path, bridge_name, dst_if)
+
+    if not _LINK.add_veth(ovs_if, dst_if, profile.mtu, profile.queues):
+        _LOG.error("Failed to create veth pair with names vethp1/2%s", docker_name)
+        return False
+
+    if not set_offloads(profile, (ovs_if, dst_if)):
+        _LINK.delete_link(ovs_if)
         return False
 
     # move to ovs host
-    if not move_if_to_host(ovs_if, bridge_name):
+    if not move_if_to_host(ovs_if, bridge_name, profile):
         _LOG.error("Failed to move interface to host")
-        run_command(["ip", "link", "delete", ovs_if], "")
-        run_command(["ip", "link", "delete", dst_if], "")
+        _LINK.delete_link(ovs_if)
+        _LINK.delete_link(dst_if)
 
         return False
 
     # move to docker dst
     if not move_if(dst_ip_ns_path, dst_if):
-        _LOG.error("Failed to move interface to container " + docker_name)
+        _LOG.error("Failed to move interface to container %s", docker_name)
+        delete_port(ovs_if, bridge_name)
         return False
 
     return True
 
-def docker_delete_if(docker_name, bridge_name, name_filter):
+def delete_port(ovs_if, bridge_name):
+    """ delete port function """
+    remove_from_ovs = link_backend.host_ns_command(
+        [OVS_VSCTL, "--if-exists", "del-port", bridge_name, ovs_if])
+
+    start = time.monotonic()
+    if _OVSDB is not None:
+        success = _OVSDB.del_port(bridge_name, ovs_if)
+    else:
+        success = link_backend.run_command(remove_from_ovs, "", retry=True)
+    metrics.observe_stage("ovs_del_port", start, success)
+    if not success:
+        _LOG.error("Failed to remove interface from ovs: %s", ovs_if)
+        return False
+
+    return True
+
+def docker_delete_if(docker_name, bridge_name, name_filter, sandbox_id=None):
     """ docker delete if function """
-    ovs_if = create_veth_pair_names(docker_name, name_filter)
-    remove_from_ovs = ["nsenter",
-                       "--mount=" + _HOST_NS_MNT,
-                       "--net=" + _HOST_NS] + \
-    ["/usr/local/bin/ovs-vsctl", "del-port", bridge_name, ovs_if]
-
-    if not run_command(remove_from_ovs, ""):
-        _LOG.error("Failed to remove interface from ovs: " + ovs_if)
+    success = delete_port(detached_port(docker_name, name_filter, sandbox_id), bridge_name)
+    record_detachment(sandbox_id, success)
+    return success
+
+def create_pool_pair(host_if, peer_if, bridge_name):
+    """ create default profile veth pair with host_if on the bridge and up, returns success """
+    profile = default_profile()
+    if not _LINK.add_veth(host_if, peer_if, profile.mtu, profile.queues):
+        _LOG.error("Failed to create veth pair %s/%s", host_if, peer_if)
+        return False
+
+    if not set_offloads(profile, (host_if, peer_if)):
+        _LINK.delete_link(host_if)
+        return False
+
+    if not move_if_to_host(host_if, bridge_name, profile) or not _LINK.set_link_up(host_if):
+        _LOG.error("Failed to attach %s to %s", host_if, bridge_name)
+        delete_port(host_if, bridge_name)
+        _LINK.delete_link(peer_if)
         return False
 
     return True
 
-def filter_name(pod_name, name_filter):
-    """ filter name """
-    ret = pod_name.startswith(name_filter)
-    if not ret:
-        _LOG.debug("{} name doesn't start with {}, not processing.".format(pod_name, name_filter))
-    return ret
+def destroy_pool_pair(host_if, peer_if, bridge_name):
+    """ remove idle pool pair from the bridge and delete it, returns success """
+    success = delete_port(host_if, bridge_name)
+    return _LINK.delete_link(peer_if) and success
+
+def attach_pool_pair(docker_name, pair, dst_ip_ns_path, bridge_name, dst_if):
+    """ move peer of a pool pair into the container as dst_if, returns success """
+    host_if, peer_if = pair
+
+    if _LINK.rename_link(peer_if, dst_if):
+        peer_if = dst_if
+        if move_if(dst_ip_ns_path, dst_if):
+            return True
+
+    _LOG.error("Failed to move interface to container %s", docker_name)
+    _POOL.release(docker_name)
+    destroy_pool_pair(host_if, peer_if, bridge_name)
+    return False
+
+async def move_if_to_host_async(if_name, bridge_name, profile=attach_profile.PLAIN):
+    """ move if to host function for the asyncio mode """
+    add_to_ovs = link_backend.host_ns_command(
+        [OVS_VSCTL, "--may-exist", "add-port", bridge_name, if_name] +
+        profile.vsctl_args(if_name))
+
+    if not await _ALINK.call("move_link_to_host", if_name):
+        _LOG.error("Failed to move %s to the default namespace", if_name)
+        return False
 
-def check_if_uuid(uuid_string):
-    """ check if uuid function """
-    regex = re.compile('^[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}$',
-                       re.I)
-    return bool(regex.match(uuid_string))
+    start = time.monotonic()
+    if _OVSDB is not None:
+        success = await async_core.run_blocking(_OVSDB.add_port, bridge_name, if_name,
+                                                profile.ovs)
+    else:
+        success = await link_backend.run_command_async(add_to_ovs, "", retry=True)
+    metrics.observe_stage("ovs_add_port", start, success)
+    if not success:
+        _LOG.error("Failed to add interface to ovs")
+        return False
 
-def docker_poll(docker_cli, name_filter, bridge_name):
-    """ docker poll function """
-    events = docker_cli.events(decode=True)
+    return True
 
-    for event in events:
+async def bring_if_up_async(docker_name, name_filter, ovs_if=None):
+    """ bring if up function for the asyncio mode """
+    if _POOL is not None and _POOL.port_of(docker_name) is not None:
+        return True
+    if ovs_if is None:
+        ovs_if, _ = create_veth_pair_names(docker_name, name_filter)
 
-        try:
-            if event['Type'] == 'container':
+    if not await _ALINK.call("set_link_up", ovs_if):
+        _LOG.error("Failed to bring interface %s up", ovs_if)
+        return False
+
+    return True
 
-                if 'io.kubernetes.docker.type' in event['Actor']['Attributes']:
-                    if event['Actor']['Attributes']['io.kubernetes.docker.type'] != 'container':
-                        continue
-                    sandbox_id = event['Actor']['Attributes']['io.kubernetes.sandbox.id']
-                    pod_name = event['Actor']['Attributes']['io.kubernetes.pod.name']
-                    if not filter_name(pod_name, "app"):
-                        continue
-                else:
-                    sandbox_id = event['Actor']['ID']
-                    pod_name = event['Actor']['Attributes']['name']
+async def set_offloads_async(profile, if_names):
+    """ apply offloads of the profile to the links for the asyncio mode, returns success """
+    for if_name in if_names if profile.offloads else ():
+        if not await _ALINK.call("set_offloads", if_name, profile.offloads):
+            return False
+    return True
 
-                    if not filter_name(pod_name, name_filter) and not check_if_uuid(pod_name):
-                        continue
+async def docker_create_if_async(docker_name, dst_ip_ns_path, bridge_name, name_filter,
+                                 names=None, profile=attach_profile.PLAIN):
+    """ docker create if function for the asyncio mode """
+    ovs_if, dst_if = names or create_veth_pair_names(docker_name, name_filter)
+    pair = _POOL.acquire(docker_name) \
+        if _POOL is not None and profile is default_profile() else None
+    if pair is not None:
+        return await attach_pool_pair_async(docker_name, pair, dst_ip_ns_path, bridge_name,
+                                            dst_if)
+
+    if not await _ALINK.call("add_veth", ovs_if, dst_if, profile.mtu, profile.queues):
+        _LOG.error("Failed to create veth pair with names vethp1/2%s", docker_name)
+        return False
 
+    if not await set_offloads_async(profile, (ovs_if, dst_if)):
+        await _ALINK.call("delete_link", ovs_if)
+        return False
 
-                sandbox = docker_cli.containers.get(sandbox_id)
-                ip_ns_path = sandbox.attrs['NetworkSettings']['SandboxKey']
+    # move to ovs host
+    if not await move_if_to_host_async(ovs_if, bridge_name, profile):
+        _LOG.error("Failed to move interface to host")
+        await _ALINK.call("delete_link", ovs_if)
+        await _ALINK.call("delete_link", dst_if)
 
-                if event['Action'] == 'start':
-                    _LOG.info("New container found: " + str(pod_name))
-                    if docker_create_if(pod_name, ip_ns_path, bridge_name, name_filter):
-                        if bring_if_up(pod_name, name_filter):
-                            _LOG.info("OVS interfaces are up")
-                        _LOG.info("Interfaces added successfully")
-                    else:
-                        _LOG.info("Adding interfaces failed")
-                        docker_delete_if(pod_name, bridge_name, name_filter)
+        return False
 
-                elif event['Action'] == 'die':
-                    docker_delete_if(pod_name, bridge_name, name_filter)
-                    _LOG.info("Container has been removed: " + str(pod_name))
+    # move to docker dst
+    if not await _ALINK.call("move_link", dst_if, dst_ip_ns_path):
+        _LOG.error("Failed to move interface to container %s", docker_name)
+        await delete_port_async(ovs_if, bridge_name)
+        return False
 
+    return True
 
+async def delete_port_async(ovs_if, bridge_name):
+    """ delete port function for the asyncio mode """
+    remove_from_ovs = link_backend.host_ns_command(
+        [OVS_VSCTL, "--if-exists", "del-port", bridge_name, ovs_if])
+
+    start = time.monotonic()
+    if _OVSDB is not None:
+        success = await async_core.run_blocking(_OVSDB.del_port, bridge_name, ovs_if)
+    else:
+        success = await link_backend.run_command_async(remove_from_ovs, "", retry=True)
+    metrics.observe_stage("ovs_del_port", start, success)
+    if not success:
+        _LOG.error("Failed to remove interface from ovs: %s", ovs_if)
+        return False
 
-        except RuntimeError as err:
-            _LOG.critical("Docker events error {}".format(err))
+    return True
 
+async def docker_delete_if_async(docker_name, bridge_name, name_filter, sandbox_id=None):
+    """ docker delete if function for the asyncio mode """
+    success = await delete_port_async(detached_port(docker_name, name_filter, sandbox_id),
+                                      bridge_name)
+    record_detachment(sandbox_id, success)
+    return success
+
+async def attach_pool_pair_async(docker_name, pair, dst_ip_ns_path, bridge_name, dst_if):
+    """ move peer of a pool pair into the container for the asyncio mode, returns success """
+    host_if, peer_if = pair
+
+    if await _ALINK.call("rename_link", peer_if, dst_if):
+        peer_if = dst_if
+        if await _ALINK.call("move_link", dst_if, dst_ip_ns_path):
+            return True
+
+    _LOG.error("Failed to move interface to container %s", docker_name)
+    _POOL.release(docker_name)
+    await delete_port_async(host_if, bridge_name)
+    await _ALINK.call("delete_link", peer_if)
+    return False
+
+def list_ports(bridge_name):
+    """ list ports of the bridge, None on failure """
+    if _OVSDB is not None:
+        return _OVSDB.list_ports(bridge_name)
+    output = link_backend.command_output(
+        link_backend.host_ns_command([OVS_VSCTL, "list-ports", bridge_name]), retry=True)
+    if output is None:
+        _LOG.error("Failed to list ports of %s", bridge_name)
+        return None
+    return set(output.split())
+
+def event_state(event):
+    """ interface state the event asks for, None if it is not handled """
+    if event['Action'] == 'start':
+        return sandbox_lifecycle.ATTACHED
+    if event['Action'] == 'die':
+        return sandbox_lifecycle.DETACHED
+    return None
+
+def handle_event(sandboxes, event, sandbox_id, pod_name, name_filter, bridge_name,
+                 previous=None):
+    """ handle event function, returns success """
+    log = daemon_logging.sandbox_log(_LOG, sandbox_id, pod_name)
+    debug_hooks.trace_step(OvsHandler.name, sandbox_id, "started")
+    success = None
+    if event['Action'] == 'start':
+        ip_ns_path = sandboxes.ns_path(sandbox_id)
+        debug_hooks.trace_step(OvsHandler.name, sandbox_id, "netns")
+        log.info("New container found: %s", pod_name)
+        profile = select_profile(sandboxes, event, sandbox_id)
+        log.info("Attaching with profile %s", profile)
+        names = reserve_veth_pair_names(sandbox_id, ip_ns_path, pod_name, name_filter,
+                                        bridge_name)
+        if docker_create_if(pod_name, ip_ns_path, bridge_name, name_filter, names, profile):
+            debug_hooks.trace_step(OvsHandler.name, sandbox_id, "create_if")
+            success = bring_if_up(pod_name, name_filter, names[0])
+            debug_hooks.trace_step(OvsHandler.name, sandbox_id, "if_up")
+            metrics.observe_event(event, success, OvsHandler.name)
+            if success:
+                log.info("OVS interfaces are up")
+                record_attachment(sandbox_id, pod_name, names[0], profile)
+            log.info("Interfaces added successfully")
+        else:
+            success = False
+            metrics.observe_event(event, False, OvsHandler.name)
+            log.info("Adding interfaces failed")
+            # a port left by an earlier attach would make the next one fail
+            if previous == sandbox_lifecycle.DETACHED:
+                metrics.OPERATIONS_SAVED.labels("cleanup").inc()
+            else:
+                docker_delete_if(pod_name, bridge_name, name_filter, sandbox_id)
+
+    elif event['Action'] == 'die':
+        success = docker_delete_if(pod_name, bridge_name, name_filter, sandbox_id)
+        metrics.observe_event(event, success, OvsHandler.name)
+        log.info("Container has been removed: %s", pod_name)
+    debug_hooks.trace_step(OvsHandler.name, sandbox_id, "done")
+    return success
+
+async def handle_event_async(sandboxes, event, sandbox_id, pod_name, name_filter, bridge_name,
+                             previous=None):
+    """ handle event function for the asyncio mode, returns success """
+    log = daemon_logging.sandbox_log(_LOG, sandbox_id, pod_name)
+    debug_hooks.trace_step(OvsHandler.name, sandbox_id, "started")
+    success = None
+    if event['Action'] == 'start':
+        ip_ns_path = await sandboxes.ns_path_async(sandbox_id)
+        debug_hooks.trace_step(OvsHandler.name, sandbox_id, "netns")
+        log.info("New container found: %s", pod_name)
+        profile = await select_profile_async(sandboxes, event, sandbox_id)
+        log.info("Attaching with profile %s", profile)
+        names = reserve_veth_pair_names(sandbox_id, ip_ns_path, pod_name, name_filter,
+                                        bridge_name)
+        if await docker_create_if_async(pod_name, ip_ns_path, bridge_name, name_filter, names,
+                                        profile):
+            debug_hooks.trace_step(OvsHandler.name, sandbox_id, "create_if")
+            success = await bring_if_up_async(pod_name, name_filter, names[0])
+            debug_hooks.trace_step(OvsHandler.name, sandbox_id, "if_up")
+            metrics.observe_event(event, success, OvsHandler.name)
+            if success:
+                log.info("OVS interfaces are up")
+                record_attachment(sandbox_id, pod_name, names[0], profile)
+            log.info("Interfaces added successfully")
+        else:
+            success = False
+            metrics.observe_event(event, False, OvsHandler.name)
+            log.info("Adding interfaces failed")
+            if previous == sandbox_lifecycle.DETACHED:
+                metrics.OPERATIONS_SAVED.labels("cleanup").inc()
+            else:
+                await docker_delete_if_async(pod_name, bridge_name, name_filter, sandbox_id)
+
+    elif event['Action'] == 'die':
+        success = await docker_delete_if_async(pod_name, bridge_name, name_filter, sandbox_id)
+        metrics.observe_event(event, success, OvsHandler.name)
+        log.info("Container has been removed: %s", pod_name)
+    debug_hooks.trace_step(OvsHandler.name, sandbox_id, "done")
+    return success
+
+def reconcile(sandboxes, selector, name_filter, bridge_name, lifecycle):
+    """ reconcile bridge ports with containers running on the node
+
+    Running sandboxes without their port on the bridge get attached, and
+    container ports without a running sandbox are removed, as are idle veth
+    pool pairs left behind which the pool does not delete itself. Ports are
+    looked up by the names recorded when they were attached. Afterwards
+    sandboxes not seen yet are known to have no port.
+    """
+    ports = list_ports(bridge_name)
+    if ports is None:
+        return 0
+    targets = docker_events.running_targets(sandboxes.docker_cli, selector)
+    expected = set()
+    pool_pods = _POOL.pods() if _POOL is not None else set()
+    records = {record["id"]: record for record in _STORE.records()} if _STORE is not None \
+        else {}
+    for sandbox_id, pod_name in targets.items():
+        record = records.pop(sandbox_id, None)
+        ovs_if = record.get("host_if") if record is not None else None
+        if ovs_if is None and _POOL is not None:
+            ovs_if = _POOL.port_of(pod_name)
+        if ovs_if is None:
+            ovs_if, _ = create_veth_pair_names(pod_name, name_filter)
+        expected.add(ovs_if)
+        pool_pods.discard(pod_name)
+        if ovs_if in ports:
+            lifecycle.set_state(sandbox_id, sandbox_lifecycle.ATTACHED)
+        else:
+            _LOG.info("Attaching missing interface to %s", pod_name)
+            if _POOL is not None:
+                _POOL.release(pod_name)
+            record_detachment(sandbox_id, True)
+            lifecycle.set_state(sandbox_id, None)
+            lifecycle.submit(sandbox_id, sandbox_lifecycle.ATTACHED, sandboxes,
+                             {'Action': 'start'}, sandbox_id, pod_name, name_filter,
+                             bridge_name)
+
+    # pool pairs whose pod is gone, their peer went with the container namespace
+    released = {_POOL.release(pod_name) for pod_name in pool_pods}
+    # idle pairs, and those of an earlier run the pool deletes itself
+    pool_ports = _POOL.ports() if _POOL is not None else set()
+    # and ports recorded for sandboxes which are gone
+    for sandbox_id, record in records.items():
+        _STORE.remove(sandbox_id)
+        released.add(record.get("host_if"))
+    for ovs_if in ports:
+        if ovs_if in expected or ovs_if in pool_ports:
+            continue
+        if ovs_if.startswith(OVS_IF_PREFIX) or ovs_if in released:
+            _LOG.info("Removing orphaned interface %s", ovs_if)
+            lifecycle.dispatcher.submit_call(ovs_if, delete_port, ovs_if, bridge_name)
+        elif ovs_if.startswith(veth_pool.POOL_IF_PREFIX):
+            # pool pair the pool does not know of, new pairs are named past it
+            _LOG.info("Removing leftover pool interface %s", ovs_if)
+            peer_if = veth_pool.POOL_PEER_PREFIX + ovs_if[len(veth_pool.POOL_IF_PREFIX):]
+            lifecycle.dispatcher.submit_call(ovs_if, destroy_pool_pair, ovs_if, peer_if,
+                                             bridge_name)
+    lifecycle.initial = sandbox_lifecycle.DETACHED
+    return len(targets)
+
+class OvsHandler(event_fanout.Handler):
+    """ OvS bridge ports of the selected sandboxes """
+    name = "ovs"
+    description = "OvS bridge ports"
+    actions = EVENT_ACTIONS
+
+    @staticmethod
+    def add_options(parser):
+        """ add options of the handler to the parser """
+        parser.add_argument(
+            "-b", "--bridge", action="store", metavar="BRIDGE_NAME", dest="bridge_name",
+            default="br0",
+            help="OvS bridge name")
+        parser.add_argument(
+            "-o", "--ovsdb", action="store", metavar="SOCKET", dest="ovsdb_socket",
+            default="",
+            help="Manage bridge ports over the OVSDB socket (e.g. {}) instead of running "
+            "ovs-vsctl".format(ovsdb_client.DEFAULT_SOCKET))
+        parser.add_argument(
+            "--veth-pool", action="store", metavar="SIZE", dest="veth_pool",
+            type=int, default=0,
+            help="Keep up to SIZE veth pairs attached to the bridge ahead of container "
+            "starts, disabled by default")
+        parser.add_argument(
+            "--veth-pool-low", action="store", metavar="COUNT", dest="veth_pool_low",
+            type=int, default=None,
+            help="Refill the veth pool once fewer than COUNT pairs are idle, half of its "
+            "size by default")
+        parser.add_argument(
+            "--attach-profiles", action="store", metavar="PATH", dest="attach_profiles",
+            default="",
+            help="JSON file of named attach profiles, setting the MTU, queues and offloads of "
+            "the veth pairs and the OVS columns of their ports")
+        parser.add_argument(
+            "--attach-profile", action="store", metavar="NAME", dest="attach_profile",
+            default=attach_profile.PLAIN_PROFILE,
+            help="Profile of the containers whose profile label is not set, also used for "
+            "the veth pool pairs (default: %(default)s)")
+        parser.add_argument(
+            "--attach-profile-label", action="store", metavar="KEY", dest="attach_profile_label",
+            default=attach_profile.PROFILE_LABEL,
+            help="Container or pod label naming the attach profile (default: %(default)s)")
+
+    def start(self, link):
+        """ load the attach profiles, connect OVSDB and load the recorded attachments """
+        global _LINK, _ALINK, _OVSDB, _POOL, _STORE, _PROFILES # pylint: disable=global-statement
+        options = self.options
+        try:
+            profiles = attach_profile.load_profiles(options.attach_profiles) \
+                if options.attach_profiles else {}
+            _PROFILES = attach_profile.AttachProfiles(profiles, options.attach_profile,
+                                                      options.attach_profile_label)
+        except (OSError, ValueError) as err:
+            _LOG.critical("Invalid attach profiles: %s", err)
+            return False
+        _LOG.info("Attach profiles: %s, default %s",
+                  ", ".join(str(profile) for _, profile in sorted(_PROFILES.profiles.items())),
+                  _PROFILES.default.name)
+        _LINK = link
+        _ALINK = link_backend.AsyncLinkBackend(_LINK)
+        _STORE = attachment_store.AttachmentStore(
+            os.path.join(options.state_dir, "ovs_attachments.log"))
+        _LOG.info("Loaded %s recorded attachments", _STORE.load())
+        metrics.register_stats("nts_ovs_attachments", "Recorded OvS sandbox attachments",
+                               _STORE.snapshot)
+        if options.ovsdb_socket:
+            _OVSDB = ovsdb_client.OvsdbClient(options.ovsdb_socket)
+            if not _OVSDB.connect():
+                _LOG.critical("Failed to connect to OVSDB at %s", options.ovsdb_socket)
+                return False
+            metrics.register_stats("nts_ovsdb", "OVSDB port transactions", _OVSDB.stats)
+        if options.veth_pool > 0:
+            low = options.veth_pool_low
+            _POOL = veth_pool.VethPool(
+                options.veth_pool, max(1, options.veth_pool // 2) if low is None else low,
+                functools.partial(create_pool_pair, bridge_name=options.bridge_name),
+                functools.partial(destroy_pool_pair, bridge_name=options.bridge_name),
+                os.path.join(options.state_dir, "ovs_veth_pool.json"),
+                list_ports(options.bridge_name) or ())
+            metrics.register_stats("nts_veth_pool", "Warm veth pool", _POOL.snapshot)
+        return True
+
+    def event_state(self, event):
+        """ interface state the event asks for, None if it is not handled """
+        return event_state(event)
+
+    def event_args(self, sandboxes, event, sandbox_id, pod_name):
+        """ handle_event arguments of the event """
+        return (sandboxes, event, sandbox_id, pod_name, self.options.name_filter,
+                self.options.bridge_name)
+
+    handle_event = staticmethod(handle_event)
+    handle_event_async = staticmethod(handle_event_async)
+
+    def reconcile(self, sandboxes, selector, lifecycle):
+        """ sync bridge ports with the running sandboxes, returns their number """
+        return reconcile(sandboxes, selector, self.options.name_filter,
+                         self.options.bridge_name, lifecycle)
+
+    def started(self):
+        """ fill the veth pool once the ports are reconciled """
+        if _POOL is not None:
+            _POOL.fill()
+
+    def stop(self):
+        """ stop the veth pool and close OVSDB and the attachments log """
+        if _POOL is not None:
+            _POOL.stop()
+            _LOG.info("Veth pool stats: %s", _POOL.snapshot())
+        if _STORE is not None:
+            _STORE.close()
+            _LOG.info("OvS attachments stats: %s", _STORE.snapshot())
+        if _OVSDB is not None:
+            _OVSDB.close()
+            _LOG.info("OVSDB stats: %s", _OVSDB.stats)
 
 def main(options):
     """ main """
-    docker_cli = docker_connect()
-    if not docker_cli:
-        _LOG.info("Failed to connect do docker server")
-
-    signal.signal(signal.SIGINT, signal_handler)
-
+    return event_fanout.main(options, [OvsHandler(options)])
 
-    _LOG.info("[Started]")
-    _LOG.info("Waiting for containers events")
-    docker_poll(docker_cli, options.name_filter, options.bridge_name)
 
 if __name__ == '__main__':
     OPTIONS = make_parser().parse_args()
-    _LOG = setup_logger(OPTIONS)
+    setup_logger(OPTIONS)
     if OPTIONS.enable.lower() != "true":
         _LOG.info("OVS disabled - shutting down")
         sys.exit()
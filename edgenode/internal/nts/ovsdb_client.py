@@ -0,0 +1,547 @@
+# coding: utf-8
+""" OVSDB JSON-RPC (RFC 7047) client managing bridge ports """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import codecs
+import collections
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+
+import deadlines
+
+DEFAULT_SOCKET = "/var/run/openvswitch/db.sock"
+DB_NAME = "Open_vSwitch"
+OFPORT_TIMEOUT = 5.0
+MAX_BATCH = 64
+# ovsdb deadlines a port request waits for: connecting, its batch, then itself alone
+REQUEST_DEADLINES = 3
+MONITOR_ID = "nts-ports"
+MONITORED = {"Bridge": ["name", "ports"],
+             "Port": ["name", "interfaces"],
+             "Interface": ["name", "ofport"]}
+
+_LOG = logging.getLogger(__name__)
+
+
+class OvsdbError(RuntimeError):
+    """ OVSDB request failure """
+
+
+def _set(value):
+    """ atoms of an OVSDB set, a single atom is a set of one """
+    if isinstance(value, list) and value and value[0] == "set":
+        return value[1]
+    return [value]
+
+def _uuids(value):
+    return {atom[1] for atom in _set(value)}
+
+def _split_columns(columns):
+    """ (column values, map column to its [key, value] pairs) of "column:key" names """
+    values = {}
+    maps = collections.OrderedDict()
+    for column, value in sorted(columns.items()):
+        column, _, key = column.partition(":")
+        if key:
+            # map values are strings
+            maps.setdefault(column, []).append([key, str(value)])
+        else:
+            values[column] = value
+    return values, maps
+
+def _row(name, columns):
+    """ row of a named port or interface with columns set, "column:key" names map keys """
+    row, maps = _split_columns(columns)
+    for column, pairs in maps.items():
+        row[column] = ["map", pairs]
+    row["name"] = name
+    return row
+
+def _map_mutations(maps):
+    """ mutations setting the keys of map columns, leaving their other keys alone """
+    mutations = []
+    for column, pairs in maps.items():
+        # insert keeps the value of a key present, so it is deleted first
+        mutations.append([column, "delete", ["set", [key for key, _ in pairs]]])
+        mutations.append([column, "insert", ["map", pairs]])
+    return mutations
+
+def _ofport(value):
+    """ ofport column value, None while it is not assigned """
+    atoms = _set(value)
+    return atoms[0] if atoms and isinstance(atoms[0], int) else None
+
+
+class _Call():
+    """ JSON-RPC request waiting for its response """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class OvsdbConnection():
+    """ JSON-RPC connection to ovsdb-server with a reader thread
+
+    Responses are matched to their requests by id, "update" notifications
+    are passed to on_update and "echo" requests are answered.
+    """
+    def __init__(self, path, on_update):
+        self.path = path
+        self.on_update = on_update
+        self._ids = itertools.count()
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self.closed = False
+        self._thread = threading.Thread(target=self._reader, name="ovsdb-reader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _send(self, message):
+        data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def call(self, method, params, timeout=None):
+        """ send request, returns its result, timeout defaults to the ovsdb deadline """
+        if timeout is None:
+            timeout = deadlines.timeout("ovsdb")
+        call = _Call()
+        with self._lock:
+            if self.closed:
+                raise OvsdbError("connection to {} is closed".format(self.path))
+            request_id = next(self._ids)
+            self._calls[request_id] = call
+        try:
+            self._send({"method": method, "params": params, "id": request_id})
+        except OSError as err:
+            self.close()
+            raise OvsdbError("{} request failed: {}".format(method, err))
+        if not call.done.wait(timeout):
+            with self._lock:
+                self._calls.pop(request_id, None)
+            raise OvsdbError(str(deadlines.expired("ovsdb", "{} request".format(method))))
+        if call.error is not None:
+            raise OvsdbError("{} request failed: {}".format(method, call.error))
+        return call.result
+
+    def _dispatch(self, message):
+        method = message.get("method")
+        if method is None:
+            with self._lock:
+                call = self._calls.pop(message.get("id"), None)
+            if call is not None:
+                call.result = message.get("result")
+                call.error = message.get("error")
+                call.done.set()
+        elif method == "update":
+            self.on_update(message["params"][1])
+        elif method == "echo":
+            self._send({"result": message["params"], "error": None, "id": message["id"]})
+
+    def _reader(self):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buf = ""
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                buf += utf8.decode(data)
+                # messages are JSON objects sent back to back
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        message, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    self._dispatch(message)
+        except OSError as err:
+            if not self.closed:
+                _LOG.error("OVSDB connection error: %s", err)
+        finally:
+            self.close()
+
+    def close(self):
+        """ close connection, pending requests fail """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            calls = list(self._calls.values())
+            self._calls.clear()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        for call in calls:
+            call.error = "connection closed"
+            call.done.set()
+
+
+class PortCache():
+    """ Bridge, Port and Interface rows kept up to date by monitor updates """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.bridges = {}
+        self.ports = {}
+        self.interfaces = {}
+
+    def reset(self, updates):
+        """ replace content with the initial monitor result """
+        with self.cond:
+            self.bridges.clear()
+            self.ports.clear()
+            self.interfaces.clear()
+        self.update(updates)
+
+    def update(self, updates):
+        """ apply monitor table updates """
+        with self.cond:
+            for uuid, row in updates.get("Bridge", {}).items():
+                new = row.get("new")
+                if new is None:
+                    self.bridges.pop(uuid, None)
+                else:
+                    self.bridges[uuid] = (new["name"], _uuids(new["ports"]))
+            for uuid, row in updates.get("Port", {}).items():
+                new = row.get("new")
+                if new is None:
+                    self.ports.pop(uuid, None)
+                else:
+                    self.ports[uuid] = (new["name"], _uuids(new["interfaces"]))
+            for uuid, row in updates.get("Interface", {}).items():
+                new = row.get("new")
+                if new is None:
+                    self.interfaces.pop(uuid, None)
+                else:
+                    self.interfaces[uuid] = (new["name"], _ofport(new["ofport"]))
+            self.cond.notify_all()
+
+    def bridge_ports(self, bridge_name):
+        """ {port name: port uuid} of the bridge, None if there is no such bridge """
+        with self.cond:
+            for name, ports in self.bridges.values():
+                if name == bridge_name:
+                    return {self.ports[uuid][0]: uuid for uuid in ports if uuid in self.ports}
+        return None
+
+    def port_bridge(self, port_name):
+        """ name of the bridge having the port, None if there is none """
+        with self.cond:
+            for name, ports in self.bridges.values():
+                if any(self.ports.get(uuid, ("",))[0] == port_name for uuid in ports):
+                    return name
+        return None
+
+    def port_interface(self, port_name):
+        """ uuid of the interface of the named port, None if there is none """
+        with self.cond:
+            for name, interfaces in self.ports.values():
+                if name == port_name and interfaces:
+                    return min(interfaces)
+        return None
+
+    def wait_ofport(self, interface_uuid, timeout):
+        """ ofport assigned to the interface, None on timeout """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                ofport = self.interfaces.get(interface_uuid, (None, None))[1]
+                remaining = deadline - time.monotonic()
+                if ofport is not None or remaining <= 0:
+                    return ofport
+                self.cond.wait(remaining)
+
+
+class _PortRequest():
+    def __init__(self, add, bridge_name, port_name, columns=None):
+        self.add = add
+        self.bridge_name = bridge_name
+        self.port_name = port_name
+        self.columns = columns or {}
+        self.done = threading.Event()
+        self.error = None
+        self.interface_uuid = None
+        # uuid of the port to delete, resolved when the request is validated
+        self.port_uuid = None
+        # the port is on the bridge already, only its columns are set
+        self.exists = False
+        # the caller stopped waiting, not applied unless it is already being
+        self.abandoned = False
+
+
+class OvsdbClient():
+    """ bridge port management over a persistent OVSDB connection
+
+    The Bridge, Port and Interface tables are monitored into a local cache,
+    so listing ports and checking them needs no request. Port additions and
+    deletions requested concurrently are batched into one transaction: while
+    a transaction is in flight new requests queue up and are sent together
+    with the next one. Adding a port waits for ovs-vswitchd to assign its
+    ofport, notified by the monitor.
+
+    Like ovs-vsctl --may-exist add-port and --if-exists del-port, adding a
+    port the bridge has already and deleting one it does not have succeed.
+    """
+    def __init__(self, path=DEFAULT_SOCKET, max_batch=MAX_BATCH, ofport_timeout=OFPORT_TIMEOUT):
+        self.path = path
+        self.max_batch = max_batch
+        self.ofport_timeout = ofport_timeout
+        self.cache = PortCache()
+        self.stats = {"transactions": 0, "batched_ops": 0, "max_batch": 0, "failed": 0,
+                      "reconnects": 0}
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._batcher, name="ovsdb-batcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connection(self):
+        """ connected and monitoring connection, reconnects if it was lost """
+        with self._conn_lock:
+            if self._conn is not None and not self._conn.closed:
+                return self._conn
+            if self._conn is not None:
+                self.stats["reconnects"] += 1
+            try:
+                conn = OvsdbConnection(self.path, self.cache.update)
+            except OSError as err:
+                raise OvsdbError("Failed to connect to {}: {}".format(self.path, err))
+            monitor = {table: {"columns": columns} for table, columns in MONITORED.items()}
+            try:
+                self.cache.reset(conn.call("monitor", [DB_NAME, MONITOR_ID, monitor]))
+            except OvsdbError:
+                conn.close()
+                raise
+            self._conn = conn
+            return conn
+
+    def connect(self):
+        """ connect and load the cache, returns success """
+        try:
+            self._connection()
+        except OvsdbError as err:
+            _LOG.error("OVSDB: %s", err)
+            return False
+        return True
+
+    def list_ports(self, bridge_name):
+        """ port names of the bridge, None on failure """
+        try:
+            self._connection()
+        except OvsdbError as err:
+            _LOG.error("OVSDB: %s", err)
+            return None
+        ports = self.cache.bridge_ports(bridge_name)
+        if ports is None:
+            _LOG.error("OVSDB: no bridge named %s", bridge_name)
+            return None
+        return set(ports)
+
+    def _request(self, add, bridge_name, port_name, columns=None):
+        request = _PortRequest(add, bridge_name, port_name, columns)
+        self._requests.put(request)
+        timeout = deadlines.timeout("ovsdb")
+        if not request.done.wait(timeout * REQUEST_DEADLINES if timeout else None):
+            request.abandoned = True
+            request.error = str(deadlines.expired("ovsdb", "port request"))
+        if request.error is not None:
+            _LOG.error("OVSDB: failed to %s port %s %s bridge %s: %s",
+                       "add" if add else "delete", port_name, "to" if add else "from", bridge_name,
+                       request.error)
+            return None
+        return request
+
+    def add_port(self, bridge_name, port_name, columns=None):
+        """ add port to the bridge and wait for its ofport, returns success
+
+        columns maps "Interface" and "Port" to column values of the new rows.
+        """
+        request = self._request(True, bridge_name, port_name, columns)
+        if request is None:
+            return False
+        ofport = self.cache.wait_ofport(request.interface_uuid, self.ofport_timeout)
+        if ofport is None or ofport < 0:
+            _LOG.error("OVSDB: port %s got no ofport (%s)",
+                       port_name, "timed out" if ofport is None else ofport)
+            return False
+        return True
+
+    def del_port(self, bridge_name, port_name):
+        """ delete port from the bridge, returns success """
+        return self._request(False, bridge_name, port_name) is not None
+
+    def _batcher(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._requests.put(None)
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        deferred = []
+        try:
+            conn = self._connection()
+            valid, deferred = self._validate(batch)
+            if len(valid) > 1:
+                try:
+                    self._transact(conn, valid)
+                    valid = []
+                except OvsdbError as err:
+                    # one bad request aborts the whole transaction, isolate it
+                    _LOG.warning("OVSDB: batch of %s failed (%s), retrying one by one",
+                                 len(valid), err)
+            for request in valid:
+                try:
+                    self._transact(conn, [request])
+                except OvsdbError as err:
+                    request.error = str(err)
+        except OvsdbError as err:
+            for request in batch:
+                if request.error is None:
+                    request.error = str(err)
+        except Exception as err: # pylint: disable=broad-except
+            # the batcher serves every request, it must not die with one batch
+            _LOG.exception("OVSDB: batch of %s failed", len(batch))
+            deferred = []
+            for request in batch:
+                if request.error is None:
+                    request.error = "unexpected error: {!r}".format(err)
+        finally:
+            for request in batch:
+                if any(request is later for later in deferred):
+                    continue
+                if request.error is not None:
+                    self.stats["failed"] += 1
+                request.done.set()
+        if deferred:
+            self._run_batch(deferred)
+
+    def _validate(self, batch):
+        """ (requests to transact, requests deferred to the next batch)
+
+        Requests failing get their error set, those with nothing to do are
+        left out. A request for a port an earlier request of the batch is for
+        is deferred, so it sees the outcome of that one.
+        """
+        valid = []
+        deferred = []
+        touched = set()
+        for request in batch:
+            if request.abandoned:
+                request.error = "abandoned"
+                continue
+            if request.port_name in touched:
+                deferred.append(request)
+                continue
+            touched.add(request.port_name)
+            ports = self.cache.bridge_ports(request.bridge_name)
+            bridge_name = self.cache.port_bridge(request.port_name)
+            if ports is None:
+                request.error = "no bridge named {}".format(request.bridge_name)
+            elif bridge_name not in (None, request.bridge_name):
+                request.error = "port {} is on bridge {}".format(request.port_name, bridge_name)
+            elif request.add and bridge_name is not None:
+                request.exists = True
+                request.interface_uuid = self.cache.port_interface(request.port_name)
+                if request.columns:
+                    valid.append(request)
+            elif request.add:
+                valid.append(request)
+            elif bridge_name is not None:
+                request.port_uuid = ports.get(request.port_name)
+                # gone from the bridge meanwhile, nothing to do
+                if request.port_uuid is not None:
+                    valid.append(request)
+        return valid, deferred
+
+    def _transact(self, conn, batch):
+        """ apply requests in one transaction """
+        ops = []
+        mutations = collections.OrderedDict()
+        inserted = []
+        for index, request in enumerate(batch):
+            if request.exists:
+                for table in ("Interface", "Port"):
+                    row, maps = _split_columns(request.columns.get(table, {}))
+                    where = [["name", "==", request.port_name]]
+                    if row:
+                        ops.append({"op": "update", "table": table, "row": row,
+                                    "where": where})
+                    if maps:
+                        ops.append({"op": "mutate", "table": table, "where": where,
+                                    "mutations": _map_mutations(maps)})
+            elif request.add:
+                inserted.append((request, len(ops)))
+                port_row = _row(request.port_name, request.columns.get("Port", {}))
+                port_row["interfaces"] = ["named-uuid", "iface{}".format(index)]
+                ops.append({"op": "insert", "table": "Interface",
+                            "row": _row(request.port_name, request.columns.get("Interface", {})),
+                            "uuid-name": "iface{}".format(index)})
+                ops.append({"op": "insert", "table": "Port", "row": port_row,
+                            "uuid-name": "port{}".format(index)})
+                mutations.setdefault(request.bridge_name, ([], []))[0].append(
+                    ["named-uuid", "port{}".format(index)])
+            else:
+                mutations.setdefault(request.bridge_name, ([], []))[1].append(
+                    ["uuid", request.port_uuid])
+        mutated = []
+        for bridge_name, (inserts, deletes) in mutations.items():
+            # unreferenced Port and Interface rows are garbage collected
+            mutated.append(len(ops))
+            bridge_mutations = []
+            if inserts:
+                bridge_mutations.append(["ports", "insert", ["set", inserts]])
+            if deletes:
+                bridge_mutations.append(["ports", "delete", ["set", deletes]])
+            ops.append({"op": "mutate", "table": "Bridge",
+                        "where": [["name", "==", bridge_name]],
+                        "mutations": bridge_mutations})
+
+        results = conn.call("transact", [DB_NAME] + ops)
+        self.stats["transactions"] += 1
+        self.stats["batched_ops"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        errors = [result for result in results if result and "error" in result]
+        if errors:
+            raise OvsdbError("; ".join("{}: {}".format(error["error"], error.get("details", ""))
+                                       for error in errors))
+        if any(results[position].get("count") != 1 for position in mutated):
+            raise OvsdbError("bridge disappeared")
+        # each addition inserted an Interface then a Port row
+        for request, position in inserted:
+            request.interface_uuid = results[position]["uuid"][1]
+
+    def close(self):
+        """ stop batching and close the connection """
+        self._requests.put(None)
+        self._thread.join()
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
@@ -0,0 +1,235 @@
+# coding: utf-8
+""" compiled pod selector """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import fnmatch
+import re
+
+K8S_TYPE_LABEL = "io.kubernetes.docker.type"
+K8S_POD_NAME_LABEL = "io.kubernetes.pod.name"
+K8S_NAMESPACE_LABEL = "io.kubernetes.pod.namespace"
+K8S_SANDBOX_ID_LABEL = "io.kubernetes.sandbox.id"
+
+K8S_POD_PREFIX = "app"
+
+UUID_PATTERN = '(?i:[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}$)'
+_HEX_DIGITS = "0123456789abcdefABCDEF"
+
+# rule kinds, see make_parser() help of the daemons
+NAME_KINDS = ("prefix", "glob", "regex", "uuid")
+POD_NAME_KINDS = ("pod-prefix", "pod-glob", "pod-regex")
+KINDS = NAME_KINDS + POD_NAME_KINDS + ("namespace", "pod-label", "label")
+
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+_QUANTIFIERS = set("*?{")
+# keys of trie nodes besides their single characters
+_TERMINAL = ""
+_PATTERN = "re"
+
+
+def _glob_prefix(pattern):
+    """ literal characters a glob starts with """
+    for index, char in enumerate(pattern):
+        if char in "*?[":
+            return pattern[:index]
+    return pattern
+
+def _regex_prefix(pattern):
+    """ literal characters every match of a regex (anchored at start) begins with
+
+    Conservative: alternations and escapes stop the scan.
+    """
+    if "|" in pattern:
+        return ""
+    prefix = []
+    for index, char in enumerate(pattern):
+        if char in _REGEX_SPECIAL:
+            if char in _QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        if index + 1 < len(pattern) and pattern[index + 1] in _QUANTIFIERS:
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+class _NameMatcher():
+    """ name rules compiled into one prefix trie
+
+    Literal prefixes end in trie nodes marked terminal. Globs and regexes
+    are hung on the node of their literal prefix, beside its terminal mark,
+    and the ones sharing a node are joined into one regex. A name is matched
+    by a single walk of the trie along its characters, so only the patterns
+    whose literal prefix matches the name are evaluated and a name which
+    leaves the trie early is rejected without running any regex.
+    """
+    def __init__(self):
+        self._root = {}
+        self._pending = {}
+        self.size = 0
+
+    def _node(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        return node
+
+    def add_prefix(self, prefix):
+        """ match names starting with prefix """
+        self._node(prefix)[_TERMINAL] = True
+        self.size += 1
+
+    def add_pattern(self, literal_prefix, regex):
+        """ match names matching regex, which all start with literal_prefix """
+        self._pending.setdefault(literal_prefix, []).append(regex)
+        self.size += 1
+
+    def compile(self):
+        """ join patterns hung on the same node """
+        for prefix, regexes in self._pending.items():
+            combined = "|".join("(?:{})".format(regex) for regex in regexes)
+            self._node(prefix)[_PATTERN] = re.compile(combined)
+        self._pending = {}
+        return self
+
+    @staticmethod
+    def _node_match(node, name):
+        """ check if name matches a rule ending in node """
+        if _TERMINAL in node:
+            return True
+        pattern = node.get(_PATTERN)
+        return pattern is not None and bool(pattern.match(name))
+
+    def match(self, name):
+        """ check if name matches a rule """
+        node = self._root
+        for char in name:
+            if self._node_match(node, name):
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return self._node_match(node, name)
+
+
+class _LabelMatcher():
+    """ label rules indexed by key, a rule without value matches any value """
+    def __init__(self):
+        self._keys = {}
+        self.size = 0
+
+    def add(self, selector):
+        """ add key or key=value selector """
+        key, sep, value = selector.partition("=")
+        if not key:
+            raise ValueError("Empty label selector key in {}".format(selector))
+        values = self._keys.setdefault(key, set())
+        if values is not None:
+            self._keys[key] = None if not sep else values | {value}
+        self.size += 1
+
+    def match(self, labels):
+        """ check if labels match a rule """
+        if not self._keys or not labels:
+            return False
+        if len(self._keys) <= len(labels):
+            pairs = ((key, labels.get(key)) for key in self._keys)
+        else:
+            pairs = ((key, value) for key, value in labels.items() if key in self._keys)
+        for key, value in pairs:
+            if value is None:
+                continue
+            values = self._keys[key]
+            if values is None or value in values:
+                return True
+        return False
+
+
+class PodSelector():
+    """ compiled set of rules selecting the containers which get interfaces
+
+    Rules are "kind:value" strings:
+      prefix:P, glob:G, regex:R, uuid - docker container name
+      pod-prefix:P, pod-glob:G, pod-regex:R - kubernetes pod name
+      namespace:N - kubernetes namespace
+      pod-label:K[=V] - kubernetes pod label
+      label:K[=V] - container label
+    A container is selected when any rule matches. Kubernetes pod labels are
+    only known to the pod sandbox, they are looked up with pod_labels().
+    """
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self._names = _NameMatcher()
+        self._pod_names = _NameMatcher()
+        self._namespaces = set()
+        self._pod_labels = _LabelMatcher()
+        self._labels = _LabelMatcher()
+        for rule in self.rules:
+            self._add(rule)
+        try:
+            self._names.compile()
+            self._pod_names.compile()
+        except re.error as err:
+            raise ValueError("Conflicting regex selectors: {}".format(err))
+
+    def _add(self, rule):
+        kind, _, value = rule.partition(":")
+        if kind not in KINDS:
+            raise ValueError("Unknown selector kind in {}, expected one of {}"
+                             .format(rule, ", ".join(KINDS)))
+        if kind == "uuid":
+            # hung on every hex digit, so other names never run the regex
+            for digit in _HEX_DIGITS:
+                self._names.add_pattern(digit, UUID_PATTERN)
+            return
+        if not value:
+            raise ValueError("Empty selector {}".format(rule))
+        if kind == "namespace":
+            self._namespaces.add(value)
+        elif kind == "pod-label":
+            self._pod_labels.add(value)
+        elif kind == "label":
+            self._labels.add(value)
+        else:
+            names = self._pod_names if kind in POD_NAME_KINDS else self._names
+            kind = kind[len("pod-"):] if kind in POD_NAME_KINDS else kind
+            if kind == "prefix":
+                names.add_prefix(value)
+            elif kind == "glob":
+                names.add_pattern(_glob_prefix(value), fnmatch.translate(value))
+            else:
+                try:
+                    re.compile(value)
+                except re.error as err:
+                    raise ValueError("Invalid regex in {}: {}".format(rule, err))
+                names.add_pattern(_regex_prefix(value), value)
+
+    @classmethod
+    def legacy(cls, name_filter):
+        """ selector of the former --filter behaviour """
+        return cls(["prefix:" + name_filter, "uuid", "pod-prefix:" + K8S_POD_PREFIX])
+
+    @property
+    def uses_pod_labels(self):
+        """ check if rules need kubernetes pod labels """
+        return self._pod_labels.size > 0
+
+    def match(self, attributes, pod_labels=None):
+        """ check if container is selected
+
+        attributes are the container labels plus its name, as reported in
+        docker event Actor attributes. pod_labels is called with the sandbox
+        ID when pod label rules are the only ones left to decide.
+        """
+        if K8S_TYPE_LABEL not in attributes:
+            return self._names.match(attributes['name']) or self._labels.match(attributes)
+        if self._pod_names.match(attributes[K8S_POD_NAME_LABEL]):
+            return True
+        if self._namespaces and attributes.get(K8S_NAMESPACE_LABEL) in self._namespaces:
+            return True
+        if self._labels.match(attributes):
+            return True
+        if not self.uses_pod_labels or pod_labels is None:
+            return False
+        return self._pod_labels.match(pod_labels(attributes[K8S_SANDBOX_ID_LABEL]))
@@ -0,0 +1,230 @@
+# coding: utf-8
+""" per sandbox interface lifecycle state machine """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+import metrics
+
+ATTACHED = "attached"
+DETACHED = "detached"
+DEFAULT_DEBOUNCE = 0.05
+
+_LOG = logging.getLogger(__name__)
+
+
+class TimerThread():
+    """ run callbacks after a delay on a background thread
+
+    Offers call_later() of the asyncio event loop to the worker threads mode.
+    """
+    def __init__(self, name="lifecycle-timer"):
+        self._timers = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_later(self, delay, func, *args):
+        """ run func(*args) in delay seconds """
+        with self._cond:
+            heapq.heappush(self._timers,
+                           (time.monotonic() + delay, next(self._sequence), func, args))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    delay = None
+                    if self._timers:
+                        delay = self._timers[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                    self._cond.wait(delay)
+                if self._stopping:
+                    return
+                _, _, func, args = heapq.heappop(self._timers)
+            try:
+                func(*args)
+            except Exception as err:  # pylint: disable=broad-except
+                _LOG.critical("Timer callback error %s", err)
+                _LOG.critical(traceback.format_exc())
+
+    def stop(self):
+        """ stop the thread, callbacks not run yet are dropped """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+
+
+class SandboxLifecycle():
+    """ coalesce docker events into net interface state changes per sandbox
+
+    Events are reduced to the state they ask for (ATTACHED or DETACHED).
+    The first event of a sandbox is dispatched at once and opens a debounce
+    window; later events within the window replace each other and only the
+    last one is dispatched when the window closes, opening the next window,
+    so start, die, start ends in a single attach. A dispatched change is
+    queued on the dispatcher and, once its turn comes, dropped if the
+    sandbox already is in that state, or run as
+    handler(*args, previous=state) where the handler returns its success.
+
+    The state of a sandbox is known after a handler of this process
+    succeeded, or set by the startup reconciliation. Unknown sandboxes are
+    in the initial state; None means the interface may or may not exist.
+    A sandbox keeps its ID across restarts of a plain docker container but
+    gets a new network namespace, so died() makes an attached state unknown
+    again and the next start attaches once more.
+    """
+    def __init__(self, dispatcher, debounce=DEFAULT_DEBOUNCE, scheduler=None):
+        self.dispatcher = dispatcher
+        self.handler = dispatcher.handler
+        self.debounce = debounce
+        self.initial = None
+        self._timer = None
+        if debounce > 0 and scheduler is None:
+            self._timer = TimerThread()
+            scheduler = self._timer
+        self._scheduler = scheduler
+        self._states = {}
+        self._pending = {}
+        # sandbox ID of the change being applied: whether the sandbox died meanwhile
+        self._applying = {}
+        self._lock = threading.Lock()
+        self.stats = {"events": 0, "coalesced": 0, "noop": 0, "applied": 0, "failed": 0}
+
+    def state(self, sandbox_id):
+        """ known interface state of the sandbox """
+        with self._lock:
+            return self._states.get(sandbox_id, self.initial)
+
+    def set_state(self, sandbox_id, state):
+        """ record interface state found outside of the handler """
+        with self._lock:
+            self._states[sandbox_id] = state
+
+    def died(self, sandbox_id):
+        """ the network namespace of the sandbox is gone, an attached interface with it """
+        with self._lock:
+            if sandbox_id in self._applying:
+                self._applying[sandbox_id] = True
+            if self._states.get(sandbox_id) == ATTACHED:
+                self._states[sandbox_id] = None
+
+    def forget(self, sandbox_id):
+        """ drop state of a destroyed sandbox once its queued changes are done """
+        with self._lock:
+            window = self._pending.pop(sandbox_id, None)
+            if window is None and sandbox_id not in self._states:
+                return
+        if window is not None and window[0] is not None:
+            self._dispatch(sandbox_id, *window)
+        self.dispatcher.submit_call(sandbox_id, self._forget, sandbox_id)
+
+    def _forget(self, sandbox_id):
+        with self._lock:
+            self._states.pop(sandbox_id, None)
+
+    def submit(self, sandbox_id, target, *args):
+        """ request target state of the sandbox, args are passed to the handler """
+        with self._lock:
+            self.stats["events"] += 1
+            window = self._pending.get(sandbox_id)
+            if window is not None:
+                if window[0] is not None:
+                    self.stats["coalesced"] += 1
+                    metrics.OPERATIONS_SAVED.labels("coalesced").inc()
+                window[:] = [target, args]
+                return
+            if self.debounce > 0:
+                window = [None, None]
+                self._pending[sandbox_id] = window
+        self._dispatch(sandbox_id, target, args)
+        if window is not None:
+            self._scheduler.call_later(self.debounce, self._expire, sandbox_id, window)
+
+    def _expire(self, sandbox_id, window):
+        with self._lock:
+            if self._pending.get(sandbox_id) is not window:
+                return
+            target, args = window
+            if target is None:
+                del self._pending[sandbox_id]
+                return
+            # keep a storm to one change per window
+            window = [None, None]
+            self._pending[sandbox_id] = window
+        self._dispatch(sandbox_id, target, args)
+        self._scheduler.call_later(self.debounce, self._expire, sandbox_id, window)
+
+    def _dispatch(self, sandbox_id, target, args):
+        func = self._apply_async if asyncio.iscoroutinefunction(self.handler) else self._apply
+        self.dispatcher.submit_call(sandbox_id, func, sandbox_id, target, args)
+
+    def _begin(self, sandbox_id, target):
+        """ (True, previous state) if the change has to be applied """
+        with self._lock:
+            previous = self._states.get(sandbox_id, self.initial)
+            if previous == target:
+                self.stats["noop"] += 1
+                metrics.OPERATIONS_SAVED.labels("noop").inc()
+                return False, previous
+            self._applying[sandbox_id] = False
+            return True, previous
+
+    def _finish(self, sandbox_id, target, success):
+        with self._lock:
+            self.stats["applied"] += 1
+            died = self._applying.pop(sandbox_id, False)
+            if success:
+                # an interface attached to the namespace which died is gone
+                self._states[sandbox_id] = None if died and target == ATTACHED else target
+            else:
+                self.stats["failed"] += 1
+                self._states[sandbox_id] = None
+
+    def _apply(self, sandbox_id, target, args):
+        apply, previous = self._begin(sandbox_id, target)
+        if not apply:
+            return
+        success = False
+        try:
+            success = self.handler(*args, previous=previous)
+        finally:
+            self._finish(sandbox_id, target, success)
+
+    async def _apply_async(self, sandbox_id, target, args):
+        apply, previous = self._begin(sandbox_id, target)
+        if not apply:
+            return
+        success = False
+        try:
+            success = await self.handler(*args, previous=previous)
+        finally:
+            self._finish(sandbox_id, target, success)
+
+    def flush(self):
+        """ dispatch pending changes without waiting for the debounce window """
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        for sandbox_id, (target, args) in pending:
+            if target is not None:
+                self._dispatch(sandbox_id, target, args)
+
+    def stop(self):
+        """ dispatch pending changes and stop the timer thread """
+        self.flush()
+        if self._timer is not None:
+            self._timer.stop()
@@ -0,0 +1,222 @@
+# coding: utf-8
+""" asyncio dispatcher tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import async_core
+import deadlines
+
+
+class AsyncDispatcherTest(unittest.TestCase):
+    """ handlers run as tasks of an event loop """
+    def setUp(self):
+        self.loop = async_core.event_loop()
+        self.addCleanup(self.loop.close)
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def run_loop(self, coroutine):
+        """ result of the coroutine run on the loop """
+        return self.loop.run_until_complete(coroutine)
+
+    async def handler(self, key, number, delay=0.0):
+        """ coroutine handler recording (key, number) once it is done """
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(delay)
+            self.events.append((key, number))
+        finally:
+            self.running -= 1
+
+    def make_dispatcher(self, handler=None, max_inflight=async_core.DEFAULT_MAX_INFLIGHT):
+        """ dispatcher created on the loop """
+        async def create():
+            return async_core.AsyncDispatcher(handler or self.handler, max_inflight)
+        return self.run_loop(create())
+
+    def of(self, key):
+        """ numbers of the events of key, in handling order """
+        return [number for event_key, number in self.events if event_key == key]
+
+    def test_key_order(self):
+        """ events of a key are handled in order, those of other keys concurrently """
+        dispatcher = self.make_dispatcher()
+        keys = ["sandbox{}".format(index) for index in range(5)]
+        sent = {key: 0 for key in keys}
+
+        async def submit():
+            for _ in range(100):
+                key = random.choice(keys)
+                dispatcher.submit(key, key, sent[key], random.random() * 0.002)
+                sent[key] += 1
+            await dispatcher.drain()
+
+        self.run_loop(submit())
+        for key in keys:
+            self.assertEqual(list(range(sent[key])), self.of(key))
+        self.assertGreater(self.max_running, 1)
+        self.assertEqual(0, dispatcher.queue_depth())
+        self.assertEqual(100, dispatcher.stats.as_dict()["processed"])
+
+    def test_max_inflight(self):
+        """ at most max_inflight handlers run at a time """
+        dispatcher = self.make_dispatcher(max_inflight=2)
+
+        async def submit():
+            for index in range(6):
+                dispatcher.submit(index, index, 0, 0.01)
+            await dispatcher.drain()
+
+        self.run_loop(submit())
+        self.assertEqual(2, self.max_running)
+        self.assertEqual(6, len(self.events))
+
+    def test_blocking_handler(self):
+        """ blocking handlers run off the loop, in order per key """
+        calls = []
+        dispatcher = self.make_dispatcher(
+            lambda number: calls.append((number, threading.get_ident())))
+
+        async def submit():
+            for number in range(10):
+                dispatcher.submit("a", number)
+            await dispatcher.drain()
+
+        self.run_loop(submit())
+        self.assertEqual(list(range(10)), [number for number, _ in calls])
+        self.assertNotIn(threading.get_ident(), {thread for _, thread in calls})
+
+    def test_handler_errors(self):
+        """ failing and late handlers are counted, the next event of the key still runs """
+        async def fail(key, number):
+            raise RuntimeError("broken {} {}".format(key, number))
+
+        dispatcher = self.make_dispatcher()
+
+        async def submit():
+            with mock.patch.dict(deadlines._TIMEOUTS, {"event": 0.01}): # pylint: disable=protected-access
+                dispatcher.submit_call("a", fail, "a", 0)
+                dispatcher.submit("a", "a", 1, 1.0)
+                dispatcher.submit("a", "a", 2)
+                await dispatcher.drain()
+
+        with self.assertLogs("async_core", "ERROR") as logs:
+            self.run_loop(submit())
+        self.assertEqual([2], self.of("a"))
+        self.assertEqual(2, dispatcher.stats.as_dict()["failed"])
+        self.assertIn("broken a 0", "\n".join(logs.output))
+
+    def test_drain_timeout(self):
+        """ drain waits for pending handlers, cancelling those running past its timeout """
+        dispatcher = self.make_dispatcher()
+
+        async def submit():
+            dispatcher.submit("a", "a", 0, 0.01)
+            dispatcher.submit("b", "b", 0, 5.0)
+            dispatcher.submit("b", "b", 1)
+            start = time.monotonic()
+            await dispatcher.drain(0.1)
+            return time.monotonic() - start
+
+        with self.assertLogs("async_core", "WARNING"):
+            elapsed = self.run_loop(submit())
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual([("a", 0)], self.events)
+        self.assertEqual(0, dispatcher.queue_depth())
+
+    def test_wait_capacity(self):
+        """ the event reader waits while limit handlers are pending """
+        dispatcher = self.make_dispatcher()
+
+        async def submit():
+            for index in range(3):
+                dispatcher.submit(index, index, 0, 0.01 * (index + 1))
+            await dispatcher.wait_capacity(2)
+            depth = dispatcher.queue_depth()
+            await dispatcher.drain()
+            return depth
+
+        self.assertEqual(1, self.run_loop(submit()))
+        self.assertEqual([(0, 0), (1, 0)], self.events[:2])
+        # woken once per handler done
+        self.assertEqual(2, dispatcher.stats.as_dict()["backpressure_waits"])
+
+
+class RunTest(unittest.TestCase):
+    """ the daemon loop """
+    def setUp(self):
+        self.loop = async_core.event_loop()
+        self.addCleanup(self.loop.close)
+        self.events = []
+        # run() leaves its executor shut down
+        patch = mock.patch.object(async_core, "_EXECUTOR", None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def handler(self, number):
+        """ handler taking a while """
+        await asyncio.sleep(0.01)
+        self.events.append(number)
+
+    def dispatcher(self):
+        """ dispatcher created on the loop """
+        async def create():
+            return async_core.AsyncDispatcher(self.handler)
+        return self.loop.run_until_complete(create())
+
+    def test_poll_ends(self):
+        """ handlers submitted by the poll coroutine are drained once it ends """
+        dispatcher = self.dispatcher()
+
+        async def poll():
+            for number in range(5):
+                dispatcher.submit(number, number)
+
+        async_core.run(poll(), [dispatcher])
+        self.assertEqual(list(range(5)), sorted(self.events))
+
+    def test_sigterm(self):
+        """ SIGTERM stops polling and drains the dispatchers """
+        dispatcher = self.dispatcher()
+
+        async def poll():
+            dispatcher.submit(0, 0)
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.sleep(10.0)
+
+        start = time.monotonic()
+        async_core.run(poll(), [dispatcher])
+        self.assertLess(time.monotonic() - start, 5.0)
+        self.assertEqual([0], self.events)
+
+    def test_poll_error(self):
+        """ an error ending the poll coroutine is raised after draining """
+        dispatcher = self.dispatcher()
+
+        async def poll():
+            dispatcher.submit(0, 0)
+            raise OSError("docker socket gone")
+
+        with self.assertRaises(OSError):
+            async_core.run(poll(), [dispatcher])
+        self.assertEqual([0], self.events)
+
+
+if __name__ == '__main__':
+    unittest.main()
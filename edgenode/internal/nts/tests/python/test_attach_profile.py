@@ -0,0 +1,111 @@
+# coding: utf-8
+""" veth attach profile tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import attach_profile
+import ovsdb_client
+
+SPEC = {"mtu": 9000, "queues": 4, "offloads": {"tx-checksumming": False},
+        "interface": {"mtu_request": 9000, "other_config:tx-steering": "hash"},
+        "port": {"tag": 100, "other_config:priority-tags": "true"}}
+
+
+class AttachProfileTest(unittest.TestCase):
+    """ profiles described by dicts """
+    def test_from_spec(self):
+        """ fields are kept, OVS columns under their table names """
+        profile = attach_profile.AttachProfile.from_spec("jumbo", SPEC)
+        self.assertEqual((9000, 4), (profile.mtu, profile.queues))
+        self.assertEqual({"tx-checksumming": False}, profile.offloads)
+        self.assertEqual({"Interface": SPEC["interface"], "Port": SPEC["port"]}, profile.ovs)
+        profile = attach_profile.AttachProfile.from_spec("empty", {})
+        self.assertEqual((None, None, {}, {}),
+                         (profile.mtu, profile.queues, profile.offloads, profile.ovs))
+
+    def test_invalid(self):
+        """ specs with unknown fields or values out of range raise ValueError """
+        for spec in ([], {"speed": 10}, {"mtu": 67}, {"mtu": 65536}, {"mtu": "9000"},
+                     {"mtu": True}, {"queues": 0}, {"offloads": {"tso": "on"}},
+                     {"offloads": {"TSO": True}}, {"offloads": ["tso"]},
+                     {"interface": {"mtu request": 9000}}, {"interface": {"Mtu": 1}},
+                     {"interface": {"options:a b": "c"}}, {"interface": {"options:": "c"}},
+                     {"port": {"tag": True}}, {"port": {"tag": 1.5}}, {"port": ["tag"]}):
+            with self.assertRaises(ValueError, msg=spec):
+                attach_profile.AttachProfile.from_spec("bad", spec)
+
+    def test_vsctl_args(self):
+        """ one set command per table, values quoted so ovs-vsctl reads strings as strings """
+        profile = attach_profile.AttachProfile.from_spec("jumbo", dict(SPEC, port={
+            "other_config:priority-tags": "true", "external_ids:owner": "a b=\"c\""}))
+        self.assertEqual(["--", "set", "Interface", "ve1-a",
+                          'mtu_request=9000', 'other_config:tx-steering="hash"',
+                          "--", "set", "Port", "ve1-a",
+                          'external_ids:owner="a b=\\"c\\""',
+                          'other_config:priority-tags="true"'],
+                         profile.vsctl_args("ve1-a"))
+        self.assertEqual([], attach_profile.PLAIN.vsctl_args("ve1-a"))
+
+    def test_ovsdb_row(self):
+        """ the OVSDB rows of a profile set the keys of maps as strings """
+        profile = attach_profile.AttachProfile.from_spec("jumbo", dict(SPEC, interface={
+            "mtu_request": 9000, "other_config:tx-steering": "hash", "options:n_rxq": 4}))
+        row = ovsdb_client._row("ve1-a", profile.ovs["Interface"]) # pylint: disable=protected-access
+        self.assertEqual({"name": "ve1-a", "mtu_request": 9000,
+                          "options": ["map", [["n_rxq", "4"]]],
+                          "other_config": ["map", [["tx-steering", "hash"]]]}, row)
+
+
+class AttachProfilesTest(unittest.TestCase):
+    """ profiles selected by sandbox labels """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="attach-profile-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def write_profiles(self, specs):
+        """ path of a profiles file of the specs """
+        path = os.path.join(self.workdir, "profiles.json")
+        with open(path, "w") as profiles_file:
+            json.dump(specs, profiles_file)
+        return path
+
+    def test_load(self):
+        """ a file of valid profiles loads, an invalid one raises ValueError """
+        profiles = attach_profile.load_profiles(self.write_profiles({"jumbo": SPEC}))
+        self.assertEqual(["jumbo"], list(profiles))
+        with self.assertRaises(ValueError):
+            attach_profile.load_profiles(self.write_profiles({"jumbo": SPEC, "bad": {"mtu": 1}}))
+        with self.assertRaises(ValueError):
+            attach_profile.load_profiles(self.write_profiles([SPEC]))
+
+    def test_select(self):
+        """ the label names the profile, the default is used without it or for unknown names """
+        jumbo = attach_profile.AttachProfile.from_spec("jumbo", SPEC)
+        profiles = attach_profile.AttachProfiles({"jumbo": jumbo})
+        self.assertTrue(profiles.selectable)
+        self.assertIs(jumbo, profiles.select({attach_profile.PROFILE_LABEL: "jumbo"}))
+        self.assertIs(attach_profile.PLAIN, profiles.select({}))
+        self.assertIs(attach_profile.PLAIN,
+                      profiles.select({attach_profile.PROFILE_LABEL: "missing"}))
+        profiles = attach_profile.AttachProfiles({"jumbo": jumbo}, default="jumbo")
+        self.assertIs(jumbo, profiles.select({}))
+        self.assertFalse(attach_profile.AttachProfiles({}).selectable)
+        with self.assertRaises(ValueError):
+            attach_profile.AttachProfiles({}, default="missing")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# coding: utf-8
+""" attachment store tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import attachment_store
+
+
+class AttachmentStoreTest(unittest.TestCase):
+    """ store in a temporary directory """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="attachment-store-test-")
+        self.path = os.path.join(self.workdir, "attachments.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_reload(self):
+        """ records changed and removed are found again by the next run """
+        store = attachment_store.AttachmentStore(self.path)
+        self.assertEqual(0, store.load())
+        store.update("sb1", netns="/proc/1/ns/net", kni_if="vEth0")
+        store.update("sb2", netns="/proc/2/ns/net", kni_if="vEth1")
+        store.update("sb1", state="attached")
+        store.remove("sb2")
+        store.close()
+        store = attachment_store.AttachmentStore(self.path)
+        self.assertEqual(1, store.load())
+        self.assertEqual("attached", store.get("sb1")["state"])
+        self.assertEqual("sb1", store.by_interface("vEth0")["id"])
+        self.assertIsNone(store.get("sb2"))
+        store.close()
+
+    def test_changes_synced(self):
+        """ a change returns once its line is synced, compaction syncs the directory """
+        synced = []
+        fsync = os.fsync
+
+        def record_fsync(fd):
+            synced.append(os.path.isdir("/proc/self/fd/{}".format(fd)))
+            fsync(fd)
+
+        store = attachment_store.AttachmentStore(self.path, compact_slack=4)
+        with mock.patch.object(os, "fsync", record_fsync):
+            store.load()
+            self.assertIn(True, synced)
+            del synced[:]
+            store.update("sb1", kni_if="vEth0")
+            self.assertEqual([False], synced)
+            self.assertEqual(1, store.snapshot()["syncs"])
+            del synced[:]
+            for _ in range(5):
+                store.update("sb1", state="attached")
+            self.assertIn(True, synced)
+        store.close()
+
+    def test_concurrent_changes(self):
+        """ concurrent changes all reach the log, sharing syncs """
+        store = attachment_store.AttachmentStore(self.path)
+        store.load()
+
+        def change(index):
+            for count in range(20):
+                store.update("sb{}".format(index), count=count)
+
+        threads = [threading.Thread(target=change, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = store.snapshot()
+        self.assertEqual(160, stats["writes"])
+        self.assertLessEqual(stats["syncs"], 160)
+        store.close()
+        store = attachment_store.AttachmentStore(self.path)
+        self.assertEqual(8, store.load())
+        self.assertEqual([19] * 8, [record["count"] for record in store.records()])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
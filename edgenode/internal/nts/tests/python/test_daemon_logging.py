@@ -0,0 +1,137 @@
+# coding: utf-8
+""" daemon logging pipeline tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import daemon_logging
+
+
+class BlockingHandler(logging.Handler):
+    """ handler keeping the messages, the first one is only handled once unblocked """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.unblocked = threading.Event()
+
+    def emit(self, record):
+        if not self.messages:
+            self.unblocked.wait(5.0)
+        self.messages.append(self.format(record))
+
+
+def record(message, lineno=10, created=0.0, level=logging.WARNING):
+    """ record of a call site at lineno """
+    log_record = logging.LogRecord("test", level, "daemon.py", lineno, message, None, None)
+    log_record.created = created
+    return log_record
+
+
+class QueueTest(unittest.TestCase):
+    """ records handed over to the writer thread """
+    def setUp(self):
+        self.handler = BlockingHandler()
+        self.pipeline = daemon_logging._Pipeline([self.handler], 0, 1.0) # pylint: disable=protected-access
+        self.pipeline.start()
+        self.logger = logging.getLogger("daemon-logging-test")
+        self.logger.propagate = False
+        self.logger.addHandler(self.pipeline.handler)
+        self.addCleanup(self.logger.removeHandler, self.pipeline.handler)
+
+    def test_arguments_rendered_when_logged(self):
+        """ arguments changed after the call do not show in the line written later """
+        self.logger.warning("first")
+        state = {"state": "attached"}
+        self.logger.warning("sandbox %s", state)
+        state["state"] = "detached"
+        self.handler.unblocked.set()
+        self.pipeline.stop()
+        self.assertEqual(["first", "sandbox {'state': 'attached'}"], self.handler.messages)
+
+    def test_full_queue(self):
+        """ records past the queue size are dropped, not waited for """
+        self.logger.warning("first")
+        for index in range(daemon_logging.QUEUE_SIZE + 10):
+            self.logger.warning("record %s", index)
+        self.assertGreater(self.pipeline.stats()["dropped"], 0)
+        self.handler.unblocked.set()
+        self.pipeline.stop()
+        self.assertEqual(self.pipeline.stats()["queued"], len(self.handler.messages))
+
+
+class RateLimitTest(unittest.TestCase):
+    """ warnings and errors of a call site let through per interval """
+    def test_burst(self):
+        """ records past the burst are dropped and counted on the next one let through """
+        limit = daemon_logging.RateLimitFilter(burst=2, interval=10.0)
+        self.assertEqual([True, True, False, False],
+                         [limit.filter(record("x", created=second)) for second in range(4)])
+        self.assertTrue(limit.filter(record("x", lineno=11, created=4.0)))
+        passed = record("x", created=10.0)
+        self.assertTrue(limit.filter(passed))
+        self.assertEqual(2, passed.suppressed)
+        self.assertEqual(2, limit.stats["suppressed"])
+
+    def test_info_and_unlimited(self):
+        """ records below WARNING, and all of them with burst 0, are let through """
+        limit = daemon_logging.RateLimitFilter(burst=1, interval=10.0)
+        self.assertTrue(all(limit.filter(record("x", level=logging.INFO)) for _ in range(5)))
+        limit = daemon_logging.RateLimitFilter(burst=0, interval=10.0)
+        self.assertTrue(all(limit.filter(record("x")) for _ in range(5)))
+
+
+class SetupTest(unittest.TestCase):
+    """ root logger set up from the daemon options """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="daemon-logging-test-")
+        self.root = logging.getLogger('')
+        self.addCleanup(self.root.setLevel, self.root.level)
+
+    def tearDown(self):
+        daemon_logging.shutdown()
+        pipeline = daemon_logging._PIPELINE # pylint: disable=protected-access
+        self.root.removeHandler(pipeline.handler)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def options(self, *args):
+        """ logging options parsed from args """
+        parser = argparse.ArgumentParser()
+        daemon_logging.add_options(parser, os.path.join(self.workdir, "daemon.log"))
+        return parser.parse_args(list(args))
+
+    def test_log_path_json(self):
+        """ records go to the log file as JSON objects, with the sandbox and pod """
+        logger = daemon_logging.setup(self.options("--log-format", "json", "-v", "DEBUG"),
+                                      "test")
+        daemon_logging.sandbox_log(logger, "abc", "pod1").info("attached %s", "vEth0")
+        daemon_logging.shutdown()
+        with open(os.path.join(self.workdir, "daemon.log")) as log_file:
+            entry = json.loads(log_file.readlines()[-1])
+        self.assertEqual(("test", "INFO", "attached vEth0", "abc", "pod1"),
+                         (entry["daemon"], entry["level"], entry["message"], entry["sandbox"],
+                          entry["pod"]))
+
+    def test_log_path_unusable(self):
+        """ a log file which can not be opened leaves the logs on stderr """
+        path = os.path.join(self.workdir, "missing", "daemon.log")
+        with self.assertLogs(level="ERROR") as logs:
+            daemon_logging.setup(self.options("--log-path", path), "test")
+        self.assertIn(path, logs.output[0])
+        self.assertEqual(1, len(daemon_logging._PIPELINE.listener.handlers)) # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+    unittest.main()
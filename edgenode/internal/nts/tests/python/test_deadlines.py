@@ -0,0 +1,182 @@
+# coding: utf-8
+""" deadline, retry and watchdog tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import deadlines
+
+
+class StalledWork():
+    """ watchdog probe of work started at since on the calling thread """
+    def __init__(self, since):
+        self.since = since
+        self.thread_id = threading.get_ident()
+
+    def __call__(self):
+        return [(self.since, self.thread_id)] if self.since is not None else []
+
+
+class WatchdogTest(unittest.TestCase):
+    """ stalls reported, and the daemon exited, by checks """
+    def setUp(self):
+        self.exits = []
+        self.work = StalledWork(None)
+
+    def watchdog(self, restart):
+        """ watchdog of the work stalling after 10s """
+        watchdog = deadlines.Watchdog(10.0, restart, lambda: self.exits.append(1))
+        watchdog.watch("handler", self.work)
+        return watchdog
+
+    def test_stall_reported_once(self):
+        """ work running past stall_after is logged once with its stack """
+        watchdog = self.watchdog(False)
+        self.work.since = time.monotonic() - 5.0
+        self.assertEqual(0.0, watchdog.check())
+        self.work.since = time.monotonic() - 11.0
+        with self.assertLogs("deadlines", "CRITICAL") as logs:
+            self.assertGreaterEqual(watchdog.check(), 11.0)
+        self.assertIn("handler stalled for", logs.output[0])
+        self.assertIn("test_stall_reported_once", logs.output[0])
+        watchdog.check()
+        self.assertEqual(1, watchdog.stats["stalls"])
+        # without restart, no stall exits
+        self.work.since = time.monotonic() - 30.0
+        with self.assertLogs("deadlines", "CRITICAL"):
+            watchdog.check()
+        self.assertEqual(2, watchdog.stats["stalls"])
+        self.assertFalse(self.exits)
+
+    def test_restart(self):
+        """ with restart, a stall of twice stall_after exits """
+        watchdog = self.watchdog(True)
+        self.work.since = time.monotonic() - 15.0
+        with self.assertLogs("deadlines", "CRITICAL"):
+            watchdog.check()
+        self.assertFalse(self.exits)
+        self.work.since = time.monotonic() - 20.0
+        with self.assertLogs("deadlines", "CRITICAL") as logs:
+            watchdog.check()
+        self.assertEqual([1], self.exits)
+        self.assertIn("exiting to be restarted", logs.output[-1])
+
+    def test_exit_status(self):
+        """ a daemon whose thread blocks past twice the watchdog time exits with 75 """
+        script = textwrap.dedent("""
+            import sys, threading, time
+            sys.path.insert(0, {!r})
+            import deadlines
+            blocked = threading.Event()
+            since = time.monotonic()
+            watchdog = deadlines.Watchdog(0.2, restart=True)
+            watchdog.watch("handler", lambda: [(since, threading.main_thread().ident)])
+            watchdog.start()
+            # stuck the way a handler blocked in a system call is
+            blocked.wait(10.0)
+            sys.exit(0)
+            """).format(NTS_DIR)
+        start = time.monotonic()
+        process = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, timeout=20)
+        self.assertEqual(deadlines.EXIT_STALLED, process.returncode, process.stderr)
+        self.assertLess(time.monotonic() - start, 5.0)
+
+    def test_loop_heartbeat(self):
+        """ a loop blocked by a callback stops beating """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        heartbeat = deadlines.LoopHeartbeat(loop, interval=0.01)
+        loop.run_until_complete(asyncio.sleep(0.05))
+        since, thread_id = heartbeat.running()[0]
+        self.assertEqual(threading.get_ident(), thread_id)
+        self.assertLess(time.monotonic() - since, 0.05)
+        stalls = []
+
+        def blocking():
+            time.sleep(0.1)
+            stalls.append(time.monotonic() - heartbeat.running()[0][0])
+
+        loop.call_soon(blocking)
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertGreaterEqual(stalls[0], 0.05)
+        heartbeat.cancel()
+
+
+class RetryTest(unittest.TestCase):
+    """ operations retried with backoff, bounded by deadlines """
+    def setUp(self):
+        patches = (mock.patch.dict(deadlines._RETRY, {"retries": 2, "backoff": 0.001}), # pylint: disable=protected-access
+                   mock.patch.dict(deadlines._TIMEOUTS, {"docker": 0.05})) # pylint: disable=protected-access
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_call_retried(self):
+        """ retryable errors are retried up to retries times, others are not """
+        calls = []
+
+        def flaky(fail):
+            calls.append(1)
+            if len(calls) <= fail:
+                raise deadlines.DeadlineExceeded("late")
+            return len(calls)
+
+        self.assertEqual(3, deadlines.call("docker", flaky, 2))
+        calls.clear()
+        with self.assertRaises(deadlines.DeadlineExceeded):
+            deadlines.call("docker", flaky, 3)
+        self.assertEqual(3, len(calls))
+        calls.clear()
+        with self.assertRaises(deadlines.DeadlineExceeded):
+            deadlines.call("docker", flaky, 1, retryable=(OSError,))
+        self.assertEqual(1, len(calls))
+
+    def test_within(self):
+        """ a coroutine running past its deadline is cancelled with DeadlineExceeded """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(1.0)
+
+        with self.assertRaises(deadlines.DeadlineExceeded) as raised:
+            loop.run_until_complete(deadlines.call_async("docker", slow, what="inspect"))
+        self.assertIn("inspect timed out after 0.05s", str(raised.exception))
+        self.assertEqual(3, len(calls))
+
+    def test_backoff(self):
+        """ delays double from the configured backoff, jittered, up to the maximum """
+        for attempt in range(20):
+            delay = min(deadlines.MAX_BACKOFF, 0.001 * 2 ** attempt)
+            self.assertTrue(delay / 2 <= deadlines.backoff(attempt) <= delay)
+
+    def test_configure(self):
+        """ timeouts of the known operations are set, 0 for none """
+        parser = argparse.ArgumentParser()
+        deadlines.add_options(parser)
+        deadlines.configure(parser.parse_args(["--timeout", "docker=0", "--retries", "-1"]))
+        self.assertIsNone(deadlines.timeout("docker"))
+        self.assertEqual(0, deadlines._RETRY["retries"]) # pylint: disable=protected-access
+        with self.assertRaises(ValueError):
+            deadlines.configure(parser.parse_args(["--timeout", "disk=1"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# coding: utf-8
+""" profiling capture tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import debug_hooks
+
+
+def attach(calls, error=None):
+    """ handler counting its calls, raising error if given """
+    calls.append(1)
+    if error is not None:
+        raise error
+    return len(calls)
+
+
+class ProfileCaptureTest(unittest.TestCase):
+    """ handlers run through a profile capture """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="debug-hooks-test-")
+        self.capture = debug_hooks.ProfileCapture()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_result(self):
+        """ the result of the handler run on a worker thread is returned and profiled """
+        calls = []
+        results = []
+        self.capture.start()
+        worker = threading.Thread(
+            target=lambda: results.append(self.capture.runcall(attach, calls)))
+        worker.start()
+        worker.join()
+        self.capture.stop()
+        self.assertEqual([1], results)
+        path = os.path.join(self.workdir, "profile.prof")
+        self.capture.dump(path, 0)
+        functions = {function[2] for function in pstats.Stats(path).stats}
+        self.assertIn("attach", functions)
+
+    def test_handler_error(self):
+        """ an error raised by the handler is passed on, the handler runs once """
+        calls = []
+        with self.assertRaises(ValueError):
+            self.capture.runcall(attach, calls, ValueError("bad event"))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, self.capture.runcall(attach, calls))
+
+    def test_profiler_conflict(self):
+        """ the handler runs once, unprofiled, while another profiler is active """
+        calls = []
+        other = debug_hooks.ProfileCapture()
+        other.start()
+        try:
+            self.assertEqual(1, self.capture.runcall(attach, calls))
+            with self.assertRaises(ValueError):
+                self.capture.runcall(attach, calls, ValueError("bad event"))
+        finally:
+            other.stop()
+        self.assertEqual(2, len(calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
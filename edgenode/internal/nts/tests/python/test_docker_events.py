@@ -0,0 +1,126 @@
+# coding: utf-8
+""" docker events helpers tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import docker
+import requests
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import deadlines
+import docker_events
+import pod_selector
+
+
+class FakeContainer():
+    """ inspected container """
+    def __init__(self, container_id, sandbox_key, labels=None):
+        self.id = container_id
+        self.attrs = {"NetworkSettings": {"SandboxKey": sandbox_key},
+                      "Config": {"Labels": labels or {}}}
+
+
+class FakeContainers():
+    """ docker_cli.containers with sandbox keys set by the test """
+    def __init__(self):
+        self.keys = {}
+        self.inspected = []
+        self.errors = []
+
+    def get(self, container_id):
+        """ inspect container, raises the errors set by the test first """
+        self.inspected.append(container_id)
+        if self.errors:
+            raise self.errors.pop(0)
+        return FakeContainer(container_id, self.keys[container_id])
+
+
+class FakeDocker():
+    """ docker client """
+    def __init__(self):
+        self.containers = FakeContainers()
+
+
+def event(action, container_id, **attributes):
+    """ docker container event """
+    attributes.setdefault("name", container_id)
+    return {"Type": "container", "Action": action,
+            "Actor": {"ID": container_id, "Attributes": attributes}}
+
+
+class SandboxCacheTest(unittest.TestCase):
+    """ namespace paths of sandboxes restarting under the same ID """
+    def setUp(self):
+        self.docker = FakeDocker()
+        self.forgotten = []
+        self.sandboxes = docker_events.SandboxCache(self.docker,
+                                                    on_evict=self.forgotten.append)
+        self.selector = pod_selector.PodSelector(["glob:*"])
+
+    def test_restart(self):
+        """ a plain container which died is inspected again on its next start """
+        self.docker.containers.keys["c1"] = "/run/docker/netns/a"
+        self.assertEqual(("c1", "c1"), docker_events.event_target(
+            event("start", "c1"), self.sandboxes, self.selector))
+        self.assertEqual("/run/docker/netns/a", self.sandboxes.ns_path("c1"))
+        self.assertEqual("/run/docker/netns/a", self.sandboxes.ns_path("c1"))
+        self.assertEqual(("c1", "c1"), docker_events.event_target(
+            event("die", "c1"), self.sandboxes, self.selector))
+        self.assertIsNone(self.sandboxes.cached_ns_path("c1"))
+        self.assertEqual(["/run/docker/netns/a"], self.forgotten)
+        self.docker.containers.keys["c1"] = "/run/docker/netns/b"
+        self.assertEqual("/run/docker/netns/b", self.sandboxes.ns_path("c1"))
+        self.assertEqual(["c1", "c1"], self.docker.containers.inspected)
+
+    def test_pod_container_died(self):
+        """ a kubernetes container dying leaves the pod sandbox cached """
+        self.docker.containers.keys["s1"] = "/run/docker/netns/a"
+        self.assertEqual("/run/docker/netns/a", self.sandboxes.ns_path("s1"))
+        docker_events.event_target(
+            event("die", "c1", **{pod_selector.K8S_TYPE_LABEL: "container",
+                                  pod_selector.K8S_SANDBOX_ID_LABEL: "s1",
+                                  pod_selector.K8S_POD_NAME_LABEL: "pod"}),
+            self.sandboxes, self.selector)
+        self.assertEqual("/run/docker/netns/a", self.sandboxes.cached_ns_path("s1"))
+        self.assertEqual([], self.forgotten)
+
+
+class InspectSandboxTest(unittest.TestCase):
+    """ retries of sandbox inspection """
+    def setUp(self):
+        self.docker = FakeDocker()
+        patch = mock.patch.dict(deadlines._RETRY, # pylint: disable=protected-access
+                                {"retries": 2, "backoff": 0.0})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_connection_error_retried(self):
+        """ an inspect which could not reach docker is tried again """
+        self.docker.containers.keys["c1"] = "/run/docker/netns/a"
+        self.docker.containers.errors = [requests.exceptions.ConnectionError("refused"),
+                                         requests.exceptions.ReadTimeout("timed out")]
+        self.assertEqual("/run/docker/netns/a",
+                         docker_events.sandbox_ns_path(self.docker, "c1"))
+        self.assertEqual(["c1"] * 3, self.docker.containers.inspected)
+
+    def test_api_error_not_retried(self):
+        """ a container docker does not know of, or an API failure, fails at once """
+        for error in (docker.errors.NotFound("No such container: c1"),
+                      docker.errors.APIError("500 Server Error")):
+            self.docker.containers.inspected = []
+            self.docker.containers.errors = [error]
+            with self.assertRaises(type(error)):
+                docker_events.sandbox_ns_path(self.docker, "c1")
+            self.assertEqual(["c1"], self.docker.containers.inspected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# coding: utf-8
+""" event dispatcher tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import event_dispatcher
+
+
+class Recorder():
+    """ handler recording (key, sequence number) of the events in handling order """
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, key, number, delay=0.0):
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.events.append((key, number))
+
+    def of(self, key):
+        """ sequence numbers of the events of key, in handling order """
+        with self.lock:
+            return [number for event_key, number in self.events if event_key == key]
+
+
+class EventDispatcherTest(unittest.TestCase):
+    """ events sharded by key over the workers """
+    def setUp(self):
+        self.recorder = Recorder()
+        self.dispatchers = []
+
+    def tearDown(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.stop()
+
+    def make_dispatcher(self, workers=4, queue_depth=event_dispatcher.DEFAULT_QUEUE_DEPTH):
+        """ dispatcher of the recorder, stopped at the end of the test """
+        dispatcher = event_dispatcher.EventDispatcher(self.recorder, workers, queue_depth)
+        self.dispatchers.append(dispatcher)
+        return dispatcher
+
+    def test_key_order(self):
+        """ events of a key are handled in the order they were submitted """
+        dispatcher = self.make_dispatcher()
+        keys = ["sandbox{}".format(index) for index in range(10)]
+        sent = {key: 0 for key in keys}
+        for _ in range(500):
+            key = random.choice(keys)
+            dispatcher.submit(key, key, sent[key], random.random() * 0.001)
+            sent[key] += 1
+        dispatcher.join()
+        for key in keys:
+            self.assertEqual(list(range(sent[key])), self.recorder.of(key))
+        stats = dispatcher.stats.as_dict()
+        self.assertEqual((500, 500, 0), (stats["submitted"], stats["processed"],
+                                         stats["failed"]))
+
+    def test_keys_concurrent(self):
+        """ an event blocked on one key does not hold up the other keys """
+        dispatcher = self.make_dispatcher(workers=8)
+        blocked = threading.Event()
+        keys = ["sandbox{}".format(index) for index in range(20)]
+        owner = hash(keys[0]) % 8
+        others = [key for key in keys[1:] if hash(key) % 8 != owner]
+        dispatcher.submit_call(keys[0], blocked.wait, 5.0)
+        dispatcher.submit(keys[0], keys[0], 0)
+        for key in others:
+            dispatcher.submit(key, key, 0)
+        deadline = time.monotonic() + 5.0
+        while len(self.recorder.events) < len(others):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual([], self.recorder.of(keys[0]))
+        self.assertEqual(1, len(dispatcher.running()))
+        blocked.set()
+        dispatcher.join()
+        self.assertEqual([0], self.recorder.of(keys[0]))
+        self.assertEqual([], dispatcher.running())
+
+    def test_backpressure(self):
+        """ submit blocks while the queue of the key is full, until its worker catches up """
+        dispatcher = self.make_dispatcher(workers=1, queue_depth=2)
+        blocked = threading.Event()
+        dispatcher.submit_call("a", blocked.wait, 5.0)
+        # wait until the worker took it, leaving the queue empty
+        while not dispatcher.running():
+            time.sleep(0.001)
+        dispatcher.submit("a", "a", 0)
+        dispatcher.submit("a", "a", 1)
+        self.assertEqual(2, dispatcher.queue_depth())
+        submitted = threading.Event()
+        submitter = threading.Thread(target=lambda: (dispatcher.submit("a", "a", 2),
+                                                     submitted.set()))
+        submitter.start()
+        self.assertFalse(submitted.wait(0.1))
+        self.assertEqual(1, dispatcher.stats.as_dict()["backpressure_waits"])
+        blocked.set()
+        submitter.join(5.0)
+        self.assertTrue(submitted.is_set())
+        dispatcher.join()
+        self.assertEqual([0, 1, 2], self.recorder.of("a"))
+
+    def test_handler_error(self):
+        """ a failing handler is counted and its worker goes on """
+        dispatcher = self.make_dispatcher(workers=1)
+
+        def fail():
+            raise RuntimeError("100% broken")
+
+        with self.assertLogs("event_dispatcher", "CRITICAL") as logs:
+            dispatcher.submit_call("a", fail)
+            dispatcher.submit("a", "a", 0)
+            dispatcher.join()
+        self.assertEqual([0], self.recorder.of("a"))
+        self.assertEqual(1, dispatcher.stats.as_dict()["failed"])
+        self.assertIn("100% broken", "\n".join(logs.output))
+
+    def test_stop_processes_queued(self):
+        """ events queued before stop are handled """
+        dispatcher = self.make_dispatcher(workers=2)
+        for number in range(20):
+            dispatcher.submit("a", "a", number, 0.001)
+        self.dispatchers.remove(dispatcher)
+        dispatcher.stop()
+        self.assertEqual(list(range(20)), self.recorder.of("a"))
+
+    def test_no_workers(self):
+        """ a dispatcher needs a worker """
+        with self.assertRaises(ValueError):
+            event_dispatcher.EventDispatcher(self.recorder, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
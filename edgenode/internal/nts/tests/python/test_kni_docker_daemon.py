@@ -0,0 +1,194 @@
+# coding: utf-8
+""" KNI daemon tests against the stand-in NES server and a fake nes_api library """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+sys.path.insert(0, os.path.join(NTS_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import attachment_store
+import fake_nes
+import kni_docker_daemon
+import nes_client
+
+
+class KniCapacityTest(unittest.TestCase):
+    """ KNI devices created without the pool on a NES with room for one """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="kni-daemon-test-")
+        path = os.path.join(self.workdir, "nes.sock")
+        self.server = fake_nes.FakeNesServer(path, max_kni=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.context = kni_docker_daemon.NesContext(None, "", path)
+        self.context.client = nes_client.NesClient(path)
+        self.context.aclient = nes_client.AsyncNesClient(path)
+        self.store = attachment_store.AttachmentStore(os.path.join(self.workdir, "store"))
+        self.store.load()
+        patches = (mock.patch.object(kni_docker_daemon, "_STORE", self.store),
+                   mock.patch.object(kni_docker_daemon, "_POOL", None),
+                   mock.patch.dict(self.capacity(), {"max": 1, "exhausted": 0}))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.context.client.close()
+        self.store.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def capacity(self):
+        """ module KNI capacity counters """
+        return kni_docker_daemon._KNI_CAPACITY # pylint: disable=protected-access
+
+    def test_failed_add_at_capacity(self):
+        """ a failed add with all KNI devices recorded counts the capacity exhausted """
+        self.assertEqual(("pod1", "vEth0"),
+                         kni_docker_daemon.create_kni_interface(self.context, "pod1"))
+        self.store.update("pod1", kni_if="vEth0")
+        self.assertEqual(("pod2", ""),
+                         kni_docker_daemon.create_kni_interface(self.context, "pod2"))
+        self.assertEqual(1, self.capacity()["exhausted"])
+
+    def test_failed_add_below_capacity(self):
+        """ a failed add with room left is not a capacity problem """
+        self.assertEqual(("pod1", "vEth0"),
+                         kni_docker_daemon.create_kni_interface(self.context, "pod1"))
+        self.assertEqual(("pod1", ""),
+                         kni_docker_daemon.create_kni_interface(self.context, "pod1"))
+        self.assertEqual(0, self.capacity()["exhausted"])
+
+    def test_collect_failed_delete(self):
+        """ the record of a gone sandbox is kept until NES deleted its interface """
+        self.assertEqual(("pod1", "vEth0"),
+                         kni_docker_daemon.create_kni_interface(self.context, "pod1"))
+        kni_docker_daemon.record_attachment("pod1", "/proc/1/ns/net", "vEth0", "attached")
+        self.server.fail_ratio = 1.0
+        self.assertFalse(kni_docker_daemon.collect_attachment(self.context, "pod1"))
+        record = self.store.get("pod1")
+        self.assertEqual(("vEth0", None), (record["kni_if"], record["state"]))
+        self.assertIn("pod1", self.server.kni.devices)
+        self.server.fail_ratio = 0.0
+        self.assertTrue(kni_docker_daemon.collect_attachment(self.context, "pod1"))
+        self.assertIsNone(self.store.get("pod1"))
+        self.assertNotIn("pod1", self.server.kni.devices)
+
+    def test_failed_add_at_capacity_async(self):
+        """ the asyncio mode counts the capacity exhausted as well """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(("pod1", "vEth0"), loop.run_until_complete(
+            kni_docker_daemon.create_kni_interface_async(self.context, "pod1")))
+        self.store.update("pod1", kni_if="vEth0")
+        self.assertEqual(("pod2", ""), loop.run_until_complete(
+            kni_docker_daemon.create_kni_interface_async(self.context, "pod2")))
+        self.assertEqual(1, self.capacity()["exhausted"])
+        loop.run_until_complete(self.context.aclient.close())
+
+
+class FakeNesLib():
+    """ nes_api session calls behaving like libs/libnes_api/libnes_api.c """
+    def __init__(self):
+        self.peers = {}
+        self.lost = False
+
+    def nes_conn_start(self, conn_ref, unix_sock_path): # pylint: disable=unused-argument
+        """ connect the session to a socket pair end kept by the test """
+        conn = conn_ref._obj # pylint: disable=protected-access
+        sock, peer = socket.socketpair()
+        conn.socket_fd = sock.detach()
+        conn.state = kni_docker_daemon.NES_REMOTE_CONNECTED
+        self.peers[conn.socket_fd] = peer
+        return kni_docker_daemon.NES_SUCCESS
+
+    def nes_conn_close(self, conn_ref):
+        """ close the socket of connected sessions only """
+        conn = conn_ref._obj # pylint: disable=protected-access
+        if conn.state != kni_docker_daemon.NES_REMOTE_CONNECTED:
+            return kni_docker_daemon.NES_FAIL
+        os.close(conn.socket_fd)
+        conn.state = kni_docker_daemon.NES_REMOTE_DISCONNECTED
+        return kni_docker_daemon.NES_SUCCESS
+
+    def nes_kni_add(self, conn_ref):
+        """ fails with the session marked disconnected while NES is lost """
+        conn = conn_ref._obj # pylint: disable=protected-access
+        if not self.lost:
+            return kni_docker_daemon.NES_SUCCESS
+        self.peers.pop(conn.socket_fd).close()
+        conn.state = kni_docker_daemon.NES_REMOTE_DISCONNECTED
+        return kni_docker_daemon.NES_FAIL
+
+    def close(self):
+        """ close the NES ends left """
+        for peer in self.peers.values():
+            peer.close()
+        self.peers.clear()
+
+
+def open_fds():
+    """ number of file descriptors of the process """
+    return len(os.listdir("/proc/self/fd"))
+
+
+class NesConnectionPoolTest(unittest.TestCase):
+    """ sessions of the nes_api library pool """
+    def setUp(self):
+        self.lib = FakeNesLib()
+        self.addCleanup(self.lib.close)
+
+    def test_lost_sessions_closed(self):
+        """ sessions the library marked disconnected do not leak their sockets """
+        pool = kni_docker_daemon.NesConnectionPool(self.lib, "nes.sock", 2)
+        self.assertEqual(kni_docker_daemon.NES_SUCCESS, pool.call(self.lib.nes_kni_add))
+        fds = open_fds()
+        self.lib.lost = True
+        for _ in range(10):
+            self.assertEqual(kni_docker_daemon.NES_FAIL, pool.call(self.lib.nes_kni_add))
+        self.lib.lost = False
+        self.assertEqual(kni_docker_daemon.NES_SUCCESS, pool.call(self.lib.nes_kni_add))
+        self.assertEqual(fds, open_fds())
+        pool.close()
+
+    def test_expired_session_closed(self):
+        """ a session dropped on timeout has its socket closed """
+        pool = kni_docker_daemon.NesConnectionPool(self.lib, "nes.sock", 1, timeout=0.0)
+        fds = open_fds()
+        self.assertEqual(kni_docker_daemon.NES_FAIL,
+                         pool.call(lambda conn_ref: kni_docker_daemon.NES_FAIL))
+        self.assertEqual(1, pool.stats["timeouts"])
+        # only the NES end of the socket pair is left
+        self.assertEqual(fds + 1, open_fds())
+
+    def test_close_once(self):
+        """ closing a session again leaves a reused descriptor alone """
+        pool = kni_docker_daemon.NesConnectionPool(self.lib, "nes.sock", 1)
+        conn = pool.acquire()
+        conn.state = 0
+        fd = conn.socket_fd
+        pool.release(conn)
+        self.assertEqual(-1, conn.socket_fd)
+        reused = os.open(os.devnull, os.O_RDONLY)
+        self.addCleanup(os.close, reused)
+        pool._close(conn) # pylint: disable=protected-access
+        self.assertEqual(fd, reused)
+        os.fstat(reused)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+# coding: utf-8
+""" KNI pool tests against the stand-in NES server """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+sys.path.insert(0, os.path.join(NTS_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import fake_nes
+import kni_pool
+import nes_client
+
+MAX_KNI = 6
+POOL_SIZE = 3
+
+
+class KniPoolTest(unittest.TestCase):
+    """ pool creating its interfaces through the protocol client """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="kni-pool-test-")
+        self.path = os.path.join(self.workdir, "nes.sock")
+        self.state_path = os.path.join(self.workdir, "kni_pool.json")
+        self.server = fake_nes.FakeNesServer(self.path, max_kni=MAX_KNI)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = nes_client.NesClient(self.path, 2.0)
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.stop()
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def create(self, dev_id):
+        """ KNI interface name of the device, "" on failure """
+        ret, if_name = self.client.kni_add(dev_id)
+        return if_name if ret == nes_client.NES_SUCCESS else ""
+
+    def destroy(self, dev_id):
+        """ delete KNI interface of the device, returns success """
+        return self.client.kni_del(dev_id)[0] == nes_client.NES_SUCCESS
+
+    def make_pool(self, in_use=()):
+        """ pool saving its state in the work directory """
+        pool = kni_pool.KniPool(POOL_SIZE, 1, MAX_KNI, self.create, self.destroy, in_use,
+                                self.state_path)
+        self.pools.append(pool)
+        return pool
+
+    def wait_idle(self, pool, count):
+        """ wait until count interfaces are idle in the pool """
+        deadline = time.monotonic() + 5.0
+        while pool.snapshot()["idle"] != count:
+            self.assertLess(time.monotonic(), deadline, pool.snapshot())
+            time.sleep(0.01)
+
+    def abandon(self, pool):
+        """ end the refill thread of the pool the way an unclean exit would, without stop() """
+        self.pools.remove(pool)
+        with pool._cond: # pylint: disable=protected-access
+            pool._stopping = True # pylint: disable=protected-access
+            pool._cond.notify_all() # pylint: disable=protected-access
+        pool._thread.join() # pylint: disable=protected-access
+
+    def test_state_file(self):
+        """ idle device IDs are saved with their interface names, in use ones are not """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        with open(self.state_path) as state_file:
+            saved = json.load(state_file)
+        self.assertEqual(POOL_SIZE, len(saved))
+        self.assertEqual(set(self.server.kni.devices), set(saved))
+        dev_id, if_name = pool.acquire()
+        with open(self.state_path) as state_file:
+            saved = json.load(state_file)
+        self.assertNotIn(dev_id, saved)
+        self.assertNotIn(if_name, pool.if_names())
+        pool.stop()
+        self.pools.remove(pool)
+        with open(self.state_path) as state_file:
+            self.assertEqual({}, json.load(state_file))
+        self.assertEqual([dev_id], list(self.server.kni.devices))
+
+    def test_unclean_exit(self):
+        """ devices left in NES by an earlier run are deleted before the pool is filled """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        in_use = pool.acquire()[0]
+        self.abandon(pool)
+        self.assertEqual(POOL_SIZE, len(self.server.kni.devices))
+
+        pool = self.make_pool([in_use])
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.assertEqual(POOL_SIZE - 1, pool.snapshot()["leftover"])
+        self.assertEqual(POOL_SIZE + 1, len(self.server.kni.devices))
+        self.assertIn(in_use, self.server.kni.devices)
+        self.assertEqual(0, pool.snapshot()["create_failed"])
+
+    def test_leftover_capacity(self):
+        """ devices left in NES count against the capacity until they are deleted """
+        with open(self.state_path, "w") as state_file:
+            json.dump({kni_pool.pool_dev_id(index): "" for index in range(MAX_KNI)},
+                      state_file)
+        for index in range(MAX_KNI):
+            self.create(kni_pool.pool_dev_id(index))
+        pool = self.make_pool()
+        device = pool.acquire()
+        self.assertIsNotNone(device)
+        self.assertEqual(0, pool.snapshot()["exhausted"])
+        self.assertEqual(0, pool.snapshot()["create_failed"])
+
+    def test_exhausted(self):
+        """ acquiring beyond the capacity is reported instead of failing in NES """
+        pool = self.make_pool()
+        devices = [pool.acquire() for _ in range(MAX_KNI)]
+        self.assertNotIn(None, devices)
+        self.assertIsNone(pool.acquire())
+        self.assertEqual(1, pool.snapshot()["exhausted"])
+        self.assertEqual(0, self.server.snapshot()["errors"])
+
+    def test_reclaim(self):
+        """ devices of a disabled pool are deleted, the state file goes with them """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        in_use = pool.acquire()[0]
+        self.abandon(pool)
+        self.assertEqual(POOL_SIZE - 1, kni_pool.reclaim(self.state_path, self.destroy,
+                                                         [in_use]))
+        self.assertEqual([in_use], list(self.server.kni.devices))
+        self.assertFalse(os.path.exists(self.state_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
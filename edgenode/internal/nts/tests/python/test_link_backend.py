@@ -0,0 +1,221 @@
+# coding: utf-8
+""" link backend tests, netlink ones in throwaway network namespaces
+
+Run as root (CAP_NET_ADMIN) with: python3 -m unittest discover -s tests/python
+"""
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import link_backend
+
+CAP_NET_ADMIN = 12
+NETNS_DIR = "/var/run/netns"
+PREFIX = "nts-test-{}-".format(os.getpid())
+
+
+def can_admin_net():
+    """ whether the process may create network namespaces and links """
+    if os.geteuid() != 0:
+        return False
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("CapEff:"):
+                    return bool(int(line.split()[1], 16) >> CAP_NET_ADMIN & 1)
+    except OSError:
+        pass
+    return False
+
+def ip_command(*args):
+    """ output of an ip command """
+    return subprocess.check_output(("ip",) + args).decode("utf-8")
+
+def link_details(if_name, netns=None):
+    """ ip -details output of a link """
+    return ip_command(*(("-netns", netns) if netns else ()) + ("-d", "link", "show", if_name))
+
+
+@unittest.skipUnless(can_admin_net(), "needs root with CAP_NET_ADMIN")
+class NetlinkLinkBackendTest(unittest.TestCase):
+    """ link operations between a daemon, a host and a sandbox namespace
+
+    The test thread itself enters the daemon namespace, the host namespace
+    stands in for link_backend.HOST_NS.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.names = {role: PREFIX + role for role in ("daemon", "host", "sandbox")}
+        for name in cls.names.values():
+            ip_command("netns", "add", name)
+        cls.paths = {role: os.path.join(NETNS_DIR, name) for role, name in cls.names.items()}
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        cls.setns = libc.setns
+        cls.own_ns = os.open("/proc/self/ns/net", os.O_RDONLY)
+        ns_fd = os.open(cls.paths["daemon"], os.O_RDONLY)
+        try:
+            if cls.setns(ns_fd, 0) != 0:
+                raise OSError(ctypes.get_errno(), "setns failed")
+        finally:
+            os.close(ns_fd)
+        cls.host_ns = link_backend.HOST_NS
+        link_backend.HOST_NS = cls.paths["host"]
+
+    @classmethod
+    def tearDownClass(cls):
+        link_backend.HOST_NS = cls.host_ns
+        cls.setns(cls.own_ns, 0)
+        os.close(cls.own_ns)
+        for name in cls.names.values():
+            subprocess.call(["ip", "netns", "delete", name])
+
+    def setUp(self):
+        self.backend = link_backend.NetlinkLinkBackend()
+
+    def tearDown(self):
+        self.backend.close()
+        for if_name in ("ntsa0", "ntsa1"):
+            subprocess.call(["ip", "link", "delete", if_name], stderr=subprocess.DEVNULL)
+
+    def test_add_veth_mtu_queues(self):
+        """ both ends get the MTU and queue count """
+        self.assertTrue(self.backend.add_veth("ntsa0", "ntsb0", 9000, 4))
+        for if_name in ("ntsa0", "ntsb0"):
+            details = link_details(if_name)
+            self.assertIn("mtu 9000", details)
+            self.assertIn("numtxqueues 4 numrxqueues 4", details)
+
+    def test_add_veth_plain(self):
+        """ a plain pair gets the default MTU and one queue """
+        self.assertTrue(self.backend.add_veth("ntsa0", "ntsb0"))
+        self.assertIn("mtu 1500", link_details("ntsb0"))
+        self.assertIn("numtxqueues 1 ", link_details("ntsb0"))
+        self.assertFalse(self.backend.add_veth("ntsa0", "ntsb1"))
+
+    def test_rename_and_delete(self):
+        """ renamed link is listed by its new name, deleting one end deletes the pair """
+        self.assertTrue(self.backend.add_veth("ntsa0", "ntsb0"))
+        self.assertTrue(self.backend.rename_link("ntsb0", "ntsc0"))
+        links = self.backend.list_links(self.paths["daemon"])
+        self.assertIn("ntsc0", links)
+        self.assertNotIn("ntsb0", links)
+        self.assertRegex(links["ntsc0"], "^([0-9a-f]{2}:){5}[0-9a-f]{2}$")
+        self.assertTrue(self.backend.delete_link("ntsa0"))
+        links = self.backend.list_links(self.paths["daemon"])
+        self.assertNotIn("ntsa0", links)
+        self.assertNotIn("ntsc0", links)
+        self.assertFalse(self.backend.delete_link("ntsa0"))
+        self.assertFalse(self.backend.rename_link("ntsa0", "ntsc0"))
+
+    def test_move_and_set_up(self):
+        """ ends are moved to the host and the sandbox namespace, the host one set up """
+        self.assertTrue(self.backend.add_veth("ntsa1", "ntsb1"))
+        self.assertTrue(self.backend.move_link("ntsb1", self.paths["sandbox"]))
+        self.assertTrue(self.backend.move_link_to_host("ntsa1"))
+        self.assertIn("ntsb1", self.backend.list_links(self.paths["sandbox"]))
+        self.assertIn("ntsa1", self.backend.list_links(self.paths["host"]))
+        self.assertNotIn("ntsa1", self.backend.list_links(self.paths["daemon"]))
+        self.assertTrue(self.backend.set_link_up("ntsa1"))
+        flags = link_details("ntsa1", self.names["host"]).split("<")[1].split(">")[0]
+        self.assertIn("UP", flags.split(","))
+        self.assertTrue(self.backend.move_link_from_host("ntsa1", self.paths["sandbox"]))
+        self.assertEqual({"ntsa1", "ntsb1"},
+                         set(self.backend.list_links(self.paths["sandbox"])) - {"lo"})
+        self.assertFalse(self.backend.move_link("ntsa1", self.paths["sandbox"]))
+
+    def test_missing_namespace(self):
+        """ operations on a namespace which does not exist fail """
+        missing = os.path.join(NETNS_DIR, PREFIX + "missing")
+        self.assertIsNone(self.backend.list_links(missing))
+        self.assertTrue(self.backend.add_veth("ntsa0", "ntsb0"))
+        self.assertFalse(self.backend.move_link("ntsb0", missing))
+
+
+
+class RunStepsTest(unittest.TestCase):
+    """ command steps stopping at the first failure """
+    steps = [("true", ["true"], "not logged"),
+             ("false", ["false"], "Failed to set 100% of veth%d"),
+             ("never", ["true"], "not run")]
+
+    def messages(self, logs):
+        """ messages of the error records of the link backend """
+        return [record.getMessage() for record in logs.records
+                if record.name == "link_backend" and record.levelname == "ERROR"]
+
+    def test_error_logged_as_is(self):
+        """ the error of the failed step is logged, % in it included """
+        with self.assertLogs("link_backend", "ERROR") as logs:
+            self.assertFalse(link_backend.run_steps(self.steps))
+        self.assertEqual("Failed to set 100% of veth%d", self.messages(logs)[-1])
+
+    def test_error_logged_as_is_async(self):
+        """ the asyncio mode logs the error of the failed step as it is as well """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with self.assertLogs("link_backend", "ERROR") as logs:
+            self.assertFalse(loop.run_until_complete(link_backend.run_steps_async(self.steps)))
+        self.assertEqual("Failed to set 100% of veth%d", self.messages(logs)[-1])
+
+
+class BlockingBackend():
+    """ in-process backend whose operations block for delay seconds """
+    def __init__(self, delay):
+        self.delay = delay
+        self.threads = set()
+
+    def set_link_up(self, if_name):
+        """ block, then succeed """
+        self.threads.add(threading.get_ident())
+        time.sleep(self.delay)
+        return if_name
+
+
+class AsyncLinkBackendTest(unittest.TestCase):
+    """ in-process operations of the asyncio mode """
+    def test_blocking_operations_overlap(self):
+        """ operations run off the event loop, concurrently and without stalling it """
+        backend = BlockingBackend(0.2)
+        alink = link_backend.AsyncLinkBackend(backend)
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def run():
+            ticking = asyncio.ensure_future(ticker())
+            start = time.monotonic()
+            results = await asyncio.gather(*(alink.call("set_link_up", "if{}".format(index))
+                                             for index in range(4)))
+            elapsed = time.monotonic() - start
+            ticking.cancel()
+            return results, elapsed
+
+        loop = asyncio.new_event_loop()
+        try:
+            results, elapsed = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(["if0", "if1", "if2", "if3"], results)
+        self.assertLess(elapsed, 0.6)
+        self.assertNotIn(threading.get_ident(), backend.threads)
+        self.assertGreater(len(ticks), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
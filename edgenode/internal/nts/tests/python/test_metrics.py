@@ -0,0 +1,172 @@
+# coding: utf-8
+""" metrics tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import http.client
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import metrics
+
+
+def samples(metric):
+    """ sample lines of the metric, without HELP and TYPE """
+    return [line for line in metric.render() if not line.startswith("#")]
+
+
+class HistogramTest(unittest.TestCase):
+    """ observed values counted in preallocated buckets """
+    def test_buckets(self):
+        """ a value equal to a bound is counted in its bucket, counts are cumulative """
+        histogram = metrics.Histogram("latency", "Latency", buckets=(1.0, 0.1, 0.5))
+        for value in (0.05, 0.1, 0.3, 0.5, 0.7, 2.0):
+            histogram.observe(value)
+        self.assertEqual(['latency_bucket{le="0.1"} 2',
+                          'latency_bucket{le="0.5"} 4',
+                          'latency_bucket{le="1.0"} 5',
+                          'latency_bucket{le="+Inf"} 6',
+                          'latency_count 6',
+                          'latency_sum 3.65'], samples(histogram))
+
+    def test_labels(self):
+        """ each label value set has its buckets, extra le label last """
+        histogram = metrics.Histogram("stage", "Stage", ("stage",), buckets=(1.0,))
+        histogram.labels("attach").observe(0.5)
+        histogram.labels("detach").observe(5.0)
+        self.assertEqual(['stage_bucket{stage="attach",le="1.0"} 1',
+                          'stage_bucket{stage="attach",le="+Inf"} 1',
+                          'stage_count{stage="attach"} 1',
+                          'stage_sum{stage="attach"} 0.5',
+                          'stage_bucket{stage="detach",le="1.0"} 0',
+                          'stage_bucket{stage="detach",le="+Inf"} 1',
+                          'stage_count{stage="detach"} 1',
+                          'stage_sum{stage="detach"} 5.0'], samples(histogram))
+
+    def test_threads(self):
+        """ values observed by several threads are all counted """
+        histogram = metrics.Histogram("latency", "Latency", buckets=(0.5,))
+
+        def observe():
+            for _ in range(1000):
+                histogram.observe(0.25)
+                histogram.observe(1)
+
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cumulative, count, total = histogram.labels().snapshot()
+        self.assertEqual(([4000, 8000], 8000, 5000.0), (cumulative, count, total))
+
+
+class CounterTest(unittest.TestCase):
+    """ counters and their exposition """
+    def test_threads(self):
+        """ increments of several threads are summed """
+        counter = metrics.Counter("events", "Events", ("action",))
+
+        def increment():
+            for _ in range(1000):
+                counter.labels("start").inc()
+            counter.labels("die").inc(2)
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['events{action="die"} 8', 'events{action="start"} 4000'],
+                         samples(counter))
+
+    def test_render(self):
+        """ HELP and TYPE lines come first, label values are escaped """
+        counter = metrics.Counter("failures", "Failures", ("reason",))
+        counter.labels('bad "name"\\').inc()
+        self.assertEqual(['# HELP failures Failures', '# TYPE failures counter',
+                          'failures{reason="bad \\"name\\"\\\\"} 1'], counter.render())
+
+    def test_no_labels(self):
+        """ a counter without labels has no braces """
+        counter = metrics.Counter("restarts", "Restarts")
+        self.assertEqual([], samples(counter))
+        counter.inc(3)
+        self.assertEqual(["restarts 3"], samples(counter))
+
+
+class RegistryTest(unittest.TestCase):
+    """ metrics rendered together and served """
+    def setUp(self):
+        self.stats = {"sessions": 2, "failed": 0.5}
+        self.registry = metrics.Registry()
+        self.registry.register(metrics.Counter("a_total", "A")).inc()
+        self.registry.register(metrics.Gauge("depth", "Depth", lambda: 7))
+        self.registry.register(metrics.StatsGauges("nes", "NES client", lambda: self.stats))
+
+    def test_render(self):
+        """ gauges are read when rendered, stats are one gauge per key """
+        text = self.registry.render()
+        self.assertTrue(text.endswith("\n"))
+        lines = text.splitlines()
+        self.assertIn("a_total 1", lines)
+        self.assertIn("depth 7", lines)
+        self.assertIn("# TYPE nes_failed gauge", lines)
+        self.assertIn("nes_failed 0.5", lines)
+        self.stats["sessions"] = 3
+        self.assertIn("nes_sessions 3", self.registry.render().splitlines())
+
+    def test_gauge_labels(self):
+        """ callback gauges have no labels """
+        with self.assertRaises(TypeError):
+            metrics.Gauge("depth", "Depth").labels("x")
+
+    def test_observe_event(self):
+        """ handled events are timed from their docker time, failures counted """
+        before = metrics.EVENT_LATENCY.labels("test", "start").snapshot()[1]
+        failures = metrics.EVENT_FAILURES.labels("test", "start").value()
+        event = {"Action": "start", "timeNano": int((time.time() - 0.5) * 1e9)}
+        metrics.observe_event(event, handler="test")
+        metrics.observe_event(event, success=False, handler="test")
+        _, count, total = metrics.EVENT_LATENCY.labels("test", "start").snapshot()
+        self.assertEqual(before + 1, count)
+        self.assertGreaterEqual(total, 0.5)
+        self.assertEqual(failures + 1, metrics.EVENT_FAILURES.labels("test", "start").value())
+
+    def test_unix_server(self):
+        """ metrics are served over a unix socket, other paths are not found """
+        workdir = tempfile.mkdtemp(prefix="metrics-test-")
+        self.addCleanup(shutil.rmtree, workdir, ignore_errors=True)
+        path = os.path.join(workdir, "metrics.sock")
+        server = metrics.start_server(path, self.registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.assertEqual((200, self.registry.render()), self.get(path, "/metrics"))
+        self.assertEqual(404, self.get(path, "/other")[0])
+
+    @staticmethod
+    def get(path, url):
+        """ (status, body) of a GET of url on the unix socket at path """
+        connection = http.client.HTTPConnection("localhost")
+        connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.sock.connect(path)
+        try:
+            connection.request("GET", url)
+            response = connection.getresponse()
+            return response.status, response.read().decode("utf-8")
+        finally:
+            connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,277 @@
+# coding: utf-8
+""" NES control client tests against the stand-in NES server """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+sys.path.insert(0, os.path.join(NTS_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import fake_nes
+import nes_client
+import nes_stats
+
+MAC = b"\x02\x00\x00\x00\x00\x01"
+
+
+def lookup(index, padding=0):
+    """ lookup keys of route index, padded with blanks the server ignores """
+    return "prio:{},{}ue_ip:10.0.{}.{}/32,srv_ip:20.0.0.1/32".format(
+        index + 1, " " * padding, index // 256, index % 256)
+
+
+class NesServerTest(unittest.TestCase):
+    """ fake NES server run in a thread """
+    latency = 0.0
+    timeout = 2.0
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="nes-client-test-")
+        self.path = os.path.join(self.workdir, "nes.sock")
+        self.server = fake_nes.FakeNesServer(self.path, latency=self.latency)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class RequestBufferTest(unittest.TestCase):
+    """ request framing """
+    def test_framing(self):
+        """ requests follow each other, each with its nes_api_msg_t header """
+        buf = nes_client.RequestBuffer()
+        self.assertEqual(10, buf.add(nes_client.FUNC_ADD_KNI, ("ct1",)))
+        self.assertEqual(8, buf.add(nes_client.FUNC_STATS_DEV, (2,)))
+        self.assertEqual(6, buf.add(nes_client.FUNC_STATS_DEV_ALL, ()))
+        self.assertEqual(nes_client.MSG_HEADER.pack(0, 12, 4) + b"ct1\0" +
+                         nes_client.MSG_HEADER.pack(0, 1, 2) + b"\x02\x00" +
+                         nes_client.MSG_HEADER.pack(0, 0, 0), bytes(buf.view[:buf.size]))
+
+    def test_limit(self):
+        """ requests which would not fit in the room left are not framed """
+        buf = nes_client.RequestBuffer()
+        sizes = []
+        while True:
+            size = buf.add(nes_client.FUNC_ADD_ROUTE, (MAC, lookup(0, 150)))
+            if not size:
+                break
+            sizes.append(size)
+        self.assertEqual(sum(sizes), buf.size)
+        self.assertLessEqual(buf.size, nes_client.MAX_IN_FLIGHT)
+        buf.clear()
+        self.assertEqual(0, buf.add(nes_client.FUNC_ADD_KNI, ("ct1",), 9))
+        self.assertEqual(10, buf.add(nes_client.FUNC_ADD_KNI, ("ct1",), 10))
+        with self.assertRaises(ValueError):
+            nes_client.RequestBuffer(nes_client.MAX_REQUEST_SIZE - 1)
+
+
+class NesClientTest(NesServerTest):
+    """ threaded client """
+    def setUp(self):
+        super().setUp()
+        self.client = nes_client.NesClient(self.path, self.timeout)
+
+    def tearDown(self):
+        self.client.close()
+        super().tearDown()
+
+    def test_responses(self):
+        """ responses are decoded into the results of nes_api """
+        self.assertEqual((nes_client.NES_SUCCESS, "vEth0"), self.client.kni_add("ct1"))
+        self.assertEqual((nes_client.NES_FAIL, ""), self.client.kni_add("ct1"))
+        devices = self.client.stats_all_dev()
+        self.assertEqual(["ENB", "EPC", "KNI"], [device.name.decode() for device in devices])
+        self.assertGreater(self.client.stats_dev(1).rcv_cnt, 0)
+        self.assertIsNone(self.client.stats_dev(7))
+        self.assertEqual(nes_client.NES_SUCCESS, self.client.route_add(MAC, lookup(0)))
+        routes = self.client.route_list(0, 10)
+        self.assertEqual(1, len(routes))
+        self.assertEqual(MAC, bytes(routes[0].dst_mac_addr.ether_addr_octet))
+        self.assertEqual(nes_client.NES_SUCCESS, self.client.route_remove(lookup(0)))
+        self.assertEqual((nes_client.NES_SUCCESS, "vEth0"), self.client.kni_del("ct1"))
+        self.assertEqual(2, self.server.snapshot()["errors"])
+
+    def test_pipelined_order(self):
+        """ each result is the response to its own request, sent in chunks NES can hold """
+        requests = [(nes_client.FUNC_ADD_KNI, ("ct{}".format(index),)) for index in range(200)]
+        requests += [(nes_client.FUNC_ADD_ROUTE, (MAC, lookup(index, 150)))
+                     for index in range(20)]
+        results = self.client.call_many(requests)
+        self.assertEqual([(nes_client.NES_SUCCESS, "vEth{}".format(index))
+                          for index in range(200)], results[:200])
+        self.assertEqual([nes_client.NES_SUCCESS] * 20, results[200:])
+        stats = self.server.snapshot()
+        self.assertEqual(0, stats["overflows"])
+        self.assertEqual(1, stats["connections"])
+        self.assertEqual(220, self.client.stats["requests"])
+        self.assertGreater(self.client.stats["pipelined"], 200)
+
+    def test_concurrent_callers(self):
+        """ callers sharing the connection keep within the NES buffer """
+        results = []
+
+        def call(index):
+            dev_id = "ct{}".format(index)
+            results.append(self.client.call_many(
+                [(nes_client.FUNC_ADD_KNI, (dev_id,)),
+                 (nes_client.FUNC_ADD_ROUTE, (MAC, lookup(index, 150))),
+                 (nes_client.FUNC_DEL_KNI, (dev_id,))]))
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(16, len(results))
+        for add, route, delete in results:
+            self.assertEqual(nes_client.NES_SUCCESS, add[0])
+            self.assertEqual(nes_client.NES_SUCCESS, route)
+            self.assertEqual(add, delete)
+        stats = self.server.snapshot()
+        self.assertEqual(0, stats["overflows"])
+        self.assertEqual(1, stats["connections"])
+
+    def test_reconnect(self):
+        """ a call after NES dropped the connection opens a new one """
+        self.assertEqual(nes_client.NES_SUCCESS, self.client.kni_add("ct1")[0])
+        self.server.drop_clients()
+        time.sleep(0.1)
+        self.assertEqual(nes_client.NES_SUCCESS, self.client.kni_del("ct1")[0])
+        self.assertEqual(2, self.server.snapshot()["connections"])
+        self.assertEqual(2, self.client.stats["connects"])
+
+    def test_call_into(self):
+        """ responses are read into the buffer given, the part beyond it is dropped """
+        devices = (nes_stats.NesApiDevT * 4)()
+        size = self.client.stats_all_dev_into(devices)
+        self.assertEqual(3 * nes_client.ctypes.sizeof(nes_stats.NesApiDevT), size)
+        self.assertEqual([b"ENB", b"EPC", b"KNI", b""], [device.name for device in devices])
+        rings = (nes_stats.NesApiRingT * 2)()
+        self.assertEqual(4 * nes_client.ctypes.sizeof(nes_stats.NesApiRingT),
+                         self.client.stats_all_ring_into(rings))
+        self.assertEqual([b"NTS_UPSTR_GTPU", b"NTS_DWSTR_GTPU"], [ring.name for ring in rings])
+        # the stream is still in step with the requests
+        self.assertEqual((nes_client.NES_SUCCESS, "vEth0"), self.client.kni_add("ct1"))
+        self.server.fail_ratio = 1.0
+        self.assertIsNone(self.client.stats_all_dev_into(devices))
+
+    def test_stats_sampler(self):
+        """ the sampler reads the counters into its tables and computes their rates """
+        for vectorized in (True, False):
+            with mock.patch.object(nes_stats, "numpy", nes_stats.numpy if vectorized else None):
+                sampler = nes_stats.NesStatsSampler(None, None, client=self.client)
+                self.assertTrue(sampler.sample())
+                time.sleep(0.01)
+                self.assertTrue(sampler.sample())
+            self.assertEqual(3, sampler.devices.count)
+            self.assertEqual(4, sampler.rings.count)
+            rates = sampler.devices.snapshot()
+            self.assertEqual({"ENB", "EPC", "KNI"}, set(rates))
+            self.assertGreater(rates["KNI"]["rcv_cnt"], 0)
+            self.assertEqual(0.0, rates["KNI"]["drp_cnt_1"])
+
+
+class NesClientTimeoutTest(NesServerTest):
+    """ threaded client of a slow NES """
+    latency = 0.5
+    timeout = 0.1
+
+    def test_timeout(self):
+        """ a request not answered in time fails and drops the connection """
+        client = nes_client.NesClient(self.path, self.timeout)
+        start = time.monotonic()
+        self.assertEqual((nes_client.NES_FAIL, ""), client.kni_add("ct1"))
+        self.assertLess(time.monotonic() - start, self.latency)
+        # NES serves one request at a time, let it finish the slow one
+        self.server.latency = 0.0
+        time.sleep(self.latency)
+        self.assertEqual(nes_client.NES_SUCCESS, client.stats_clear_all())
+        self.assertEqual(2, client.stats["connects"])
+        client.close()
+
+
+class AsyncNesClientTest(NesServerTest):
+    """ asyncio client """
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.client = nes_client.AsyncNesClient(self.path, self.timeout)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+        super().tearDown()
+
+    def run_calls(self, calls):
+        """ results of the calls made in one loop iteration """
+        async def gather():
+            return await asyncio.gather(*[call() for call in calls])
+        return self.loop.run_until_complete(gather())
+
+    def test_pipelined_order(self):
+        """ requests beyond the room NES has left wait for responses, results stay in order """
+        calls = [lambda index=index: self.client.kni_add("ct{}".format(index))
+                 for index in range(200)]
+        calls += [lambda index=index: self.client.route_add(MAC, lookup(index, 150))
+                  for index in range(20)]
+        results = self.run_calls(calls)
+        self.assertEqual([(nes_client.NES_SUCCESS, "vEth{}".format(index))
+                          for index in range(200)], results[:200])
+        self.assertEqual([nes_client.NES_SUCCESS] * 20, results[200:])
+        stats = self.server.snapshot()
+        self.assertEqual(0, stats["overflows"])
+        self.assertEqual(1, stats["connections"])
+        self.assertGreater(self.client.stats["waits"], 0)
+
+    def test_reconnect(self):
+        """ a call after NES dropped the connection opens a new one """
+        self.assertEqual(nes_client.NES_SUCCESS,
+                         self.run_calls([lambda: self.client.kni_add("ct1")])[0][0])
+        self.server.drop_clients()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(nes_client.NES_SUCCESS,
+                         self.run_calls([lambda: self.client.kni_del("ct1")])[0][0])
+        self.assertEqual(1, self.client.stats["reconnects"])
+
+
+class AsyncNesClientTimeoutTest(NesServerTest):
+    """ asyncio client of a slow NES """
+    latency = 0.5
+    timeout = 0.1
+
+    def test_timeout(self):
+        """ a request not answered in time fails and drops the connection """
+        loop = asyncio.new_event_loop()
+        client = nes_client.AsyncNesClient(self.path, self.timeout)
+
+        async def call(method):
+            return await method()
+        start = time.monotonic()
+        self.assertEqual((nes_client.NES_FAIL, ""),
+                         loop.run_until_complete(call(lambda: client.kni_add("ct1"))))
+        self.assertLess(time.monotonic() - start, self.latency)
+        self.server.latency = 0.0
+        time.sleep(self.latency)
+        self.assertEqual(nes_client.NES_SUCCESS,
+                         loop.run_until_complete(call(client.stats_clear_all)))
+        self.assertEqual(1, client.stats["reconnects"])
+        loop.run_until_complete(client.close())
+        loop.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
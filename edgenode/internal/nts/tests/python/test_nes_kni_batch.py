@@ -0,0 +1,194 @@
+# coding: utf-8
+""" NES KNI request batching tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import contextlib
+import ctypes
+import os
+import sys
+import threading
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import nes_kni_batch
+
+
+class FakeConn(ctypes.Structure):
+    """ nes_remote_t stand-in, alive until NES drops it """
+    _fields_ = [("state", ctypes.c_int), ("number", ctypes.c_int), ("alive", ctypes.c_int)]
+
+
+class FakePool():
+    """ sessions handed out one at a time, broken ones are not reused """
+    def __init__(self):
+        self.opened = []
+        self.idle = []
+        self.unreachable = False
+        self.hung = set()
+
+    @contextlib.contextmanager
+    def session(self):
+        """ idle or new session, None when NES is unreachable """
+        if self.unreachable:
+            yield None
+            return
+        if self.idle:
+            conn = self.idle.pop()
+        else:
+            conn = FakeConn(nes_kni_batch.NES_REMOTE_CONNECTED, len(self.opened), 1)
+            self.opened.append(conn)
+        yield conn
+        if conn.state != nes_kni_batch.NES_REMOTE_INVALID:
+            self.idle.append(conn)
+
+    @staticmethod
+    def is_alive(conn):
+        """ whether NES still answers on the session """
+        return bool(conn.alive)
+
+    def expired(self, conn, _):
+        """ whether the last call on the session ran past its deadline """
+        return conn.number in self.hung
+
+
+class FakeLib():
+    """ nes_kni_add and nes_kni_del, failing as told per device ID """
+    def __init__(self, pool):
+        self.pool = pool
+        self.calls = []
+        self.outcomes = {}
+        self.lock = threading.Lock()
+
+    def _modify(self, operation, conn_ref, dev_id, if_name):
+        conn = conn_ref._obj # pylint: disable=protected-access
+        dev_id = dev_id.value.decode("utf-8")
+        with self.lock:
+            self.calls.append((conn.number, operation, dev_id))
+            outcomes = self.outcomes.get(dev_id)
+            outcome = outcomes.pop(0) if outcomes else "ok"
+        if outcome == "lost":
+            conn.alive = 0
+            return nes_kni_batch.NES_FAIL
+        if outcome == "hung":
+            self.pool.hung.add(conn.number)
+            return nes_kni_batch.NES_FAIL
+        if outcome == "error":
+            raise RuntimeError("library failure")
+        if outcome == "fail":
+            return nes_kni_batch.NES_FAIL
+        if_name.value = b"vEth" + dev_id.encode("utf-8")
+        return nes_kni_batch.NES_SUCCESS
+
+    def nes_kni_add(self, conn_ref, dev_id, if_name):
+        """ add the KNI interface of dev_id """
+        return self._modify("add", conn_ref, dev_id, if_name)
+
+    def nes_kni_del(self, conn_ref, dev_id, if_name):
+        """ delete the KNI interface of dev_id """
+        return self._modify("del", conn_ref, dev_id, if_name)
+
+
+class KniBatcherTest(unittest.TestCase):
+    """ requests batched on the sessions of a fake pool """
+    def setUp(self):
+        self.pool = FakePool()
+        self.lib = FakeLib(self.pool)
+        self.batcher = None
+
+    def tearDown(self):
+        if self.batcher is not None:
+            self.batcher.stop()
+
+    def run_batch(self, dev_ids, delete_if=False, window=1.0):
+        """ results of the requests for dev_ids sent at once as one batch """
+        self.batcher = nes_kni_batch.KniBatcher(self.lib, self.pool, window,
+                                                max_batch=len(dev_ids))
+        results = {}
+
+        def modify(dev_id):
+            results[dev_id] = self.batcher.modify(dev_id, delete_if)
+
+        threads = []
+        for dev_id in dev_ids:
+            threads.append(threading.Thread(target=modify, args=(dev_id,)))
+            threads[-1].start()
+            # queued in the order of dev_ids
+            while len(self.lib.calls) + len(self.batcher._queue) < len(threads): # pylint: disable=protected-access
+                threading.Event().wait(0.001)
+        for thread in threads:
+            thread.join(5.0)
+        return [results[dev_id] for dev_id in dev_ids]
+
+    def test_batch(self):
+        """ requests of a batch share one session, each caller gets its result """
+        self.lib.outcomes["2"] = ["fail"]
+        results = self.run_batch(["1", "2", "3"])
+        self.assertEqual([(nes_kni_batch.NES_SUCCESS, "vEth1"), (nes_kni_batch.NES_FAIL, ""),
+                          (nes_kni_batch.NES_SUCCESS, "vEth3")], results)
+        self.assertEqual(1, len(self.pool.opened))
+        self.assertEqual({0}, {number for number, _, _ in self.lib.calls})
+        self.assertEqual(3, len(self.lib.calls))
+        self.assertEqual({"batches": 1, "requests": 3, "failed": 1, "max_batch": 3,
+                          "sessions_lost": 0}, self.batcher.stats)
+
+    def test_session_lost(self):
+        """ the request failing on a lost session is retried once on a new one """
+        self.lib.outcomes["2"] = ["lost"]
+        results = self.run_batch(["1", "2", "3"], delete_if=True)
+        self.assertEqual([nes_kni_batch.NES_SUCCESS] * 3, [ret for ret, _ in results])
+        self.assertEqual([(0, "del", "1"), (0, "del", "2"), (1, "del", "2"), (1, "del", "3")],
+                         self.lib.calls)
+        self.assertEqual(nes_kni_batch.NES_REMOTE_INVALID, self.pool.opened[0].state)
+        self.assertEqual([self.pool.opened[1]], self.pool.idle)
+        self.assertEqual(1, self.batcher.stats["sessions_lost"])
+        self.assertEqual(0, self.batcher.stats["failed"])
+
+    def test_session_lost_twice(self):
+        """ a request losing its retry session too fails, the rest of the batch goes on """
+        self.lib.outcomes["1"] = ["lost", "lost"]
+        results = self.run_batch(["1", "2"])
+        self.assertEqual([(nes_kni_batch.NES_FAIL, ""), (nes_kni_batch.NES_SUCCESS, "vEth2")],
+                         results)
+        self.assertEqual([(0, "add", "1"), (1, "add", "1"), (2, "add", "2")], self.lib.calls)
+        self.assertEqual(2, self.batcher.stats["sessions_lost"])
+
+    def test_hung(self):
+        """ a request running past its deadline fails without retry, the rest moves on """
+        self.lib.outcomes["1"] = ["hung"]
+        results = self.run_batch(["1", "2"])
+        self.assertEqual([nes_kni_batch.NES_FAIL, nes_kni_batch.NES_SUCCESS],
+                         [ret for ret, _ in results])
+        self.assertEqual([(0, "add", "1"), (0, "add", "2")], self.lib.calls)
+        self.assertEqual(0, self.batcher.stats["sessions_lost"])
+
+    def test_library_error(self):
+        """ a library error fails the request alone """
+        self.lib.outcomes["1"] = ["error"]
+        with self.assertLogs("nes_kni_batch", "CRITICAL"):
+            results = self.run_batch(["1", "2"])
+        self.assertEqual([nes_kni_batch.NES_FAIL, nes_kni_batch.NES_SUCCESS],
+                         [ret for ret, _ in results])
+
+    def test_unreachable(self):
+        """ all requests of the batch fail when no session can be opened """
+        self.pool.unreachable = True
+        with self.assertLogs("nes_kni_batch", "ERROR"):
+            results = self.run_batch(["1", "2"])
+        self.assertEqual([(nes_kni_batch.NES_FAIL, "")] * 2, results)
+        self.assertEqual(2, self.batcher.stats["failed"])
+
+    def test_stop(self):
+        """ requests made after stop fail without reaching NES """
+        self.batcher = nes_kni_batch.KniBatcher(self.lib, self.pool, 0.0)
+        self.assertEqual((nes_kni_batch.NES_SUCCESS, "vEth1"), self.batcher.modify("1", False))
+        self.batcher.stop()
+        self.assertEqual((nes_kni_batch.NES_FAIL, ""), self.batcher.modify("2", False))
+        self.assertEqual(1, len(self.lib.calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
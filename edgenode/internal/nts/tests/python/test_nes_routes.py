@@ -0,0 +1,175 @@
+# coding: utf-8
+""" NES route management tests against the stand-in NES server """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+sys.path.insert(0, os.path.join(NTS_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import fake_nes
+import nes_client
+import nes_routes
+
+MAC1 = "02:00:00:00:00:01"
+MAC2 = "02:00:00:00:00:02"
+LOOKUP1 = "prio:99,encap_proto:noencap,ue_ip:10.0.0.1/32,srv_ip:192.168.10.11/32"
+LOOKUP2 = "prio:98,ue_ip:10.0.0.2/32,srv_port:80-81"
+
+
+class LookupTest(unittest.TestCase):
+    """ lookup keys parsing and formatting """
+    def test_round_trip(self):
+        """ formatted lookup keys parse back into the same fields """
+        for lookup in (LOOKUP1, LOOKUP2, "prio:1,qci:1-5,teid:0x10,enb_ip:10.1.0.0/16",
+                       "prio:5,ue_port:1000", "prio:7,srv_port:0-65535"):
+            fields = nes_routes.parse_lookup(lookup)
+            self.assertEqual(fields, nes_routes.parse_lookup(nes_routes.format_lookup(fields)))
+
+    def test_fields(self):
+        """ keys not given match any value, GTP-U keys are ignored without encapsulation """
+        fields = dict(zip(nes_routes.FIELDS,
+                          nes_routes.parse_lookup("prio:3,encap_proto:noencap,qci:2,"
+                                                  "srv_ip:192.168.0.0/24")))
+        self.assertEqual(3, fields["prio"])
+        self.assertEqual(0, fields["encap_proto"])
+        self.assertEqual((0, 0xFF), (fields["qci_min"], fields["qci_max"]))
+        self.assertEqual((0xC0A80000, 24), (fields["srv_ip"], fields["srv_ip_mask"]))
+        self.assertEqual((0, 0xFFFF), (fields["ue_port_min"], fields["ue_port_max"]))
+        fields = dict(zip(nes_routes.FIELDS, nes_routes.parse_lookup("prio:3,qci:2,teid:010")))
+        self.assertEqual(nes_routes.NTS_ENCAP_GTPU_FLAG, fields["encap_proto"])
+        self.assertEqual((2, 2), (fields["qci_min"], fields["qci_max"]))
+        self.assertEqual((8, 8), (fields["teid_min"], fields["teid_max"]))
+
+    def test_invalid(self):
+        """ lookup keys NES would reject raise ValueError """
+        for lookup in ("prio:1", "prio:1,foo:2", "prio:1,qci:256", "prio:1,ue_ip:10.0.0.256",
+                       "prio:1,encap_proto:vxlan,qci:1", "prio:1,ue_port:1:2",
+                       "prio:1," + ",".join(["qci:1"] * 10),
+                       "prio:1,srv_port:1" + " " * nes_routes.NES_MAX_LOOKUP_ENTRY_LEN):
+            with self.assertRaises(ValueError, msg=lookup):
+                nes_routes.parse_lookup(lookup)
+
+    def test_reverse_key(self):
+        """ a route and its reverse, as NES lists them, share their key """
+        route = nes_routes.Route.parse(MAC1, "prio:5,ue_ip:10.0.0.1/32,srv_ip:20.0.0.1/32,"
+                                             "ue_port:1000,srv_port:80")
+        reverse = nes_routes.Route.parse(MAC1, "prio:5,ue_ip:20.0.0.1/32,srv_ip:10.0.0.1/32,"
+                                               "ue_port:80,srv_port:1000")
+        other = nes_routes.Route.parse(MAC1, "prio:5,ue_ip:10.0.0.1/32,srv_ip:20.0.0.2/32")
+        self.assertEqual(route.key, reverse.key)
+        self.assertNotEqual(route.key, other.key)
+
+
+class RouteManagerTest(unittest.TestCase):
+    """ routes applied through the protocol client """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="nes-routes-test-")
+        path = os.path.join(self.workdir, "nes.sock")
+        self.server = fake_nes.FakeNesServer(path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = nes_client.NesClient(path, 2.0)
+        self.manager = nes_routes.RouteManager(None, None, client=self.client)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def held(self):
+        """ {lookup keys: MAC address} of the routes NES holds """
+        return {nes_routes.format_lookup(fields): nes_routes.format_mac(mac)
+                for fields, mac in self.server.routes.routes.items()}
+
+    def counts(self, report):
+        """ non-zero counts of the report """
+        return {name: count for name, count in report.counts.items() if count}
+
+    def write_routes(self, lines):
+        """ path of a routes file of the lines """
+        path = os.path.join(self.workdir, "routes")
+        with open(path, "w") as routes_file:
+            routes_file.write("\n".join(lines) + "\n")
+        return path
+
+    def test_add_unchanged(self):
+        """ missing routes are added, those NES holds already are left alone """
+        routes = [nes_routes.Route.parse(MAC1, LOOKUP1), nes_routes.Route.parse(MAC2, LOOKUP2)]
+        report = self.manager.apply(routes)
+        self.assertTrue(report.success)
+        self.assertEqual({"added": 2}, self.counts(report))
+        requests = self.server.snapshot()["requests"]
+        report = self.manager.apply(routes)
+        self.assertEqual({"unchanged": 2}, self.counts(report))
+        # one list request, nothing added or removed
+        self.assertEqual(requests + 1, self.server.snapshot()["requests"])
+        self.assertEqual({route.lookup: nes_routes.format_mac(route.mac)
+                          for route in routes}, self.held())
+
+    def test_replace(self):
+        """ a route whose destination changed is removed and added again """
+        self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1)])
+        report = self.manager.apply([nes_routes.Route.parse(MAC2, LOOKUP1)])
+        self.assertEqual({"replaced": 1}, self.counts(report))
+        self.assertEqual([MAC2], list(self.held().values()))
+
+    def test_prune(self):
+        """ routes not desired are removed, unless pruning is off """
+        self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1),
+                            nes_routes.Route.parse(MAC2, LOOKUP2)])
+        report = self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1)], prune=False)
+        self.assertEqual({"unchanged": 1}, self.counts(report))
+        self.assertEqual(2, len(self.held()))
+        report = self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1)])
+        self.assertEqual({"unchanged": 1, "removed": 1}, self.counts(report))
+        self.assertEqual([MAC1], list(self.held().values()))
+
+    def test_reverse_present(self):
+        """ the reverse of a desired route listed by NES counts as the route """
+        reverse = "prio:99,encap_proto:noencap,ue_ip:192.168.10.11/32,srv_ip:10.0.0.1/32"
+        self.assertEqual(nes_client.NES_SUCCESS,
+                         self.client.route_add(nes_routes.parse_mac(MAC1), reverse))
+        report = self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1)])
+        self.assertEqual({"unchanged": 1}, self.counts(report))
+
+    def test_conflict(self):
+        """ desired routes with the same keys and different destinations are reported """
+        report = self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1),
+                                     nes_routes.Route.parse(MAC2, LOOKUP1)])
+        self.assertFalse(report.success)
+        self.assertEqual("invalid", report.failures[0][0])
+        self.assertEqual([MAC1], list(self.held().values()))
+
+    def test_invalid_lines_block_prune(self):
+        """ a file with invalid lines is not applied with pruning, only without it """
+        self.manager.apply([nes_routes.Route.parse(MAC2, LOOKUP2)])
+        path = self.write_routes(["# routes", "", "{} {}".format(MAC1, LOOKUP1),
+                                  "{} prio:1,foo:2".format(MAC1)])
+        report = self.manager.apply_file(path)
+        self.assertEqual({"failed": 1}, self.counts(report))
+        self.assertEqual([MAC2], list(self.held().values()))
+        report = self.manager.apply_file(path, prune=False)
+        self.assertEqual({"added": 1, "failed": 1}, self.counts(report))
+        self.assertEqual({MAC1, MAC2}, set(self.held().values()))
+
+    def test_missing_file(self):
+        """ a routes file which can not be read changes nothing """
+        self.manager.apply([nes_routes.Route.parse(MAC1, LOOKUP1)])
+        report = self.manager.apply_file(os.path.join(self.workdir, "missing"))
+        self.assertFalse(report.success)
+        self.assertEqual(1, len(self.held()))
+
+
+if __name__ == '__main__':
+    unittest.main()
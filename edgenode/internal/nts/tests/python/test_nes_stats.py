@@ -0,0 +1,220 @@
+# coding: utf-8
+""" NES statistics sampler tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import ctypes
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import nes_stats
+
+RCV, DROP = nes_stats.RING_COUNTERS.index("rcv_cnt"), nes_stats.RING_COUNTERS.index("drp_cnt_1")
+
+
+class StatsTableTest(unittest.TestCase):
+    """ ring counters sampled with and without NumPy """
+    def run(self, result=None):
+        """ run each test with NumPy, when installed, and with plain lists """
+        for vectorized in ((True, False) if nes_stats.numpy is not None else (False,)):
+            with mock.patch.object(nes_stats, "numpy", nes_stats.numpy if vectorized else None):
+                super().run(result)
+
+    def setUp(self):
+        self.table = nes_stats.StatsTable("ring", nes_stats.NesApiRingT,
+                                          nes_stats.RING_COUNTERS, nes_stats.RING_DROPS, 4, 3)
+
+    def set_rings(self, *rings):
+        """ fill the raw array with (name, index, rcv_cnt, drp_cnt_1) rings """
+        for row, (name, index, received, dropped) in enumerate(rings):
+            ring = self.table.raw[row]
+            ring.name = name.encode("utf-8")
+            ring.index = index
+            ring.stats.rcv_cnt = received
+            ring.stats.drp_cnt_1 = dropped
+        self.table.count = len(rings)
+
+    def test_rates(self):
+        """ rates are the deltas of the last two samples per second """
+        self.set_rings(("UPSTR", 0, 100, 0), ("DWSTR", 1, 50, 5))
+        self.table.record(10.0)
+        self.assertFalse(self.table.valid)
+        self.assertEqual({}, self.table.snapshot())
+        self.assertEqual([], self.table.dropping())
+        self.set_rings(("UPSTR", 0, 300, 0), ("DWSTR", 1, 50, 9))
+        self.table.record(12.0)
+        self.assertTrue(self.table.valid)
+        self.assertEqual(100.0, self.table.rate(0, RCV))
+        self.assertEqual(0.0, self.table.rate(1, RCV))
+        self.assertEqual(2.0, self.table.rate(1, DROP))
+        self.assertEqual(300, self.table.value(0, RCV))
+        self.assertEqual(["DWSTR"], self.table.dropping())
+        self.assertEqual({"UPSTR", "DWSTR"}, set(self.table.snapshot()))
+
+    def test_reset(self):
+        """ counters going back or a ring re-created under another index give no rate """
+        self.set_rings(("UPSTR", 0, 100, 10), ("DWSTR", 1, 50, 0))
+        self.table.record(1.0)
+        self.set_rings(("UPSTR", 0, 20, 12), ("DWSTR", 2, 80, 0))
+        self.table.record(2.0)
+        self.assertTrue(self.table.valid)
+        self.assertEqual(0.0, self.table.rate(0, RCV))
+        self.assertEqual(2.0, self.table.rate(0, DROP))
+        self.assertEqual(0.0, self.table.rate(1, RCV))
+
+    def test_invalid_interval(self):
+        """ no rates over samples of a different number of rings or at the same time """
+        self.set_rings(("UPSTR", 0, 100, 0))
+        self.table.record(1.0)
+        self.set_rings(("UPSTR", 0, 200, 0), ("DWSTR", 1, 50, 0))
+        self.table.record(2.0)
+        self.assertFalse(self.table.valid)
+        self.table.record(2.0)
+        self.assertFalse(self.table.valid)
+        self.assertNotIn("nts_nes_ring_rcv_cnt_rate", "\n".join(self.table.render("nts_nes_ring")))
+
+    def test_series(self):
+        """ the history keeps the last samples, oldest first """
+        for second in range(5):
+            self.set_rings(("UPSTR", 0, second * 10, 0))
+            self.table.record(float(second))
+        self.assertEqual([(2.0, 20), (3.0, 30), (4.0, 40)], self.table.series(0, RCV))
+        self.assertEqual([], self.table.series(1, RCV))
+
+    def test_render(self):
+        """ totals are counters and rates gauges, labelled with the ring name """
+        self.set_rings(("UPSTR", 0, 100, 0))
+        self.table.record(1.0)
+        self.set_rings(("UPSTR", 0, 150, 0))
+        self.table.record(2.0)
+        lines = self.table.render("nts_nes_ring")
+        self.assertIn("# TYPE nts_nes_ring_rcv_cnt_total counter", lines)
+        self.assertIn('nts_nes_ring_rcv_cnt_total{ring="UPSTR"} 150', lines)
+        self.assertIn("# TYPE nts_nes_ring_rcv_cnt_rate gauge", lines)
+        self.assertIn('nts_nes_ring_rcv_cnt_rate{ring="UPSTR"} 50.0', lines)
+
+
+class ListTest(unittest.TestCase):
+    """ lists returned by the NES library """
+    def setUp(self):
+        self.keep = []
+
+    def sq_list(self, *names):
+        """ nes_sq_t of rings with names """
+        sq_list = nes_stats.NesSqT()
+        previous = None
+        for index, name in enumerate(names):
+            ring = nes_stats.NesApiRingT(name=name.encode("utf-8"), index=index)
+            node = nes_stats.NesSqNodeT(data=ctypes.cast(ctypes.pointer(ring), ctypes.c_void_p))
+            self.keep.extend([ring, node])
+            if previous is None:
+                sq_list.head = ctypes.pointer(node)
+            else:
+                previous.next = ctypes.pointer(node)
+            previous = node
+        sq_list.cnt = len(names)
+        self.keep.append(sq_list)
+        return ctypes.pointer(sq_list)
+
+    def test_fill(self):
+        """ elements are copied up to the size of the table """
+        table = nes_stats.StatsTable("ring", nes_stats.NesApiRingT, nes_stats.RING_COUNTERS,
+                                     nes_stats.RING_DROPS, 2, 3)
+        self.assertEqual(1, table.fill(self.sq_list("UPSTR")))
+        self.assertEqual("UPSTR", table.name(0))
+        with self.assertLogs("nes_stats", "WARNING"):
+            self.assertEqual(2, table.fill(self.sq_list("A", "B", "C")))
+        self.assertEqual(["A", "B"], [table.name(row) for row in range(2)])
+
+    def test_sampler_pool(self):
+        """ the sampler frees the lists, and counts a NES error code as a failure """
+        lib = mock.Mock()
+        pool = mock.Mock()
+        lists = [self.sq_list("ENB", "EPC"), self.sq_list("UPSTR")]
+        pool.call.side_effect = lambda func: lists.pop(0)
+        sampler = nes_stats.NesStatsSampler(lib, pool)
+        sampler._free = mock.Mock() # pylint: disable=protected-access
+        self.assertTrue(sampler.sample())
+        self.assertEqual((2, 1), (sampler.devices.count, sampler.rings.count))
+        self.assertEqual(2, lib.nes_sq_dtor_free.call_count)
+        self.assertEqual(2, sampler._free.call_count) # pylint: disable=protected-access
+        pool.call.side_effect = None
+        pool.call.return_value = -1
+        with self.assertLogs("nes_stats", "ERROR"):
+            self.assertFalse(sampler.sample())
+        self.assertEqual({"samples": 1, "failures": 1, "overruns": 0}, sampler.stats)
+
+
+class FakeClient():
+    """ protocol client returning devices whose counters grow on each read """
+    def __init__(self):
+        self.reads = 0
+
+    def stats_all_dev_into(self, devices):
+        """ two devices, KNI dropping """
+        self.reads += 1
+        for row, name in enumerate((b"KNI", b"ENB")):
+            devices[row].name = name
+            devices[row].index = row
+            devices[row].stats.rcv_cnt = 100 * self.reads
+            devices[row].stats.drp_cnt_1 = self.reads if row == 0 else 0
+        return 2 * ctypes.sizeof(nes_stats.NesApiDevT)
+
+    @staticmethod
+    def stats_all_ring_into(_):
+        """ no rings """
+        return 0
+
+
+class SamplerTest(unittest.TestCase):
+    """ sampler reading the protocol client """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="nes-stats-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        self.output_path = os.path.join(self.workdir, "stats.jsonl")
+
+    def test_export(self):
+        """ drops are logged, rates of each interval appended to the output file """
+        sampler = nes_stats.NesStatsSampler(None, None, interval=0.01,
+                                            output_path=self.output_path, client=FakeClient())
+        sampler._output = open(self.output_path, "a") # pylint: disable=protected-access
+        sampler.sample()
+        with self.assertLogs("nes_stats", "WARNING") as logs:
+            sampler.sample()
+        self.assertIn("NES device dropping packets: KNI", logs.output[0])
+        sampler.stop()
+        with open(self.output_path) as output:
+            records = [json.loads(line) for line in output]
+        self.assertEqual(1, len(records))
+        self.assertEqual({"KNI", "ENB"}, set(records[0]["devices"]))
+        self.assertEqual({}, records[0]["rings"])
+        self.assertGreater(records[0]["devices"]["ENB"]["rcv_cnt"], 0)
+
+    def test_thread(self):
+        """ the thread samples until stopped """
+        client = FakeClient()
+        sampler = nes_stats.NesStatsSampler(None, None, interval=0.01, client=client)
+        with self.assertLogs("nes_stats", "WARNING"):
+            sampler.start()
+            while client.reads < 3:
+                sampler._stop.wait(0.01) # pylint: disable=protected-access
+            sampler.stop()
+        reads = client.reads
+        sampler._stop.wait(0.05) # pylint: disable=protected-access
+        self.assertEqual(reads, client.reads)
+        self.assertEqual(reads, sampler.stats["samples"])
+        self.assertIn('nts_nes_dev_rcv_cnt_total{device="KNI"} ' + str(100 * reads),
+                      sampler.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+# coding: utf-8
+""" OVSDB client tests against the stand-in ovsdb-server """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+sys.path.insert(0, os.path.join(NTS_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import deadlines
+import fake_ovsdb
+import ovsdb_client
+
+
+class OvsdbClientTest(unittest.TestCase):
+    """ port management over a fake OVSDB with bridges br0 and br1 """
+    latency = 0.0
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="ovsdb-client-test-")
+        path = os.path.join(self.workdir, "db.sock")
+        self.server = fake_ovsdb.FakeOvsdbServer(path, bridges=("br0", "br1"),
+                                                 latency=self.latency)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = ovsdb_client.OvsdbClient(path, ofport_timeout=2.0)
+        self.assertTrue(self.client.connect())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def rows(self, table, name):
+        """ server rows of the table with the name """
+        return [row for row in self.server.db.tables[table].values() if row["name"] == name]
+
+    def test_add_and_delete(self):
+        """ added port gets an ofport and is listed, deleted one is gone with its rows """
+        self.assertTrue(self.client.add_port("br0", "ve1-a"))
+        self.assertEqual({"ve1-a"}, self.client.list_ports("br0"))
+        self.assertEqual(1, len(self.rows("Interface", "ve1-a")))
+        self.assertGreater(self.rows("Interface", "ve1-a")[0]["ofport"], 0)
+        self.assertTrue(self.client.del_port("br0", "ve1-a"))
+        self.assertEqual(set(), self.client.list_ports("br0"))
+        self.assertEqual([], self.rows("Port", "ve1-a"))
+        self.assertEqual([], self.rows("Interface", "ve1-a"))
+
+    def test_add_with_columns(self):
+        """ Interface and Port columns are set on the new rows, keys of maps included """
+        columns = {"Interface": {"mtu_request": 9000, "other_config:tx-steering": "hash"},
+                   "Port": {"tag": 100}}
+        self.assertTrue(self.client.add_port("br0", "ve1-a", columns))
+        interface, = self.rows("Interface", "ve1-a")
+        self.assertEqual(9000, interface["mtu_request"])
+        self.assertEqual(["map", [["tx-steering", "hash"]]], interface["other_config"])
+        self.assertEqual(100, self.rows("Port", "ve1-a")[0]["tag"])
+
+    def test_add_existing(self):
+        """ adding a port the bridge has succeeds, as --may-exist add-port, and sets columns """
+        self.assertTrue(self.client.add_port("br0", "ve1-a"))
+        transactions = self.client.stats["transactions"]
+        self.assertTrue(self.client.add_port("br0", "ve1-a"))
+        self.assertEqual(transactions, self.client.stats["transactions"])
+        self.assertTrue(self.client.add_port("br0", "ve1-a", {"Port": {"tag": 7}}))
+        port, = self.rows("Port", "ve1-a")
+        self.assertEqual(7, port["tag"])
+        self.assertEqual(1, len(self.rows("Interface", "ve1-a")))
+        self.assertEqual(0, self.client.stats["failed"])
+
+    def test_update_map_keys(self):
+        """ adding an existing port sets the keys of maps, leaving their other keys alone """
+        columns = {"Interface": {"other_config:tx-steering": "hash", "options:key": "flow"}}
+        self.assertTrue(self.client.add_port("br0", "ve1-a", columns))
+        columns = {"Interface": {"other_config:tx-steering": "thread",
+                                 "other_config:pmd-rxq-affinity": 3, "mtu_request": 1500}}
+        self.assertTrue(self.client.add_port("br0", "ve1-a", columns))
+        interface, = self.rows("Interface", "ve1-a")
+        self.assertEqual(["map", [["pmd-rxq-affinity", "3"], ["tx-steering", "thread"]]],
+                         interface["other_config"])
+        self.assertEqual(["map", [["key", "flow"]]], interface["options"])
+        self.assertEqual(1500, interface["mtu_request"])
+        self.assertEqual(0, self.client.stats["failed"])
+
+    def test_delete_missing(self):
+        """ deleting a port the bridge does not have succeeds, as --if-exists del-port """
+        self.assertTrue(self.client.del_port("br0", "ve1-gone"))
+        self.assertTrue(self.client.add_port("br0", "ve1-a"))
+        self.assertTrue(self.client.del_port("br0", "ve1-a"))
+        self.assertTrue(self.client.del_port("br0", "ve1-a"))
+        self.assertEqual(0, self.client.stats["failed"])
+
+    def test_other_bridge(self):
+        """ a port on another bridge is neither added nor deleted """
+        self.assertTrue(self.client.add_port("br1", "ve1-a"))
+        self.assertFalse(self.client.add_port("br0", "ve1-a"))
+        self.assertFalse(self.client.del_port("br0", "ve1-a"))
+        self.assertEqual({"ve1-a"}, self.client.list_ports("br1"))
+        self.assertFalse(self.client.add_port("br9", "ve1-b"))
+        self.assertIsNone(self.client.list_ports("br9"))
+        self.assertEqual(3, self.client.stats["failed"])
+
+    def test_concurrent_batches(self):
+        """ concurrent additions, duplicates included, are batched and all succeed """
+        results = []
+
+        def add(name):
+            results.append(self.client.add_port("br0", name))
+
+        threads = [threading.Thread(target=add, args=("ve1-{}".format(index % 20),))
+                   for index in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([True] * 40, results)
+        self.assertEqual({"ve1-{}".format(index) for index in range(20)},
+                         self.client.list_ports("br0"))
+        self.assertEqual(20, len(self.server.db.tables["Interface"]))
+        self.assertLess(self.client.stats["transactions"], 40)
+
+    def test_port_gone_after_validation(self):
+        """ a port deleted from the cache by a monitor update before its transaction is
+        deleted by the uuid resolved when validating
+        """
+        self.assertTrue(self.client.add_port("br0", "ve1-a"))
+        validate = self.client._validate # pylint: disable=protected-access
+
+        def validate_then_update(batch):
+            result = validate(batch)
+            with self.client.cache.cond:
+                self.client.cache.ports.clear()
+            return result
+
+        with mock.patch.object(self.client, "_validate", validate_then_update):
+            self.assertTrue(self.client.del_port("br0", "ve1-a"))
+        self.assertEqual([], self.rows("Port", "ve1-a"))
+        self.assertTrue(self.client.add_port("br0", "ve1-b"))
+
+    def test_unexpected_error(self):
+        """ a batch failing with an unexpected error fails its requests, later ones run """
+        with mock.patch.object(self.client, "_transact", side_effect=KeyError("ve1-a")):
+            self.assertFalse(self.client.add_port("br0", "ve1-a"))
+        self.assertEqual(1, self.client.stats["failed"])
+        self.assertTrue(self.client.add_port("br0", "ve1-a"))
+
+    def test_request_deadline(self):
+        """ a request the batcher does not get to in time fails and is not applied """
+        release = threading.Event()
+        run_batch = self.client._run_batch # pylint: disable=protected-access
+
+        def stalled(batch):
+            release.wait()
+            run_batch(batch)
+
+        with mock.patch.object(self.client, "_run_batch", stalled):
+            # pylint: disable=protected-access
+            with mock.patch.dict(deadlines._TIMEOUTS, {"ovsdb": 0.05}):
+                start = time.monotonic()
+                self.assertFalse(self.client.add_port("br0", "ve1-a"))
+                self.assertLess(time.monotonic() - start, 1.0)
+            release.set()
+            self.assertTrue(self.client.add_port("br0", "ve1-b"))
+        self.assertEqual({"ve1-b"}, self.client.list_ports("br0"))
+
+
+class OvsdbClientBatchTest(OvsdbClientTest):
+    """ the same with slow transactions, so requests queue up into batches """
+    latency = 0.05
+
+    def test_add_then_delete_in_batch(self):
+        """ a delete queued behind the addition of its port in a batch runs after it """
+        results = {}
+
+        def call(key, func, name):
+            results[key] = func("br0", name)
+
+        busy = threading.Thread(target=call, args=("busy", self.client.add_port, "ve1-x"))
+        busy.start()
+        time.sleep(0.01)
+        add = threading.Thread(target=call, args=("add", self.client.add_port, "ve1-a"))
+        add.start()
+        time.sleep(0.01)
+        delete = threading.Thread(target=call, args=("del", self.client.del_port, "ve1-a"))
+        delete.start()
+        for thread in (busy, add, delete):
+            thread.join()
+        self.assertEqual({"busy": True, "add": True, "del": True}, results)
+        self.assertEqual({"ve1-x"}, self.client.list_ports("br0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# coding: utf-8
+""" pod selector tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import sys
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import pod_selector
+
+UUID = "0f8fad5b-d9cb-469f-a165-70867728950e"
+
+
+def container(name):
+    """ event attributes of a plain docker container """
+    return {"name": name}
+
+
+class PodSelectorTest(unittest.TestCase):
+    """ container name rules """
+    def test_shared_prefix(self):
+        """ a prefix and a pattern starting with it both match """
+        selector = pod_selector.PodSelector(["prefix:mec", "glob:mec*x"])
+        self.assertTrue(selector.match(container("mec-app")))
+        self.assertTrue(selector.match(container("mec-box")))
+        self.assertTrue(selector.match(container("mec")))
+        self.assertFalse(selector.match(container("me")))
+        self.assertFalse(selector.match(container("other")))
+
+    def test_prefix_within_pattern(self):
+        """ a pattern hung on a node the prefix passes through keeps the prefix """
+        selector = pod_selector.PodSelector(["prefix:mec-app", "regex:mec-[0-9]+$"])
+        self.assertTrue(selector.match(container("mec-app1")))
+        self.assertTrue(selector.match(container("mec-42")))
+        self.assertFalse(selector.match(container("mec-ab")))
+
+    def test_legacy(self):
+        """ the legacy prefix on a hex digit still matches beside the uuid rule """
+        selector = pod_selector.PodSelector.legacy("a")
+        self.assertTrue(selector.match(container("abc")))
+        self.assertTrue(selector.match(container("a")))
+        self.assertTrue(selector.match(container(UUID)))
+        self.assertFalse(selector.match(container("bcd")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# coding: utf-8
+""" sandbox lifecycle tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import sys
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import docker_events
+import pod_selector
+import sandbox_lifecycle
+from sandbox_lifecycle import ATTACHED, DETACHED
+
+
+class InlineDispatcher():
+    """ dispatcher running calls at once, with a handler recording its changes """
+    def __init__(self):
+        self.changes = []
+        self.on_change = None
+
+    def handler(self, action, previous=None):
+        """ record the change, returns success """
+        self.changes.append((action, previous))
+        if self.on_change is not None:
+            self.on_change()
+        return True
+
+    def submit_call(self, key, func, *args): # pylint: disable=unused-argument
+        """ run func """
+        func(*args)
+
+
+class ManualScheduler():
+    """ scheduler whose calls run when the test fires them """
+    def __init__(self):
+        self.calls = []
+
+    def call_later(self, delay, func, *args): # pylint: disable=unused-argument
+        """ keep the call """
+        self.calls.append((func, args))
+
+    def fire(self):
+        """ run the calls kept so far """
+        calls, self.calls = self.calls, []
+        for func, args in calls:
+            func(*args)
+
+
+def event(action, **attributes):
+    """ docker container event """
+    return {"Type": "container", "Action": action,
+            "Actor": {"ID": "c1", "Attributes": attributes}}
+
+
+class SandboxLifecycleTest(unittest.TestCase):
+    """ restarts of a plain docker container, which keeps its sandbox ID """
+    def setUp(self):
+        self.dispatcher = InlineDispatcher()
+        self.scheduler = ManualScheduler()
+        self.lifecycle = sandbox_lifecycle.SandboxLifecycle(self.dispatcher, 1.0,
+                                                            self.scheduler)
+        self.lifecycle.initial = DETACHED
+
+    def test_restart(self):
+        """ a start after the container died attaches again """
+        self.lifecycle.submit("c1", ATTACHED, "start")
+        self.scheduler.fire()
+        self.lifecycle.died("c1")
+        self.lifecycle.submit("c1", ATTACHED, "start")
+        self.scheduler.fire()
+        self.assertEqual([("start", DETACHED), ("start", None)], self.dispatcher.changes)
+        self.assertEqual(ATTACHED, self.lifecycle.state("c1"))
+
+    def test_restart_within_window(self):
+        """ start, die, start in one debounce window still attaches to the new namespace """
+        self.lifecycle.submit("c1", ATTACHED, "start")
+        self.lifecycle.died("c1")
+        self.lifecycle.submit("c1", DETACHED, "die")
+        self.lifecycle.submit("c1", ATTACHED, "start")
+        self.scheduler.fire()
+        self.assertEqual([("start", DETACHED), ("start", None)], self.dispatcher.changes)
+
+    def test_died_while_attaching(self):
+        """ an attach finishing after the container died is not taken for the new one """
+        self.dispatcher.on_change = lambda: self.lifecycle.died("c1")
+        self.lifecycle.submit("c1", ATTACHED, "start")
+        self.assertIsNone(self.lifecycle.state("c1"))
+
+    def test_detached_stays(self):
+        """ a container detached before it died has no interface either way """
+        self.lifecycle.set_state("c1", DETACHED)
+        self.lifecycle.died("c1")
+        self.assertEqual(DETACHED, self.lifecycle.state("c1"))
+        self.lifecycle.died("c2")
+        self.assertEqual(DETACHED, self.lifecycle.state("c2"))
+
+    def test_sandbox_died(self):
+        """ only plain docker containers are sandboxes dying with their namespace """
+        self.assertTrue(docker_events.sandbox_died(event("die", name="app")))
+        self.assertFalse(docker_events.sandbox_died(event("kill", name="app", signal="15")))
+        self.assertFalse(docker_events.sandbox_died(
+            event("die", name="app", **{pod_selector.K8S_TYPE_LABEL: "container"})))
+
+
+if __name__ == "__main__":
+    unittest.main()
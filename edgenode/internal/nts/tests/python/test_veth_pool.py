@@ -0,0 +1,190 @@
+# coding: utf-8
+""" veth pool tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+NTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, NTS_DIR)
+
+# pylint: disable=wrong-import-position
+import veth_pool
+
+POOL_SIZE = 3
+
+
+class FakeBridge():
+    """ veth pairs created by the pool, bridge interface names to their peer """
+    def __init__(self):
+        self.pairs = {}
+        self.fail_create = False
+        self.fail_destroy = False
+        self.lock = threading.Lock()
+
+    def create(self, host_if, peer_if):
+        """ create the pair, fails like ip link add for a name taken """
+        with self.lock:
+            if self.fail_create or host_if in self.pairs:
+                return False
+            self.pairs[host_if] = peer_if
+            return True
+
+    def destroy(self, host_if, peer_if):
+        """ delete the pair, fails if it is not there """
+        with self.lock:
+            if self.fail_destroy or self.pairs.get(host_if) != peer_if:
+                return False
+            del self.pairs[host_if]
+            return True
+
+
+class VethPoolTest(unittest.TestCase):
+    """ pool creating its pairs on a fake bridge """
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="veth-pool-test-")
+        self.state_path = os.path.join(self.workdir, "veth_pool.json")
+        self.bridge = FakeBridge()
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def make_pool(self):
+        """ pool saving its state in the work directory, bridge ports in use """
+        pool = veth_pool.VethPool(POOL_SIZE, 1, self.bridge.create, self.bridge.destroy,
+                                  self.state_path, list(self.bridge.pairs))
+        self.pools.append(pool)
+        return pool
+
+    def saved(self):
+        """ content of the state file """
+        with open(self.state_path) as state_file:
+            return json.load(state_file)
+
+    def wait_idle(self, pool, count):
+        """ wait until count pairs are idle in the pool """
+        deadline = time.monotonic() + 5.0
+        while pool.snapshot()["idle"] != count:
+            self.assertLess(time.monotonic(), deadline, pool.snapshot())
+            time.sleep(0.01)
+
+    def abandon(self, pool):
+        """ end the refill thread of the pool the way an unclean exit would, without stop() """
+        self.pools.remove(pool)
+        with pool._cond: # pylint: disable=protected-access
+            pool._stopping = True # pylint: disable=protected-access
+            pool._cond.notify() # pylint: disable=protected-access
+        pool._thread.join() # pylint: disable=protected-access
+
+    def test_state_file(self):
+        """ idle pairs and pod ports are saved, idle pairs are deleted on stop """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.assertEqual(sorted(self.bridge.pairs), self.saved()["pairs"])
+        host_if, peer_if = pool.acquire("pod1")
+        self.assertEqual(self.bridge.pairs[host_if], peer_if)
+        self.assertEqual({"pod1": host_if}, self.saved()["assigned"])
+        self.assertNotIn(host_if, self.saved()["pairs"])
+        self.assertNotIn(host_if, pool.ports())
+        pool.stop()
+        self.pools.remove(pool)
+        self.assertEqual([], self.saved()["pairs"])
+        self.assertEqual([host_if], list(self.bridge.pairs))
+
+    def test_unclean_exit(self):
+        """ pairs left by an earlier run are deleted and their names not handed out again """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        host_if, _ = pool.acquire("pod1")
+        self.abandon(pool)
+        leftover = set(self.bridge.pairs) - {host_if}
+
+        pool = self.make_pool()
+        self.assertEqual(host_if, pool.port_of("pod1"))
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.assertEqual(len(leftover), pool.snapshot()["leftover"])
+        self.assertEqual(0, pool.snapshot()["create_failed"])
+        self.assertFalse(leftover & set(self.bridge.pairs))
+        self.assertEqual(POOL_SIZE + 1, len(self.bridge.pairs))
+        self.assertIn(host_if, self.bridge.pairs)
+
+    def test_names_not_reused(self):
+        """ a restarted pool names its pairs past those of the earlier runs """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        host_if, _ = pool.acquire("pod1")
+        pool.release("pod1")
+        pool.stop()
+        self.pools.remove(pool)
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        indexes = [veth_pool.pool_pair_index(name) for name in pool.ports()]
+        self.assertGreater(min(indexes), veth_pool.pool_pair_index(host_if))
+
+    def test_ports_in_use(self):
+        """ pool pairs on the bridge the state file does not name are skipped """
+        self.bridge.create(*veth_pool.pool_pair_names(7))
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.assertEqual(0, pool.snapshot()["create_failed"])
+        self.assertEqual({"vp1-8", "vp1-9", "vp1-10"}, pool.ports())
+
+    def test_earlier_state_format(self):
+        """ a state file of the pod ports only is loaded """
+        with open(self.state_path, "w") as state_file:
+            json.dump({"pod1": "vp1-4"}, state_file)
+        pool = self.make_pool()
+        self.assertEqual("vp1-4", pool.port_of("pod1"))
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.assertEqual({"vp1-5", "vp1-6", "vp1-7"}, pool.ports())
+
+    def test_create_failures(self):
+        """ refilling pauses after failed creations, until the next acquire """
+        self.bridge.fail_create = True
+        pool = self.make_pool()
+        pool.fill()
+        deadline = time.monotonic() + 5.0
+        while pool.snapshot()["create_failed"] < veth_pool.MAX_CREATE_FAILURES:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual([], self.saved()["pairs"])
+        self.bridge.fail_create = False
+        self.assertIsNone(pool.acquire("pod1"))
+        self.wait_idle(pool, POOL_SIZE)
+
+    def test_failed_stop(self):
+        """ idle pairs which could not be deleted are left to the next run """
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.bridge.fail_destroy = True
+        pool.stop()
+        self.pools.remove(pool)
+        self.assertEqual(sorted(self.bridge.pairs), self.saved()["pairs"])
+        self.bridge.fail_destroy = False
+        pool = self.make_pool()
+        pool.fill()
+        self.wait_idle(pool, POOL_SIZE)
+        self.assertEqual(POOL_SIZE, pool.snapshot()["leftover"])
+        self.assertEqual(POOL_SIZE, len(self.bridge.pairs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+# coding: utf-8
+""" pool of veth pairs attached to the OVS bridge ahead of container starts """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import collections
+import json
+import logging
+import os
+import threading
+
+POOL_IF_PREFIX = "vp1-"
+POOL_PEER_PREFIX = "vp2-"
+# consecutive failed creations after which refilling waits for the next acquire
+MAX_CREATE_FAILURES = 3
+
+_LOG = logging.getLogger(__name__)
+
+
+def pool_pair_names(index):
+    """ bridge and peer interface names of pool pair index """
+    return POOL_IF_PREFIX + str(index), POOL_PEER_PREFIX + str(index)
+
+def pool_pair_index(host_if):
+    """ index of the pool pair of a bridge interface, None if it is not one """
+    if not host_if or not host_if.startswith(POOL_IF_PREFIX):
+        return None
+    index = host_if[len(POOL_IF_PREFIX):]
+    return int(index) if index.isdigit() else None
+
+
+class VethPool():
+    """ veth pairs with one end added to the bridge and up, ready to be handed out
+
+    create(host_if, peer_if) and destroy(host_if, peer_if) do the link and
+    bridge work and return their success. Once fill() is called, a background
+    thread fills the pool up to size pairs, and refills it whenever fewer
+    than low are idle. Pairs handed out keep their bridge port name, so the
+    port of each pod is saved to state_path to be found again after a restart.
+
+    The idle pairs and those being created are saved to state_path as well.
+    They are left behind when the daemon exits without stop(), so those of
+    an earlier run are deleted by the background thread before it creates
+    any. Pair names are not reused, also across restarts: indexes start
+    past the last one saved and past those of ports_in_use.
+    """
+    def __init__(self, size, low, create, destroy, state_path, ports_in_use=()):
+        self.size = size
+        self.low = low
+        self._create = create
+        self._destroy = destroy
+        self.state_path = state_path
+        self._idle = collections.deque()
+        self._assigned = {}
+        self._in_use = set(ports_in_use)
+        self._creating = set()
+        self._leftover = set()
+        self._next_index = 0
+        self._cond = threading.Condition()
+        self._requested = False
+        self._stopping = False
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "create_failed": 0,
+                      "leftover": 0, "reclaimed": 0}
+        self._load()
+        indexes = [pool_pair_index(host_if) for host_if in self._in_use | self._leftover]
+        self._next_index = max([self._next_index] + [index + 1 for index in indexes
+                                                     if index is not None])
+        self._thread = threading.Thread(target=self._refill, name="veth-pool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError) as err:
+            _LOG.debug("No veth pool state loaded from %s: %s", self.state_path, err)
+            return
+        if not isinstance(state, dict):
+            return
+        if not isinstance(state.get("assigned"), dict):
+            # pod ports only, as saved before the pool saved its pairs
+            state = {"assigned": state}
+        self._assigned = state["assigned"]
+        self._in_use.update(self._assigned.values())
+        self._leftover = {host_if for host_if in state.get("pairs", [])
+                          if pool_pair_index(host_if) is not None} - \
+            set(self._assigned.values())
+        if isinstance(state.get("next_index"), int):
+            self._next_index = state["next_index"]
+
+    def _save(self):
+        """ write pod ports and the pairs held to the state file, called with the lock held """
+        pairs = self._leftover | self._creating | {pair[0] for pair in self._idle}
+        state = {"assigned": self._assigned, "pairs": sorted(pairs),
+                 "next_index": self._next_index}
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as state_file:
+                json.dump(state, state_file, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+        except OSError as err:
+            _LOG.error("Failed to save veth pool state to %s: %s", self.state_path, err)
+
+    def snapshot(self):
+        """ stats with the current number of idle and assigned pairs """
+        with self._cond:
+            stats = dict(self.stats)
+            stats["idle"] = len(self._idle)
+            stats["assigned"] = len(self._assigned)
+        return stats
+
+    def ports(self):
+        """ bridge interfaces of the idle pairs and of those left by an earlier run """
+        with self._cond:
+            return {pair[0] for pair in self._idle} | self._leftover
+
+    def acquire(self, pod_name):
+        """ (bridge interface, peer interface) of an idle pair given to the pod, None if empty """
+        with self._cond:
+            pair = self._idle.popleft() if self._idle else None
+            if len(self._idle) < self.low or pair is None:
+                self._requested = True
+                self._cond.notify()
+            if pair is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self._assigned[pod_name] = pair[0]
+            self._save()
+        return pair
+
+    def port_of(self, pod_name):
+        """ bridge interface of the pair given to the pod, None if it has none """
+        with self._cond:
+            return self._assigned.get(pod_name)
+
+    def pods(self):
+        """ names of the pods given a pair """
+        with self._cond:
+            return set(self._assigned)
+
+    def release(self, pod_name):
+        """ forget the pair of the pod, returns its bridge interface or None """
+        with self._cond:
+            host_if = self._assigned.pop(pod_name, None)
+            if host_if is not None:
+                self._save()
+        return host_if
+
+    def _next_pair(self):
+        """ pair names not used before, called with the lock held """
+        while True:
+            pair = pool_pair_names(self._next_index)
+            self._next_index += 1
+            # names are not reused, the port of a released pair may not be deleted yet
+            if pair[0] not in self._in_use:
+                return pair
+
+    def _wanted(self):
+        """ pairs to create to fill the pool, called with the lock held """
+        pairs = [self._next_pair()
+                 for _ in range(self.size - len(self._idle) - len(self._creating))]
+        self._creating.update(pair[0] for pair in pairs)
+        self._save()
+        return pairs
+
+    def _reclaim_leftover(self):
+        """ delete the pairs left by an earlier run """
+        with self._cond:
+            leftover = sorted(self._leftover, key=pool_pair_index)
+        if leftover:
+            _LOG.info("Deleting %s veth pool pairs left by an earlier run", len(leftover))
+        for host_if in leftover:
+            if self._stopping:
+                return
+            # a failure means part of the pair was gone already
+            destroyed = self._destroy(*pool_pair_names(pool_pair_index(host_if)))
+            with self._cond:
+                self._leftover.discard(host_if)
+                if destroyed:
+                    self.stats["leftover"] += 1
+                self._save()
+
+    def _refill(self):
+        self._reclaim_leftover()
+        while True:
+            with self._cond:
+                while not self._stopping and not self._requested:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                self._requested = False
+                pairs = self._wanted()
+            failures = 0
+            for index, pair in enumerate(pairs):
+                created = False if self._stopping else self._create(*pair)
+                with self._cond:
+                    self._creating.discard(pair[0])
+                    if created:
+                        self.stats["created"] += 1
+                        self._idle.append(pair)
+                        failures = 0
+                    elif not self._stopping:
+                        # the name may be taken by a pair left over, leave it
+                        self.stats["create_failed"] += 1
+                        failures += 1
+                    self._save()
+                if failures >= MAX_CREATE_FAILURES:
+                    _LOG.error("Failed to create %s veth pool pairs in a row, refilling paused",
+                               failures)
+                    with self._cond:
+                        self._creating.difference_update(pair[0] for pair in pairs[index + 1:])
+                        self._save()
+                    break
+
+    def fill(self):
+        """ start filling up to size """
+        with self._cond:
+            self._requested = True
+            self._cond.notify()
+
+    def stop(self):
+        """ stop refilling and delete idle pairs """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for pair in idle:
+            destroyed = self._destroy(*pair)
+            with self._cond:
+                if destroyed:
+                    self.stats["reclaimed"] += 1
+                else:
+                    # kept in the state file to be deleted by the next run
+                    _LOG.warning("Failed to delete idle veth pool pair %s", pair[0])
+                    self._leftover.add(pair[0])
+                self._save()
+        _LOG.info("Reclaimed %s idle veth pairs", self.stats["reclaimed"])
@@ -4,22 +4,131 @@
 # Copyright (c) 2020 Intel Corporation
 
 """This plugin will call yum module and retry installation task if installation fail."""
-# All parameters of yum module can be used. Two additional parameters can also be provided:
+# All parameters of yum module can be used. Additional parameters can also be provided:
 # - retries: number of retries (default: 10)
-# - delay: time (in seconds) that plugin will wait between retries (default: 5)
-# Number of retries and delay can be also configured by global variables
-# number_of_retries and retry_delay provided in group_vars.
+# - delay: time (in seconds) that plugin will wait before the first retry (default: 5)
+# - max_delay: maximum time (in seconds) between retries (default: 60)
+# - retry_budget: total time (in seconds) of all attempts and delays, 0 for no limit (default: 0)
+# - disable_failing_repo: disable the repository whose mirrors failed before the next
+#   attempt (default: False); if the packages are then missing, the repositories are
+#   enabled again and the attempts go on without disabling any
+# They can be also configured by global variables number_of_retries, retry_delay,
+# retry_max_delay, retry_budget and retry_disable_failing_repo provided in group_vars.
+#
+# Failures are classified by yum's rc, msg and failures: fatal ones (missing packages,
+# dependency conflicts, invalid arguments...) fail at once, retryable ones (mirror
+# timeouts, metadata download errors, yum lock...) and unknown ones are retried.
+# The delay doubles after each attempt, up to max_delay, with random jitter between delay and
+# the doubled delay, so no retry waits less than delay. Classification
+# of each attempt is returned in 'attempt_history', with the repositories disabled or
+# enabled again after it and the failure masked by disabled repositories, if any.
 
 from __future__ import (absolute_import, division, print_function)
+import random
+import re
 import time
 from ansible.plugins.action import ActionBase
 MetaClass = type
 
 DEFAULT_VALUES = {
     'retries': {'value': 10, 'ansible_var': 'number_of_retries'},
-    'delay': {'value': 5, 'ansible_var': 'retry_delay'}
+    'delay': {'value': 5, 'ansible_var': 'retry_delay'},
+    'max_delay': {'value': 60, 'ansible_var': 'retry_max_delay'},
+    'retry_budget': {'value': 0, 'ansible_var': 'retry_budget'},
+    'disable_failing_repo': {'value': False, 'ansible_var': 'retry_disable_failing_repo'}
 }
 
+# Failures which will not go away by retrying, checked before the retryable ones
+FATAL_PATTERNS = (
+    r'No package .* available',
+    r'No package matching',
+    r'Requires: ',
+    r'conflicts with ',
+    r'Transaction check error',
+    r'Multilib version problems',
+    r'Public key for .* is not installed',
+    r'GPG key retrieval failed',
+    r'Unsupported parameters',
+    r'value of .* must be one of',
+    r'No RPM file matching',
+    r'is not a valid rpm',
+)
+RETRYABLE_PATTERNS = (
+    r'[Tt]imed? ?out',
+    r'Errno 14',
+    r'Errno 256',
+    r'No more mirrors to try',
+    r'Trying other mirror',
+    r'Cannot retrieve repository metadata',
+    r'Cannot find a valid baseurl',
+    r'Could not resolve host',
+    r'Connection refused',
+    r'Connection reset',
+    r'HTTP Error 5\d\d',
+    r'does not match checksum',
+    r'lock ?file is held by another process',
+    r'another app is currently holding the yum lock',
+)
+# Repository ids named by mirror failures
+REPO_PATTERNS = (
+    r' from ([\w.-]+): \[Errno',
+    r'for repository: ([\w.-]+?)\.?(?:\s|$)',
+    r'valid baseurl for repo: ([\w.-]+)',
+)
+
+FATAL = 'fatal'
+RETRYABLE = 'retryable'
+UNKNOWN = 'unknown'
+
+
+def failure_text(result):
+    """failure_text joins msg, failures and output lines of a yum result"""
+    parts = [result.get('msg')]
+    for key in ('failures', 'results'):
+        value = result.get(key)
+        parts.extend(value if isinstance(value, list) else [value])
+    return '\n'.join(str(part) for part in parts if part)
+
+
+def classify(result):
+    """classify returns (class, matched text) of a failed yum result, class is one of
+    FATAL, RETRYABLE or UNKNOWN"""
+    text = failure_text(result)
+    for patterns, kind in ((FATAL_PATTERNS, FATAL), (RETRYABLE_PATTERNS, RETRYABLE)):
+        for pattern in patterns:
+            match = re.search(pattern, text)
+            if match:
+                return kind, match.group(0)
+    return UNKNOWN, None
+
+
+def failing_repos(result):
+    """failing_repos returns ids of the repositories named by mirror failures"""
+    text = failure_text(result)
+    repos = []
+    for pattern in REPO_PATTERNS:
+        for repo in re.findall(pattern, text):
+            if repo not in repos:
+                repos.append(repo)
+    return repos
+
+
+def backoff(attempt, delay, max_delay):
+    """backoff returns the jittered delay before retry attempt (from 0), doubled after each,
+    never shorter than delay"""
+    lower = min(delay, max_delay)
+    upper = max(lower, min(max_delay, delay * 2 ** attempt))
+    return random.uniform(lower, upper)
+
+
+def repo_list(value):
+    """repo_list returns repository ids of a disablerepo/enablerepo argument"""
+    if not value:
+        return []
+    if isinstance(value, list):
+        return [str(repo) for repo in value]
+    return [repo.strip() for repo in str(value).split(',') if repo.strip()]
+
 class ActionModule(ActionBase):
     """Class containing two methods and returns attempt of script and its outcome"""
     def get_variable(self, arg):
@@ -55,41 +164,109 @@ class ActionModule(ActionBase):
         # If this is non-installation task run it with original yum module.
         # Remove unused variables form module_args dict if necessary.
         if (state not in ('present', 'installed')) or autoremove == 'yes':
-            if (self.module_args.get('retries') is not None
-                    or self.module_args.get('delay') is not None):
+            if any(self.module_args.get(arg) is not None for arg in DEFAULT_VALUES):
                 self._display.vvv('This is not an installation task. Retries will be omitted.')
-                if self.module_args.get('retries') is not None:
-                    del self.module_args['retries']
-                if self.module_args.get('delay') is not None:
-                    del self.module_args['delay']
+                for arg in DEFAULT_VALUES:
+                    if self.module_args.get(arg) is not None:
+                        del self.module_args[arg]
             return self._execute_module(module_name='yum', module_args=self.module_args,
                                         task_vars=self.task_vars, tmp=tmp)
 
-        # Find actual values of retries and delay.
-        number_of_retries = self.get_variable('retries')
-        retry_delay = self.get_variable('delay')
+        # Find actual values of the retry settings.
+        number_of_retries = int(self.get_variable('retries'))
+        retry_delay = float(self.get_variable('delay'))
+        max_delay = float(self.get_variable('max_delay'))
+        retry_budget = float(self.get_variable('retry_budget'))
+        disable_failing_repo = str(self.get_variable('disable_failing_repo')).lower() in \
+            ('true', 'yes', '1')
 
-        # Run task for number_of_retries, break if it succeeded.
+        # Run task for number_of_retries, break if it succeeded, failed for good or the
+        # next attempt would start after the retry budget.
+        start = time.time()
+        history = []
         attempt = 0
+        disabled_repos = []
+        retryable = None
+        retryable_msg = None
         for attempt in range(number_of_retries):
             result = self._execute_module(module_name='yum', module_args=self.module_args,
                                           task_vars=self.task_vars, tmp=tmp)
 
             return_code = result.get('rc')
             if return_code == 0:
+                history.append({'attempt': attempt + 1, 'rc': return_code,
+                                'classification': 'success'})
+                break
+
+            kind, reason = classify(result)
+            history.append({'attempt': attempt + 1, 'rc': return_code, 'classification': kind,
+                            'reason': reason})
+            if kind == FATAL and disabled_repos:
+                # the packages may only be missing from the repositories left, the failure
+                # is still the one of the disabled repositories; they are enabled again
+                self._display.display("Error occurred after disabling repositories %s (%s)."
+                                      " Enabling them again." % (', '.join(disabled_repos),
+                                                                 reason))
+                history[-1].update({'classification': retryable[0], 'reason': retryable[1],
+                                    'masked_reason': reason, 'enabled_repos': disabled_repos})
+                self.enable_repos(disabled_repos)
+                result['msg'] = "%s (after disabling failing repositories %s, which failed" \
+                    " with: %s)" % (result.get('msg') or 'yum failed', ', '.join(disabled_repos),
+                                    retryable_msg)
+                kind, reason = retryable
+                disabled_repos = []
+                disable_failing_repo = False
+            else:
+                retryable = (kind, reason)
+                retryable_msg = result.get('msg') or reason
+            if kind == FATAL:
+                self._display.display("Error occurred which retrying will not fix (%s)."
+                                      " Giving up." % reason)
                 break
 
             if attempt < (number_of_retries - 1):
-                self._display.display("Error occurred. Will retry after %s seconds."
-                                      " You can find details below:" % str(retry_delay))
+                delay = backoff(attempt, retry_delay, max_delay)
+                if retry_budget and time.time() - start + delay > retry_budget:
+                    self._display.display("Error occurred. Retry budget of %s seconds"
+                                          " is spent. Giving up." % str(retry_budget))
+                    break
+                history[-1]['delay'] = round(delay, 2)
+                self._display.display("Error occurred. Will retry after %.1f seconds."
+                                      " You can find details below:" % delay)
                 if (result.get('msg') is not None and result.get('msg') != ''):
                     self._display.display("%s" % str(result['msg']))
                 else:
                     self._display.display("%s" % str(result))
-                time.sleep(retry_delay)
+                disabled = self.disable_repos(failing_repos(result)) \
+                    if disable_failing_repo else []
+                if disabled:
+                    history[-1]['disabled_repos'] = disabled
+                    disabled_repos += disabled
+                time.sleep(delay)
                 self._display.display("\nRetrying task - attempt %s of %s"
                                       % (str(attempt + 2), str(number_of_retries)))
 
         result['attempts'] = attempt + 1
+        result['attempt_history'] = history
         return result
+
+    def disable_repos(self, repos):
+        """disable_repos adds repositories to disablerepo of the next attempts, returns the
+        ones added; repositories enabled explicitly by the task are kept"""
+        disabled = repo_list(self.module_args.get('disablerepo'))
+        enabled = repo_list(self.module_args.get('enablerepo'))
+        added = [repo for repo in repos if repo not in disabled and repo not in enabled]
+        if added:
+            self._display.display("Disabling failing repositories: %s" % ', '.join(added))
+            self.module_args['disablerepo'] = disabled + added
+        return added
+
+    def enable_repos(self, repos):
+        """enable_repos takes repositories disable_repos added out of disablerepo again"""
+        disabled = [repo for repo in repo_list(self.module_args.get('disablerepo'))
+                    if repo not in repos]
+        if disabled:
+            self.module_args['disablerepo'] = disabled
+        else:
+            self.module_args.pop('disablerepo', None)
         
\ No newline at end of file
@@ -0,0 +1,228 @@
+# coding: utf-8
+""" yum action plugin retry tests """
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2020 Intel Corporation
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+OEK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, os.path.join(OEK_DIR, "action_plugins"))
+
+# pylint: disable=wrong-import-position
+import yum
+
+REPO_FAILURE = {"rc": 1, "msg": "Failure talking to yum: failure: repodata/repomd.xml from "
+                                "epel: [Errno 256] No more mirrors to try."}
+MISSING = {"rc": 126, "msg": "No package docker-ce available."}
+SUCCESS = {"rc": 0, "changed": True}
+MIRROR_FAILURE = ("http://mirror.example.com/centos/7/os/x86_64/repodata/repomd.xml:"
+                  " [Errno 12] Timeout on http://mirror.example.com/: (28, 'Operation timed out')"
+                  "\nTrying other mirror.")
+
+
+class ClassifyTest(unittest.TestCase):
+    """ failed yum results sorted into fatal, retryable and unknown ones """
+    def test_fatal(self):
+        """ failures retrying will not fix are fatal, even beside retryable ones """
+        for result in ({"msg": "No package foo available."},
+                       {"failures": ["No package matching 'foo' found available"]},
+                       {"msg": "Error: Package: bar-1.0 (base)\n           Requires: libfoo.so"},
+                       {"results": ["Transaction check error:\n  file /x conflicts with y"]},
+                       {"msg": "Unsupported parameters for (yum) module: foo",
+                        "failures": [MIRROR_FAILURE]}):
+            self.assertEqual(yum.FATAL, yum.classify(result)[0], result)
+
+    def test_retryable(self):
+        """ mirror, network and lock failures are retryable, with the text matched """
+        self.assertEqual((yum.RETRYABLE, "Timeout"),
+                         yum.classify({"results": [MIRROR_FAILURE]}))
+        for result in ({"msg": "Cannot retrieve repository metadata (repomd.xml) for "
+                               "repository: epel. Please verify its path and try again"},
+                       {"msg": "Could not resolve host: mirrors.example.com"},
+                       {"failures": "Existing lock /var/run/yum.pid: another app is currently "
+                                    "holding the yum lock; waiting for it to exit..."},
+                       {"msg": "HTTP Error 503 - Service Unavailable"}):
+            self.assertEqual(yum.RETRYABLE, yum.classify(result)[0], result)
+
+    def test_unknown(self):
+        """ failures matching no pattern are unknown """
+        self.assertEqual((yum.UNKNOWN, None), yum.classify({"msg": "Something went wrong"}))
+        self.assertEqual((yum.UNKNOWN, None), yum.classify({"rc": 1}))
+
+
+class FailingReposTest(unittest.TestCase):
+    """ repositories named by mirror failures """
+    def test_repos(self):
+        """ each repository is named once, in the order of the failures """
+        result = {"msg": "Cannot retrieve repository metadata (repomd.xml) for repository: "
+                         "epel. Please verify its path and try again",
+                  "results": ["foo-1.0.rpm from updates: [Errno 256] No more mirrors to try.",
+                              "bar-1.0.rpm from updates: [Errno 256] No more mirrors to try.",
+                              "Cannot find a valid baseurl for repo: docker-ce-stable"]}
+        self.assertEqual(["updates", "epel", "docker-ce-stable"], yum.failing_repos(result))
+
+    def test_none(self):
+        """ failures not naming repositories give none """
+        self.assertEqual([], yum.failing_repos({"msg": "No package foo available."}))
+        self.assertEqual([], yum.failing_repos({"results": [MIRROR_FAILURE]}))
+
+
+class BackoffTest(unittest.TestCase):
+    """ delays before the retries """
+    def test_first_retry(self):
+        """ the first retry waits the configured delay """
+        for _ in range(100):
+            self.assertEqual(5, yum.backoff(0, 5, 60))
+
+    def test_doubling(self):
+        """ delays are jittered from the configured delay up to the doubled one """
+        for attempt in range(1, 8):
+            upper = min(60, 5 * 2 ** attempt)
+            for _ in range(100):
+                self.assertTrue(5 <= yum.backoff(attempt, 5, 60) <= upper, attempt)
+
+    def test_max_delay(self):
+        """ no delay exceeds max_delay, even below the configured delay """
+        for attempt in range(8):
+            self.assertLessEqual(yum.backoff(attempt, 5, 60), 60)
+            self.assertEqual(3, yum.backoff(attempt, 5, 3))
+
+
+class FakeClock():
+    """ time.time and time.sleep of the plugin, attempts take seconds each """
+    def __init__(self, seconds=1.0):
+        self.now = 1000.0
+        self.seconds = seconds
+        self.slept = []
+
+    def time(self):
+        """ current time """
+        return self.now
+
+    def sleep(self, delay):
+        """ pass delay seconds """
+        self.slept.append(delay)
+        self.now += delay
+
+
+class RunTest(unittest.TestCase):
+    """ installations retried by the action plugin """
+    def setUp(self):
+        self.clock = FakeClock()
+        for patch in (mock.patch.object(yum.ActionBase, "run", return_value={}),
+                      mock.patch.object(yum.time, "time", self.clock.time),
+                      mock.patch.object(yum.time, "sleep", self.clock.sleep),
+                      mock.patch.object(yum.random, "uniform", lambda low, high: low)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.calls = []
+
+    def run_plugin(self, results, task_vars=None, **args):
+        """ plugin result of a task installing docker-ce, yum returning results in turn """
+        plugin = yum.ActionModule.__new__(yum.ActionModule)
+        plugin._task = mock.Mock(args=dict({"name": "docker-ce", "state": "present"}, **args)) # pylint: disable=protected-access
+        plugin._display = mock.Mock() # pylint: disable=protected-access
+        results = iter(results)
+
+        def execute_module(module_name, module_args, task_vars, tmp): # pylint: disable=unused-argument
+            self.assertEqual("yum", module_name)
+            self.calls.append(dict(module_args))
+            self.clock.now += self.clock.seconds
+            return dict(next(results))
+        plugin._execute_module = execute_module # pylint: disable=protected-access
+        return plugin.run(task_vars=task_vars or {})
+
+    def classifications(self, result):
+        """ classification of each attempt """
+        return [entry["classification"] for entry in result["attempt_history"]]
+
+    def test_retried_until_success(self):
+        """ retryable failures are retried after growing delays, the settings not passed on """
+        result = self.run_plugin([REPO_FAILURE, REPO_FAILURE, SUCCESS], retries=5, delay=2)
+        self.assertEqual(0, result["rc"])
+        self.assertEqual(3, result["attempts"])
+        self.assertEqual([yum.RETRYABLE, yum.RETRYABLE, "success"], self.classifications(result))
+        self.assertEqual([2, 2], [entry["delay"] for entry in result["attempt_history"][:2]])
+        self.assertEqual([2.0, 2.0], self.clock.slept)
+        self.assertTrue(all("retries" not in args and "delay" not in args
+                            for args in self.calls))
+
+    def test_fatal_fails_fast(self):
+        """ a failure retrying will not fix ends the task at once """
+        result = self.run_plugin([MISSING, SUCCESS])
+        self.assertEqual(126, result["rc"])
+        self.assertEqual(1, result["attempts"])
+        self.assertEqual([yum.FATAL], self.classifications(result))
+        self.assertEqual("No package docker-ce available",
+                         result["attempt_history"][0]["reason"])
+        self.assertEqual([], self.clock.slept)
+
+    def test_retries_spent(self):
+        """ the result of the last attempt is returned once the retries are spent """
+        result = self.run_plugin([REPO_FAILURE] * 3, task_vars={"number_of_retries": 3})
+        self.assertEqual(1, result["rc"])
+        self.assertEqual(3, result["attempts"])
+        self.assertNotIn("delay", result["attempt_history"][-1])
+
+    def test_retry_budget(self):
+        """ no attempt starts past the retry budget, attempts included """
+        self.clock.seconds = 20.0
+        result = self.run_plugin([REPO_FAILURE] * 10, retry_budget=60, delay=5, max_delay=60)
+        # 20s attempt, 5s, 20s attempt, 5s, 20s attempt, the next 10s delay ends past 60s
+        self.assertEqual(3, result["attempts"])
+        self.assertEqual([5.0, 5.0], self.clock.slept)
+        result = self.run_plugin([REPO_FAILURE] * 2 + [SUCCESS], delay=5,
+                                 task_vars={"retry_budget": 0})
+        self.assertEqual(0, result["rc"])
+
+    def test_disable_failing_repo(self):
+        """ the repository of a mirror failure is disabled for the next attempts """
+        result = self.run_plugin([REPO_FAILURE, SUCCESS], disable_failing_repo=True,
+                                 disablerepo="extras")
+        self.assertEqual(0, result["rc"])
+        self.assertEqual(["epel"], result["attempt_history"][0]["disabled_repos"])
+        self.assertEqual("extras", self.calls[0]["disablerepo"])
+        self.assertEqual(["extras", "epel"], self.calls[1]["disablerepo"])
+        self.assertNotIn("disable_failing_repo", self.calls[0])
+
+    def test_enabled_repo_kept(self):
+        """ repositories the task enables are not disabled """
+        result = self.run_plugin([REPO_FAILURE, SUCCESS], enablerepo="epel",
+                                 task_vars={"retry_disable_failing_repo": "yes"})
+        self.assertNotIn("disabled_repos", result["attempt_history"][0])
+        self.assertNotIn("disablerepo", self.calls[1])
+
+    def test_disabled_repo_missing_packages(self):
+        """ packages missing once their repository is disabled do not hide its failure """
+        result = self.run_plugin([REPO_FAILURE, MISSING, REPO_FAILURE, SUCCESS],
+                                 disable_failing_repo=True)
+        self.assertEqual(0, result["rc"])
+        self.assertEqual([yum.RETRYABLE] * 3 + ["success"], self.classifications(result))
+        masked = result["attempt_history"][1]
+        self.assertEqual("No package docker-ce available", masked["masked_reason"])
+        self.assertEqual(["epel"], masked["enabled_repos"])
+        self.assertEqual([None, ["epel"], None, None],
+                         [args.get("disablerepo") for args in self.calls])
+
+    def test_disabled_repo_missing_packages_reported(self):
+        """ the last failure names the disabled repositories and their failure """
+        result = self.run_plugin([REPO_FAILURE, MISSING], retries=2, disable_failing_repo=True)
+        self.assertEqual(126, result["rc"])
+        self.assertEqual([yum.RETRYABLE, yum.RETRYABLE], self.classifications(result))
+        self.assertIn("No package docker-ce available.", result["msg"])
+        self.assertIn("after disabling failing repositories epel", result["msg"])
+        self.assertIn("No more mirrors to try", result["msg"])
+
+    def test_not_installation(self):
+        """ other tasks run yum once, without the retry settings """
+        result = self.run_plugin([REPO_FAILURE], state="absent", retries=3)
+        self.assertEqual(1, result["rc"])
+        self.assertNotIn("attempt_history", result)
+        self.assertEqual([{"name": "docker-ce", "state": "absent"}], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()